@@ -0,0 +1,441 @@
+"""bq-antipattern-api の負荷試験・スループット計測。
+
+app.py を uvicorn でローカル起動し、クエリのコーパスを指定した同時実行数で投げ続けて
+requests/sec・レイテンシ（p50/p95/p99）・ワーカーあたりの CPU 時間とピークメモリを測る。
+Cloud Run のインスタンスサイズや concurrency を決める材料、および「リクエストごとに
+JVM を起動する」現行方式と別方式を比べる土台にする。
+
+    python benchmarks/antipattern_api_bench.py                        # 偽の解析エンジンで計測
+    python benchmarks/antipattern_api_bench.py --concurrency 1,4,16 --workers 2
+    python benchmarks/antipattern_api_bench.py --mode jar             # 本物の JAR（java が必要）
+    python benchmarks/antipattern_api_bench.py --url http://localhost:8080   # 起動済みの別実装
+
+偽の解析エンジン（fake_recognizer.py）は起動コストとクエリサイズ比例のコストを CPU で
+消費する。CPU・メモリの計測は Linux の /proc を読むため、それ以外の OS では省略する。
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bench_common import (
+    DEFAULT_TOLERANCE,
+    compare_to_baseline,
+    format_table,
+    load_baselines,
+    save_baseline,
+    summarize_latencies,
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+API_DIR = ROOT / "bq-antipattern-api"
+FAKE_RECOGNIZER = Path(__file__).resolve().parent / "fake_recognizer.py"
+BENCH_NAME = "antipattern_api"
+STARTUP_TIMEOUT_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 120
+SAMPLE_INTERVAL_SECONDS = 0.2
+
+# 実運用のワーストクエリに近い形のコーパス（小さいもの〜長い IN リストを含むもの）
+CORPUS = [
+    "SELECT * FROM `proj.sales.orders` ORDER BY created_at",
+    "WITH my_cte AS (SELECT * FROM `my_project.my_dataset.raw_data`) SELECT * FROM my_cte AS t1 "
+    "JOIN my_cte AS t2 ON t1.id = t2.parent_id WHERE t1.id IN "
+    "(SELECT user_id FROM `my_project.my_dataset.users`) ORDER BY t1.created_at",
+    "SELECT user_id, COUNT(*) AS c FROM `proj.logs.events` "
+    "WHERE REGEXP_CONTAINS(path, r'^/api/') GROUP BY user_id",
+    "SELECT o.id, c.name FROM `proj.sales.orders` o JOIN `proj.sales.customers` c "
+    "ON o.customer_id = c.id WHERE o.created_at >= '2024-01-01' LIMIT 100",
+    # 数十KB 級（自動生成された IN リスト）
+    "SELECT * FROM `proj.sales.orders` WHERE id IN ("
+    + ", ".join(str(n) for n in range(8000))
+    + ")",
+]
+
+
+def load_corpus(path):
+    """1行1件の JSON（{"query": ...}）またはプレーンな SQL 行のファイルを読む。"""
+    queries = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        queries.append(json.loads(line)["query"] if line.lstrip().startswith("{") else line)
+    return queries
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post_query(url, query):
+    body = json.dumps({"query": query}).encode("utf-8")
+    request = urllib.request.Request(
+        f"{url}/analyze", data=body, headers={"Content-Type": "application/json"}
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0  # 接続失敗・タイムアウト
+    return status, time.perf_counter() - started
+
+
+def wait_until_ready(url, process=None, poll_seconds=0.2):
+    """/ready が 200 を返す（起動時のウォームアップが終わる）まで待つ。"""
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"API server exited during startup (code {process.returncode})")
+        try:
+            with urllib.request.urlopen(f"{url}/ready", timeout=2):
+                return
+        except OSError:
+            # 接続できない（起動前）か 503（ウォームアップ中）
+            time.sleep(poll_seconds)
+    raise RuntimeError(f"API server did not become ready within {STARTUP_TIMEOUT_SECONDS}s")
+
+
+def start_server(mode, workers, startup_ms, per_kb_ms, extra_env=None, wait=True):
+    """app.py を uvicorn で起動し、(プロセス, URL) を返す。wait なら準備完了まで待つ。"""
+    env = dict(os.environ, **(extra_env or {}))
+    if mode == "fake":
+        env["RECOGNIZER_COMMAND"] = (
+            f"{sys.executable} {FAKE_RECOGNIZER} --startup-ms {startup_ms} --per-kb-ms {per_kb_ms}"
+        )
+    else:
+        env.pop("RECOGNIZER_COMMAND", None)
+        if not (API_DIR / "bigquery-antipattern-recognition.jar").exists():
+            raise SystemExit(
+                "bq-antipattern-api/bigquery-antipattern-recognition.jar が見つかりません"
+            )
+    port = _free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=API_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    if not wait:
+        return process, url
+    try:
+        wait_until_ready(url, process)
+    except Exception:
+        process.kill()
+        raise
+    return process, url
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ------------------------------------------
+# /proc によるワーカーの CPU・メモリ計測（Linux のみ）
+# ------------------------------------------
+
+
+def _proc_available():
+    return Path("/proc/self/stat").exists()
+
+
+def _children(pid):
+    children = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # comm に空白や括弧が入り得るので、最後の ')' の後ろから数える
+        fields = stat.rsplit(")", 1)[1].split()
+        if int(fields[1]) == pid:
+            children.append(int(entry.name))
+    return children
+
+
+def _cpu_seconds(pid):
+    """プロセス自身と回収済みの子（解析エンジン）の CPU 時間の合計。"""
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    # utime, stime, cutime, cstime（フィールド 14〜17。')' の後ろでは 11〜14 番目）
+    ticks = sum(int(value) for value in fields[11:15])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _rss_bytes(pid):
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+class WorkerSampler:
+    """uvicorn ワーカー（と実行中の解析エンジン）の CPU 時間とピーク RSS を追う。
+
+    --workers 1 ではサーバープロセス自体がワーカー、2以上では起動直後の子プロセスが
+    ワーカー。解析エンジンはワーカーの子なので、CPU は cutime/cstime に、メモリは
+    サンプリング時点で生きている子の RSS としてワーカーに足し込む。
+    """
+
+    def __init__(self, server_pid):
+        self.workers = _children(server_pid) or [server_pid]
+        self.peak_rss = {pid: 0 for pid in self.workers}
+        self._cpu_start = {pid: _cpu_seconds(pid) for pid in self.workers}
+        self._cpu_end = dict(self._cpu_start)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        for pid in self.workers:
+            try:
+                rss = _rss_bytes(pid)
+                for child in _children(pid):
+                    try:
+                        rss += _rss_bytes(child)
+                    except OSError:
+                        pass  # 計測中に終わった解析エンジン
+                self.peak_rss[pid] = max(self.peak_rss[pid], rss)
+                self._cpu_end[pid] = _cpu_seconds(pid)
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL_SECONDS):
+            self._sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+    def per_worker(self):
+        return [
+            {
+                "pid": pid,
+                "cpu_seconds": round(self._cpu_end[pid] - self._cpu_start[pid], 3),
+                "peak_rss_mib": round(self.peak_rss[pid] / (1024 * 1024), 1),
+            }
+            for pid in self.workers
+        ]
+
+
+# ------------------------------------------
+# 負荷の生成
+# ------------------------------------------
+
+
+def run_level(url, corpus, concurrency, requests_per_level, server_pid=None):
+    """同時実行数 concurrency のクローズドループで requests_per_level 件を投げる。"""
+    lock = threading.Lock()
+    issued = 0
+    latencies = []
+    statuses = {}
+
+    def worker():
+        nonlocal issued
+        while True:
+            with lock:
+                if issued >= requests_per_level:
+                    return
+                query = corpus[issued % len(corpus)]
+                issued += 1
+            status, seconds = post_query(url, query)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(seconds)
+
+    sampler = WorkerSampler(server_pid) if server_pid and _proc_available() else None
+    started = time.perf_counter()
+    if sampler:
+        sampler.__enter__()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+    finally:
+        if sampler:
+            sampler.__exit__()
+    elapsed = time.perf_counter() - started
+
+    ok = statuses.get(200, 0)
+    result = {
+        "concurrency": concurrency,
+        "requests": requests_per_level,
+        "seconds": round(elapsed, 3),
+        "rps": round(ok / elapsed, 2) if elapsed else 0.0,
+        "latency": summarize_latencies(latencies),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+    if sampler:
+        workers = sampler.per_worker()
+        result["workers"] = workers
+        total_cpu = sum(w["cpu_seconds"] for w in workers)
+        result["cpu_seconds_per_request"] = round(total_cpu / ok, 4) if ok else 0.0
+        result["peak_rss_mib"] = max(w["peak_rss_mib"] for w in workers)
+    return result
+
+
+def run_benchmark(args, corpus):
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server(args.mode, args.workers, args.startup_ms, args.per_kb_ms)
+    try:
+        # 最初のリクエストの遅さ（インポート・JIT 等）を計測から外す
+        for query in corpus[: args.warmup]:
+            post_query(url, query)
+        levels = [
+            run_level(url, corpus, c, args.requests, process.pid if process else None)
+            for c in args.concurrency
+        ]
+    finally:
+        if process:
+            stop_server(process)
+
+    metrics = {}
+    counts = {}
+    for level in levels:
+        prefix = f"c{level['concurrency']}"
+        metrics[f"{prefix}.latency_p50"] = level["latency"]["p50"]
+        metrics[f"{prefix}.latency_p95"] = level["latency"]["p95"]
+        if "cpu_seconds_per_request" in level:
+            metrics[f"{prefix}.cpu_seconds_per_request"] = level["cpu_seconds_per_request"]
+            metrics[f"{prefix}.peak_rss_mib"] = level["peak_rss_mib"]
+        # 失敗件数は決定的に 0 のはずなので、1件でも出れば回帰
+        counts[f"{prefix}.errors"] = sum(
+            n for code, n in level["statuses"].items() if code != "200"
+        )
+    return {
+        "params": {
+            "mode": "external" if args.url else args.mode,
+            "workers": args.workers,
+            "startup_ms": args.startup_ms,
+            "per_kb_ms": args.per_kb_ms,
+            "requests": args.requests,
+            "corpus_size": len(corpus),
+        },
+        "levels": levels,
+        "metrics": metrics,
+        "counts": counts,
+    }
+
+
+def print_result(result):
+    params = result["params"]
+    print(
+        f"\n=== bq-antipattern-api ({params['mode']}, workers={params['workers']}, "
+        f"startup={params['startup_ms']}ms, per_kb={params['per_kb_ms']}ms) ==="
+    )
+    rows = []
+    for level in result["levels"]:
+        latency = level["latency"]
+        rows.append(
+            [
+                level["concurrency"],
+                level["rps"],
+                latency["p50"],
+                latency["p95"],
+                latency["p99"],
+                level.get("cpu_seconds_per_request", "-"),
+                level.get("peak_rss_mib", "-"),
+                ",".join(f"{code}:{n}" for code, n in level["statuses"].items()),
+            ]
+        )
+    headers = ["conc", "rps", "p50", "p95", "p99", "cpu_s/req", "peak_rss_mib", "statuses"]
+    print(format_table(rows, headers))
+    for level in result["levels"]:
+        for worker in level.get("workers", []):
+            print(
+                f"  c{level['concurrency']} worker {worker['pid']}: "
+                f"cpu={worker['cpu_seconds']}s peak_rss={worker['peak_rss_mib']}MiB"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bq-antipattern-api の負荷試験")
+    parser.add_argument("--mode", choices=["fake", "jar"], default="fake")
+    parser.add_argument("--url", help="起動済みのサーバーを計測する（起動・CPU 計測はしない）")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda v: [int(c) for c in v.split(",")],
+        default=[1, 4, 8],
+        help="同時実行数（カンマ区切りで複数）",
+    )
+    parser.add_argument("--requests", type=int, default=40, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn のワーカー数")
+    parser.add_argument("--warmup", type=int, default=2, help="計測前に投げるリクエスト数")
+    parser.add_argument("--startup-ms", type=float, default=300.0, help="偽の JVM 起動コスト")
+    parser.add_argument("--per-kb-ms", type=float, default=5.0, help="偽の解析コスト（1KBあたり）")
+    parser.add_argument("--corpus", help="クエリのコーパス（1行1件。JSON か SQL）")
+    parser.add_argument("--scenario", default="default", help="ベースラインの保存名")
+    parser.add_argument("--compare", action="store_true", help="ベースラインと比較する")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインに保存")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else CORPUS
+    result = run_benchmark(args, corpus)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_result(result)
+
+    if args.save_baseline:
+        path = save_baseline(BENCH_NAME, args.scenario, result)
+        print(f"Baseline saved: {path.relative_to(ROOT)} [{args.scenario}]", file=sys.stderr)
+    if args.compare:
+        baseline = load_baselines(BENCH_NAME).get(args.scenario)
+        if baseline is None:
+            print(f"Baseline not found: [{args.scenario}]", file=sys.stderr)
+            sys.exit(1)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:", file=sys.stderr)
+            for message in regressions:
+                print(f"  - {message}", file=sys.stderr)
+            sys.exit(1)
+        print("\nNo regressions against baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""ベンチマーク共通の集計・ベースライン比較。
+
+各ベンチマークは結果を {"metrics": {名前: 値}, "counts": {名前: 回数}} の形にまとめ、
+benchmarks/baselines/<ベンチマーク名>.json にシナリオ名ごとのベースラインとして保存する。
+比較では metrics（時間・メモリなど小さいほど良い値）は許容率を超えた悪化を、
+counts（外部呼び出し回数など決定的な値）は1回でも増えたら回帰として扱う。
+"""
+
+import json
+import math
+from pathlib import Path
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+# 時間・メモリの揺らぎとして許容する悪化率（0.25 = 25% 増まで）
+DEFAULT_TOLERANCE = 0.25
+# 悪化率が許容を超えても、絶対差がこれ未満なら回帰としない（1回きりの呼び出しに
+# スケジューラの揺らぎが数 ms 乗っただけで落ちないように）
+DEFAULT_MIN_DELTA = 0.02
+
+
+def percentile(values, pct):
+    """線形補間のパーセンタイル（pct は 0〜100）。空なら 0.0。"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return float(ordered[0])
+    rank = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return float(ordered[low] + (ordered[high] - ordered[low]) * (rank - low))
+
+
+def summarize_latencies(values):
+    """秒単位の値の一覧を件数とパーセンタイルにまとめる。"""
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4) if values else 0.0,
+    }
+
+
+def baseline_path(bench_name):
+    return BASELINE_DIR / f"{bench_name}.json"
+
+
+def load_baselines(bench_name):
+    path = baseline_path(bench_name)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def save_baseline(bench_name, scenario_name, result):
+    """シナリオの結果をベースラインとして書き込む（他シナリオの値は残す）。"""
+    baselines = load_baselines(bench_name)
+    baselines[scenario_name] = {
+        "params": result.get("params", {}),
+        "metrics": result["metrics"],
+        "counts": result.get("counts", {}),
+    }
+    path = baseline_path(bench_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(baselines, ensure_ascii=False, indent=2, sort_keys=True) + "\n",
+        encoding="utf-8",
+    )
+    return path
+
+
+def compare_to_baseline(result, baseline, tolerance=DEFAULT_TOLERANCE, min_delta=DEFAULT_MIN_DELTA):
+    """ベースラインに対する回帰の一覧（人が読むメッセージ）を返す。空なら回帰なし。"""
+    regressions = []
+    for name, base_value in baseline.get("metrics", {}).items():
+        value = result["metrics"].get(name)
+        if value is None or not base_value:
+            continue
+        if value > base_value * (1 + tolerance) and value - base_value >= min_delta:
+            regressions.append(
+                f"{name}: {value} > baseline {base_value} (+{(value / base_value - 1) * 100:.0f}%)"
+            )
+    for name, base_count in baseline.get("counts", {}).items():
+        count = result.get("counts", {}).get(name, 0)
+        if count > base_count:
+            regressions.append(f"{name}: {count} calls > baseline {base_count}")
+    return regressions
+
+
+def format_table(rows, headers):
+    """列幅を揃えたテキスト表（端末出力用）。"""
+    table = [headers] + [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(headers))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in table]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
@@ -0,0 +1,76 @@
+"""bigquery-antipattern-recognition.jar の代わりに起動する偽の解析エンジン。
+
+`java -jar bigquery-antipattern-recognition.jar --query <SQL>` と同じ引数を受け取り、
+JAR と同じ形式の標準出力を返す。起動コスト（JVM の起動に相当）とクエリ1KBあたりの
+解析コストを指定でき、既定では CPU を実際に消費する（sleep では CPU 競合が再現できないため）。
+
+    RECOGNIZER_COMMAND="python benchmarks/fake_recognizer.py --startup-ms 300" uvicorn app:app
+"""
+
+import argparse
+import re
+import sys
+import time
+
+_SEPARATOR = "-" * 50
+
+# 検出ルール（名前, 正規表現, メッセージ）。JAR の代表的なルールの見た目だけを真似る
+_RULES = [
+    (
+        "SimpleSelectStar",
+        r"(?i)select\s+\*",
+        "SELECT * on table. Check that all columns are needed.",
+    ),
+    (
+        "OrderByWithoutLimit",
+        r"(?i)order\s+by(?![\s\S]*\blimit\b)",
+        "ORDER BY clause without LIMIT.",
+    ),
+    ("SemiJoinWithoutAgg", r"(?i)\bin\s*\(\s*select\b", "Subquery in filter without aggregation."),
+    ("CTEsEvalMultipleTimes", r"(?i)\bwith\b", "CTE may be evaluated multiple times."),
+    ("StringComparison", r"(?i)regexp_contains", "REGEXP_CONTAINS can be replaced by LIKE."),
+]
+
+
+def _spend(milliseconds, burn_cpu):
+    """milliseconds だけ時間を使う。burn_cpu なら busy loop で CPU を消費する。"""
+    if milliseconds <= 0:
+        return
+    if not burn_cpu:
+        time.sleep(milliseconds / 1000)
+        return
+    deadline = time.process_time() + milliseconds / 1000
+    while time.process_time() < deadline:
+        pass
+
+
+def recommendations(query):
+    return [
+        f"* {name}: {message}" for name, pattern, message in _RULES if re.search(pattern, query)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="偽の bigquery-antipattern-recognition")
+    parser.add_argument("--query", required=True)
+    parser.add_argument("--startup-ms", type=float, default=300.0, help="起動コスト（ミリ秒）")
+    parser.add_argument("--per-kb-ms", type=float, default=5.0, help="クエリ1KBあたりのコスト")
+    parser.add_argument("--sleep", action="store_true", help="CPU を使わず sleep で待つ")
+    args = parser.parse_args(argv)
+
+    _spend(args.startup_ms, not args.sleep)
+    _spend(args.per_kb_ms * len(args.query.encode("utf-8")) / 1024, not args.sleep)
+
+    # JAR は解析ログの後に、区切り線で挟んで推奨事項を出す
+    print("INFO: Running anti-pattern recognition (fake)")
+    found = recommendations(args.query)
+    if found:
+        print(_SEPARATOR)
+        print("Recommendations for query: query provided by cli:")
+        print("\n".join(found))
+        print(_SEPARATOR)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
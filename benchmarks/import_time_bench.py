@@ -0,0 +1,208 @@
+"""main-app のコールドスタート（`import main`）にかかる時間のベンチマーク。
+
+Cloud Run Job はテナントごとに新しいコンテナで起動するため、モジュールの読み込み時間が
+そのまま毎回の実行時間に乗る。新しいプロセスで `python -X importtime -c "import main"` を
+繰り返し実行し、import 全体の中央値と、直接 import しているモジュールのうち重いものを表示する。
+あわせて遅延 import（lazy_imports）にした SDK を後から読み込んだときのコストも別に測る
+（実際に触れた処理の中で払われるため、起動時間には含まれない）。
+
+    python benchmarks/import_time_bench.py                   # 計測して表示
+    python benchmarks/import_time_bench.py --compare         # ベースラインと比較（回帰で exit 1）
+    python benchmarks/import_time_bench.py --save-baseline   # ベースラインを更新
+
+import 時間は環境（ディスク・Python のバージョン・SDK のバージョン）に強く依存するため、
+ベースラインは計測するマシンごとに保存する。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+from bench_common import (
+    DEFAULT_TOLERANCE,
+    compare_to_baseline,
+    format_table,
+    load_baselines,
+    save_baseline,
+)
+
+BENCH_NAME = "import_time"
+SCENARIO = "cold_start"
+MAIN_APP_SRC = Path(__file__).resolve().parent.parent / "main-app" / "src"
+
+# import main の後で、遅延 import にした SDK を1つずつ読み込んで所要時間を JSON で出す
+# （共有する依存は最初に読み込んだ SDK に計上される）
+_DEFERRED_SCRIPT = """
+import importlib
+import json
+import time
+
+import lazy_imports
+import main
+
+timings = {}
+for value in list(vars(main).values()):
+    if isinstance(value, lazy_imports.LazyModule):
+        name = object.__getattribute__(value, "_name")
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        timings[name] = time.perf_counter() - started
+print(json.dumps(timings))
+"""
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力を [(深さ, モジュール名, 自身の秒, 累積の秒)] にする（出力順）。"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        head, cumulative_us, name = line.split("|", 2)
+        self_us = head.split(":", 1)[1]
+        # 先頭の空白1つは区切りで、以降の空白2つごとにネストが1段深くなる
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((depth, name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return entries
+
+
+def top_level_import(entries, module):
+    """最上位で import された module の (累積秒, 直接の import, 読み込んだモジュール数) を返す。
+
+    -X importtime は子を親より先に出力するため、module の行の直前にある
+    （ひとつ前の最上位の行より後の）行が module から読み込まれたモジュールになる。
+    """
+    children = []
+    loaded = 0
+    for depth, name, _, cumulative in entries:
+        if depth == 0:
+            if name == module:
+                return cumulative, children, loaded + 1
+            children, loaded = [], 0
+            continue
+        loaded += 1
+        if depth == 1:
+            children.append((name, cumulative))
+    raise ValueError(f"{module} was not imported")
+
+
+def _run_python(code, importtime=False):
+    flags = ["-X", "importtime"] if importtime else []
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    completed = subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=MAIN_APP_SRC,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"import failed:\n{completed.stderr[-2000:]}")
+    return completed
+
+
+def measure_cold_start(repeat):
+    """新しいプロセスで import main を repeat 回行い、中央値と重い直接 import を返す。"""
+    totals = []
+    children_samples = {}
+    module_counts = []
+    for _ in range(repeat):
+        total, children, loaded = top_level_import(
+            parse_importtime(_run_python("import main", importtime=True).stderr), "main"
+        )
+        totals.append(total)
+        module_counts.append(loaded)
+        for name, cumulative in children:
+            children_samples.setdefault(name, []).append(cumulative)
+    children = sorted(
+        ((name, statistics.median(values)) for name, values in children_samples.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    return statistics.median(totals), children, max(module_counts)
+
+
+def measure_deferred(repeat):
+    """遅延 import にした SDK を import main の後に読み込むコスト（中央値）を返す。"""
+    samples = {}
+    for _ in range(repeat):
+        timings = json.loads(_run_python(_DEFERRED_SCRIPT).stdout)
+        for name, seconds in timings.items():
+            samples.setdefault(name, []).append(seconds)
+    return sorted(
+        ((name, statistics.median(values)) for name, values in samples.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+
+
+def run_benchmark(repeat, top):
+    import_main, children, modules = measure_cold_start(repeat)
+    deferred = measure_deferred(repeat)
+    deferred_total = sum(seconds for _, seconds in deferred)
+    return {
+        "params": {"repeat": repeat, "python": sys.version.split()[0]},
+        "metrics": {"import_main_s": round(import_main, 4)},
+        "counts": {"modules_imported": modules},
+        "heaviest_imports": [[name, round(seconds, 4)] for name, seconds in children[:top]],
+        "deferred_imports": [[name, round(seconds, 4)] for name, seconds in deferred],
+        "deferred_total_s": round(deferred_total, 4),
+    }
+
+
+def print_result(result):
+    params = result["params"]
+    print(
+        f"import main: {result['metrics']['import_main_s']}s "
+        f"(median of {params['repeat']} processes, python {params['python']}, "
+        f"modules={result['counts']['modules_imported']})"
+    )
+    print(format_table(result["heaviest_imports"], ["direct import", "cumulative_s"]))
+    print(
+        f"\ndeferred SDK imports: {result['deferred_total_s']}s (paid on first use, not at startup)"
+    )
+    print(format_table(result["deferred_imports"], ["module", "cumulative_s"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main-app の import 時間のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="計測するプロセス数")
+    parser.add_argument("--top", type=int, default=10, help="表示する重い直接 import の件数")
+    parser.add_argument("--compare", action="store_true", help="ベースラインと比較する")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインに保存")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.repeat, args.top)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_result(result)
+
+    if args.save_baseline:
+        path = save_baseline(BENCH_NAME, SCENARIO, result)
+        print(f"Baseline saved: {path}", file=sys.stderr)
+    if args.compare:
+        baseline = load_baselines(BENCH_NAME).get(SCENARIO)
+        if baseline is None:
+            print("Baseline not found (run with --save-baseline on this machine)", file=sys.stderr)
+            sys.exit(1)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:", file=sys.stderr)
+            for message in regressions:
+                print(f"  - {message}", file=sys.stderr)
+            sys.exit(1)
+        print("\nNo regressions against baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""main-app（分析ジョブ本体）のオフラインベンチマーク。
+
+本物の main() を、BigQuery / GCS / Gemini / 構文解析 API の偽物（main_app_fakes）に
+つないで実行し、全体の所要時間・ステージ別のレイテンシ（p50/p95/p99）・ピークメモリ・
+外部呼び出し回数を測る。クラウドの認証もネットワークも不要。
+
+    python benchmarks/main_app_bench.py                     # 既定シナリオを実行して表示
+    python benchmarks/main_app_bench.py --compare           # ベースラインと比較（回帰で exit 1）
+    python benchmarks/main_app_bench.py --save-baseline     # ベースラインを更新
+    python benchmarks/main_app_bench.py --scenario large --regions 6 --error-rate 0.05
+
+ステージ別のレイテンシは main-app の計時スパン（tracing）をそのまま集める。
+遅延は偽物が sleep で作るため、時間の回帰はパイプライン側の逐次化・余計な呼び出しを表す。
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import types
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+from bench_common import (
+    DEFAULT_TOLERANCE,
+    compare_to_baseline,
+    format_table,
+    load_baselines,
+    save_baseline,
+    summarize_latencies,
+)
+from main_app_fakes import (
+    ANTIPATTERN_API,
+    BQ_METADATA,
+    BQ_QUERY,
+    GCS,
+    GEMINI,
+    FakeAntipatternApi,
+    FakeBigQueryClient,
+    FakeGcs,
+    FakeGenerativeModel,
+    FaultInjector,
+    TenantShape,
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+MAIN_APP_SRC = ROOT / "main-app" / "src"
+BENCH_NAME = "main_app"
+BUCKET_NAME = "bench-report-bucket"
+
+# main.py の import 文を満たすためだけのスタブ（tests/conftest.py と同じ考え方）。
+# 実 SDK が入っていればそちらを使う。どちらにしてもクライアントは偽物に差し替える。
+_IMPORT_STUBS = {
+    "vertexai": ["init"],
+    "vertexai.generative_models": ["GenerativeModel"],
+    "dotenv": ["load_dotenv"],
+    "google.cloud.bigquery": ["Client"],
+}
+
+# 1呼び出しあたりの遅延（平均秒, 揺らぎ秒）。実測の桁を保ったまま数秒で回る大きさにしてある
+DEFAULT_LATENCIES = {
+    BQ_QUERY: (0.040, 0.010),
+    BQ_METADATA: (0.008, 0.002),
+    GCS: (0.005, 0.001),
+    ANTIPATTERN_API: (0.020, 0.005),
+    GEMINI: (0.080, 0.020),
+}
+
+SCENARIOS = {
+    "small": {"regions": 1, "jobs_per_region": 5, "worst_limit": 5},
+    "medium": {"regions": 3, "jobs_per_region": 20, "worst_limit": 10, "tables_per_query": 3},
+    "large": {
+        "regions": 6,
+        "jobs_per_region": 50,
+        "worst_limit": 25,
+        "tables_per_query": 5,
+        "query_kb": 16,
+    },
+    # 構文解析 API と Gemini が一定割合で失敗するテナント
+    # （API の失敗を再現するため、ローカルの事前判定を切ってすべて API に送る）
+    "flaky": {
+        "regions": 2,
+        "jobs_per_region": 10,
+        "worst_limit": 10,
+        "prescreen": False,
+        "error_rates": {ANTIPATTERN_API: 0.2, GEMINI: 0.1, BQ_METADATA: 0.05},
+    },
+}
+DEFAULT_SCENARIOS = ["small", "medium", "flaky"]
+
+_DEFAULT_PARAMS = {
+    "regions": 1,
+    "jobs_per_region": 10,
+    "worst_limit": 10,
+    "tables_per_query": 2,
+    "columns_per_table": 20,
+    "query_kb": 2,
+    "response_chars": 2000,
+    "mode": "sync",
+    # 短いクエリを構文解析 API に送らずローカルで判定する（ANTIPATTERN_PRESCREEN）
+    "prescreen": True,
+    "latency_scale": 1.0,
+    "error_rates": {},
+    "seed": 0,
+}
+# ステージ別 p95 をベースライン比較に含める下限（これ未満は揺らぎの方が大きい）
+MIN_COMPARABLE_STAGE_SECONDS = 0.005
+
+
+def scenario_params(name, **overrides):
+    """シナリオ既定値に CLI 等の上書きを重ねたパラメータ。"""
+    params = {**_DEFAULT_PARAMS, **SCENARIOS.get(name, {})}
+    params.update({k: v for k, v in overrides.items() if v is not None})
+    return params
+
+
+def load_main_module():
+    """main-app/src/main.py をロードする（未導入の SDK は import 用スタブで補う）。"""
+    for name, attrs in _IMPORT_STUBS.items():
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            stub = types.ModuleType(name)
+            for attr in attrs:
+                setattr(stub, attr, lambda *args, **kwargs: None)
+            sys.modules[name] = stub
+            parent_name, _, child = name.rpartition(".")
+            if parent_name in sys.modules:
+                setattr(sys.modules[parent_name], child, stub)
+
+    # main-app 配下にバイトコードを残さない（Cloud Run Job の再ビルド判定に影響するため）
+    sys.dont_write_bytecode = True
+    if str(MAIN_APP_SRC) not in sys.path:
+        sys.path.insert(0, str(MAIN_APP_SRC))
+    spec = importlib.util.spec_from_file_location("analyzer_main_bench", MAIN_APP_SRC / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextmanager
+def _patched(target, attrs):
+    saved = {name: getattr(target, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(target, name, value)
+
+
+@contextmanager
+def _single_task_env():
+    """シャード実行の環境変数が残っていても単一タスクとして動かす。"""
+    keys = ("CLOUD_RUN_TASK_INDEX", "CLOUD_RUN_TASK_COUNT", "CLOUD_RUN_EXECUTION")
+    saved = {key: os.environ.pop(key, None) for key in keys}
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is not None:
+                os.environ[key] = value
+
+
+def run_once(main_module, params):
+    """偽物につないだ main() を1回実行する。"""
+    import tracing
+
+    latencies = {
+        service: (mean * params["latency_scale"], jitter * params["latency_scale"])
+        for service, (mean, jitter) in DEFAULT_LATENCIES.items()
+    }
+    injector = FaultInjector(latencies, params["error_rates"], seed=params["seed"])
+    shape = TenantShape(
+        regions=params["regions"],
+        jobs_per_region=params["jobs_per_region"],
+        tables_per_query=params["tables_per_query"],
+        columns_per_table=params["columns_per_table"],
+        query_kb=params["query_kb"],
+    )
+    gcs = FakeGcs(injector)
+    patches = {
+        "SAAS_PROJECT_ID": "bench-saas-project",
+        "CUSTOMER_PROJECT_ID": "bench-customer-project",
+        "GCS_BUCKET_NAME": BUCKET_NAME,
+        "BQ_ANTIPATTERN_API_URL": "https://antipattern.bench.invalid",
+        "WORST_QUERY_LIMIT": params["worst_limit"],
+        "GEMINI_GENERATION_MODE": params["mode"],
+        "ANTIPATTERN_PRESCREEN": params["prescreen"],
+        "PROFILE_MODE": False,
+        "TIMING_OTEL_EXPORT": False,
+        "bigquery": types.SimpleNamespace(
+            Client=lambda project=None: FakeBigQueryClient(injector, shape, project),
+            QueryJobConfig=lambda **kwargs: types.SimpleNamespace(**kwargs),
+        ),
+        "storage": types.SimpleNamespace(Client=gcs.client),
+        "vertexai": types.SimpleNamespace(init=lambda **kwargs: None),
+        "generative_models": types.SimpleNamespace(
+            GenerativeModel=lambda name: FakeGenerativeModel(injector, params["response_chars"])
+        ),
+        "requests": FakeAntipatternApi(injector),
+        "get_oidc_token": lru_cache(maxsize=1)(lambda audience: "bench-id-token"),
+        # 実行者は認証情報から取る（ワークロード SA の場合と同じく BigQuery への問い合わせは無い）
+        "get_credentials_email": lambda: "analyzer-sa@bench.iam.gserviceaccount.com",
+        "generate_report_signed_url": lambda blob: "https://signed.bench.invalid/report.md",
+    }
+
+    spans = []
+    tracing.add_span_listener(spans.append)
+    try:
+        with _single_task_env(), _patched(main_module, patches):
+            started = time.perf_counter()
+            try:
+                main_module.main()
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code or 0
+            wall_seconds = time.perf_counter() - started
+    finally:
+        tracing.remove_span_listener(spans.append)
+        tracing.drain_spans()
+
+    return {
+        "wall_seconds": wall_seconds,
+        "exit_code": exit_code,
+        "spans": spans,
+        "calls": dict(injector.calls),
+        "summary": gcs.read_json(BUCKET_NAME, main_module.SUMMARY_BLOB_PATH),
+    }
+
+
+def run_benchmark(name, params, repeat=5, warmup=1, main_module=None):
+    """warmup 回の空回し → repeat 回の計測 → tracemalloc 付きで1回（ピークメモリ）。"""
+    main_module = main_module or load_main_module()
+    for _ in range(warmup):
+        run_once(main_module, params)
+
+    runs = [run_once(main_module, params) for _ in range(repeat)]
+
+    # tracemalloc 自体が遅いので、メモリは計時と別の1回で測る
+    tracemalloc.start()
+    try:
+        run_once(main_module, params)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    durations = defaultdict(list)
+    for run in runs:
+        for record in run["spans"]:
+            durations[record["stage"]].append(record["duration_seconds"])
+    stages = {stage: summarize_latencies(values) for stage, values in sorted(durations.items())}
+
+    walls = [run["wall_seconds"] for run in runs]
+    wall = summarize_latencies(walls)
+    metrics = {
+        "wall_seconds_p50": wall["p50"],
+        "peak_memory_mib": round(peak / (1024 * 1024), 2),
+    }
+    for stage, summary in stages.items():
+        if summary["p95"] >= MIN_COMPARABLE_STAGE_SECONDS:
+            metrics[f"stage.{stage}.p95"] = summary["p95"]
+
+    # 呼び出し回数はシードが同じなら毎回同じなので、最後の1回を代表値にする
+    counts = {f"calls.{service}": count for service, count in sorted(runs[-1]["calls"].items())}
+    failed_runs = sum(1 for run in runs if run["exit_code"])
+    last_summary = runs[-1]["summary"] or {}
+    return {
+        "scenario": name,
+        "params": params,
+        "wall": wall,
+        "stages": stages,
+        "metrics": metrics,
+        "counts": counts,
+        "failed_runs": failed_runs,
+        "text_summary": last_summary.get("text_summary"),
+    }
+
+
+def print_result(result):
+    print(f"\n=== {result['scenario']} ===")
+    params = result["params"]
+    print(
+        f"regions={params['regions']} jobs/region={params['jobs_per_region']} "
+        f"worst_limit={params['worst_limit']} tables/query={params['tables_per_query']} "
+        f"query_kb={params['query_kb']} mode={params['mode']} prescreen={params['prescreen']} "
+        f"errors={params['error_rates']}"
+    )
+    wall = result["wall"]
+    print(
+        f"wall: p50={wall['p50']}s p95={wall['p95']}s max={wall['max']}s "
+        f"(runs={wall['count']}, failed={result['failed_runs']})  "
+        f"peak memory: {result['metrics']['peak_memory_mib']} MiB"
+    )
+    rows = [
+        [stage, s["count"], s["p50"], s["p95"], s["p99"], s["max"]]
+        for stage, s in sorted(result["stages"].items(), key=lambda kv: -kv[1]["p95"])
+    ]
+    print(format_table(rows, ["stage", "count", "p50", "p95", "p99", "max"]))
+    print("calls: " + ", ".join(f"{k.split('.', 1)[1]}={v}" for k, v in result["counts"].items()))
+    print(f"summary: {result['text_summary']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main-app のオフラインベンチマーク")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help=f"実行するシナリオ（複数指定可。既定: {', '.join(DEFAULT_SCENARIOS)}）",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前の空回し回数")
+    parser.add_argument("--regions", type=int, help="リージョン数")
+    parser.add_argument(
+        "--jobs", dest="jobs_per_region", type=int, help="リージョンあたりのジョブ数"
+    )
+    parser.add_argument("--worst-limit", type=int, help="WORST_QUERY_LIMIT")
+    parser.add_argument(
+        "--tables", dest="tables_per_query", type=int, help="クエリあたりのテーブル数"
+    )
+    parser.add_argument("--query-kb", type=int, help="クエリ本文の大きさ（KB）")
+    parser.add_argument("--mode", choices=["sync", "stream"], help="GEMINI_GENERATION_MODE")
+    parser.add_argument("--latency-scale", type=float, help="全サービスの遅延に掛ける倍率")
+    parser.add_argument(
+        "--error-rate", type=float, help="構文解析 API と Gemini に共通で与える失敗率"
+    )
+    parser.add_argument("--seed", type=int, help="遅延・失敗の乱数シード")
+    parser.add_argument(
+        "--no-prescreen",
+        dest="prescreen",
+        action="store_const",
+        const=False,
+        help="構文解析をすべて API に送る（ローカルの事前判定を使わない）",
+    )
+    parser.add_argument("--compare", action="store_true", help="ベースラインと比較する")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインに保存")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    parser.add_argument("--verbose", action="store_true", help="main-app のログを表示する")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    overrides = {
+        "regions": args.regions,
+        "jobs_per_region": args.jobs_per_region,
+        "worst_limit": args.worst_limit,
+        "tables_per_query": args.tables_per_query,
+        "query_kb": args.query_kb,
+        "mode": args.mode,
+        "latency_scale": args.latency_scale,
+        "seed": args.seed,
+        "prescreen": args.prescreen,
+    }
+    if args.error_rate is not None:
+        overrides["error_rates"] = {ANTIPATTERN_API: args.error_rate, GEMINI: args.error_rate}
+
+    main_module = load_main_module()
+    baselines = load_baselines(BENCH_NAME) if args.compare else {}
+    regressions = []
+    results = []
+    for name in args.scenario or DEFAULT_SCENARIOS:
+        params = scenario_params(name, **overrides)
+        result = run_benchmark(name, params, args.repeat, args.warmup, main_module)
+        results.append(result)
+        if not args.json:
+            print_result(result)
+
+        if args.save_baseline:
+            path = save_baseline(BENCH_NAME, name, result)
+            print(f"Baseline saved: {path.relative_to(ROOT)} [{name}]", file=sys.stderr)
+        if args.compare:
+            if name not in baselines:
+                regressions.append(f"[{name}] baseline not found (run make bench-baseline)")
+                continue
+            regressions += [
+                f"[{name}] {message}"
+                for message in compare_to_baseline(result, baselines[name], args.tolerance)
+            ]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    if regressions:
+        print("\nRegressions against baseline:", file=sys.stderr)
+        for message in regressions:
+            print(f"  - {message}", file=sys.stderr)
+        sys.exit(1)
+    if args.compare:
+        print("\nNo regressions against baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""main-app のベンチマーク用に、外部サービスをプロセス内で置き換える偽物。
+
+BigQuery / GCS / Gemini / 構文解析 API のそれぞれに、呼び出しごとの遅延（平均±揺らぎ）と
+失敗率を与えられる。乱数はシードで固定するので、同じシナリオなら呼び出し回数と
+失敗する呼び出しは毎回同じになる（時間だけが実測値）。
+"""
+
+import datetime
+import json
+import random
+import time
+import types
+from collections import Counter
+
+# サービス名（遅延・失敗率・呼び出し回数のキー）
+BQ_QUERY = "bq_query"
+BQ_METADATA = "bq_metadata"
+GCS = "gcs"
+ANTIPATTERN_API = "antipattern_api"
+GEMINI = "gemini"
+SERVICES = (BQ_QUERY, BQ_METADATA, GCS, ANTIPATTERN_API, GEMINI)
+
+_REGION_NAMES = ["US", "EU", "asia-northeast1", "us-central1", "europe-west1", "asia-southeast1"]
+
+
+class InjectedError(RuntimeError):
+    """失敗率の設定によって意図的に起こした失敗。"""
+
+
+class FaultInjector:
+    """呼び出しごとに遅延を入れ、確率的に失敗させる。
+
+    latencies は {サービス: (平均秒, 揺らぎ秒)}、error_rates は {サービス: 0〜1}。
+    失敗させるかどうかに関わらず乱数を同じ順で引くため、失敗率を変えても
+    遅延の系列は変わらない。
+    """
+
+    def __init__(self, latencies=None, error_rates=None, seed=0, sleep=time.sleep):
+        self.latencies = latencies or {}
+        self.error_rates = error_rates or {}
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._sleep = sleep
+
+    def hit(self, service):
+        self.calls[service] += 1
+        mean, jitter = self.latencies.get(service, (0.0, 0.0))
+        delay = max(0.0, self._rng.uniform(mean - jitter, mean + jitter))
+        failed = self._rng.random() < self.error_rates.get(service, 0.0)
+        if delay:
+            self._sleep(delay)
+        if failed:
+            raise InjectedError(f"Injected {service} failure")
+
+
+class Row(types.SimpleNamespace):
+    """BigQuery の Row 相当（属性アクセスと items()）。"""
+
+    def items(self):
+        return vars(self).items()
+
+
+class TenantShape:
+    """偽のテナントの規模（リージョン数・ジョブ数・クエリの大きさなど）。"""
+
+    def __init__(
+        self,
+        regions=1,
+        jobs_per_region=10,
+        tables_per_query=2,
+        columns_per_table=20,
+        query_kb=2,
+        datasets_per_region=3,
+    ):
+        self.regions = regions
+        self.jobs_per_region = jobs_per_region
+        self.tables_per_query = tables_per_query
+        self.columns_per_table = columns_per_table
+        self.query_kb = query_kb
+        self.datasets_per_region = datasets_per_region
+
+    def region_names(self):
+        names = []
+        for i in range(self.regions):
+            base = _REGION_NAMES[i % len(_REGION_NAMES)]
+            names.append(base if i < len(_REGION_NAMES) else f"{base}-{i}")
+        return names
+
+    def dataset_locations(self):
+        return {
+            f"dataset_{region.lower()}_{n}": region
+            for region in self.region_names()
+            for n in range(self.datasets_per_region)
+        }
+
+    def query_text(self, region, number):
+        tables = [
+            f"proj.dataset_{region}_0.table_{number}_{t}" for t in range(self.tables_per_query)
+        ]
+        head = f"SELECT * FROM {tables[0]}"
+        for table in tables[1:]:
+            head += f" JOIN {table} USING (id)"
+        # 大きなクエリ（長い IN リストや CASE 式）の再現として、指定サイズまで条件を足す
+        padding = []
+        size = len(head)
+        while size < self.query_kb * 1024:
+            clause = f" OR col_{len(padding) % self.columns_per_table} = 'value_{len(padding)}'"
+            padding.append(clause)
+            size += len(clause)
+        return head + (" WHERE FALSE" + "".join(padding) if padding else "")
+
+    def worst_jobs(self, region):
+        region = region.lower()
+        return [
+            Row(
+                user_email="analyst@example.com",
+                job_id=f"{region}_job_{n}",
+                query=self.query_text(region, n),
+                project_id="customer-project",
+                billed_gb=round(1000.0 / (n + 1), 3),
+                duration_seconds=(n * 37) % 600,
+                slot_hours=round(10.0 / (n + 1), 3),
+                source_type="Human_User",
+                difficulty="Medium",
+                region_name=region,
+                referenced_tables=[
+                    {
+                        "project_id": "proj",
+                        "dataset_id": f"dataset_{region}_0",
+                        "table_id": f"table_{n}_{t}",
+                    }
+                    for t in range(self.tables_per_query)
+                ],
+            )
+            for n in range(self.jobs_per_region)
+        ]
+
+    def query_plan(self, job_id):
+        """ジョブの実行計画（QueryPlanEntry 相当）。読み取り → JOIN → 集計 → 出力の4段階。"""
+        n = int(job_id.rsplit("_", 1)[-1])
+        scale = 1000.0 / (n + 1)
+        stages = [
+            ("S00: Input", 40, 10, 300, 120, 20, 0),
+            ("S01: Join+", 200, 5, 20, 900, 80, 0 if n % 3 else 1),
+            ("S02: Aggregate", 60, 30, 10, 250, 40, 0),
+            ("S03: Output", 10, 5, 5, 20, 10, 0),
+        ]
+        return [
+            types.SimpleNamespace(
+                entry_id=str(i),
+                name=name,
+                slot_ms=int(slot * scale),
+                parallel_inputs=100,
+                wait_ms_avg=wait,
+                read_ms_avg=read,
+                compute_ms_avg=compute,
+                compute_ms_max=compute * (8 if name == "S02: Aggregate" and n % 2 else 2),
+                write_ms_avg=write,
+                shuffle_output_bytes=int(scale * 1024 * 1024 * (i + 1)),
+                shuffle_output_bytes_spilled=int(scale * 1024 * 1024) * spilled,
+            )
+            for i, (name, slot, wait, read, compute, write, spilled) in enumerate(stages)
+        ]
+
+    def compute_pricing_rows(self, region):
+        """コンピュート料金の試算の材料（sql/compute_pricing.sql の結果）。1日分、朝に山がある。"""
+        minute_slots = [40.0 + (460.0 if 540 <= m < 600 else 0.0) for m in range(0, 1440, 2)]
+        return [
+            Row(
+                period_minutes=1440,
+                job_count=self.jobs_per_region,
+                billed_bytes=self.jobs_per_region * 50 * 2**30,
+                reserved_slot_share=0.0,
+                minute_slots=minute_slots,
+            )
+        ]
+
+    def repeated_aggregation_rows(self, region):
+        """繰り返される集計（sql/repeated_aggregations.sql の結果）。ダッシュボードの集計2種類。"""
+        table = f"proj.dataset_{region}_0.table_0_0"
+        return [
+            Row(
+                query_hash=f"{region}_{n}",
+                runs=200 * (n + 1),
+                users=5,
+                active_hour_buckets=list(range(12 * n, 12 * n + 12)),
+                billed_bytes=200 * (n + 1) * 2 * 2**30,
+                slot_ms=200 * (n + 1) * 30_000,
+                sample_query=(
+                    f"SELECT col_0, SUM(col_{n + 1}) AS total_{n} FROM {table} "
+                    f"WHERE col_0 = 'value_{n}' GROUP BY col_0"
+                ),
+                tables=[table],
+                period_hours=24,
+            )
+            for n in range(2)
+        ]
+
+    def table_workload_rows(self, region):
+        """スキャン量の多いテーブルと、そのテーブルを読むクエリ（sql/table_workload.sql の結果）。"""
+        rows = []
+        for t in range(2):
+            table = f"proj.dataset_{region}_0.table_0_{t}"
+            queries = [
+                Row(
+                    query=f"SELECT * FROM {table} WHERE col_{(n + t) % 3} = 'value_{n}'",
+                    runs=10,
+                    billed_bytes=(n + 1) * 10 * 2**30,
+                )
+                for n in range(5)
+            ]
+            rows.append(
+                Row(
+                    table_name=table,
+                    billed_bytes=sum(q.billed_bytes for q in queries),
+                    runs=50,
+                    queries=queries,
+                )
+            )
+        return rows
+
+    def timeline_rows(self, region):
+        """スロット使用量のピークの分（sql/slot_timeline.sql の結果）。朝9時台の2つの山。"""
+        base = datetime.datetime(2024, 1, 1, 9, 0, tzinfo=datetime.timezone.utc)
+        minutes = [0, 1, 2, 3, 30, 31]
+        return [
+            Row(
+                minute=base + datetime.timedelta(minutes=m),
+                avg_slots=500.0 - m,
+                running_jobs=self.jobs_per_region,
+                overall_avg_slots=120.0,
+                p50_queued_seconds=0.4,
+                p95_queued_seconds=12.0,
+                top_jobs=[
+                    {
+                        "job_id": f"{region.lower()}_job_{n}",
+                        "user_email": "analyst@example.com",
+                        "avg_slots": 100.0 / (n + 1),
+                        "queued_seconds": float(n),
+                    }
+                    for n in range(min(3, self.jobs_per_region))
+                ],
+            )
+            for m in minutes
+        ]
+
+    def storage_rows(self, region):
+        gib = 2**30
+        return [
+            Row(
+                dataset_name=f"dataset_{region}_{n}",
+                table_name=f"table_{t}",
+                billing_model="LOGICAL",
+                active_logical_bytes=60 * (n + 1) * gib,
+                long_term_logical_bytes=40 * (n + 1) * gib,
+                active_physical_bytes=15 * (n + 1) * gib,
+                long_term_physical_bytes=10 * (n + 1) * gib,
+                time_travel_physical_bytes=3 * (t + 1) * gib,
+                fail_safe_physical_bytes=2 * gib,
+            )
+            for n in range(self.datasets_per_region)
+            for t in range(3)
+        ]
+
+    def cold_table_rows(self, region):
+        gib = 2**30
+        last_read = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        return [
+            Row(
+                dataset_name=f"dataset_{region}_{n}",
+                table_name=f"archive_{n}",
+                billing_model="LOGICAL",
+                active_logical_bytes=0,
+                long_term_logical_bytes=500 * (n + 1) * gib,
+                active_physical_bytes=0,
+                long_term_physical_bytes=100 * (n + 1) * gib,
+                time_travel_physical_bytes=0,
+                fail_safe_physical_bytes=gib,
+                creation_time=last_read,
+                last_modified_time=last_read,
+                last_read_time=last_read if n % 2 else None,
+                read_jobs=n % 2,
+            )
+            for n in range(self.datasets_per_region)
+        ]
+
+
+class FakeQueryJob:
+    def __init__(self, rows, total_bytes_processed):
+        self.rows = rows
+        self.total_bytes_processed = total_bytes_processed
+
+    def result(self, timeout=None):
+        return list(self.rows)
+
+
+class FakeBigQueryClient:
+    """SQL の中身で応答を振り分ける bigquery.Client の代わり。"""
+
+    def __init__(self, injector, shape, project=None):
+        self.injector = injector
+        self.shape = shape
+        self.project = project
+
+    def query(self, sql, location=None, **kwargs):
+        self.injector.hit(BQ_QUERY)
+        job_config = kwargs.get("job_config")
+        if getattr(job_config, "dry_run", False):
+            # 改善SQL のドライラン。行は返さず、処理バイト数だけを見積もる
+            return FakeQueryJob([], total_bytes_processed=5 * 2**30)
+        if "session_user()" in sql:
+            rows = [Row(user_email="analyzer-sa@example.iam.gserviceaccount.com")]
+        elif "antipattern_master" in sql:
+            rows = [
+                Row(
+                    pattern_name=name,
+                    problem_description=f"{name} の問題点",
+                    best_practice=f"{name} の修正方法",
+                )
+                for name in ("SimpleSelectStar", "JoinOrder", "SemiJoinWithoutAgg")
+            ]
+        elif "last_reads" in sql:
+            rows = self.shape.cold_table_rows(location)
+        elif "TABLE_STORAGE" in sql:
+            rows = self.shape.storage_rows(location)
+        elif "heavy_tables" in sql:
+            rows = self.shape.table_workload_rows(location)
+        elif "normalized_literals" in sql:
+            rows = self.shape.repeated_aggregation_rows(location)
+        elif "minute_slots" in sql:
+            rows = self.shape.compute_pricing_rows(location)
+        elif "JOBS_TIMELINE_BY_PROJECT" in sql:
+            rows = self.shape.timeline_rows(location)
+        elif "JOBS_BY_PROJECT" in sql:
+            rows = self.shape.worst_jobs(location)
+        else:
+            rows = []
+        return FakeQueryJob(rows, total_bytes_processed=10 * 1024 * 1024 * len(rows))
+
+    def list_datasets(self, project=None, timeout=None, **kwargs):
+        self.injector.hit(BQ_METADATA)
+        return [types.SimpleNamespace(reference=name) for name in self.shape.dataset_locations()]
+
+    def get_dataset(self, reference, timeout=None, **kwargs):
+        self.injector.hit(BQ_METADATA)
+        return types.SimpleNamespace(location=self.shape.dataset_locations()[reference])
+
+    def get_job(self, job_id, project=None, location=None, timeout=None, **kwargs):
+        self.injector.hit(BQ_METADATA)
+        return types.SimpleNamespace(job_id=job_id, query_plan=self.shape.query_plan(job_id))
+
+    def get_table(self, table_name, timeout=None, **kwargs):
+        self.injector.hit(BQ_METADATA)
+        return types.SimpleNamespace(
+            time_partitioning=types.SimpleNamespace(field="created_at", type_="DAY"),
+            clustering_fields=["col_0", "col_1"],
+            schema=[
+                types.SimpleNamespace(name=f"col_{i}", field_type="STRING")
+                for i in range(self.shape.columns_per_table)
+            ],
+            num_bytes=50 * 2**30,
+            num_rows=100_000_000,
+        )
+
+
+class FakeBlob:
+    def __init__(self, store, bucket_name, name):
+        self._store = store
+        self._key = (bucket_name, name)
+        self.name = name
+        self.metadata = None
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        self._store.injector.hit(GCS)
+        self._store.objects[self._key] = data
+
+    def download_as_text(self):
+        self._store.injector.hit(GCS)
+        data = self._store.objects[self._key]
+        return data.decode("utf-8") if isinstance(data, bytes) else data
+
+    def exists(self):
+        self._store.injector.hit(GCS)
+        return self._key in self._store.objects
+
+    def delete(self):
+        self._store.injector.hit(GCS)
+        self._store.objects.pop(self._key, None)
+
+
+class FakeBucket:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self._store, self.name, name)
+
+
+class FakeGcs:
+    """全 storage.Client で共有するオブジェクト置き場。"""
+
+    def __init__(self, injector):
+        self.injector = injector
+        self.objects = {}
+
+    def client(self, project=None):
+        return FakeStorageClient(self)
+
+    def read_json(self, bucket_name, name):
+        data = self.objects.get((bucket_name, name))
+        return json.loads(data) if data is not None else None
+
+
+class FakeStorageClient:
+    def __init__(self, store):
+        self._store = store
+
+    def bucket(self, name):
+        return FakeBucket(self._store, name)
+
+    def list_blobs(self, bucket_name, max_results=None, prefix=None, **kwargs):
+        self._store.injector.hit(GCS)
+        names = sorted(
+            name
+            for bucket, name in self._store.objects
+            if bucket == bucket_name and name.startswith(prefix or "")
+        )
+        return [FakeBlob(self._store, bucket_name, name) for name in names[:max_results]]
+
+
+class FakeGenerativeModel:
+    """GenerativeModel の代わり。stream=True では最初のチャンクまでに遅延を入れる。"""
+
+    def __init__(self, injector, response_chars=2000, chunk_chars=200):
+        self.injector = injector
+        self.response_chars = response_chars
+        self.chunk_chars = chunk_chars
+
+    def _text(self, prompt):
+        rewrite = (
+            "### 改善SQL\n```sql\nSELECT col_0, col_1 FROM proj.dataset_0.table_0\n"
+            "WHERE created_at >= '2024-01-01'\n```\n"
+        )
+        body = "改善案: パーティション列で絞り込み、必要な列だけを SELECT してください。" * 100
+        return (rewrite + body)[: self.response_chars]
+
+    def generate_content(self, prompt, stream=False):
+        self.injector.hit(GEMINI)
+        text = self._text(prompt)
+        if not stream:
+            return types.SimpleNamespace(text=text)
+        return iter(
+            types.SimpleNamespace(text=text[i : i + self.chunk_chars])
+            for i in range(0, len(text), self.chunk_chars)
+        )
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, payload):
+        self.content = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+class FakeAntipatternApi:
+    """requests モジュールの代わり（main-app は requests.post しか使わない）。"""
+
+    def __init__(self, injector):
+        self.injector = injector
+
+    def post(self, url, json=None, headers=None, timeout=None, **kwargs):
+        self.injector.hit(ANTIPATTERN_API)
+        query = (json or {}).get("query", "")
+        findings = ["SimpleSelectStar"] if "SELECT *" in query else []
+        if " JOIN " in query:
+            findings.append("JoinOrder")
+        return FakeResponse({"recommendations": "\n".join(findings)})
@@ -0,0 +1,177 @@
+"""bq-antipattern-api の起動時間（JVM の起動とインスタンスのコールドスタート）のベンチマーク。
+
+2つを測る。
+
+1. 解析エンジン1回の起動から終了まで（--mode jar のみ）。JVM オプションの組み合わせ
+   （素の java -jar / TieredStopAtLevel=1 / それに AppCDS アーカイブを足したもの）ごとに
+   同じクエリを繰り返し解析し、所要時間の p50/p95 を比べる。AppCDS アーカイブは
+   Dockerfile と同じ手順（-XX:ArchiveClassesAtExit）で一時ディレクトリに作る。
+2. インスタンスのコールドスタート。app.py を起動してから /ready が 200 を返すまでと、
+   その直後の最初の /analyze の所要時間を、起動時のウォームアップの有無で比べる。
+
+    python benchmarks/recognizer_startup_bench.py                  # 偽の解析エンジン（2 のみ）
+    python benchmarks/recognizer_startup_bench.py --mode jar       # 本物の JAR（java が必要）
+
+偽の解析エンジンは JVM のクラス読み込みやページキャッシュを再現しないため、fake モードの
+数値は仕組み（ウォームアップ・/ready）が動くことの確認にとどまる。
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from antipattern_api_bench import (
+    API_DIR,
+    CORPUS,
+    post_query,
+    start_server,
+    stop_server,
+    wait_until_ready,
+)
+from bench_common import format_table, summarize_latencies
+
+JAR_NAME = "bigquery-antipattern-recognition.jar"
+# app.py の既定の JAVA_OPTIONS と揃える
+TIERED = ["-XX:TieredStopAtLevel=1"]
+READY_POLL_SECONDS = 0.05
+
+
+def jvm_variants(archive_path):
+    """比べる JVM オプションの組み合わせ（名前, java と -jar の間に入れる引数）。"""
+    return [
+        ("plain", []),
+        ("tiered", TIERED),
+        ("tiered+cds", TIERED + [f"-XX:SharedArchiveFile={archive_path}", "-Xshare:auto"]),
+    ]
+
+
+def build_cds_archive(archive_path, query):
+    """Dockerfile と同じ手順で AppCDS アーカイブを作る。作れたら True。"""
+    subprocess.run(
+        ["java", f"-XX:ArchiveClassesAtExit={archive_path}", *TIERED, "-jar", JAR_NAME]
+        + ["--query", query],
+        cwd=API_DIR,
+        capture_output=True,
+        check=False,
+    )
+    return Path(archive_path).exists()
+
+
+def measure_launches(java_args, query, repeat):
+    """java <java_args> -jar <JAR> --query <query> を repeat 回実行した所要時間（秒）。"""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            ["java", *java_args, "-jar", JAR_NAME, "--query", query],
+            cwd=API_DIR,
+            capture_output=True,
+            check=False,
+        )
+        seconds.append(time.perf_counter() - started)
+        if completed.returncode != 0:
+            raise RuntimeError(f"recognizer failed: {completed.stderr[-500:]!r}")
+    return seconds
+
+
+def run_jvm_benchmark(query, repeat):
+    with tempfile.TemporaryDirectory() as workdir:
+        archive_path = str(Path(workdir) / "app-cds.jsa")
+        if not build_cds_archive(archive_path, query):
+            print("AppCDS archive could not be created; skipping the cds variant", file=sys.stderr)
+        rows = {}
+        for name, java_args in jvm_variants(archive_path):
+            if "cds" in name and not Path(archive_path).exists():
+                continue
+            # 最初の1回はページキャッシュ載せのため計測から外す
+            measure_launches(java_args, query, 1)
+            rows[name] = summarize_latencies(measure_launches(java_args, query, repeat))
+        return rows
+
+
+def measure_cold_start(mode, warmup, startup_ms, per_kb_ms, query):
+    """1回のコールドスタートで (起動→/ready の秒, 最初の /analyze の秒) を返す。"""
+    env = {"WARMUP_ON_STARTUP": "true" if warmup else "false"}
+    started = time.perf_counter()
+    process, url = start_server(mode, 1, startup_ms, per_kb_ms, extra_env=env, wait=False)
+    try:
+        wait_until_ready(url, process, poll_seconds=READY_POLL_SECONDS)
+        ready_seconds = time.perf_counter() - started
+        status, first_seconds = post_query(url, query)
+        if status != 200:
+            raise RuntimeError(f"first /analyze returned {status}")
+    finally:
+        stop_server(process)
+    return ready_seconds, first_seconds
+
+
+def run_cold_start_benchmark(mode, repeat, startup_ms, per_kb_ms, query):
+    rows = {}
+    for warmup in (False, True):
+        ready, first = [], []
+        for _ in range(repeat):
+            ready_seconds, first_seconds = measure_cold_start(
+                mode, warmup, startup_ms, per_kb_ms, query
+            )
+            ready.append(ready_seconds)
+            first.append(first_seconds)
+        ready, first = summarize_latencies(ready), summarize_latencies(first)
+        rows["warmup" if warmup else "no-warmup"] = {
+            "ready": ready,
+            "first_request": first,
+            # 利用者が待つのはトラフィックを受けてからの first_request。ウォームアップは
+            # その分を ready 側（トラフィックを受ける前）へ移す。
+            "ready_plus_first_p50": round(ready["p50"] + first["p50"], 4),
+        }
+    return rows
+
+
+def print_result(result):
+    params = result["params"]
+    print(f"\n=== bq-antipattern-api startup ({params['mode']}, repeat={params['repeat']}) ===")
+    if result.get("jvm"):
+        rows = [[name, s["p50"], s["p95"], s["max"]] for name, s in result["jvm"].items()]
+        print("recognizer launch (seconds per analysis)")
+        print(format_table(rows, ["jvm options", "p50", "p95", "max"]))
+    rows = [
+        [name, s["ready"]["p50"], s["first_request"]["p50"], s["ready_plus_first_p50"]]
+        for name, s in result["cold_start"].items()
+    ]
+    print("instance cold start (seconds)")
+    print(format_table(rows, ["startup", "ready_p50", "first_request_p50", "total_p50"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bq-antipattern-api の起動時間のベンチマーク")
+    parser.add_argument("--mode", choices=["fake", "jar"], default="fake")
+    parser.add_argument("--repeat", type=int, default=5, help="各構成の計測回数")
+    parser.add_argument(
+        "--startup-ms", type=float, default=300.0, help="偽の解析エンジンの起動コスト"
+    )
+    parser.add_argument("--per-kb-ms", type=float, default=5.0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args()
+
+    if args.mode == "jar" and not (API_DIR / JAR_NAME).exists():
+        raise SystemExit(f"bq-antipattern-api/{JAR_NAME} が見つかりません")
+
+    query = CORPUS[1]
+    result = {"params": {"mode": args.mode, "repeat": args.repeat}}
+    if args.mode == "jar":
+        result["jvm"] = run_jvm_benchmark(query, args.repeat)
+    result["cold_start"] = run_cold_start_benchmark(
+        args.mode, args.repeat, args.startup_ms, args.per_kb_ms, query
+    )
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_result(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,21 @@
+import asyncio
 import logging
 import os
 import re
-import subprocess
+import shlex
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
 from pydantic import BaseModel
 
 # --- ロガーの設定 ---
@@ -13,7 +25,254 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+JAR_PATH = "bigquery-antipattern-recognition.jar"
+# AppCDS（クラスデータ共有）のアーカイブ。Docker のビルド時に JAR を1回動かして作る。
+# あれば JVM はクラスの読み込み・検証を省けるため、解析1件ごとの起動が速くなる。
+CDS_ARCHIVE_PATH = os.getenv("CDS_ARCHIVE_PATH", "app-cds.jsa")
+# JVM の追加オプション。解析は1回きりの短命なプロセスなので、C2 コンパイラまで
+# 待たない（TieredStopAtLevel=1）方が起動から終了までの合計が短い。
+JAVA_OPTIONS = os.getenv("JAVA_OPTIONS", "-XX:TieredStopAtLevel=1")
+# 起動時に解析を1回流し（JAR・CDS アーカイブ・JVM をページキャッシュに載せ）てから
+# /ready で準備完了を返す。Cloud Run はスタートアップ プローブが通るまでトラフィックを送らない。
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+WARMUP_QUERY = (
+    "WITH c AS (SELECT * FROM `warmup.dataset.events`) "
+    "SELECT * FROM c WHERE id IN (SELECT id FROM `warmup.dataset.users`) ORDER BY 1"
+)
+# 解析エンジンの起動コマンド（末尾に --query <SQL> を付けて実行する）。
+# 未設定なら JAR を直接起動する。負荷試験では偽の解析エンジンに差し替える。
+RECOGNIZER_COMMAND = os.getenv("RECOGNIZER_COMMAND")
+# 同時に起動する解析エンジン（JVM）の上限。JVM は1つで数百 MB 使うため、
+# コンテナのメモリを超えないようにインスタンスのサイズに合わせて決める。
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "2"))
+# 上限に達したときに順番待ちさせる件数。待ち行列も埋まっていれば即座に 503 を返す。
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "8"))
+# 503 の Retry-After（秒）。呼び出し元はこの秒数だけ待って再送する。
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "5"))
+ANALYSIS_TIMEOUT_SECONDS = float(os.getenv("ANALYSIS_TIMEOUT_SECONDS", "60"))
+# クライアントの切断を確認する間隔（切断されたら解析エンジンを止める）
+DISCONNECT_POLL_SECONDS = 0.5
+# 応答を受け取る相手がいないことを表すステータス（nginx の慣習に合わせる）
+CLIENT_CLOSED_REQUEST = 499
+NO_FINDINGS = "No anti-patterns found."
+
+
+def java_command():
+    command = ["java", *shlex.split(JAVA_OPTIONS)]
+    if CDS_ARCHIVE_PATH and os.path.exists(CDS_ARCHIVE_PATH):
+        # Xshare:auto なので、アーカイブが JVM・JAR と合わなければ使わずに通常どおり起動する
+        command += [f"-XX:SharedArchiveFile={CDS_ARCHIVE_PATH}", "-Xshare:auto"]
+    return command + ["-jar", JAR_PATH]
+
+
+def recognizer_command(query):
+    if RECOGNIZER_COMMAND:
+        return shlex.split(RECOGNIZER_COMMAND) + ["--query", query]
+    return java_command() + ["--query", query]
+
+
+def recognizer_available():
+    return bool(RECOGNIZER_COMMAND) or os.path.exists(JAR_PATH)
+
+
+class Saturated(Exception):
+    """実行中・待機中の解析が上限に達している。"""
+
+
+class AnalysisLimiter:
+    """解析エンジンの同時実行数と待ち行列の長さを制限する。
+
+    イベントループ上でだけ使う（カウンタの更新の間に await を挟まないのでロックは不要）。
+    """
+
+    def __init__(self, max_concurrency, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def saturated(self):
+        return self.running + self.waiting >= self.max_concurrency + self.max_queue
+
+    @asynccontextmanager
+    async def slot(self):
+        """実行枠を確保する。待ち行列まで埋まっていれば待たずに Saturated を送出する。"""
+        if self.saturated:
+            raise Saturated()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+
+limiter = AnalysisLimiter(MAX_CONCURRENCY, MAX_QUEUE)
+
+# --- Prometheus メトリクス（GET /metrics） ---
+# 既定のレジストリ（プロセスの CPU 等）ではなく専用のものに登録する。
+# uvicorn は1ワーカーで動かす前提（複数ワーカーではワーカーごとの値になる）。
+metrics_registry = CollectorRegistry()
+# JVM の起動込みで数百 ms〜60 秒（タイムアウト）
+_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+REQUEST_SECONDS = Histogram(
+    "antipattern_api_request_seconds",
+    "End-to-end /analyze latency, including queueing.",
+    ["outcome"],
+    buckets=_LATENCY_BUCKETS,
+    registry=metrics_registry,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "antipattern_api_queue_wait_seconds",
+    "Time spent waiting for a recognizer slot.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60),
+    registry=metrics_registry,
+)
+RECOGNIZER_SECONDS = Histogram(
+    "antipattern_api_recognizer_seconds",
+    "Wall time of one recognizer (JVM) run that finished before the timeout.",
+    buckets=_LATENCY_BUCKETS,
+    registry=metrics_registry,
+)
+QUERY_BYTES = Histogram(
+    "antipattern_api_query_bytes",
+    "Size of the analysed SQL in UTF-8 bytes.",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+    registry=metrics_registry,
+)
+RECOGNIZER_FAILURES = Counter(
+    "antipattern_api_recognizer_nonzero_exit",
+    "Recognizer runs that exited with a non-zero code.",
+    registry=metrics_registry,
+)
+TIMEOUTS = Counter(
+    "antipattern_api_timeouts",
+    "Analyses killed after ANALYSIS_TIMEOUT_SECONDS.",
+    registry=metrics_registry,
+)
+NO_FINDINGS_RESULTS = Counter(
+    "antipattern_api_no_findings",
+    'Analyses that returned "No anti-patterns found."',
+    registry=metrics_registry,
+)
+IN_FLIGHT = Gauge(
+    "antipattern_api_in_flight",
+    "Analyses currently running or waiting for a slot.",
+    ["state"],
+    registry=metrics_registry,
+)
+# スクレイプ時に limiter の値を読む（リクエストごとの更新はしない）
+IN_FLIGHT.labels("running").set_function(lambda: limiter.running)
+IN_FLIGHT.labels("waiting").set_function(lambda: limiter.waiting)
+
+
+async def run_recognizer(query, timeout):
+    """解析エンジンを子プロセスで実行し、(終了コード, 標準出力) を返す。
+
+    タイムアウトやキャンセル（クライアントの切断）で抜けるときは子プロセスを kill する。
+    """
+    process = await asyncio.create_subprocess_exec(
+        *recognizer_command(query),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+    started = time.perf_counter()
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    RECOGNIZER_SECONDS.observe(time.perf_counter() - started)
+    return process.returncode, stdout.decode("utf-8", errors="replace")
+
+
+async def analyze_in_slot(query):
+    queued = time.perf_counter()
+    async with limiter.slot():
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued)
+        logger.info("Executing JAR file...")
+        return await run_recognizer(query, ANALYSIS_TIMEOUT_SECONDS)
+
+
+async def cancel_on_disconnect(request, task):
+    """クライアントが切断したら task をキャンセルする。キャンセルしたら True を返す。"""
+    while not task.done():
+        if await request.is_disconnected():
+            task.cancel()
+            return True
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+    return False
+
+
+def extract_recommendations(raw_output):
+    # 正規表現で「Recommendations for query:」から次の「---」までの部分だけを切り抜く
+    match = re.search(r"Recommendations for query:.*?(?=\n-|$)", raw_output, re.DOTALL)
+
+    if match:
+        # 見つかった場合はその部分だけを抽出
+        logger.info("Anti-patterns found and extracted successfully.")
+        return match.group(0).strip()
+    # 何も指摘がなかった場合
+    logger.info("No anti-patterns found in the query.")
+    return NO_FINDINGS
+
+
+# 起動時のウォームアップの状態（/ready が返す）
+readiness = {"ready": False, "warmup_seconds": None, "detail": "starting"}
+
+
+async def warm_up():
+    """解析を1回流してから準備完了にする。
+
+    ウォームアップの解析が失敗しても準備完了にする（各リクエストで改めて実行されるため）。
+    解析エンジン自体が無い場合だけは準備完了にしない。
+    """
+    if not recognizer_available():
+        readiness["detail"] = "JAR file not found."
+        logger.error("Warm-up skipped: JAR file not found. The service will not become ready.")
+        return
+    if WARMUP_ON_STARTUP:
+        started = time.perf_counter()
+        try:
+            async with limiter.slot():
+                returncode, _ = await run_recognizer(WARMUP_QUERY, ANALYSIS_TIMEOUT_SECONDS)
+            if returncode != 0:
+                logger.warning(f"Warm-up analysis returned non-zero exit code: {returncode}")
+        except Exception:
+            logger.exception("Warm-up analysis failed. Marking the service ready anyway.")
+        readiness["warmup_seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(f"Warm-up finished in {readiness['warmup_seconds']}s.")
+    readiness.update(ready=True, detail="ready")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # ウォームアップ中も /ready には応答する必要があるため、バックグラウンドで流す
+    task = asyncio.ensure_future(warm_up())
+    yield
+    task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/ready")
+async def ready():
+    status_code = 200 if readiness["ready"] else 503
+    return JSONResponse(status_code=status_code, content=readiness)
 
 
 class AnalyzeRequest(BaseModel):
@@ -21,56 +280,64 @@ class AnalyzeRequest(BaseModel):
 
 
 @app.post("/analyze")
-def analyze_query(req: AnalyzeRequest):
+async def analyze_query(req: AnalyzeRequest, request: Request):
     # 長すぎるクエリがログを埋め尽くさないよう、最初の100文字だけログに出す
     short_query = req.query[:100] + ("..." if len(req.query) > 100 else "")
     logger.info(f"Received analysis request. Query: {short_query}")
 
-    jar_path = "bigquery-antipattern-recognition.jar"
-
-    if not os.path.exists(jar_path):
+    if not recognizer_available():
         error_msg = "JAR file not found."
         logger.error(error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
 
+    QUERY_BYTES.observe(len(req.query.encode("utf-8")))
+    started = time.perf_counter()
+    outcome = "error"
+    analysis = asyncio.ensure_future(analyze_in_slot(req.query))
+    watcher = asyncio.ensure_future(cancel_on_disconnect(request, analysis))
     try:
-        logger.info("Executing JAR file...")
-        result = subprocess.run(
-            ["java", "-jar", jar_path, "--query", req.query],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            timeout=60,
-        )
-
-        raw_output = result.stdout
+        returncode, raw_output = await analysis
 
         # Java側の実行がエラー（終了コードが0以外）だった場合のログ
-        if result.returncode != 0:
-            logger.warning(f"JAR execution returned non-zero exit code: {result.returncode}")
-
-        # 正規表現で「Recommendations for query:」から次の「---」までの部分だけを切り抜く
-        recommendations = ""
-        match = re.search(r"Recommendations for query:.*?(?=\n-|$)", raw_output, re.DOTALL)
-
-        if match:
-            # 見つかった場合はその部分だけを抽出
-            recommendations = match.group(0).strip()
-            logger.info("Anti-patterns found and extracted successfully.")
-        else:
-            # 何も指摘がなかった場合
-            recommendations = "No anti-patterns found."
-            logger.info("No anti-patterns found in the query.")
+        if returncode != 0:
+            logger.warning(f"JAR execution returned non-zero exit code: {returncode}")
+            RECOGNIZER_FAILURES.inc()
 
+        recommendations = extract_recommendations(raw_output)
+        if recommendations == NO_FINDINGS:
+            NO_FINDINGS_RESULTS.inc()
+        outcome = "success"
         return {
             "status": "success",
             "recommendations": recommendations,
         }
 
-    except subprocess.TimeoutExpired:
-        logger.error("Analysis timed out after 60 seconds.")
+    except Saturated:
+        outcome = "rejected"
+        logger.warning(
+            f"Analysis queue is full (running={limiter.running}, waiting={limiter.waiting}). "
+            "Rejecting request."
+        )
+        raise HTTPException(
+            status_code=503,
+            detail="Analysis queue is full.",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        TIMEOUTS.inc()
+        logger.error(f"Analysis timed out after {ANALYSIS_TIMEOUT_SECONDS:g} seconds.")
         raise HTTPException(status_code=504, detail="Analysis timed out.")
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        if watcher.done() and not watcher.cancelled() and watcher.result():
+            logger.info("Client disconnected. Analysis cancelled.")
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+        raise
     except Exception as e:
         # logger.exception() を使うと、エラーのスタックトレースもログに記録してくれます
         logger.exception("An unexpected error occurred during analysis.")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        watcher.cancel()
+        REQUEST_SECONDS.labels(outcome).observe(time.perf_counter() - started)
@@ -0,0 +1,25 @@
+/* 調査期間のクエリ全体（リテラル違いは1つにまとめる）のアンチパターン集計用SQL */
+SELECT
+    -- リテラルだけが違うクエリは同じハッシュになる（無ければクエリ本文のハッシュ）
+    COALESCE(query_info.query_hashes.normalized_literals, TO_HEX(MD5(query))) AS query_hash,
+    ANY_VALUE(query) AS query,
+    COUNT(*) AS runs,
+    SUM(total_bytes_billed) AS billed_bytes,
+    SUM(total_slot_ms) AS slot_ms
+FROM
+    `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT
+WHERE
+    -- 調査期間・除外条件は worst_ranking.sql と同じ
+    creation_time >= {start_time_expr}
+    {end_time_expr}
+    AND job_type = 'QUERY'
+    AND statement_type = 'SELECT'
+    AND error_result IS NULL
+    AND total_bytes_billed > 0
+    AND user_email != '{analyzer_email}'
+    AND NOT REGEXP_CONTAINS(query, r'(?i)INFORMATION_SCHEMA')
+GROUP BY
+    query_hash
+ORDER BY
+    billed_bytes DESC
+LIMIT {limit}
@@ -0,0 +1,64 @@
+/* 長期間読まれていない大きなテーブル（未使用・コールドテーブル）抽出用SQL */
+WITH last_reads AS (
+    -- テーブルごとの最後の読み取り（JOBS の保持期間いっぱいの {lookback_days} 日を見る）
+    SELECT
+        t.dataset_id AS dataset_name,
+        t.table_id AS table_name,
+        MAX(j.creation_time) AS last_read_time,
+        COUNT(*) AS read_jobs
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT AS j,
+        UNNEST(j.referenced_tables) AS t
+    WHERE
+        j.creation_time >= TIMESTAMP_SUB({period_end_expr}, INTERVAL {lookback_days} DAY)
+        AND j.creation_time < {period_end_expr}
+        AND j.error_result IS NULL
+        AND j.user_email != '{analyzer_email}'
+        AND t.project_id = '{target_project}'
+    GROUP BY
+        dataset_name, table_name
+),
+billing_models AS (
+    -- 料金モデルはデータセットごとの設定（未設定なら論理ストレージ）
+    SELECT
+        schema_name AS dataset_name,
+        UPPER(JSON_VALUE(option_value)) AS billing_model
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.SCHEMATA_OPTIONS
+    WHERE
+        option_name = 'storage_billing_model'
+)
+SELECT
+    s.table_schema AS dataset_name,
+    s.table_name,
+    COALESCE(b.billing_model, 'LOGICAL') AS billing_model,
+    -- 月額の計算は logical_vs_physical_storage_analysis.sql と同じ列で行う（storage_pricing.py）
+    s.active_logical_bytes,
+    s.long_term_logical_bytes,
+    s.active_physical_bytes - s.time_travel_physical_bytes AS active_physical_bytes,
+    s.long_term_physical_bytes,
+    s.time_travel_physical_bytes,
+    s.fail_safe_physical_bytes,
+    s.creation_time,
+    s.storage_last_modified_time AS last_modified_time,
+    r.last_read_time,
+    COALESCE(r.read_jobs, 0) AS read_jobs
+FROM
+    `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.TABLE_STORAGE AS s
+    LEFT JOIN last_reads AS r
+        ON s.table_schema = r.dataset_name AND s.table_name = r.table_name
+    LEFT JOIN billing_models AS b
+        ON s.table_schema = b.dataset_name
+WHERE
+    NOT s.deleted
+    AND s.table_type = 'BASE TABLE'
+    AND s.total_logical_bytes >= {min_bytes}
+    -- 作成から {idle_days} 日経っていて、その間読まれていないテーブル
+    AND s.creation_time < TIMESTAMP_SUB({period_end_expr}, INTERVAL {idle_days} DAY)
+    AND (
+        r.last_read_time IS NULL
+        OR r.last_read_time < TIMESTAMP_SUB({period_end_expr}, INTERVAL {idle_days} DAY)
+    )
+ORDER BY
+    s.total_logical_bytes DESC
+LIMIT {limit}
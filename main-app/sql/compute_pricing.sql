@@ -0,0 +1,52 @@
+/* コンピュート料金モデル（オンデマンド vs Editions）試算用SQL */
+WITH raw_timeline AS (
+    SELECT
+        period_start,
+        period_slot_ms,
+        job_creation_time AS creation_time
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_TIMELINE_BY_PROJECT
+    WHERE
+        -- 調査期間（job_creation_time はパーティション列）
+        job_creation_time >= {start_time_expr}
+        AND job_type = 'QUERY'
+        AND period_slot_ms > 0
+        -- スクリプトの親ジョブは子ジョブのスロットを合算しているため除外（二重計上を防ぐ）
+        AND (statement_type IS NULL OR statement_type != 'SCRIPT')
+),
+timeline AS (
+    SELECT * FROM raw_timeline WHERE TRUE {end_time_expr}
+),
+-- 1分ごとの平均スロット数（使用量の無い分は含まない）
+per_minute AS (
+    SELECT
+        TIMESTAMP_TRUNC(period_start, MINUTE) AS minute,
+        SUM(period_slot_ms) / (1000 * 60) AS avg_slots
+    FROM
+        timeline
+    GROUP BY
+        minute
+),
+jobs AS (
+    SELECT
+        COUNT(*) AS job_count,
+        -- 予約で動いたジョブは課金バイトが0になるため、処理バイトをオンデマンドでの課金量とみなす
+        SUM(IF(reservation_id IS NULL, total_bytes_billed, total_bytes_processed)) AS billed_bytes,
+        SUM(IF(reservation_id IS NULL, 0, total_slot_ms)) / NULLIF(SUM(total_slot_ms), 0) AS reserved_slot_share
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT
+    WHERE
+        creation_time >= {start_time_expr}
+        {end_time_expr}
+        AND job_type = 'QUERY'
+        AND (statement_type IS NULL OR statement_type != 'SCRIPT')
+        AND error_result IS NULL
+)
+SELECT
+    TIMESTAMP_DIFF(LEAST(CURRENT_TIMESTAMP(), {period_end_expr}), {start_time_expr}, MINUTE) AS period_minutes,
+    j.job_count,
+    j.billed_bytes,
+    j.reserved_slot_share,
+    ARRAY(SELECT avg_slots FROM per_minute) AS minute_slots
+FROM
+    jobs AS j
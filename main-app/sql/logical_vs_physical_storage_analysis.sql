@@ -1,33 +1,30 @@
-/* ストレージ最適化診断用SQL */
-WITH StorageStats AS (
+/* ストレージ最適化診断用SQL（テーブル単位。料金の計算と判定は storage_pricing.py） */
+WITH billing_models AS (
+    -- 料金モデルはデータセットごとの設定（未設定なら論理ストレージ）
     SELECT
-        table_schema AS dataset_name,
-        -- 論理サイズ (GB)
-        SUM(total_logical_bytes) / 1024 / 1024 / 1024 AS logical_gb,
-        -- 物理サイズ (GB)
-        SUM(total_physical_bytes) / 1024 / 1024 / 1024 AS physical_gb,
-        -- タイムトラベルサイズ (GB)
-        SUM(time_travel_physical_bytes) / 1024 / 1024 / 1024 AS time_travel_gb
+        schema_name AS dataset_name,
+        UPPER(JSON_VALUE(option_value)) AS billing_model
     FROM
-        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.TABLE_STORAGE
-    GROUP BY
-        1
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.SCHEMATA_OPTIONS
+    WHERE
+        option_name = 'storage_billing_model'
 )
 SELECT
-    dataset_name,
-    logical_gb,
-    physical_gb,
-    -- 圧縮率
-    logical_gb / NULLIF(physical_gb, 0) AS compression_ratio,
-    -- 提案ロジック
-    CASE
-        WHEN logical_gb / NULLIF(physical_gb, 0) > 2.0 THEN '【推奨】物理ストレージへ変更 (コスト削減見込み大)'
-        WHEN logical_gb / NULLIF(physical_gb, 0) BETWEEN 1.5 AND 2.0 THEN '検討 (コスト削減見込み中)'
-        ELSE '現状維持 (論理ストレージのままが良い)'
-    END AS recommendation
+    s.table_schema AS dataset_name,
+    s.table_name,
+    COALESCE(b.billing_model, 'LOGICAL') AS billing_model,
+    -- 論理ストレージ（アクティブ / 長期保存）
+    s.active_logical_bytes,
+    s.long_term_logical_bytes,
+    -- 物理ストレージ（アクティブ / 長期保存）。active_physical_bytes はタイムトラベルを含むため分けて返す
+    -- （フェイルセーフは含まない）。物理の料金モデルではタイムトラベル・フェイルセーフも課金される
+    s.active_physical_bytes - s.time_travel_physical_bytes AS active_physical_bytes,
+    s.long_term_physical_bytes,
+    s.time_travel_physical_bytes,
+    s.fail_safe_physical_bytes
 FROM
-    StorageStats
+    `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.TABLE_STORAGE AS s
+    LEFT JOIN billing_models AS b
+        ON s.table_schema = b.dataset_name
 WHERE
-    logical_gb > 1 -- あまりに小さいデータセットは無視
-ORDER BY
-    compression_ratio DESC;
\ No newline at end of file
+    s.total_logical_bytes > 0 OR s.total_physical_bytes > 0
@@ -0,0 +1,53 @@
+/* 繰り返し実行される集計クエリ（マテリアライズドビュー・BI Engine の候補）抽出用SQL */
+WITH aggregations AS (
+    SELECT
+        -- リテラルだけが違うクエリは同じハッシュになる（無ければクエリ本文のハッシュ）
+        COALESCE(query_info.query_hashes.normalized_literals, TO_HEX(MD5(query))) AS query_hash,
+        user_email,
+        creation_time,
+        query,
+        total_bytes_billed,
+        total_slot_ms,
+        ARRAY(
+            SELECT FORMAT('%s.%s.%s', t.project_id, t.dataset_id, t.table_id)
+            FROM UNNEST(referenced_tables) AS t
+            ORDER BY 1
+        ) AS tables
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT
+    WHERE
+        -- 調査期間・除外条件は worst_ranking.sql と同じ
+        creation_time >= {start_time_expr}
+        {end_time_expr}
+        AND job_type = 'QUERY'
+        AND statement_type = 'SELECT'
+        AND error_result IS NULL
+        AND total_bytes_billed > 0
+        AND user_email != '{analyzer_email}'
+        AND NOT REGEXP_CONTAINS(query, r'(?i)INFORMATION_SCHEMA')
+        -- 集計（GROUP BY）を含むクエリだけ
+        AND REGEXP_CONTAINS(query, r'(?i)\bGROUP\s+BY\b')
+        AND ARRAY_LENGTH(referenced_tables) > 0
+)
+SELECT
+    query_hash,
+    COUNT(*) AS runs,
+    COUNT(DISTINCT user_email) AS users,
+    -- 実行のあった時間帯（UNIX 時間を1時間単位にした番号）。1時間ごとに更新するビューの更新回数の目安。
+    -- 同じビューにまとまる別のクエリと重なる時間帯を数え直せるよう、数ではなく集合で返す
+    ARRAY_AGG(DISTINCT DIV(UNIX_SECONDS(creation_time), 3600)) AS active_hour_buckets,
+    SUM(total_bytes_billed) AS billed_bytes,
+    SUM(total_slot_ms) AS slot_ms,
+    ANY_VALUE(query) AS sample_query,
+    ANY_VALUE(tables) AS tables,
+    -- 調査期間の長さ（月あたりへの換算用）
+    TIMESTAMP_DIFF(LEAST(CURRENT_TIMESTAMP(), {period_end_expr}), {start_time_expr}, HOUR) AS period_hours
+FROM
+    aggregations
+GROUP BY
+    query_hash
+HAVING
+    runs >= {min_runs}
+ORDER BY
+    billed_bytes DESC
+LIMIT {limit}
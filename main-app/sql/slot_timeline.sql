@@ -0,0 +1,77 @@
+/* スロット使用量のタイムライン（同時実行の競合）診断用SQL */
+WITH raw_timeline AS (
+    SELECT
+        period_start,
+        period_slot_ms,
+        job_id,
+        user_email,
+        job_creation_time AS creation_time,
+        job_start_time
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_TIMELINE_BY_PROJECT
+    WHERE
+        -- 調査期間（job_creation_time はパーティション列）
+        job_creation_time >= {start_time_expr}
+        AND period_slot_ms > 0
+        -- スクリプトの親ジョブは子ジョブのスロットを合算しているため除外（二重計上を防ぐ）
+        AND (statement_type IS NULL OR statement_type != 'SCRIPT')
+),
+timeline AS (
+    SELECT * FROM raw_timeline WHERE TRUE {end_time_expr}
+),
+-- 1分ごとの平均スロット数と、その分に動いていたジョブ数
+per_minute AS (
+    SELECT
+        TIMESTAMP_TRUNC(period_start, MINUTE) AS minute,
+        SUM(period_slot_ms) / (1000 * 60) AS avg_slots,
+        COUNT(DISTINCT job_id) AS running_jobs
+    FROM
+        timeline
+    GROUP BY
+        minute
+),
+peak_minutes AS (
+    SELECT * FROM per_minute ORDER BY avg_slots DESC LIMIT {peak_minutes}
+),
+-- ピークの分ごとの、ジョブ別のスロット数と作成から実行開始までの待ち
+job_minutes AS (
+    SELECT
+        TIMESTAMP_TRUNC(period_start, MINUTE) AS minute,
+        job_id,
+        ANY_VALUE(user_email) AS user_email,
+        SUM(period_slot_ms) / (1000 * 60) AS avg_slots,
+        TIMESTAMP_DIFF(ANY_VALUE(job_start_time), ANY_VALUE(creation_time), MILLISECOND) / 1000 AS queued_seconds
+    FROM
+        timeline
+    WHERE
+        TIMESTAMP_TRUNC(period_start, MINUTE) IN (SELECT minute FROM peak_minutes)
+    GROUP BY
+        minute, job_id
+),
+-- 期間全体の待ち（ジョブ単位）
+queue AS (
+    SELECT
+        APPROX_QUANTILES(TIMESTAMP_DIFF(job_start_time, creation_time, MILLISECOND) / 1000, 100)[OFFSET(50)] AS p50_queued_seconds,
+        APPROX_QUANTILES(TIMESTAMP_DIFF(job_start_time, creation_time, MILLISECOND) / 1000, 100)[OFFSET(95)] AS p95_queued_seconds
+    FROM
+        (SELECT DISTINCT job_id, creation_time, job_start_time FROM timeline)
+)
+SELECT
+    p.minute,
+    p.avg_slots,
+    p.running_jobs,
+    (SELECT AVG(avg_slots) FROM per_minute) AS overall_avg_slots,
+    q.p50_queued_seconds,
+    q.p95_queued_seconds,
+    ARRAY(
+        SELECT AS STRUCT j.job_id, j.user_email, j.avg_slots, j.queued_seconds
+        FROM job_minutes AS j
+        WHERE j.minute = p.minute
+        ORDER BY j.avg_slots DESC
+        LIMIT {top_jobs}
+    ) AS top_jobs
+FROM
+    peak_minutes AS p
+    CROSS JOIN queue AS q
+ORDER BY
+    p.minute
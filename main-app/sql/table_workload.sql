@@ -0,0 +1,75 @@
+/* スキャン量の多いテーブルと、そのテーブルを読むクエリ（パーティション・クラスタリング列の推奨用）抽出用SQL */
+WITH jobs AS (
+    SELECT
+        -- リテラルだけが違うクエリは同じハッシュになる（無ければクエリ本文のハッシュ）
+        COALESCE(query_info.query_hashes.normalized_literals, TO_HEX(MD5(query))) AS query_hash,
+        query,
+        total_bytes_billed,
+        referenced_tables
+    FROM
+        `{target_project}`.`region-{region}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT
+    WHERE
+        -- 調査期間・除外条件は worst_ranking.sql と同じ
+        creation_time >= {start_time_expr}
+        {end_time_expr}
+        AND job_type = 'QUERY'
+        AND statement_type = 'SELECT'
+        AND error_result IS NULL
+        AND total_bytes_billed > 0
+        AND user_email != '{analyzer_email}'
+        AND NOT REGEXP_CONTAINS(query, r'(?i)INFORMATION_SCHEMA')
+        AND ARRAY_LENGTH(referenced_tables) > 0
+),
+-- ジョブの課金バイトは参照テーブルで等分する（テーブルごとの読み取り量は JOBS に無いため）
+table_jobs AS (
+    SELECT
+        FORMAT('%s.%s.%s', t.project_id, t.dataset_id, t.table_id) AS table_name,
+        j.query_hash,
+        j.query,
+        j.total_bytes_billed / ARRAY_LENGTH(j.referenced_tables) AS billed_bytes
+    FROM
+        jobs AS j,
+        UNNEST(j.referenced_tables) AS t
+),
+heavy_tables AS (
+    SELECT
+        table_name,
+        SUM(billed_bytes) AS billed_bytes,
+        COUNT(*) AS runs
+    FROM
+        table_jobs
+    GROUP BY
+        table_name
+    ORDER BY
+        billed_bytes DESC
+    LIMIT {table_limit}
+),
+shapes AS (
+    SELECT
+        table_name,
+        query_hash,
+        ANY_VALUE(query) AS query,
+        COUNT(*) AS runs,
+        SUM(billed_bytes) AS billed_bytes
+    FROM
+        table_jobs
+    WHERE
+        table_name IN (SELECT table_name FROM heavy_tables)
+    GROUP BY
+        table_name, query_hash
+)
+SELECT
+    h.table_name,
+    h.billed_bytes,
+    h.runs,
+    ARRAY(
+        SELECT AS STRUCT s.query, s.runs, s.billed_bytes
+        FROM shapes AS s
+        WHERE s.table_name = h.table_name
+        ORDER BY s.billed_bytes DESC
+        LIMIT {query_limit}
+    ) AS queries
+FROM
+    heavy_tables AS h
+ORDER BY
+    h.billed_bytes DESC
@@ -0,0 +1,173 @@
+"""調査期間のクエリ全体でのアンチパターンの集計（センサス）。
+
+ワーストクエリの解析では上位 WORST_QUERY_LIMIT 件しか構文解析しないため、antipattern_master の
+各ルールがワークロード全体でどれだけ当たっているかは分からなかった。ここでは調査期間の
+クエリをリテラル違いでまとめた単位（sql/antipattern_census.sql）で全件判定し、ルールごとに
+クエリ数・実行回数・課金バイト・スロット時間を集計する。
+
+判定はまずローカルのルール（antipattern_rules.prescreen）で行い、その場で判定できない
+クエリだけを構文解析 API に並列で送る（課金バイトの多い順に上限件数まで）。API に送れなかった
+クエリは「未判定」として別に数え、割合は判定したクエリの課金バイトに対して求める。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from antipattern_rules import NO_FINDINGS, REPORT_HEADER, rule_names
+
+# API の応答の見出し（REPORT_HEADER の前半。API は前後の出力を切り抜いて返す）
+_API_HEADER = REPORT_HEADER.split(":", 1)[0]
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+@dataclass
+class QueryShape:
+    """リテラル違いをまとめたクエリ1つ分。"""
+
+    query_hash: str
+    query: str
+    runs: int
+    billed_bytes: float
+    slot_ms: float
+    rules: list | None = None  # 当たったルール（None は未判定）
+    remote: bool = False  # API で判定したか
+
+
+@dataclass
+class PatternStats:
+    rule: str
+    queries: int = 0
+    runs: int = 0
+    billed_bytes: float = 0.0
+    slot_ms: float = 0.0
+
+    def add(self, shape):
+        self.queries += 1
+        self.runs += shape.runs
+        self.billed_bytes += shape.billed_bytes
+        self.slot_ms += shape.slot_ms
+
+
+@dataclass
+class Census:
+    shapes: list
+    patterns: dict = field(default_factory=dict)  # {ルール名: PatternStats}
+
+    @property
+    def judged_billed_bytes(self):
+        """判定できたクエリの課金バイト（割合の分母。未判定のクエリは含めない）。"""
+        return sum(s.billed_bytes for s in self.shapes if s.rules is not None)
+
+    def count(self, predicate):
+        matched = [s for s in self.shapes if predicate(s)]
+        return len(matched), sum(s.billed_bytes for s in matched)
+
+    def ranked(self):
+        return sorted(self.patterns.values(), key=lambda p: p.billed_bytes, reverse=True)
+
+
+def build_shapes(rows):
+    return [
+        QueryShape(
+            query_hash=_field(row, "query_hash"),
+            query=_field(row, "query") or "",
+            runs=int(_field(row, "runs") or 0),
+            billed_bytes=float(_field(row, "billed_bytes") or 0),
+            slot_ms=float(_field(row, "slot_ms") or 0),
+        )
+        for row in rows
+    ]
+
+
+def _parse_remote(report):
+    """API の応答からルール名。失敗・スキップの文言なら None（未判定）。"""
+    if report == NO_FINDINGS:
+        return []
+    if report and report.startswith(_API_HEADER):
+        return rule_names(report)
+    return None
+
+
+def run_census(
+    shapes, screen, analyze_remote=None, max_remote=0, concurrency=1, allows=lambda: True
+):
+    """各クエリを判定してルールごとに集計する。
+
+    screen はローカル判定（Screening を返す）、analyze_remote は API 呼び出し（応答の文字列を
+    返す）。API には、ローカルで判定できなかったクエリを課金バイトの多い順に max_remote 件まで、
+    concurrency 件ずつ並列に送る。allows() が False になったら（持ち時間の不足）送るのをやめる。
+    """
+    undecided = []
+    for shape in shapes:
+        screening = screen(shape.query)
+        if screening.decided:
+            shape.rules = [f.rule for f in screening.findings]
+        else:
+            undecided.append(shape)
+    if analyze_remote and max_remote > 0:
+        pending = sorted(undecided, key=lambda s: s.billed_bytes, reverse=True)[:max_remote]
+        size = max(concurrency, 1)
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            for start in range(0, len(pending), size):
+                if not allows():
+                    break
+                batch = pending[start : start + size]
+                for shape, report in zip(
+                    batch, executor.map(analyze_remote, [s.query for s in batch])
+                ):
+                    shape.rules = _parse_remote(report)
+                    shape.remote = shape.rules is not None
+    census = Census(shapes)
+    for shape in shapes:
+        # 同じルールが複数箇所で当たっても、クエリとしては1回と数える
+        for rule in dict.fromkeys(shape.rules or []):
+            census.patterns.setdefault(rule, PatternStats(rule)).add(shape)
+    return census
+
+
+# ==========================================
+# レポート
+# ==========================================
+
+
+def _tib(value):
+    return f"{value / 2**40:,.2f}"
+
+
+def format_census(census, truncated=False):
+    """レポートに載せる Markdown（ルールごとの件数・課金・スロット時間）。"""
+    if not census.shapes:
+        return "対象となるクエリの実行履歴がありませんでした。"
+    total = census.judged_billed_bytes
+    lines = [
+        "| アンチパターン | クエリ数 | 実行回数 | 課金 (TiB) | 判定したクエリの課金に占める割合 "
+        "| スロット時間 |",
+        "|---|--:|--:|--:|--:|--:|",
+    ]
+    for stats in census.ranked():
+        share = stats.billed_bytes / total if total else 0.0
+        lines.append(
+            f"| {stats.rule} | {stats.queries:,} | {stats.runs:,} | {_tib(stats.billed_bytes)} "
+            f"| {share:.0%} | {stats.slot_ms / 3_600_000:,.1f} |"
+        )
+    if not census.patterns:
+        lines.append("| （該当なし） | 0 | 0 | 0.00 | 0% | 0.0 |")
+    clean, clean_bytes = census.count(lambda s: s.rules == [])
+    undecided, undecided_bytes = census.count(lambda s: s.rules is None)
+    remote, _ = census.count(lambda s: s.remote)
+    lines += [
+        "",
+        f"- 判定したクエリ: {len(census.shapes) - undecided:,} 件"
+        f"（うち構文解析 API で判定 {remote:,} 件）、指摘なし {clean:,} 件"
+        f"（課金 {_tib(clean_bytes)} TiB）",
+        f"- 未判定（ローカルで判定できず、API でも判定しなかった）: {undecided:,} 件"
+        f"（課金 {_tib(undecided_bytes)} TiB）",
+    ]
+    note = "1つのクエリに複数のアンチパターンが当たることがあるため、割合の合計は100%を超えることがあります。"
+    if truncated:
+        note = "課金バイトの多いクエリから上限件数までを対象にしています。" + note
+    lines.append("\n" + note)
+    return "\n".join(lines)
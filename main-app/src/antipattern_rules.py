@@ -0,0 +1,575 @@
+"""アンチパターンのローカル判定（構文解析 API の前段のふるい）。
+
+ワーストクエリの多くは短く、指摘なしか SimpleSelectStar・OrderByWithoutLimit のような
+単純なルールに当たるだけである。そうしたクエリは構文解析 API（JAR）を呼ばずに、
+ここで antipattern_master のルールを判定する。
+
+SQL はトークン列にしたあと括弧の入れ子で木にし（解析は1回だけ）、各ルールはその木を見る。
+ZetaSQL の完全な構文解析ではないため、判定に自信が持てないクエリ（長いクエリ・複数文・
+DDL/DML・スクリプト・未対応の構文・字句エラー）は decided=False を返し、呼び出し側は
+従来どおり API に送る。出力は API（JAR）と同じ「* ルール名: メッセージ」の形式にする。
+"""
+
+import re
+from dataclasses import dataclass, field
+
+# 既定でローカル判定するクエリの上限（UTF-8 のバイト数）。長いクエリは API に任せる
+DEFAULT_MAX_QUERY_BYTES = 4096
+NO_FINDINGS = "No anti-patterns found."
+# API（JAR の CLI 出力）と同じ見出し。下流（プロンプト・辞書の抽出）は同じ形式を前提にする
+REPORT_HEADER = "Recommendations for query: query provided by cli:"
+# ローカルで判定するルール（antipattern_master の行）。これ以外のルールが当たり得るクエリは
+# UNSUPPORTED_KEYWORDS で API に送る
+SUPPORTED_RULES = (
+    "SimpleSelectStar",
+    "SemiJoinWithoutAgg",
+    "CTEsEvalMultipleTimes",
+    "OrderByWithoutLimit",
+    "StringComparison",
+    "LatestRecordWithAnalyticFun",
+    "DynamicPredicate",
+    "WhereOrder",
+)
+_RULE_LINE_RE = re.compile(r"^\* (\w+):", re.M)
+
+# ローカルで判定しないクエリの目印。JAR 側にしか無いルール（MissingDropStatement 等）が
+# 当たり得るもの、または木の形を前提にしたルールが誤判定しやすい構文
+UNSUPPORTED_KEYWORDS = frozenset(
+    {
+        "CREATE",
+        "DECLARE",
+        "BEGIN",
+        "EXECUTE",
+        "CALL",
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+        "MERGE",
+        "TRUNCATE",
+        "DROP",
+        "ALTER",
+        "PIVOT",
+        "UNPIVOT",
+        "MATCH_RECOGNIZE",
+        "TEMP",
+        "TEMPORARY",
+    }
+)
+# WHERE 句の終わり（同じ階層でこれらが来たら WHERE の条件は終わる）
+_WHERE_END = frozenset({"GROUP", "HAVING", "QUALIFY", "WINDOW", "ORDER", "LIMIT", "UNION"})
+_WHERE_END |= {"INTERSECT", "EXCEPT"}
+_COMPARISON_OPS = frozenset({"=", "!=", "<>", "<", ">", "<=", ">="})
+# 単純な文字列比較に置き換えられない正規表現の記号
+_REGEX_META = re.compile(r"[.^$*+?()\[\]{}|\\]")
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>(?:[rRbB]{1,2})?(?:'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\\n])*'|"(?:\\.|[^"\\\n])*"))
+  | (?P<quoted>`[^`]*`)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op><=|>=|<>|!=|\|\||<<|>>|[=<>+\-*/%&|^~])
+  | (?P<punct>[(),.;\[\]:@?{}])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+class PrescreenError(ValueError):
+    """字句・括弧の対応が崩れていて、ローカルでは判定できない。"""
+
+
+@dataclass(frozen=True)
+class Token:
+    kind: str  # "word" / "quoted" / "string" / "number" / "op" / "punct"
+    text: str
+    line: int
+    start: int = field(default=0, compare=False)  # SQL 中の開始位置（文字数）
+
+    @property
+    def upper(self):
+        return self.text.upper() if self.kind == "word" else self.text
+
+    @property
+    def name(self):
+        """識別子としての名前（バッククォートを外して小文字にした比較用の値）。"""
+        if self.kind == "quoted":
+            return self.text[1:-1].lower()
+        return self.text.lower()
+
+    def is_keyword(self, *keywords):
+        return self.kind == "word" and self.upper in keywords
+
+
+@dataclass
+class Group:
+    """括弧で囲まれた部分。items は Token と Group の列。"""
+
+    items: list = field(default_factory=list)
+    line: int = 1
+
+    @property
+    def is_query(self):
+        first = self.items[0] if self.items else None
+        return isinstance(first, Token) and first.is_keyword("SELECT", "WITH")
+
+
+@dataclass(frozen=True)
+class Finding:
+    rule: str
+    message: str
+
+    def format(self):
+        return f"* {self.rule}: {self.message}"
+
+
+@dataclass
+class Screening:
+    """ローカル判定の結果。decided が False なら API に送る。"""
+
+    decided: bool
+    findings: list = field(default_factory=list)
+    reason: str = ""
+
+    def report(self):
+        """API（bq-antipattern-api）の recommendations と同じ形式の文字列。"""
+        if not self.findings:
+            return NO_FINDINGS
+        return "\n".join([REPORT_HEADER] + [f.format() for f in self.findings])
+
+
+def rule_names(report):
+    """「* ルール名: メッセージ」形式の解析結果から、当たったルール名を出現順に返す。"""
+    return _RULE_LINE_RE.findall(report)
+
+
+# ==========================================
+# 字句解析と括弧の木（partition_pruning と共用）
+# ==========================================
+
+
+def tokenize(sql):
+    tokens = []
+    line = 1
+    pos = 0
+    while pos < len(sql):
+        match = _TOKEN_RE.match(sql, pos)
+        if not match:
+            raise PrescreenError(f"unexpected character {sql[pos]!r} at line {line}")
+        kind = match.lastgroup
+        text = match.group()
+        if kind not in ("space", "comment"):
+            tokens.append(Token(kind, text, line, pos))
+        line += text.count("\n")
+        pos = match.end()
+    return tokens
+
+
+def build_tree(tokens):
+    """括弧の対応で入れ子にした木（最上位の Group）を返す。"""
+    root = Group(line=1)
+    stack = [root]
+    for token in tokens:
+        if token.text == "(" and token.kind == "punct":
+            group = Group(line=token.line)
+            stack[-1].items.append(group)
+            stack.append(group)
+        elif token.text == ")" and token.kind == "punct":
+            if len(stack) == 1:
+                raise PrescreenError(f"unbalanced ')' at line {token.line}")
+            stack.pop()
+        else:
+            stack[-1].items.append(token)
+    if len(stack) != 1:
+        raise PrescreenError("unbalanced '('")
+    return root
+
+
+def _walk(group):
+    """group 自身と、その中のすべての Group を順に返す。"""
+    yield group
+    for item in group.items:
+        if isinstance(item, Group):
+            yield from _walk(item)
+
+
+def query_blocks(root):
+    """クエリの階層（最上位と、SELECT / WITH で始まる括弧）を返す。"""
+    return [group for group in _walk(root) if group is root or group.is_query]
+
+
+def group_tokens(group):
+    """group 内のすべての Token（入れ子の中も含む）を順に返す。"""
+    for item in group.items:
+        if isinstance(item, Group):
+            yield from group_tokens(item)
+        else:
+            yield item
+
+
+def is_word(item, *keywords):
+    return isinstance(item, Token) and item.is_keyword(*keywords)
+
+
+def _find_keyword_pairs(items, first, second):
+    """同じ階層で first second と続く位置（first の添字）を返す。"""
+    return [
+        i
+        for i in range(len(items) - 1)
+        if is_word(items[i], first) and is_word(items[i + 1], second)
+    ]
+
+
+def where_clause(items):
+    """同じ階層の WHERE の条件部分（items の切り出し）。無ければ空。"""
+    for i, item in enumerate(items):
+        if is_word(item, "WHERE"):
+            end = next(
+                (j for j in range(i + 1, len(items)) if is_word(items[j], *_WHERE_END)),
+                len(items),
+            )
+            return items[i + 1 : end]
+    return []
+
+
+def table_path(items, start):
+    """items[start:] のテーブルパス（a.b.c / `a.b.c` / a-b.c）を (名前, 次の添字) で返す。"""
+    parts = []
+    i = start
+    while i < len(items) and isinstance(items[i], Token):
+        token = items[i]
+        if token.kind in ("word", "quoted", "number") or token.text == "-":
+            parts.append(token.text.strip("`"))
+            i += 1
+            if i < len(items) and isinstance(items[i], Token) and items[i].text == ".":
+                parts.append(".")
+                i += 1
+                continue
+            # プロジェクト ID のハイフン（my-project.ds.t）
+            if i < len(items) and isinstance(items[i], Token) and items[i].text == "-":
+                continue
+        break
+    if not parts or parts[0] in (".", "-"):
+        return None, start
+    return "".join(parts), i
+
+
+def _cte_definitions(block):
+    """WITH で始まる階層の CTE 定義 {名前: 定義の行}。"""
+    items = block.items
+    if not is_word(items[0] if items else None, "WITH"):
+        return {}
+    return {
+        items[i].name: items[i].line
+        for i in range(1, len(items) - 2)
+        if isinstance(items[i], Token)
+        and items[i].kind in ("word", "quoted")
+        and is_word(items[i + 1], "AS")
+        and isinstance(items[i + 2], Group)
+    }
+
+
+def defined_cte_names(root):
+    return {name for block in query_blocks(root) for name in _cte_definitions(block)}
+
+
+# ==========================================
+# ルール（antipattern_master の pattern_name と対応）
+# ==========================================
+
+
+def rule_simple_select_star(root, cte_names):
+    findings = []
+    for block in query_blocks(root):
+        items = block.items
+        for i, item in enumerate(items):
+            if not is_word(item, "SELECT"):
+                continue
+            j = i + 1
+            if j < len(items) and is_word(items[j], "DISTINCT", "ALL"):
+                j += 1
+            if not (j + 1 < len(items) and isinstance(items[j], Token) and items[j].text == "*"):
+                continue
+            # SELECT * EXCEPT(...) / REPLACE(...) は列を選んでいるので対象外
+            if not is_word(items[j + 1], "FROM"):
+                continue
+            table, _ = table_path(items, j + 2)
+            if table and table.lower() not in cte_names:
+                findings.append(
+                    Finding(
+                        "SimpleSelectStar",
+                        f"SELECT * on table: {table}. Check that all columns are needed.",
+                    )
+                )
+    return findings
+
+
+def rule_order_by_without_limit(root):
+    findings = []
+    for block in query_blocks(root):
+        items = block.items
+        for i in _find_keyword_pairs(items, "ORDER", "BY"):
+            if not any(is_word(item, "LIMIT") for item in items[i + 2 :]):
+                findings.append(
+                    Finding(
+                        "OrderByWithoutLimit",
+                        f"ORDER BY clause without LIMIT at line {items[i].line}.",
+                    )
+                )
+    return findings
+
+
+def rule_ctes_eval_multiple_times(root):
+    findings = []
+    for block in query_blocks(root):
+        definitions = _cte_definitions(block)
+        if not definitions:
+            continue
+        references = dict.fromkeys(definitions, 0)
+        tokens = list(group_tokens(block))
+        for k in range(1, len(tokens)):
+            token = tokens[k]
+            if token.kind not in ("word", "quoted") or token.name not in references:
+                continue
+            if tokens[k - 1].is_keyword("FROM", "JOIN"):
+                references[token.name] += 1
+        for name, count in references.items():
+            if count > 1:
+                findings.append(
+                    Finding(
+                        "CTEsEvalMultipleTimes",
+                        f"CTE with multiple references: alias {name} defined at line "
+                        f"{definitions[name]} is referenced {count} times.",
+                    )
+                )
+    return findings
+
+
+def rule_semi_join_without_agg(root):
+    findings = []
+    for group in _walk(root):
+        items = group.items
+        for i in range(len(items) - 1):
+            subquery = items[i + 1]
+            if not (is_word(items[i], "IN") and isinstance(subquery, Group) and subquery.is_query):
+                continue
+            sub_items = subquery.items
+            distinct = len(sub_items) > 1 and is_word(sub_items[1], "DISTINCT")
+            grouped = bool(_find_keyword_pairs(sub_items, "GROUP", "BY"))
+            if not distinct and not grouped:
+                findings.append(
+                    Finding(
+                        "SemiJoinWithoutAgg",
+                        f"IN filter with a subquery without DISTINCT or GROUP BY at line "
+                        f"{items[i].line}.",
+                    )
+                )
+    return findings
+
+
+def rule_dynamic_predicate(root):
+    findings = []
+    for block in query_blocks(root):
+        where = where_clause(block.items)
+        for i, item in enumerate(where):
+            if not (isinstance(item, Group) and item.is_query):
+                continue
+            before = where[i - 1] if i > 0 else None
+            after = where[i + 1] if i + 1 < len(where) else None
+            if any(
+                isinstance(op, Token) and op.kind == "op" and op.text in _COMPARISON_OPS
+                for op in (before, after)
+            ):
+                findings.append(
+                    Finding(
+                        "DynamicPredicate",
+                        f"Using subquery in filter at line {item.line}. Converting this "
+                        "dynamic predicate to static might provide better performance.",
+                    )
+                )
+    return findings
+
+
+def _simple_regex_pattern(literal):
+    """LIKE / = で置き換えられる正規表現リテラルなら True。"""
+    body = re.sub(r"^[rRbB]{1,2}", "", literal)
+    quote = body[:3] if body[:3] in ("'''", '"""') else body[0]
+    pattern = body[len(quote) : -len(quote)]
+    pattern = re.sub(r"^(\^|\.\*)", "", pattern)
+    pattern = re.sub(r"(\$|\.\*)$", "", pattern)
+    return bool(pattern) and not _REGEX_META.search(pattern)
+
+
+def rule_string_comparison(root):
+    findings = []
+    for group in _walk(root):
+        items = group.items
+        for i in range(len(items) - 1):
+            args = items[i + 1]
+            if not (is_word(items[i], "REGEXP_CONTAINS") and isinstance(args, Group)):
+                continue
+            commas = [k for k, a in enumerate(args.items) if isinstance(a, Token) and a.text == ","]
+            pattern = args.items[commas[0] + 1 :] if commas else []
+            if (
+                len(pattern) == 1
+                and isinstance(pattern[0], Token)
+                and pattern[0].kind == "string"
+                and _simple_regex_pattern(pattern[0].text)
+            ):
+                findings.append(
+                    Finding(
+                        "StringComparison",
+                        f"REGEXP_CONTAINS at line {items[i].line}. Prefer LIKE instead of "
+                        "REGEXP_CONTAINS if possible.",
+                    )
+                )
+    return findings
+
+
+def rule_latest_record_with_analytic_fun(root):
+    # ROW_NUMBER() OVER (...) AS 別名 を集める
+    aliases = {}
+    for group in _walk(root):
+        items = group.items
+        for i in range(len(items) - 5):
+            if (
+                is_word(items[i], "ROW_NUMBER")
+                and isinstance(items[i + 1], Group)
+                and is_word(items[i + 2], "OVER")
+                and isinstance(items[i + 3], Group)
+                and is_word(items[i + 4], "AS")
+                and isinstance(items[i + 5], Token)
+                and items[i + 5].kind in ("word", "quoted")
+            ):
+                aliases[items[i + 5].name] = items[i].line
+    if not aliases:
+        return []
+    findings = []
+    for block in query_blocks(root):
+        where = [item for item in where_clause(block.items) if isinstance(item, Token)]
+        for k in range(len(where) - 2):
+            first, op, last = where[k], where[k + 1], where[k + 2]
+            if op.text != "=":
+                continue
+            if (first.name in aliases and last.text == "1") or (
+                last.name in aliases and first.text == "1"
+            ):
+                alias = first.name if first.name in aliases else last.name
+                findings.append(
+                    Finding(
+                        "LatestRecordWithAnalyticFun",
+                        f"Seems like you might be using analytical function row_number in line "
+                        f"{aliases[alias]} to filter the latest record in line {op.line}.",
+                    )
+                )
+    return findings
+
+
+def split_and(where):
+    """WHERE の条件を最上位の AND で分ける。最上位に OR があれば分けない（None）。"""
+    if any(is_word(item, "OR") for item in where):
+        return None
+    predicates, current = [], []
+    between = False
+    for item in where:
+        if is_word(item, "BETWEEN"):
+            between = True
+        if is_word(item, "AND") and not between:
+            predicates.append(current)
+            current = []
+            continue
+        if is_word(item, "AND"):
+            between = False
+        current.append(item)
+    predicates.append(current)
+    return [p for p in predicates if p]
+
+
+def _is_expensive(predicate):
+    return any(
+        is_word(item, "LIKE")
+        or (isinstance(item, Token) and item.kind == "word" and item.upper.startswith("REGEXP_"))
+        for item in predicate
+    )
+
+
+def is_column(items):
+    """a / t.a / `t`.a のような列参照だけから成るか。"""
+    return bool(items) and all(
+        isinstance(item, Token) and (item.kind in ("word", "quoted") or item.text == ".")
+        for item in items
+    )
+
+
+def _is_selective(predicate):
+    """列 = リテラル、または 列 IN (リテラル, ...) の単純な絞り込み。"""
+    last = predicate[-1]
+    if len(predicate) < 3:
+        return False
+    if isinstance(last, Token) and last.kind in ("string", "number"):
+        operator = predicate[-2]
+        return isinstance(operator, Token) and operator.text == "=" and is_column(predicate[:-2])
+    if isinstance(last, Group) and is_word(predicate[-2], "IN"):
+        return not last.is_query and is_column(predicate[:-2])
+    return False
+
+
+def rule_where_order(root):
+    findings = []
+    for block in query_blocks(root):
+        predicates = split_and(where_clause(block.items))
+        if not predicates:
+            continue
+        for k, predicate in enumerate(predicates):
+            if _is_expensive(predicate) and any(_is_selective(p) for p in predicates[k + 1 :]):
+                line = next(item.line for item in predicate if isinstance(item, Token))
+                findings.append(
+                    Finding(
+                        "WhereOrder",
+                        f"LIKE/REGEXP filter in line {line} precedes a more selective filter.",
+                    )
+                )
+                break
+    return findings
+
+
+# ==========================================
+# 判定の入口
+# ==========================================
+
+
+def prescreen(sql, max_query_bytes=DEFAULT_MAX_QUERY_BYTES):
+    """SQL をローカルのルールで判定する。判定できなければ decided=False。"""
+    if len(sql.encode("utf-8")) > max_query_bytes:
+        return Screening(False, reason="query too long")
+    try:
+        tokens = tokenize(sql)
+        root = build_tree(tokens)
+    except PrescreenError as e:
+        return Screening(False, reason=str(e))
+
+    # 末尾の ; は1文として扱う
+    statements = [t for t in root.items if isinstance(t, Token) and t.text == ";"]
+    if len(statements) > 1 or (statements and root.items[-1] is not statements[-1]):
+        return Screening(False, reason="multiple statements")
+    first = root.items[0] if root.items else None
+    if not (is_word(first, "SELECT", "WITH") or isinstance(first, Group)):
+        return Screening(False, reason="not a query")
+    unsupported = sorted({t.upper for t in tokens if t.is_keyword(*UNSUPPORTED_KEYWORDS)})
+    if unsupported:
+        return Screening(False, reason=f"unsupported syntax: {', '.join(unsupported)}")
+
+    cte_names = defined_cte_names(root)
+    findings = (
+        rule_simple_select_star(root, cte_names)
+        + rule_semi_join_without_agg(root)
+        + rule_ctes_eval_multiple_times(root)
+        + rule_order_by_without_limit(root)
+        + rule_string_comparison(root)
+        + rule_latest_record_with_analytic_fun(root)
+        + rule_dynamic_predicate(root)
+        + rule_where_order(root)
+    )
+    return Screening(True, findings)
@@ -0,0 +1,209 @@
+"""Vertex AI バッチ予測による Gemini の一括生成。
+
+ワーストクエリが数十〜数百件あるテナントでは、1件ずつ同期で generate_content を
+呼ぶと実行時間もクォータも大きく消費する。全プロンプトを JSONL にまとめて
+バッチ予測ジョブとして投入し、完了後の出力ファイルから結果を組み立てる。
+
+投入・完了待ち・出力取得はバックエンドに委ねる。本番は VertexBatchBackend
+（GCS + BatchPredictionJob）、テストやローカル検証では LocalBatchBackend に差し替える。
+"""
+
+import datetime
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# 入力行と出力行を突き合わせるキー。GenerateContentRequest の labels に載せると
+# 出力側の request にそのまま残る。
+REQUEST_KEY_LABEL = "analyzer_key"
+# バッチ予測の出力ディレクトリ内で結果が入るファイル名の末尾
+PREDICTIONS_SUFFIX = "predictions.jsonl"
+
+
+class BatchPredictionError(RuntimeError):
+    """バッチ予測ジョブが失敗した、または待機時間内に終わらなかった。"""
+
+
+def split_gcs_uri(uri):
+    """gs://bucket/path を (bucket, path) に分解する。"""
+    if not uri or not uri.startswith("gs://"):
+        raise ValueError(f"Not a GCS URI: {uri}")
+    bucket, _, path = uri[len("gs://") :].partition("/")
+    return bucket, path
+
+
+def build_batch_requests(prompts):
+    """{キー: プロンプト} をバッチ予測の入力 JSONL に変換する。"""
+    lines = []
+    for key, prompt in prompts.items():
+        request = {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "labels": {REQUEST_KEY_LABEL: str(key)},
+        }
+        lines.append(json.dumps({"request": request}, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+
+def _response_text(response):
+    """出力行の response から候補1件目のテキストを取り出す。無ければ None。"""
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(part.get("text", "") for part in parts)
+    return text or None
+
+
+def _prompt_text(request):
+    contents = (request or {}).get("contents") or []
+    if not contents:
+        return None
+    return "".join(part.get("text", "") for part in contents[0].get("parts") or [])
+
+
+def parse_batch_results(results_jsonl, prompts):
+    """出力 JSONL を {キー: 生成テキスト} に戻す。
+
+    出力の行順は入力と一致しない。labels でキーを引き、labels が落ちていた場合は
+    プロンプト本文で突き合わせる。結果が得られなかったキーは None にする。
+    """
+    results = {key: None for key in prompts}
+    key_by_prompt = {prompt: key for key, prompt in prompts.items()}
+
+    for line in results_jsonl.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Skipping malformed batch output line: {e}")
+            continue
+
+        request = record.get("request") or {}
+        key = (request.get("labels") or {}).get(REQUEST_KEY_LABEL)
+        if key is None:
+            key = key_by_prompt.get(_prompt_text(request))
+        if key is None or key not in results:
+            logger.warning("Batch output line could not be matched to a prompt.")
+            continue
+
+        if record.get("status"):
+            logger.error(f"Batch prediction failed for {key}: {record['status']}")
+            continue
+        results[key] = _response_text(record.get("response"))
+
+    return results
+
+
+class LocalBatchBackend:
+    """プロセス内で生成関数を呼ぶだけの代替バックエンド（テスト・ローカル検証用）。
+
+    generate_fn(prompt) -> str を受け取り、Vertex の出力と同じ形式の JSONL を返す。
+    """
+
+    def __init__(self, generate_fn):
+        self.generate_fn = generate_fn
+        self.submitted = []
+
+    def submit(self, requests_jsonl):
+        self.submitted.append(requests_jsonl)
+        return requests_jsonl
+
+    def wait(self, handle):
+        lines = []
+        for line in handle.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                text = self.generate_fn(_prompt_text(record["request"]))
+                record["response"] = {
+                    "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]
+                }
+                record["status"] = ""
+            except Exception as e:
+                record["status"] = str(e)
+            lines.append(json.dumps(record, ensure_ascii=False))
+        return "\n".join(lines)
+
+
+class VertexBatchBackend:
+    """GCS に入力を置き、Vertex AI の BatchPredictionJob で生成する本番バックエンド。
+
+    gcs_prefix 配下に実行ごとのディレクトリを切り、input.jsonl と output/ を置く。
+    Vertex AI サービスエージェントがこの場所を読み書きできる必要がある。
+    """
+
+    def __init__(
+        self, model_name, gcs_prefix, storage_client, poll_interval_seconds, timeout_seconds
+    ):
+        self.model_name = model_name
+        self.gcs_prefix = gcs_prefix.rstrip("/")
+        self.storage_client = storage_client
+        self.poll_interval_seconds = poll_interval_seconds
+        self.timeout_seconds = timeout_seconds
+
+    def submit(self, requests_jsonl):
+        # バッチモード以外では不要な SDK なので、使うときだけ読み込む
+        from vertexai.batch_prediction import BatchPredictionJob
+
+        run_prefix = f"{self.gcs_prefix}/{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        input_uri = f"{run_prefix}/input.jsonl"
+        bucket_name, path = split_gcs_uri(input_uri)
+        self.storage_client.bucket(bucket_name).blob(path).upload_from_string(
+            requests_jsonl, content_type="application/jsonl"
+        )
+        logger.info(f"Batch input uploaded to: {input_uri}")
+
+        job = BatchPredictionJob.submit(
+            source_model=self.model_name,
+            input_dataset=input_uri,
+            output_uri_prefix=f"{run_prefix}/output",
+        )
+        logger.info(f"Batch prediction job submitted: {job.resource_name}")
+        return job
+
+    def wait(self, job):
+        deadline = time.monotonic() + self.timeout_seconds
+        while not job.has_ended:
+            if time.monotonic() >= deadline:
+                raise BatchPredictionError(
+                    f"Batch prediction job did not finish within {self.timeout_seconds}s: "
+                    f"{job.resource_name}"
+                )
+            time.sleep(self.poll_interval_seconds)
+            job.refresh()
+
+        if not job.has_succeeded:
+            raise BatchPredictionError(f"Batch prediction job failed: {job.error}")
+
+        bucket_name, prefix = split_gcs_uri(job.output_location)
+        outputs = [
+            blob.download_as_text()
+            for blob in self.storage_client.list_blobs(bucket_name, prefix=prefix)
+            if blob.name.endswith(PREDICTIONS_SUFFIX)
+        ]
+        if not outputs:
+            raise BatchPredictionError(f"No predictions found under {job.output_location}")
+        return "\n".join(outputs)
+
+
+def generate_with_batch(prompts, backend):
+    """全プロンプトを1つのバッチとして生成し、{キー: テキスト or None} を返す。
+
+    ジョブ自体が失敗した場合も例外にはせず、全件 None（＝生成失敗）として返す。
+    """
+    if not prompts:
+        return {}
+    try:
+        handle = backend.submit(build_batch_requests(prompts))
+        results = parse_batch_results(backend.wait(handle), prompts)
+    except Exception as e:
+        logger.error(f"Gemini batch prediction failed: {e}")
+        return {key: None for key in prompts}
+
+    succeeded = sum(1 for text in results.values() if text is not None)
+    logger.info(f"Batch prediction finished: {succeeded}/{len(prompts)} prompts succeeded.")
+    return results
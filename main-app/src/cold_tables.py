@@ -0,0 +1,93 @@
+"""長期間読まれていない大きなテーブル（未使用・コールドテーブル）。
+
+ストレージの費用は、誰も読んでいないテーブルが大半を占めていることが多い。
+sql/cold_tables.sql が JOBS の referenced_tables からテーブルごとの最後の読み取りを集計し、
+TABLE_STORAGE のサイズと突き合わせて、一定期間読まれていないテーブルだけを返す
+（テーブル数の多いプロジェクトでも、集計は BigQuery 側で済ませる）。ここでは
+データセットの料金モデルでの月額を storage_pricing と同じ単価で計算し、高い順に並べる。
+"""
+
+from dataclasses import dataclass
+
+from storage_pricing import PHYSICAL, TableStorage, prices_for
+
+_GIB = 2**30
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+@dataclass
+class ColdTable:
+    storage: TableStorage
+    billing_model: str
+    monthly_cost: float  # 今の料金モデルでの月額（USD）
+    last_read: object  # datetime | None（調査した期間に読まれていなければ None）
+    last_modified: object  # datetime | None
+    read_jobs: int
+
+    @property
+    def name(self):
+        return f"{self.storage.dataset}.{self.storage.table}"
+
+    @property
+    def size_bytes(self):
+        if self.billing_model == PHYSICAL:
+            return self.storage.physical_bytes
+        return self.storage.logical_bytes
+
+
+def find_cold_tables(rows, region):
+    """sql/cold_tables.sql の行から、月額の高い順のコールドテーブル。"""
+    prices, _ = prices_for(region)
+    tables = []
+    for row in rows:
+        storage = TableStorage.from_row(row)
+        billing_model = (_field(row, "billing_model") or "LOGICAL").upper()
+        cost = (
+            storage.physical_cost(prices)
+            if billing_model == PHYSICAL
+            else storage.logical_cost(prices)
+        )
+        tables.append(
+            ColdTable(
+                storage=storage,
+                billing_model=billing_model,
+                monthly_cost=cost,
+                last_read=_field(row, "last_read_time"),
+                last_modified=_field(row, "last_modified_time"),
+                read_jobs=int(_field(row, "read_jobs") or 0),
+            )
+        )
+    return sorted(tables, key=lambda t: t.monthly_cost, reverse=True)
+
+
+def _date(value, missing):
+    return value.strftime("%Y-%m-%d") if value else missing
+
+
+def format_cold_tables(tables, idle_days, lookback_days, max_tables=20):
+    """レポートに載せる Markdown（コールドテーブルの一覧と、まとめて削除したときの削減額）。"""
+    if not tables:
+        return "対象となるコールドテーブルはありませんでした。"
+    never = f"{lookback_days} 日以上なし"
+    lines = [
+        "| テーブル | 最後の読み取り | 最後の更新 | サイズ (GiB) | 料金モデル | 月額 (USD) |",
+        "|---|---|---|--:|---|--:|",
+    ]
+    for table in tables[:max_tables]:
+        lines.append(
+            f"| `{table.name}` | {_date(table.last_read, never)} "
+            f"| {_date(table.last_modified, '-')} | {table.size_bytes / _GIB:,.1f} "
+            f"| {table.billing_model.lower()} | {table.monthly_cost:,.2f} |"
+        )
+    total = sum(t.monthly_cost for t in tables)
+    shown = f"（上位 {max_tables} 件を表示）" if len(tables) > max_tables else ""
+    lines.append(
+        f"\n{idle_days} 日以上読まれていないテーブルが {len(tables)} 件{shown}、"
+        f"月 ${total:,.2f} のストレージ料金がかかっています。不要なら削除、"
+        "残す必要があれば有効期限（expiration_timestamp）の設定や GCS へのエクスポートを検討してください。"
+        "他のプロジェクトからの読み取りは、このプロジェクトのジョブ履歴に残らないため含まれません。"
+    )
+    return "\n".join(lines)
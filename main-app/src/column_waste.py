@@ -0,0 +1,239 @@
+"""SELECT * で読む列の無駄（列単位のスキャン量の見積もり）。
+
+SimpleSelectStar の指摘には、どれだけ無駄に読んでいるかの数字が無かった。BigQuery は
+列指向なので、CTE・サブクエリの SELECT * は外側で使う列だけに絞られるが、結果にそのまま
+出る SELECT * はテーブルの全列を読む。ここでは antipattern_rules と同じ括弧の木で、
+結果まで届く `SELECT * FROM テーブル` を見つけ、クエリ中のほかの場所（絞り込み・JOIN・
+並べ替えなど）で名前が出てこない列を「SELECT * でのみ読まれる列」とする。
+
+列ごとのサイズは BigQuery からは取れないため、get_table の論理バイト数・行数と列の型から
+推定する（固定長の型は型の幅 × 行数、残りを可変長の列で等分）。削減見込みは、推定した
+読み取り量の比率でジョブの課金バイトを参照テーブルに割り振って求める。
+"""
+
+from dataclasses import dataclass, field
+
+from antipattern_rules import (
+    Group,
+    PrescreenError,
+    Token,
+    build_tree,
+    defined_cte_names,
+    group_tokens,
+    is_word,
+    query_blocks,
+    table_path,
+    tokenize,
+)
+from compute_pricing import ON_DEMAND_USD_PER_TIB
+from partition_pruning import match_table
+
+# 固定長の型の1値あたりのバイト数（BigQuery のデータサイズの計算方法）
+_FIXED_WIDTHS = {
+    "INT64": 8,
+    "INTEGER": 8,
+    "FLOAT64": 8,
+    "FLOAT": 8,
+    "NUMERIC": 16,
+    "BIGNUMERIC": 32,
+    "BOOL": 1,
+    "BOOLEAN": 1,
+    "DATE": 8,
+    "DATETIME": 8,
+    "TIME": 8,
+    "TIMESTAMP": 8,
+    "INTERVAL": 16,
+}
+_TIB = 2**40
+
+
+def column_sizes(table):
+    """列ごとの推定バイト数 {列名: バイト数}。テーブルのサイズが分からなければ None。"""
+    if not table.num_bytes or not table.columns:
+        return None
+    rows = table.num_rows or 0
+    fixed = {
+        name: _FIXED_WIDTHS[(data_type or "").upper()] * rows
+        for name, data_type in table.columns
+        if (data_type or "").upper() in _FIXED_WIDTHS
+    }
+    fixed_total = sum(fixed.values())
+    if fixed_total > table.num_bytes:
+        # NULL の多い列は型の幅より小さい。全体に収まるよう縮める
+        fixed = {name: size * table.num_bytes / fixed_total for name, size in fixed.items()}
+        fixed_total = table.num_bytes
+    variable = [name for name, _ in table.columns if name not in fixed]
+    share = (table.num_bytes - fixed_total) / len(variable) if variable else 0.0
+    return {name: fixed.get(name, share) for name, _ in table.columns}
+
+
+def _outer_selects_star(root):
+    """最上位の SELECT（UNION のいずれか）が SELECT * か。"""
+    items = root.items
+    for i, item in enumerate(items):
+        if not is_word(item, "SELECT"):
+            continue
+        j = i + 1
+        if j < len(items) and is_word(items[j], "DISTINCT", "ALL"):
+            j += 1
+        if j < len(items) and isinstance(items[j], Token) and items[j].text == "*":
+            return True
+    return False
+
+
+def _star_sites(root, cte_names):
+    """結果まで届く `SELECT * FROM テーブル` を [(テーブルパス, EXCEPT で除く列, 行)] で返す。"""
+    reaches_output = _outer_selects_star(root)
+    sites = []
+    for block in query_blocks(root):
+        if block is not root and not reaches_output:
+            # 外側で列を選んでいれば、BigQuery が使う列だけに絞る
+            continue
+        items = block.items
+        for i, item in enumerate(items):
+            if not is_word(item, "SELECT"):
+                continue
+            j = i + 1
+            if j < len(items) and is_word(items[j], "DISTINCT", "ALL"):
+                j += 1
+            if not (j < len(items) and isinstance(items[j], Token) and items[j].text == "*"):
+                continue
+            j += 1
+            excluded = set()
+            while j + 1 < len(items) and is_word(items[j], "EXCEPT", "REPLACE"):
+                if not isinstance(items[j + 1], Group):
+                    break
+                if is_word(items[j], "EXCEPT"):
+                    excluded |= {
+                        t.name for t in group_tokens(items[j + 1]) if t.kind in ("word", "quoted")
+                    }
+                j += 2
+            if not (j < len(items) and is_word(items[j], "FROM")):
+                continue
+            path, _ = table_path(items, j + 1)
+            if path and path.lower() not in cte_names:
+                sites.append((path, excluded, item.line))
+    return sites
+
+
+@dataclass
+class StarScan:
+    """結果まで届く SELECT * の参照1つの見積もり。"""
+
+    table: str
+    line: int
+    read_columns: int
+    read_bytes: float  # SELECT * で読む列の推定バイト数（テーブル全体）
+    unused: list  # SELECT * でのみ読まれる列 [(列名, 推定バイト数)]（大きい順）
+    saved_bytes: float = 0.0  # このジョブの課金バイトに換算した削減見込み
+
+    @property
+    def unused_bytes(self):
+        return sum(size for _, size in self.unused)
+
+    def as_dict(self):
+        return {
+            "table": self.table,
+            "line": self.line,
+            "read_columns": self.read_columns,
+            "unused_columns": [name for name, _ in self.unused],
+            "unused_bytes": round(self.unused_bytes),
+            "saved_bytes": round(self.saved_bytes),
+        }
+
+
+@dataclass
+class ColumnWasteReport:
+    """クエリ1件の見積もり。decided が False ならクエリを解析できなかった。"""
+
+    decided: bool
+    scans: list = field(default_factory=list)
+    reason: str = ""
+
+    @property
+    def has_facts(self):
+        return any(scan.unused for scan in self.scans)
+
+    @property
+    def saved_bytes(self):
+        return sum(scan.saved_bytes for scan in self.scans)
+
+    def facts(self):
+        """レポートに載せる箇条書き。"""
+        lines = []
+        for scan in self.scans:
+            if not scan.unused:
+                continue
+            share = scan.unused_bytes / scan.read_bytes if scan.read_bytes else 0.0
+            top = "、".join(f"`{name}`（{_gib(size)} GiB）" for name, size in scan.unused[:5])
+            lines.append(
+                f"- `{scan.table}`（{scan.line} 行目）: SELECT * で {scan.read_columns} 列"
+                f"（推定 {_gib(scan.read_bytes)} GiB）を読み、そのうち {len(scan.unused)} 列"
+                f"（推定 {_gib(scan.unused_bytes)} GiB、{share:.0%}）はクエリ中のほかの場所で"
+                f"使われていません。大きい列: {top}"
+            )
+        saved = self.saved_bytes
+        lines.append(
+            f"- 使う列だけを選ぶと、このジョブで約 {_gib(saved)} GiB"
+            f"（オンデマンド料金で ${saved / _TIB * ON_DEMAND_USD_PER_TIB:,.2f}）の削減見込みです"
+            "（列のサイズは型とテーブルのサイズからの推定）。"
+        )
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {
+            "decided": self.decided,
+            "reason": self.reason,
+            "saved_bytes": round(self.saved_bytes),
+            "tables": [scan.as_dict() for scan in self.scans],
+        }
+
+
+def _gib(value):
+    return f"{value / 2**30:,.1f}"
+
+
+def estimate_column_waste(sql, tables, billed_bytes):
+    """SELECT * でのみ読まれる列と、ジョブの課金バイトに換算した削減見込み。"""
+    try:
+        tokens = tokenize(sql)
+        root = build_tree(tokens)
+    except PrescreenError as e:
+        return ColumnWasteReport(False, reason=str(e))
+    sites = _star_sites(root, defined_cte_names(root))
+    # クエリ中に名前が出てくる列は使われているとみなす
+    names = {t.name for t in tokens if t.kind in ("word", "quoted")}
+
+    sized = [(t, column_sizes(t)) for t in tables if not t.error]
+    sized = [(t, sizes) for t, sizes in sized if sizes]
+    scans = []
+    star_tables = set()
+    for path, excluded, line in sites:
+        table = match_table(path, [t for t, _ in sized])
+        if table is None or table.name in star_tables:
+            continue
+        star_tables.add(table.name)
+        sizes = next(s for t, s in sized if t is table)
+        read = {name: size for name, size in sizes.items() if name.lower() not in excluded}
+        unused = sorted(
+            ((name, size) for name, size in read.items() if name.lower() not in names),
+            key=lambda c: c[1],
+            reverse=True,
+        )
+        scans.append(StarScan(table.name, line, len(read), sum(read.values()), unused))
+
+    # ジョブの課金バイトを、推定した読み取り量の比率で参照テーブルに割り振る
+    reads = {}
+    for table, sizes in sized:
+        scan = next((s for s in scans if s.table == table.name), None)
+        if scan is not None:
+            reads[table.name] = scan.read_bytes
+        else:
+            reads[table.name] = sum(size for name, size in sizes.items() if name.lower() in names)
+    total_read = sum(reads.values())
+    for scan in scans:
+        if not total_read or not scan.read_bytes:
+            continue
+        attributed = billed_bytes * reads[scan.table] / total_read
+        scan.saved_bytes = min(attributed * scan.unused_bytes / scan.read_bytes, scan.unused_bytes)
+    return ColumnWasteReport(True, scans)
@@ -0,0 +1,241 @@
+"""コンピュート料金モデル（オンデマンド vs Editions の予約）の試算。
+
+ストレージには料金モデルの判定（analyze_storage_pricing）があるが、クエリの
+料金には無かった。調査期間のジョブ履歴（sql/compute_pricing.sql）から、
+オンデマンドの課金バイトと1分ごとのスロット使用量を求め、Editions の予約を
+ベースライン・自動スケーリングの上限を変えて試算し、最も安い構成と月あたりの
+差額を示す。
+
+1分ごとの使用量は自動スケーリングの単位（50 スロット）に切り上げてから昇順に並べ、
+累積和を持っておく。構成ごとの自動スケーリング分は二分探索と累積和で求まるため、
+分の数（30日で約4.3万）に比例する計算は最初の一度だけで済む。
+"""
+
+import bisect
+import math
+from dataclasses import dataclass, field
+from itertools import accumulate
+
+# 米国マルチリージョンの定価（USD）。実際の単価はリージョン・契約によって異なる。
+ON_DEMAND_USD_PER_TIB = 6.25
+# 自動スケーリングはこの単位で増減し、1分単位で課金される
+AUTOSCALE_INCREMENT = 50
+MONTH_MINUTES = 30 * 24 * 60
+# 上限を超えた需要（待ちになる分）がこの割合以下の構成だけを推奨する
+MAX_OVER_CAPACITY_SHARE = 0.01
+
+
+@dataclass(frozen=True)
+class Edition:
+    name: str
+    usd_per_slot_hour: float
+    commit_usd_per_slot_hour: float | None  # 1年コミットの単価（コミットできなければ None）
+    allows_baseline: bool
+    max_slots: int | None  # 予約あたりの上限（無ければ None）
+
+
+EDITIONS = (
+    Edition("Standard", 0.04, None, False, 1600),
+    Edition("Enterprise", 0.06, 0.048, True, None),
+    Edition("Enterprise Plus", 0.10, 0.08, True, None),
+)
+
+
+def _round_up(slots):
+    return math.ceil(slots / AUTOSCALE_INCREMENT) * AUTOSCALE_INCREMENT
+
+
+def _round_down(slots):
+    return math.floor(slots / AUTOSCALE_INCREMENT) * AUTOSCALE_INCREMENT
+
+
+class SlotDemand:
+    """期間中の1分ごとのスロット需要（自動スケーリングの単位に切り上げ済み）。"""
+
+    def __init__(self, minute_slots, period_minutes):
+        self.minutes = sorted(_round_up(float(s)) for s in minute_slots if s)
+        self.period_minutes = max(int(period_minutes or 0), len(self.minutes))
+        self._prefix = [0, *accumulate(self.minutes)]
+
+    @property
+    def total_slot_minutes(self):
+        return self._prefix[-1]
+
+    @property
+    def peak(self):
+        return self.minutes[-1] if self.minutes else 0
+
+    def quantile(self, q, active_only=False):
+        """需要の分位点。active_only でなければ使用量の無い分（0）も含める。"""
+        if not self.minutes:
+            return 0
+        idle = 0 if active_only else self.period_minutes - len(self.minutes)
+        rank = math.ceil(q * (idle + len(self.minutes))) - 1
+        return self.minutes[rank - idle] if rank >= idle else 0
+
+    def _sum_between(self, low, high):
+        """low < 需要 <= high の分の (件数, 需要の合計)。"""
+        i = bisect.bisect_right(self.minutes, low)
+        k = bisect.bisect_right(self.minutes, high)
+        return k - i, self._prefix[k] - self._prefix[i]
+
+    def autoscale_slot_minutes(self, baseline, max_slots):
+        """ベースラインを超え、上限までの需要の合計（自動スケーリングで課金されるスロット分）。"""
+        count, total = self._sum_between(baseline, max_slots)
+        capped = len(self.minutes) - bisect.bisect_right(self.minutes, max_slots)
+        return total - count * baseline + capped * (max_slots - baseline)
+
+    def over_capacity_share(self, max_slots):
+        """需要のうち上限を超える（待ちになる）スロット分の割合。"""
+        if not self.total_slot_minutes:
+            return 0.0
+        count, total = self._sum_between(max_slots, math.inf)
+        return (total - count * max_slots) / self.total_slot_minutes
+
+
+@dataclass
+class ReservationPlan:
+    edition: str
+    baseline_slots: int
+    max_slots: int
+    committed: bool  # ベースラインを1年コミットで契約するか
+    monthly_usd: float
+    over_capacity_share: float
+
+
+@dataclass
+class PricingSimulation:
+    period_minutes: int
+    job_count: int
+    billed_bytes: int
+    reserved_slot_share: float
+    on_demand_monthly_usd: float
+    plans: list = field(default_factory=list)  # 月額の安い順
+
+    @property
+    def best(self):
+        """上限を超える需要が許容範囲内の構成のうち、最も安いもの。"""
+        return next(
+            (p for p in self.plans if p.over_capacity_share <= MAX_OVER_CAPACITY_SHARE), None
+        )
+
+    @property
+    def monthly_savings_usd(self):
+        best = self.best
+        return self.on_demand_monthly_usd - best.monthly_usd if best else 0.0
+
+
+def _candidates(demand):
+    """試算するベースラインと上限の候補。"""
+    baselines = {0} | {_round_down(demand.quantile(q)) for q in (0.5, 0.75, 0.9, 0.95)}
+    maxima = {demand.quantile(q, active_only=True) for q in (0.95, 0.99)} | {demand.peak}
+    return sorted(baselines), sorted(m for m in maxima if m > 0)
+
+
+def plan_cost(demand, edition, baseline, max_slots, committed):
+    """1か月（30日）あたりの料金。ベースラインは常時、自動スケーリング分は使った分だけ課金。"""
+    scale = MONTH_MINUTES / demand.period_minutes
+    baseline_rate = edition.commit_usd_per_slot_hour if committed else edition.usd_per_slot_hour
+    baseline_usd = baseline * baseline_rate * MONTH_MINUTES / 60
+    autoscale = demand.autoscale_slot_minutes(baseline, max_slots)
+    return baseline_usd + autoscale / 60 * edition.usd_per_slot_hour * scale
+
+
+def simulate(minute_slots, period_minutes, billed_bytes, job_count=0, reserved_slot_share=0.0):
+    """オンデマンドと Editions の各構成の月額を試算する。"""
+    demand = SlotDemand(minute_slots, period_minutes)
+    simulation = PricingSimulation(
+        period_minutes=demand.period_minutes,
+        job_count=int(job_count or 0),
+        billed_bytes=int(billed_bytes or 0),
+        reserved_slot_share=float(reserved_slot_share or 0),
+        on_demand_monthly_usd=0.0,
+    )
+    if not demand.period_minutes:
+        return simulation
+    simulation.on_demand_monthly_usd = (
+        simulation.billed_bytes
+        / 2**40
+        * ON_DEMAND_USD_PER_TIB
+        * MONTH_MINUTES
+        / demand.period_minutes
+    )
+    baselines, maxima = _candidates(demand)
+    for edition in EDITIONS:
+        for max_slots in maxima:
+            if edition.max_slots and max_slots > edition.max_slots:
+                continue
+            for baseline in baselines if edition.allows_baseline else [0]:
+                if baseline > max_slots:
+                    continue
+                for committed in (False, True) if edition.commit_usd_per_slot_hour else (False,):
+                    if committed and not baseline:
+                        continue
+                    simulation.plans.append(
+                        ReservationPlan(
+                            edition=edition.name,
+                            baseline_slots=baseline,
+                            max_slots=max_slots,
+                            committed=committed,
+                            monthly_usd=plan_cost(demand, edition, baseline, max_slots, committed),
+                            over_capacity_share=demand.over_capacity_share(max_slots),
+                        )
+                    )
+    simulation.plans.sort(key=lambda p: p.monthly_usd)
+    return simulation
+
+
+def _plan_label(plan):
+    contract = "1年コミット" if plan.committed else "従量"
+    return (
+        f"{plan.edition}（ベースライン {plan.baseline_slots} / 上限 {plan.max_slots} スロット、"
+        f"ベースラインは{contract}）"
+    )
+
+
+def format_pricing(simulation, max_plans=5):
+    """レポートに載せる Markdown（オンデマンドと最安の構成の比較、安い順の構成の表）。"""
+    if not simulation.plans:
+        return "対象となるクエリの実行履歴がありませんでした。"
+    days = simulation.period_minutes / (24 * 60)
+    lines = [
+        f"- 調査期間: {days:,.1f} 日（クエリ {simulation.job_count:,} 件）。"
+        "月額は30日あたりに換算しています。",
+        f"- オンデマンド: ${simulation.on_demand_monthly_usd:,.2f} / 月"
+        f"（課金 {simulation.billed_bytes / 2**40:,.2f} TiB）",
+    ]
+    best = simulation.best
+    if best is None:
+        lines.append("- 上限を超える需要を許容範囲に収める Editions の構成がありませんでした。")
+    elif simulation.monthly_savings_usd > 0:
+        lines.append(
+            f"- **最安の構成: {_plan_label(best)} ${best.monthly_usd:,.2f} / 月"
+            f"（オンデマンドより月 ${simulation.monthly_savings_usd:,.2f} の削減見込み）**"
+        )
+    else:
+        lines.append(
+            f"- **オンデマンドのままが安い見込みです**（Editions の最安は {_plan_label(best)} "
+            f"${best.monthly_usd:,.2f} / 月）"
+        )
+    if simulation.reserved_slot_share:
+        lines.append(
+            f"- 期間中のスロット使用量の {simulation.reserved_slot_share:.0%} は既存の予約で"
+            "実行されています（そのジョブは処理バイトでオンデマンドの料金を試算しています）。"
+        )
+    lines += [
+        "",
+        "| エディション | ベースライン | 上限 | ベースラインの契約 | 月額 (USD) | 上限を超える需要 |",
+        "|---|--:|--:|---|--:|--:|",
+    ]
+    eligible = [p for p in simulation.plans if p.over_capacity_share <= MAX_OVER_CAPACITY_SHARE]
+    for plan in (eligible or simulation.plans)[:max_plans]:
+        lines.append(
+            f"| {plan.edition} | {plan.baseline_slots} | {plan.max_slots} "
+            f"| {'1年コミット' if plan.committed else '従量'} | {plan.monthly_usd:,.2f} "
+            f"| {plan.over_capacity_share:.1%} |"
+        )
+    lines.append(
+        "\n米国マルチリージョンの定価で試算しています。実際の単価はリージョン・契約により異なり、"
+        "オンデマンドの無料枠は考慮していません。上限を超える需要は待ちになり、実行時間が延びます。"
+    )
+    return "\n".join(lines)
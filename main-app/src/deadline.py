@@ -0,0 +1,57 @@
+"""実行全体の持ち時間（デッドライン）の管理。
+
+Cloud Run Job にはタスクタイムアウトがあり、超えるとコンテナごと停止されて
+レポートも summary.json も残らない。実行開始時に持ち時間を決め、各ステージの
+タイムアウトを残り時間から割り当てることで、最後の保存処理の時間を必ず残す。
+残りが少ないときは下位のクエリから Gemini を省略（構文解析のみ）→ 解析自体を省略、
+の順に段階的に縮退させる。
+"""
+
+import time
+
+# 残り時間が尽きかけていても、API 呼び出しに渡すタイムアウトはこれ未満にしない
+MIN_TIMEOUT_SECONDS = 1.0
+
+# 1クエリ分の解析をどこまで行うか（degradation_level の戻り値）
+FULL = "full"  # スキーマ取得・構文解析・Gemini の全て
+ANTIPATTERN_ONLY = "antipattern_only"  # Gemini を省略し構文解析の指摘のみ
+SKIP = "skip"  # 解析自体を省略
+
+
+class RunDeadline:
+    """実行の持ち時間。reserve_seconds はレポート保存用に最後まで手を付けない分。"""
+
+    def __init__(self, total_seconds, reserve_seconds=0, clock=time.monotonic):
+        self.total_seconds = total_seconds
+        self.reserve_seconds = reserve_seconds
+        self._clock = clock
+        self._expires_at = clock() + total_seconds - reserve_seconds
+
+    def remaining(self):
+        """作業に使える残り秒数（保存用の予約分を除く）。負にはならない。"""
+        return max(0.0, self._expires_at - self._clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        """seconds 秒かかる処理を始めても予約分に食い込まないか。"""
+        return self.remaining() >= seconds
+
+    def timeout(self, default, keep_seconds=0):
+        """default 秒を上限に、残り時間（から keep_seconds 秒を残した分）に収まるタイムアウト値を返す。"""
+        return max(MIN_TIMEOUT_SECONDS, min(default, self.remaining() - keep_seconds))
+
+
+def stage_timeout(deadline, default, keep_seconds=0):
+    """deadline が無ければ default をそのまま返す（単体での呼び出し用）。"""
+    return deadline.timeout(default, keep_seconds) if deadline else default
+
+
+def degradation_level(deadline, llm_seconds, analysis_seconds):
+    """残り時間から、次の1クエリをどこまで解析するかを決める。"""
+    if deadline is None or deadline.allows(llm_seconds):
+        return FULL
+    if deadline.allows(analysis_seconds):
+        return ANTIPATTERN_ONLY
+    return SKIP
@@ -0,0 +1,313 @@
+"""ワークロードからのパーティション列・クラスタリング列の推奨。
+
+スキーマ情報（fetch_table_metadata）からテーブルが分割・クラスタリングされているかは
+分かるが、実際にどの列で絞り込まれているかは見ていなかった。調査期間にスキャン量の
+多かったテーブルごとに、そのテーブルを読むクエリ（sql/table_workload.sql）を
+partition_pruning.column_usage で読み、列ごとに「絞り込み（等値・範囲）・JOIN に
+使われたクエリの課金バイト」の索引を作る。そこからパーティション列（日付・時刻の列）と
+クラスタリング列（最大4列）を選び、スキャン量の削減を見積もる。
+
+削減の見積もりは概算で、パーティション列で絞り込むクエリは読む量が
+PARTITION_SCAN_REDUCTION、クラスタリング列で絞り込むクエリは
+CLUSTER_SCAN_REDUCTION だけ減るとみなす（実際の削減は値の分布と絞り込む範囲による）。
+"""
+
+from dataclasses import dataclass, field
+
+from partition_pruning import (
+    EQUALITY,
+    INGESTION_TIME_COLUMNS,
+    JOIN_KEY,
+    OTHER_FILTER,
+    RANGE,
+    column_usage,
+)
+
+# 絞り込みで読む量が減る割合の仮定
+PARTITION_SCAN_REDUCTION = 0.8
+CLUSTER_SCAN_REDUCTION = 0.5
+MAX_CLUSTERING_COLUMNS = 4
+
+# パーティション列にできる型と PARTITION BY の式
+_PARTITION_EXPRESSIONS = {
+    "DATE": "{column}",
+    "TIMESTAMP": "DATE({column})",
+    "DATETIME": "DATETIME_TRUNC({column}, DAY)",
+}
+# 日単位以外の時間単位の分割（HOUR・MONTH・YEAR）で列を切り詰める関数
+_TRUNC_FUNCTIONS = {
+    "DATE": "DATE_TRUNC",
+    "TIMESTAMP": "TIMESTAMP_TRUNC",
+    "DATETIME": "DATETIME_TRUNC",
+}
+# クラスタリング列にできる型
+_CLUSTERABLE_TYPES = frozenset(
+    {"STRING", "INTEGER", "INT64", "NUMERIC", "BIGNUMERIC", "BOOLEAN", "BOOL"}
+    | {"DATE", "DATETIME", "TIMESTAMP", "GEOGRAPHY"}
+)
+_KIND_LABELS = {EQUALITY: "等値", RANGE: "範囲", OTHER_FILTER: "その他の条件", JOIN_KEY: "JOIN"}
+# クラスタリング列の順位付けの重み（等値・JOIN の条件はブロックの絞り込みが効きやすい）
+_CLUSTER_WEIGHTS = {EQUALITY: 1.0, JOIN_KEY: 1.0, RANGE: 0.5, OTHER_FILTER: 0.25}
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def current_partition_expression(table):
+    """今のテーブルの分割を再現する PARTITION BY の式。分割なし・再現できなければ None。
+
+    取り込み時間分割（_PARTITIONTIME）は列ではないため、式にできない。
+    """
+    column = table.partition_column
+    if not column or column.lower() in INGESTION_TIME_COLUMNS:
+        return None
+    if table.partition_type == "RANGE":
+        if not table.partition_range:
+            return None
+        start, end, interval = table.partition_range
+        return f"RANGE_BUCKET({column}, GENERATE_ARRAY({start}, {end}, {interval}))"
+    types = {name.lower(): (data_type or "").upper() for name, data_type in table.columns}
+    data_type = types.get(column.lower())
+    unit = (table.partition_type or "DAY").upper()
+    if data_type not in _TRUNC_FUNCTIONS:
+        return None
+    if unit == "DAY":
+        return _PARTITION_EXPRESSIONS[data_type].format(column=column)
+    return f"{_TRUNC_FUNCTIONS[data_type]}({column}, {unit})"
+
+
+@dataclass
+class ColumnStats:
+    """列ごとの、使われ方別のクエリの課金バイト。"""
+
+    name: str
+    data_type: str | None
+    bytes_by_kind: dict = field(default_factory=dict)
+
+    @property
+    def filter_bytes(self):
+        return sum(v for k, v in self.bytes_by_kind.items() if k != JOIN_KEY)
+
+    @property
+    def cluster_score(self):
+        return sum(_CLUSTER_WEIGHTS[k] * v for k, v in self.bytes_by_kind.items())
+
+
+@dataclass
+class TableWorkload:
+    """1テーブルを読むクエリの、列の使われ方の索引。"""
+
+    table: object  # TableMetadata
+    billed_bytes: float
+    runs: int
+    analyzed_bytes: float = 0.0  # 解析できたクエリの課金バイト
+    columns: dict = field(default_factory=dict)  # {列名（小文字）: ColumnStats}
+    shapes: list = field(default_factory=list)  # [(課金バイト, 絞り込みに使った列の集合)]
+
+    def add_query(self, query, billed_bytes):
+        uses = column_usage(query, [self.table])
+        if uses is None:
+            return
+        self.analyzed_bytes += billed_bytes
+        types = {name.lower(): data_type for name, data_type in self.table.columns}
+        filtered = set()
+        for use in uses:
+            if use.table != self.table.name:
+                continue
+            stats = self.columns.setdefault(
+                use.column, ColumnStats(use.column, types.get(use.column))
+            )
+            stats.bytes_by_kind[use.kind] = stats.bytes_by_kind.get(use.kind, 0) + billed_bytes
+            if use.kind != JOIN_KEY:
+                filtered.add(use.column)
+        self.shapes.append((billed_bytes, filtered))
+
+    @property
+    def coverage(self):
+        return self.analyzed_bytes / self.billed_bytes if self.billed_bytes else 0.0
+
+    def read_share(self, partition_column, clustering):
+        """その配置のとき、解析できたクエリが読む量の割合（分割・クラスタリングなしを 1 とする）。"""
+        if not self.analyzed_bytes:
+            return 1.0
+        clustering = {c.lower() for c in clustering}
+        read = 0.0
+        for billed, filtered in self.shapes:
+            share = 1.0
+            if partition_column and partition_column.lower() in filtered:
+                share *= 1 - PARTITION_SCAN_REDUCTION
+            if clustering & filtered:
+                share *= 1 - CLUSTER_SCAN_REDUCTION
+            read += billed * share
+        return read / self.analyzed_bytes
+
+
+@dataclass
+class KeyRecommendation:
+    workload: TableWorkload
+    partition_column: str | None
+    partition_expression: str | None
+    clustering: list
+    saved_bytes: float  # 調査期間の課金バイトの削減見込み
+
+    @property
+    def table(self):
+        return self.workload.table
+
+    @property
+    def changed(self):
+        # partition_expression が None なら今の分割（列・単位とも）のまま
+        current_clustering = [c.lower() for c in self.table.clustering_fields]
+        return self.saved_bytes > 0 and (
+            self.partition_expression is not None
+            or [c.lower() for c in self.clustering] != current_clustering
+        )
+
+    @property
+    def ingestion_time_partitioned(self):
+        column = (self.table.partition_column or "").lower()
+        return column in INGESTION_TIME_COLUMNS
+
+    def ddl(self):
+        """新しい配置でテーブルを作り直す DDL（現在のテーブルからコピー）。
+
+        取り込み時間分割のテーブル（SELECT * では _PARTITIONTIME を引き継げない）と、
+        今の分割を式にできないテーブルでは None。
+        """
+        if self.ingestion_time_partitioned:
+            return None
+        partition = self.partition_expression
+        if partition is None and self.partition_column:
+            partition = current_partition_expression(self.table)
+            if partition is None:
+                return None
+        lines = [f"CREATE TABLE `{self.table.name}_new`"]
+        if partition:
+            lines.append(f"PARTITION BY {partition}")
+        if self.clustering:
+            lines.append(f"CLUSTER BY {', '.join(self.clustering)}")
+        lines.append(f"AS SELECT * FROM `{self.table.name}`;")
+        return "\n".join(lines)
+
+
+def build_workload(row, table):
+    """sql/table_workload.sql の1行（テーブル1つ）から列の使われ方の索引を作る。"""
+    workload = TableWorkload(
+        table=table,
+        billed_bytes=float(_field(row, "billed_bytes") or 0),
+        runs=int(_field(row, "runs") or 0),
+    )
+    for entry in _field(row, "queries") or []:
+        workload.add_query(_field(entry, "query"), float(_field(entry, "billed_bytes") or 0))
+    return workload
+
+
+def _original_name(table, column):
+    return next((name for name, _ in table.columns if name.lower() == column), column)
+
+
+def recommend(workload):
+    """ワークロードに合うパーティション列・クラスタリング列と、削減見込み。"""
+    table = workload.table
+    partition_column = partition_expression = None
+    candidates = [
+        s
+        for s in workload.columns.values()
+        if (s.data_type or "").upper() in _PARTITION_EXPRESSIONS and s.filter_bytes
+    ]
+    best = max(candidates, key=lambda s: s.filter_bytes, default=None)
+    if best and best.name not in table.partition_columns:
+        partition_column = _original_name(table, best.name)
+        partition_expression = _PARTITION_EXPRESSIONS[best.data_type.upper()].format(
+            column=partition_column
+        )
+    elif table.partition_column:
+        # 日付・時刻の列での絞り込みが無いか、今の分割列が最適なら、今の分割（単位も）を変えない
+        partition_column = table.partition_column
+    ranked = sorted(
+        (
+            s
+            for s in workload.columns.values()
+            if (s.data_type or "").upper() in _CLUSTERABLE_TYPES
+            and s.name != (partition_column or "").lower()
+            and s.cluster_score
+        ),
+        key=lambda s: s.cluster_score,
+        reverse=True,
+    )
+    clustering = [_original_name(table, s.name) for s in ranked[:MAX_CLUSTERING_COLUMNS]]
+    current = workload.read_share(table.partition_column, table.clustering_fields)
+    proposed = workload.read_share(partition_column, clustering)
+    saved = max(current - proposed, 0.0) * workload.analyzed_bytes
+    return KeyRecommendation(workload, partition_column, partition_expression, clustering, saved)
+
+
+# ==========================================
+# レポート
+# ==========================================
+
+
+def _gib(value):
+    return f"{value / 2**30:,.1f}"
+
+
+def _layout(partition_column, clustering):
+    partition = f"`{partition_column}`" if partition_column else "なし"
+    cluster = ", ".join(f"`{c}`" for c in clustering) or "なし"
+    return f"分割 {partition} / クラスタ {cluster}"
+
+
+def format_recommendations(recommendations, max_ddl=3):
+    """レポートに載せる Markdown（テーブルごとの現状と推奨の表、作り直しの DDL）。"""
+    if not recommendations:
+        return "対象となるテーブルのワークロードがありませんでした。"
+    lines = [
+        "| テーブル | 課金 (GiB) | 解析できた割合 | 現在の配置 | 推奨する配置 | 削減見込み (GiB) |",
+        "|---|--:|--:|---|---|--:|",
+    ]
+    for rec in recommendations:
+        table = rec.table
+        proposal = (
+            _layout(rec.partition_column, rec.clustering) if rec.changed else "現在のままで良い"
+        )
+        lines.append(
+            f"| `{table.name}` | {_gib(rec.workload.billed_bytes)} | {rec.workload.coverage:.0%} "
+            f"| {_layout(table.partition_column, table.clustering_fields)} | {proposal} "
+            f"| {_gib(rec.saved_bytes) if rec.changed else '-'} |"
+        )
+    for rec in [r for r in recommendations if r.changed][:max_ddl]:
+        used = sorted(
+            rec.workload.columns.values(),
+            key=lambda s: s.filter_bytes + s.cluster_score,
+            reverse=True,
+        )
+        usage = "、".join(
+            f"`{_original_name(rec.table, s.name)}`（"
+            + " / ".join(
+                f"{_KIND_LABELS[kind]} {_gib(v)} GiB" for kind, v in sorted(s.bytes_by_kind.items())
+            )
+            + "）"
+            for s in used[:5]
+        )
+        lines += ["", f"**`{rec.table.name}`**: よく使われる条件の列 {usage}", ""]
+        ddl = rec.ddl()
+        if ddl:
+            lines += ["```sql", ddl, "```"]
+        elif rec.ingestion_time_partitioned:
+            lines.append(
+                "取り込み時間で分割されたテーブルは、CREATE TABLE AS SELECT では各行の"
+                " `_PARTITIONTIME` を引き継げないため、作り直しの DDL は載せていません。"
+                "クラスタリング列は `bq update --clustering_fields` で変更できます"
+                "（変更後に書き込まれるデータから効きます）。"
+            )
+        else:
+            lines.append(
+                "今の分割の設定を DDL で再現できないため、作り直しの DDL は載せていません。"
+            )
+    lines.append(
+        "\n課金バイトは、複数のテーブルを読むクエリでは参照テーブルで等分しています。"
+        f"削減見込みは、パーティション列で絞り込むクエリの読み取りが {PARTITION_SCAN_REDUCTION:.0%}、"
+        f"クラスタリング列で絞り込むクエリの読み取りが {CLUSTER_SCAN_REDUCTION:.0%} 減るとみなした概算です。"
+    )
+    return "\n".join(lines)
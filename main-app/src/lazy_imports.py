@@ -0,0 +1,47 @@
+"""重い SDK の遅延 import。
+
+vertexai（aiplatform）・google-cloud-bigquery・google-cloud-storage・requests は
+import だけで合計数秒かかる。Cloud Run Job はテナントごとに毎回コールドスタートするため、
+モジュール読み込み時には名前だけを用意し、属性に初めて触れたときに本体を import する。
+テストやベンチマークからの差し替え（setattr）も本体のモジュールにそのまま届く。
+"""
+
+import importlib
+
+
+class LazyModule:
+    """属性に初めて触れたときに import するモジュールの代理。"""
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = object.__getattribute__(self, "_module")
+        if module is None:
+            # import 自体はモジュール単位でロックされるため、複数スレッドから同時に
+            # 触れても同じモジュールが返る（ここで全体をロックすると並行 import を妨げる）
+            module = importlib.import_module(object.__getattribute__(self, "_name"))
+            object.__setattr__(self, "_module", module)
+        return module
+
+    @property
+    def loaded(self):
+        return object.__getattribute__(self, "_module") is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyModule {object.__getattribute__(self, '_name')} ({state})>"
+
+
+def lazy_module(name):
+    return LazyModule(name)
@@ -1,19 +1,71 @@
 import datetime
+import io
 import json
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import lru_cache
 
 import google.auth
-import google.auth.transport.requests
-import google.oauth2.id_token
-import requests
-import vertexai
 from dotenv import load_dotenv
-from google.api_core.exceptions import Forbidden, NotFound
-from google.cloud import bigquery, storage
-from vertexai.generative_models import GenerativeModel
+
+from antipattern_census import build_shapes, format_census, run_census
+from antipattern_rules import Screening, prescreen
+from batch_prediction import VertexBatchBackend, generate_with_batch
+from cold_tables import find_cold_tables, format_cold_tables
+from column_waste import estimate_column_waste
+from compute_pricing import format_pricing, simulate
+from deadline import ANTIPATTERN_ONLY, SKIP, RunDeadline, degradation_level, stage_timeout
+from key_advisor import build_workload, format_recommendations, recommend
+from lazy_imports import lazy_module
+from mv_candidates import find_candidates, format_candidates
+from partition_pruning import TableMetadata, verify_pruning
+from query_plan import summarize_plan
+from rewrite_validation import (
+    RewriteCollector,
+    RewriteRejected,
+    qualify_tables,
+    validate_rewrite,
+)
+from sharding import (
+    GcsShardStore,
+    LocalShardStore,
+    ShardContext,
+    cleanup_shards,
+    clear_stale_shards,
+    collect_shard_results,
+    load_manifest,
+    merge_shard_results,
+    publish_manifest,
+    wait_for_manifest,
+    write_shard_result,
+)
+from slot_timeline import format_timeline
+from storage_history import (
+    dump_snapshots,
+    format_trends,
+    history_path,
+    load_snapshots,
+    record_snapshot,
+)
+from storage_pricing import analyze as analyze_storage
+from storage_pricing import format_storage, reportable
+from tracing import drain_spans, enable_otel_export, shutdown_otel, span, summarize_spans
+
+# 重い SDK は初めて使うときに import する（コールドスタート短縮。lazy_imports.py 参照）
+api_exceptions = lazy_module("google.api_core.exceptions")
+auth_transport = lazy_module("google.auth.transport.requests")
+bigquery = lazy_module("google.cloud.bigquery")
+generative_models = lazy_module("vertexai.generative_models")
+oauth2_id_token = lazy_module("google.oauth2.id_token")
+# cProfile / pstats / tracemalloc は PROFILE_MODE のときだけ使う
+profiling = lazy_module("profiling")
+requests = lazy_module("requests")
+storage = lazy_module("google.cloud.storage")
+vertexai = lazy_module("vertexai")
 
 # --- ロギングの設定 ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -43,12 +95,102 @@ TIME_RANGE_START = os.getenv("TIME_RANGE_START")
 TIME_RANGE_END = os.getenv("TIME_RANGE_END")
 # 抽出するワーストクエリの件数を取得
 WORST_QUERY_LIMIT = int(os.getenv("WORST_QUERY_LIMIT", "1"))
+# Gemini の生成方式。"sync"（1件ずつ同期生成）/ "stream"（ストリーミングでレポートへ直接書き込み）
+# / "batch"（Vertex AI バッチ予測）。件数の多いテナントでは batch の方がクォータ消費が少ないが、
+# 完了まで数分以上かかる。
+GEMINI_GENERATION_MODE = os.getenv("GEMINI_GENERATION_MODE", "sync")
+# バッチ入出力の置き場所。未設定ならレポートバケットの batch/ 配下を使う。
+GEMINI_BATCH_GCS_PREFIX = os.getenv("GEMINI_BATCH_GCS_PREFIX")
+GEMINI_BATCH_POLL_INTERVAL_SECONDS = int(os.getenv("GEMINI_BATCH_POLL_INTERVAL_SECONDS", "30"))
+# Cloud Run Job のタスクタイムアウト（600s）内にレポート保存まで終えられる値にする
+GEMINI_BATCH_TIMEOUT_SECONDS = int(os.getenv("GEMINI_BATCH_TIMEOUT_SECONDS", "480"))
+# 実行全体の持ち時間（秒）。Cloud Run Job のタスクタイムアウト（600s）より短くし、
+# 超える前に下位クエリの解析を縮退させてでもレポートを保存する。
+RUN_DEADLINE_SECONDS = int(os.getenv("RUN_DEADLINE_SECONDS", "540"))
+# レポートと summary.json の保存用に、持ち時間の末尾で確保しておく秒数
+RUN_FINALIZE_RESERVE_SECONDS = int(os.getenv("RUN_FINALIZE_RESERVE_SECONDS", "30"))
+# 1クエリの Gemini 生成に見込む秒数。残りがこれを切ったら構文解析の指摘のみに縮退する
+GEMINI_MIN_BUDGET_SECONDS = int(os.getenv("GEMINI_MIN_BUDGET_SECONDS", "60"))
+# 1クエリのスキーマ取得＋構文解析に見込む秒数。残りがこれを切ったら解析自体を省略する
+ANALYSIS_MIN_BUDGET_SECONDS = int(os.getenv("ANALYSIS_MIN_BUDGET_SECONDS", "15"))
+# レポート冒頭の節（ストレージ判定・料金の試算などの任意の分析）で使わず、ワーストクエリの
+# 解析に残す秒数。残りがこれを切ったら、残りの節を省略する
+REPORT_SECTION_RESERVE_SECONDS = int(os.getenv("REPORT_SECTION_RESERVE_SECONDS", "240"))
+# シャード実行（CLOUD_RUN_TASK_COUNT > 1）の共有ストア。未設定ならレポートバケットを使う。
+# ローカルで複数タスクを模擬するときに、共有ディレクトリを指定する。
+SHARD_STORE_DIR = os.getenv("SHARD_STORE_DIR")
+SHARD_MANIFEST_POLL_SECONDS = 5
+# ステージ別の計時を OpenTelemetry にも送るか（summary.json とログへの出力は常に行う）
+TIMING_OTEL_EXPORT = os.getenv("TIMING_OTEL_EXPORT", "false").lower() == "true"
+# 実行全体を cProfile / tracemalloc の下で動かし、結果をレポートバケットに保存するか
+PROFILE_MODE = os.getenv("PROFILE_MODE", "false").lower() == "true"
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+# 各呼び出しのタイムアウト上限（残り時間がこれより短ければ残り時間に切り詰める）
+BQ_QUERY_TIMEOUT_SECONDS = 180
+BQ_METADATA_TIMEOUT_SECONDS = 30
+ANTIPATTERN_API_TIMEOUT_SECONDS = 60
+# 構文解析 API が混雑（503）を返したときの再送回数と、Retry-After が無いときの待ち秒数
+ANTIPATTERN_API_MAX_RETRIES = int(os.getenv("ANTIPATTERN_API_MAX_RETRIES", "2"))
+ANTIPATTERN_API_RETRY_AFTER_SECONDS = 5
+# 構文解析 API の前に、短く単純なクエリはローカルのルール（antipattern_rules）で判定する。
+# ローカルで判定できないクエリ（長い・複数文・未対応の構文など）だけを API に送る。
+# JAR との一致（tests/data/antipattern_parity.jsonl）を記録するまでは既定で使わない。
+ANTIPATTERN_PRESCREEN = os.getenv("ANTIPATTERN_PRESCREEN", "false").lower() == "true"
+ANTIPATTERN_PRESCREEN_MAX_BYTES = int(os.getenv("ANTIPATTERN_PRESCREEN_MAX_BYTES", "4096"))
+# 調査期間のクエリ全体（リテラル違いは1つにまとめる）をアンチパターンで判定し、ルールごとに集計するか。
+# 件数が多いため、ANTIPATTERN_PRESCREEN にかかわらずまずローカルのルールで判定し、判定できない
+# クエリだけを課金バイトの多い順に API_QUERIES 件まで構文解析 API に送る。
+ANTIPATTERN_CENSUS = os.getenv("ANTIPATTERN_CENSUS", "false").lower() == "true"
+ANTIPATTERN_CENSUS_MAX_QUERIES = int(os.getenv("ANTIPATTERN_CENSUS_MAX_QUERIES", "5000"))
+ANTIPATTERN_CENSUS_API_QUERIES = int(os.getenv("ANTIPATTERN_CENSUS_API_QUERIES", "50"))
+ANTIPATTERN_CENSUS_CONCURRENCY = int(os.getenv("ANTIPATTERN_CENSUS_CONCURRENCY", "4"))
+# センサスで API を呼ぶのは、持ち時間の残りがこれ以上ある間だけ（ワーストクエリの解析の分を残す）
+ANTIPATTERN_CENSUS_RESERVE_SECONDS = int(os.getenv("ANTIPATTERN_CENSUS_RESERVE_SECONDS", "240"))
+# ワーストクエリごとにジョブの実行計画（query_plan）を取得し、ボトルネックを要約するか
+QUERY_PLAN_ANALYSIS = os.getenv("QUERY_PLAN_ANALYSIS", "true").lower() == "true"
+# ワーストクエリごとに、結果まで届く SELECT * で無駄に読んでいる列と削減見込みを推定するか
+COLUMN_WASTE_ANALYSIS = os.getenv("COLUMN_WASTE_ANALYSIS", "true").lower() == "true"
+# Gemini の助言の改善SQL をドライランし、実行できるかと元のジョブからの削減量を検証するか
+REWRITE_VALIDATION = os.getenv("REWRITE_VALIDATION", "true").lower() == "true"
+# リージョンごとにスロット使用量のタイムライン（JOBS_TIMELINE）からピークの時間帯を求めるか
+SLOT_TIMELINE_ANALYSIS = os.getenv("SLOT_TIMELINE_ANALYSIS", "true").lower() == "true"
+SLOT_TIMELINE_PEAK_MINUTES = int(os.getenv("SLOT_TIMELINE_PEAK_MINUTES", "30"))
+SLOT_TIMELINE_MAX_WINDOWS = 5
+SLOT_TIMELINE_TOP_JOBS = 3
+# リージョンごとにオンデマンドと Editions の予約の料金を試算するか
+COMPUTE_PRICING_ANALYSIS = os.getenv("COMPUTE_PRICING_ANALYSIS", "true").lower() == "true"
+# リージョンごとに繰り返し実行される集計クエリから、マテリアライズドビュー・BI Engine の候補を探すか
+MV_CANDIDATE_ANALYSIS = os.getenv("MV_CANDIDATE_ANALYSIS", "true").lower() == "true"
+MV_CANDIDATE_MIN_RUNS = int(os.getenv("MV_CANDIDATE_MIN_RUNS", "10"))
+MV_CANDIDATE_QUERY_LIMIT = 200
+MV_CANDIDATE_MAX = 5
+# リージョンごとにスキャン量の多いテーブルを読むクエリから、パーティション列・クラスタリング列を推奨するか
+KEY_ADVISOR_ANALYSIS = os.getenv("KEY_ADVISOR_ANALYSIS", "true").lower() == "true"
+KEY_ADVISOR_MAX_TABLES = int(os.getenv("KEY_ADVISOR_MAX_TABLES", "5"))
+KEY_ADVISOR_QUERY_LIMIT = 100
+# ストレージ判定の結果をレポートバケットの履歴（history/storage/）に残し、増加の傾向を出すか
+STORAGE_HISTORY = os.getenv("STORAGE_HISTORY", "true").lower() == "true"
+STORAGE_HISTORY_MAX_SNAPSHOTS = int(os.getenv("STORAGE_HISTORY_MAX_SNAPSHOTS", "365"))
+# リージョンごとに、長期間読まれていない大きなテーブル（未使用・コールド）を探すか
+COLD_TABLE_ANALYSIS = os.getenv("COLD_TABLE_ANALYSIS", "true").lower() == "true"
+COLD_TABLE_IDLE_DAYS = int(os.getenv("COLD_TABLE_IDLE_DAYS", "90"))
+COLD_TABLE_MIN_GIB = float(os.getenv("COLD_TABLE_MIN_GIB", "1"))
+# 最後の読み取りを探す期間（JOBS の保持期間 180 日）
+COLD_TABLE_LOOKBACK_DAYS = 180
+COLD_TABLE_QUERY_LIMIT = 200
+COLD_TABLE_MAX = 20
 # ファイルパスの設定
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 WORST_RANKING_SQL_PATH = os.path.join(BASE_DIR, "sql", "worst_ranking.sql")
 STORAGE_ANALYSIS_SQL_PATH = os.path.join(
     BASE_DIR, "sql", "logical_vs_physical_storage_analysis.sql"
 )
+SLOT_TIMELINE_SQL_PATH = os.path.join(BASE_DIR, "sql", "slot_timeline.sql")
+COMPUTE_PRICING_SQL_PATH = os.path.join(BASE_DIR, "sql", "compute_pricing.sql")
+MV_CANDIDATES_SQL_PATH = os.path.join(BASE_DIR, "sql", "repeated_aggregations.sql")
+TABLE_WORKLOAD_SQL_PATH = os.path.join(BASE_DIR, "sql", "table_workload.sql")
+COLD_TABLES_SQL_PATH = os.path.join(BASE_DIR, "sql", "cold_tables.sql")
+ANTIPATTERN_CENSUS_SQL_PATH = os.path.join(BASE_DIR, "sql", "antipattern_census.sql")
 GEMINI_PROMPT_PATH = os.path.join(BASE_DIR, "prompts", "gemini_prompt.txt")
 
 # ==========================================
@@ -56,6 +198,27 @@ GEMINI_PROMPT_PATH = os.path.join(BASE_DIR, "prompts", "gemini_prompt.txt")
 # ==========================================
 
 
+class ReportSink:
+    """Markdown レポートの書き込み先。
+
+    行単位の追記（append）に加えて、ストリーミング生成のチャンクを区切り無しで
+    そのまま書き込める（write）。応答全文を別途保持せずにレポートへ流し込むため。
+    """
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+
+    def append(self, line):
+        self._buffer.write(line)
+        self._buffer.write("\n")
+
+    def write(self, chunk):
+        self._buffer.write(chunk)
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
 def load_external_file(filepath):
     """外部SQLファイルを読み込む"""
     if not os.path.exists(filepath):
@@ -73,13 +236,14 @@ def check_bucket_exists(storage_client, bucket_name):
     try:
         # roles/storage.objectAdmin で許可される objects.list でアクセス確認する。
         # get_bucket() は storage.buckets.get を要求し objectAdmin に含まれないため使わない。
-        list(storage_client.list_blobs(bucket_name, max_results=1))
+        with span("gcs.bucket_check"):
+            list(storage_client.list_blobs(bucket_name, max_results=1))
         logger.info(f"✅ Connection verified: GCS Bucket '{bucket_name}' is accessible.")
         return True
-    except NotFound:
+    except api_exceptions.NotFound:
         logger.error(f"Bucket '{bucket_name}' not found in customer project.")
         return False
-    except Forbidden:
+    except api_exceptions.Forbidden:
         logger.error(f"Access denied to bucket '{bucket_name}'. Check analyzer_sa permissions.")
         return False
     except Exception as e:
@@ -87,27 +251,64 @@ def check_bucket_exists(storage_client, bucket_name):
         return False
 
 
-def get_current_user_email(client):
-    """実行者のメールアドレスを取得（除外用）"""
+def get_credentials_email():
+    """実行中の認証情報（ワークロード SA）のメールアドレス。分からなければ None。
+
+    Cloud Run のメタデータサーバー由来の認証情報は refresh するまで "default" を返すため、
+    その場合だけ refresh する（メタデータサーバーへの問い合わせで、BigQuery より速い）。
+    ユーザー認証（ローカル実行）にはメールアドレスが無い。
+    """
+    try:
+        with span("auth.analyzer_identity"):
+            credentials, _ = google.auth.default()
+            email = getattr(credentials, "service_account_email", None)
+            if email == "default":
+                credentials.refresh(auth_transport.Request())
+                email = getattr(credentials, "service_account_email", None)
+        return email if email and email != "default" else None
+    except Exception as e:
+        logger.warning(f"Could not read analyzer email from credentials: {e}")
+        return None
+
+
+def get_current_user_email(client, deadline=None):
+    """実行者のメールアドレスを取得（除外用）。
+
+    認証情報から分かればそれを使い、分からない場合だけ session_user() を問い合わせる。
+    """
+    email = get_credentials_email()
+    if email:
+        return email
     try:
-        job = client.query("SELECT session_user() as user_email")
-        result = list(job.result())
+        with span("bq.analyzer_identity"):
+            job = client.query("SELECT session_user() as user_email")
+            result = list(job.result(timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS)))
         return result[0].user_email
     except Exception as e:
         logger.warning(f"Could not detect analyzer email: {e}")
         return "unknown"
 
 
-def get_active_regions(client, target_project):
+def get_active_regions(client, target_project, deadline=None):
     """データセットが存在するリージョンを特定"""
     regions = set()
     logger.info(f"Discovering active regions in {target_project}...")
     try:
-        datasets = list(client.list_datasets(project=target_project))
-        for dataset_item in datasets:
-            dataset = client.get_dataset(dataset_item.reference)
-            if dataset.location:
-                regions.add(dataset.location.lower())
+        with span("bq.active_regions") as sp:
+            datasets = list(
+                client.list_datasets(
+                    project=target_project,
+                    timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS),
+                )
+            )
+            for dataset_item in datasets:
+                dataset = client.get_dataset(
+                    dataset_item.reference,
+                    timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS),
+                )
+                if dataset.location:
+                    regions.add(dataset.location.lower())
+            sp.set(datasets=len(datasets), regions=len(regions))
         return regions
     except Exception as e:
         logger.error(f"Error discovering regions: {e}")
@@ -131,6 +332,13 @@ def get_time_range_expressions():
     return start_time_expr, end_time_expr
 
 
+def get_period_end_expression():
+    """調査期間の終わりの時刻の式（終わりを指定しなければ現在時刻）"""
+    if not TIME_RANGE_INTERVAL and TIME_RANGE_START and TIME_RANGE_END:
+        return f"TIMESTAMP('{TIME_RANGE_END}')"
+    return "CURRENT_TIMESTAMP()"
+
+
 # ==========================================
 # 外部API / BigQuery 解析系関数
 # ==========================================
@@ -139,10 +347,10 @@ def get_time_range_expressions():
 @lru_cache(maxsize=1)
 def get_oidc_token(audience):
     """OIDCトークンを取得し、キャッシュする（高速化）"""
-    auth_req = google.auth.transport.requests.Request()
+    auth_req = auth_transport.Request()
     try:
         # 本番環境 (Cloud Run) 用
-        return google.oauth2.id_token.fetch_id_token(auth_req, audience)
+        return oauth2_id_token.fetch_id_token(auth_req, audience)
     except Exception:
         # ローカルテスト環境用
         credentials, _ = google.auth.default()
@@ -150,7 +358,15 @@ def get_oidc_token(audience):
         return credentials.id_token
 
 
-def analyze_with_bq_antipattern_api(query_string):
+def retry_after_seconds(response):
+    """503 応答の Retry-After（秒数形式）を読む。無い・読めないときは既定値。"""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return ANTIPATTERN_API_RETRY_AFTER_SECONDS
+
+
+def analyze_with_bq_antipattern_api(query_string, deadline=None):
     """構文解析APIを呼び出す。トークンはキャッシュを利用。"""
     if not BQ_ANTIPATTERN_API_URL:
         logger.warning("BQ_ANTIPATTERN_API_URL is not set. Skipping API call.")
@@ -159,14 +375,31 @@ def analyze_with_bq_antipattern_api(query_string):
     endpoint = f"{BQ_ANTIPATTERN_API_URL.rstrip('/')}/analyze"
 
     try:
-        # キャッシュされた関数からトークンを取得
-        id_token = get_oidc_token(BQ_ANTIPATTERN_API_URL)
-
-        headers = {"Authorization": f"Bearer {id_token}", "Content-Type": "application/json"}
-        response = requests.post(
-            endpoint, json={"query": query_string}, headers=headers, timeout=60
-        )
-        response.raise_for_status()
+        with span("api.antipattern") as sp:
+            # キャッシュされた関数からトークンを取得（キャッシュの当否も記録する）
+            hits_before = get_oidc_token.cache_info().hits
+            id_token = get_oidc_token(BQ_ANTIPATTERN_API_URL)
+            sp.set(cache="hit" if get_oidc_token.cache_info().hits > hits_before else "miss")
+
+            headers = {"Authorization": f"Bearer {id_token}", "Content-Type": "application/json"}
+            for attempt in range(ANTIPATTERN_API_MAX_RETRIES + 1):
+                response = requests.post(
+                    endpoint,
+                    json={"query": query_string},
+                    headers=headers,
+                    timeout=stage_timeout(deadline, ANTIPATTERN_API_TIMEOUT_SECONDS),
+                )
+                # 503 は API 側の待ち行列が埋まっているだけなので、指定された秒数待って再送する
+                if response.status_code != 503 or attempt == ANTIPATTERN_API_MAX_RETRIES:
+                    break
+                wait_seconds = retry_after_seconds(response)
+                if deadline and not deadline.allows(wait_seconds + ANALYSIS_MIN_BUDGET_SECONDS):
+                    break
+                logger.warning(f"bq-antipattern-api is busy. Retrying in {wait_seconds:g}s.")
+                sp.set(retries=attempt + 1)
+                time.sleep(wait_seconds)
+            response.raise_for_status()
+            sp.set(bytes=len(response.content))
 
         return response.json().get("recommendations", "")
 
@@ -175,93 +408,488 @@ def analyze_with_bq_antipattern_api(query_string):
         return "アンチパターンの解析ツール呼び出しに失敗しました。"
 
 
-def get_query_schema_info(client, referenced_tables):
-    """INFORMATION_SCHEMA.JOBSの履歴(referenced_tables)から元のテーブルの完全なスキーマ情報を取得する"""
-    schema_details = []
+def screen_antipatterns(query_string, force=False):
+    """ローカルのルールでの判定。ANTIPATTERN_PRESCREEN=false なら（force でなければ）常に未判定。"""
+    if not (ANTIPATTERN_PRESCREEN or force):
+        return Screening(False, reason="prescreen disabled")
     try:
-        # 履歴から取得した「参照しているテーブルのリスト」を確認
-        if not referenced_tables:
-            return "参照しているテーブル情報が取得できませんでした。"
+        return prescreen(query_string, max_query_bytes=ANTIPATTERN_PRESCREEN_MAX_BYTES)
+    except Exception as e:
+        # ローカル判定の不具合で解析を止めない（未判定として API に送る）
+        logger.warning(f"Local anti-pattern pre-screen failed: {e}")
+        return Screening(False, reason=f"prescreen error: {type(e).__name__}")
 
-        for table_ref in referenced_tables:
-            try:
-                # table_ref は dict または Row オブジェクトとして扱う
-                if isinstance(table_ref, dict):
-                    project_id = table_ref.get("project_id")
-                    dataset_id = table_ref.get("dataset_id")
-                    table_id = table_ref.get("table_id")
-                else:
-                    project_id = getattr(table_ref, "project_id", None)
-                    dataset_id = getattr(table_ref, "dataset_id", None)
-                    table_id = getattr(table_ref, "table_id", None)
-
-                if not project_id or not dataset_id or not table_id:
-                    continue
 
-                table_name = f"{project_id}.{dataset_id}.{table_id}"
-                table = client.get_table(table_name)
-                info = [f"■ テーブル: {table_name}"]
+def analyze_antipatterns(query_string, deadline=None):
+    """構文解析。ローカルのルールで判定できたクエリは API を呼ばない。"""
+    if ANTIPATTERN_PRESCREEN:
+        with span("local.antipattern") as sp:
+            screening = screen_antipatterns(query_string)
+            sp.set(decided=screening.decided, findings=len(screening.findings))
+        if screening.decided:
+            return screening.report()
+        logger.info(f"Local anti-pattern pre-screen undecided ({screening.reason}).")
+    return analyze_with_bq_antipattern_api(query_string, deadline)
 
-                # パーティション情報
-                if table.time_partitioning:
-                    part_field = table.time_partitioning.field or "_PARTITIONTIME"
-                    info.append(
-                        f"  - パーティション列: {part_field} (分割タイプ: {table.time_partitioning.type_})"
-                    )
-                else:
-                    info.append("  - パーティション: 未設定 (フルスキャンのリスクあり)")
 
-                # クラスタリング情報
-                if table.clustering_fields:
-                    info.append(f"  - クラスタリング列: {', '.join(table.clustering_fields)}")
+def fetch_census_queries(scan, sql_template):
+    """アンチパターンのセンサス用に、調査期間のクエリ（リテラル違いは1つ）を集める。失敗したら空。"""
+    try:
+        return scan.query("antipattern_census", sql_template, limit=ANTIPATTERN_CENSUS_MAX_QUERIES)
+    except Exception as e:
+        logger.error(f"Anti-pattern census query failed in {scan.region}: {e}")
+        return []
+
+
+def analyze_antipattern_census(rows, deadline=None, truncated=False):
+    """集めたクエリ全体をアンチパターンで判定し、ルールごとの件数・課金・スロット時間を返す。
+
+    クエリが無い・判定に失敗したときは None。
+    """
+    if not rows:
+        return None
+    try:
+        with span("local.antipattern_census", queries=len(rows)) as sp:
+            census = run_census(
+                build_shapes(rows),
+                # 全件を API に送ると上限件数しか判定できないため、センサスは常にローカルで判定する
+                lambda query: screen_antipatterns(query, force=True),
+                analyze_remote=lambda query: analyze_with_bq_antipattern_api(query, deadline),
+                max_remote=ANTIPATTERN_CENSUS_API_QUERIES if BQ_ANTIPATTERN_API_URL else 0,
+                concurrency=ANTIPATTERN_CENSUS_CONCURRENCY,
+                allows=lambda: (
+                    deadline is None or deadline.allows(ANTIPATTERN_CENSUS_RESERVE_SECONDS)
+                ),
+            )
+            sp.set(patterns=len(census.patterns))
+        return format_census(census, truncated)
+    except Exception as e:
+        logger.error(f"Anti-pattern census failed: {e}")
+        return None
+
+
+def table_ref_name(table_ref):
+    """referenced_tables の1件（dict または Row オブジェクト）の完全修飾名。欠けていれば None。"""
+    if isinstance(table_ref, dict):
+        parts = [table_ref.get(key) for key in ("project_id", "dataset_id", "table_id")]
+    else:
+        parts = [getattr(table_ref, key, None) for key in ("project_id", "dataset_id", "table_id")]
+    return ".".join(parts) if all(parts) else None
+
 
-                columns = [f"{f.name} ({f.field_type})" for f in table.schema]
-                info.append(f"  - カラム一覧: {', '.join(columns)}")
+def fetch_table_metadata(client, referenced_tables, deadline=None):
+    """INFORMATION_SCHEMA.JOBSの履歴(referenced_tables)から元のテーブルの情報を取得する。
+
+    TableMetadata のリストを返す（取得に失敗したテーブルは error 付き）。
+    """
+    tables = []
+    try:
+        for table_ref in referenced_tables or []:
+            if deadline and deadline.expired():
+                logger.warning("Run deadline reached. Skipping remaining schema lookups.")
+                break
+            try:
+                table_name = table_ref_name(table_ref)
+                if table_name is None:
+                    continue
 
-                schema_details.append("\n".join(info))
+                with span("bq.table_schema"):
+                    table = client.get_table(
+                        table_name, timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS)
+                    )
+                metadata = TableMetadata(
+                    name=table_name,
+                    clustering_fields=list(table.clustering_fields or []),
+                    columns=[(f.name, f.field_type) for f in table.schema],
+                    num_bytes=getattr(table, "num_bytes", None),
+                    num_rows=getattr(table, "num_rows", None),
+                )
+                range_partitioning = getattr(table, "range_partitioning", None)
+                if table.time_partitioning:
+                    metadata.partition_column = table.time_partitioning.field or "_PARTITIONTIME"
+                    metadata.partition_type = table.time_partitioning.type_
+                elif range_partitioning:
+                    metadata.partition_column = range_partitioning.field
+                    metadata.partition_type = "RANGE"
+                    bounds = range_partitioning.range_
+                    metadata.partition_range = (bounds.start, bounds.end, bounds.interval)
+                tables.append(metadata)
 
             except Exception as e:
+                table_id = table_name.rsplit(".", 1)[-1]
                 logger.warning(f"Failed to get schema for {table_id}: {e}")
-                schema_details.append(f"■ テーブル: {table_id} (権限不足等によりスキーマ取得失敗)")
-
-        return (
-            "\n\n".join(schema_details)
-            if schema_details
-            else "参照しているテーブル情報が取得できませんでした。"
-        )
+                tables.append(TableMetadata(name=table_id, error=str(e)))
 
     except Exception as e:
         logger.warning(f"Schema extraction failed: {e}")
-        return "クエリの解析に失敗したため、スキーマ情報を特定できませんでした。"
+    return tables
+
+
+def fetch_query_plan(client, job, deadline=None):
+    """ワーストジョブの実行計画を取得して要約する（取得できなければ空の PlanSummary）。"""
+    try:
+        with span("bq.query_plan") as sp:
+            query_job = client.get_job(
+                job.job_id,
+                project=getattr(job, "project_id", None) or CUSTOMER_PROJECT_ID,
+                location=job.region_name,
+                timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS),
+            )
+            plan = summarize_plan(getattr(query_job, "query_plan", None))
+            sp.set(stages=len(plan.stages))
+        return plan
+    except Exception as e:
+        logger.warning(f"Failed to get query plan for {job.job_id}: {e}")
+        return summarize_plan([])
 
 
-def analyze_storage_pricing(client, target_project, region, sql_template):
-    """ストレージ料金モデルの判定"""
+def dry_run_bytes(client, sql, region, deadline=None):
+    """SQL をドライランし、処理されるバイト数を返す。BigQuery が受け付けなければ RewriteRejected。"""
+    config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
     try:
-        # formatメソッドを使って外部SQLの変数を動的に置換
-        formatted_sql = sql_template.format(target_project=target_project, region=region)
-        query_job = client.query(formatted_sql, location=region)
-        results = list(query_job.result())
-
-        if not results:
-            return "対象となるストレージデータがありませんでした。"
-
-        # 表のヘッダーを作成（数値カラムは右寄せ --: を使用）
-        lines = [
-            "| データセット | 論理 (GB) | 物理 (GB) | 圧縮率 | 推奨アクション |",
-            "|---|--:|--:|--:|---|",
-        ]
-        # 取得した結果を表の行として追加
-        for row in results:
-            lines.append(
-                f"| `{row.dataset_name}` | {row.logical_gb:.2f} | {row.physical_gb:.2f} "
-                f"| {row.compression_ratio:.2f} | *{row.recommendation}* |"
+        with span("bq.rewrite_dry_run", region=region) as sp:
+            query_job = client.query(
+                sql,
+                job_config=config,
+                location=region,
+                timeout=stage_timeout(deadline, BQ_METADATA_TIMEOUT_SECONDS),
             )
-        return "\n".join(lines)
+            sp.set(bytes=query_job.total_bytes_processed)
+    except api_exceptions.BadRequest as e:
+        # 構文・列名の誤りなど。権限不足（403）や見つからないテーブル（404）は検証できなかった扱い
+        raise RewriteRejected(getattr(e, "message", None) or str(e)) from e
+    return query_job.total_bytes_processed
+
+
+def validate_advice_rewrite(client, job, advice, deadline=None):
+    """助言の改善SQL をドライランで検証する（改善SQL が無ければ None）。
 
+    ドライランは SaaS プロジェクトで実行するので、プロジェクトを省いたテーブル名は
+    元のジョブの参照テーブルの完全修飾名に直してから渡す。
+    """
+    table_names = [
+        name for name in map(table_ref_name, getattr(job, "referenced_tables", None) or []) if name
+    ]
+    check = validate_rewrite(
+        advice,
+        job.query,
+        (getattr(job, "billed_gb", None) or 0) * 2**30,
+        lambda sql: dry_run_bytes(
+            client, qualify_tables(sql, table_names), job.region_name, deadline
+        ),
+    )
+    if check is not None and check.error:
+        logger.warning(f"Dry run of the suggested rewrite for {job.job_id} failed: {check.error}")
+    return check
+
+
+def format_schema_info(tables):
+    """プロンプトに渡すスキーマ情報のテキスト。"""
+    schema_details = []
+    for table in tables:
+        if table.error:
+            schema_details.append(f"■ テーブル: {table.name} (権限不足等によりスキーマ取得失敗)")
+            continue
+        info = [f"■ テーブル: {table.name}"]
+
+        # パーティション情報
+        if table.partition_column:
+            info.append(
+                f"  - パーティション列: {table.partition_column} (分割タイプ: {table.partition_type})"
+            )
+        else:
+            info.append("  - パーティション: 未設定 (フルスキャンのリスクあり)")
+
+        # クラスタリング情報
+        if table.clustering_fields:
+            info.append(f"  - クラスタリング列: {', '.join(table.clustering_fields)}")
+
+        columns = [f"{name} ({field_type})" for name, field_type in table.columns]
+        info.append(f"  - カラム一覧: {', '.join(columns)}")
+
+        schema_details.append("\n".join(info))
+
+    return (
+        "\n\n".join(schema_details)
+        if schema_details
+        else "参照しているテーブル情報が取得できませんでした。"
+    )
+
+
+# ==========================================
+# レポート冒頭の節（リージョンごとの分析）
+# ==========================================
+
+
+@dataclass
+class RegionScan:
+    """1リージョン分の分析に共通する入力。レポート冒頭の各節の分析関数に渡す。"""
+
+    client: object
+    target_project: str
+    region: str
+    analyzer_email: str
+    start_time_expr: str
+    end_time_expr: str
+    deadline: object = None
+    history_store: object = None
+    reserve_seconds: float = 0  # クエリのタイムアウトで使わずに残す秒数
+    # ストレージ判定の結果（同じリージョンの増加の傾向の記録に使う）
+    storage_datasets: list | None = None
+
+    def query(self, name, sql_template, **params):
+        """分析用の SQL を埋めて実行し、結果の行のリストを返す（スパン名は bq.<name>）。
+
+        SQL テンプレートが使わない変数は format で無視される。
+        """
+        formatted_sql = sql_template.format(
+            target_project=self.target_project,
+            region=self.region,
+            analyzer_email=self.analyzer_email,
+            start_time_expr=self.start_time_expr,
+            end_time_expr=self.end_time_expr,
+            period_end_expr=get_period_end_expression(),
+            **params,
+        )
+        with span(f"bq.{name}", region=self.region) as sp:
+            query_job = self.client.query(formatted_sql, location=self.region)
+            results = list(
+                query_job.result(
+                    timeout=stage_timeout(
+                        self.deadline, BQ_QUERY_TIMEOUT_SECONDS, self.reserve_seconds
+                    )
+                )
+            )
+            sp.set(bytes=getattr(query_job, "total_bytes_processed", None), rows=len(results))
+        return results
+
+
+def analyze_storage_pricing(scan, sql_template):
+    """ストレージ料金モデルの判定（テーブル単位の内訳から、両方の料金モデルの月額を比較）"""
+    results = scan.query("storage_pricing", sql_template)
+    with span("local.storage_pricing", region=scan.region):
+        datasets = analyze_storage(results, scan.region)
+    scan.storage_datasets = datasets
+    if not reportable(datasets):
+        return None
+    return format_storage(datasets, scan.region)
+
+
+def analyze_storage_growth(scan, sql_template=None):
+    """ストレージ判定の結果を履歴に追記し、増加の傾向を返す（履歴を残さない設定なら None）"""
+    if scan.history_store is None or not scan.storage_datasets:
+        return None
+    return update_storage_history(scan.history_store, scan.region, scan.storage_datasets)
+
+
+def update_storage_history(store, region, datasets, taken_at=None):
+    """ストレージ判定の結果を履歴に追記し、増加の傾向の Markdown を返す（失敗したら None）。"""
+    taken_at = taken_at or datetime.datetime.now(datetime.timezone.utc)
+    path = history_path(region)
+    try:
+        with span("gcs.storage_history", region=region):
+            snapshots = load_snapshots(store.read_text(path))
+            snapshots = record_snapshot(
+                snapshots, datasets, taken_at, STORAGE_HISTORY_MAX_SNAPSHOTS
+            )
+            store.write_text(path, dump_snapshots(snapshots, region))
+        return format_trends(snapshots)
     except Exception as e:
-        logger.error(f"Storage analysis failed: {e}")
-        return "ストレージ分析に失敗しました。"
+        logger.error(f"Failed to update storage history for {region}: {e}")
+        return None
+
+
+def analyze_slot_timeline(scan, sql_template):
+    """スロット使用量のピークの時間帯と、そこで多くのスロットを使ったジョブ"""
+    results = scan.query(
+        "slot_timeline",
+        sql_template,
+        peak_minutes=SLOT_TIMELINE_PEAK_MINUTES,
+        top_jobs=SLOT_TIMELINE_TOP_JOBS,
+    )
+    if not results:
+        return None
+    return format_timeline(results, SLOT_TIMELINE_MAX_WINDOWS, SLOT_TIMELINE_TOP_JOBS)
+
+
+def analyze_compute_pricing(scan, sql_template):
+    """オンデマンドと Editions の予約（ベースライン・自動スケーリングの上限）の料金比較"""
+    results = scan.query("compute_pricing", sql_template)
+    if not results:
+        return None
+    row = results[0]
+    with span("local.compute_pricing", region=scan.region):
+        simulation = simulate(
+            row.minute_slots,
+            row.period_minutes,
+            row.billed_bytes,
+            row.job_count,
+            row.reserved_slot_share,
+        )
+    if not simulation.plans:
+        return None
+    return format_pricing(simulation)
+
+
+def analyze_mv_candidates(scan, sql_template):
+    """繰り返し実行される集計クエリのうち、マテリアライズドビュー・BI Engine で削減できるもの"""
+    results = scan.query(
+        "mv_candidates",
+        sql_template,
+        min_runs=MV_CANDIDATE_MIN_RUNS,
+        limit=MV_CANDIDATE_QUERY_LIMIT,
+    )
+    with span("local.mv_candidates", region=scan.region):
+        candidates = find_candidates(results)
+    if not candidates:
+        return None
+    return format_candidates(candidates, MV_CANDIDATE_MAX)
+
+
+def analyze_cold_tables(scan, sql_template):
+    """長期間読まれていない大きなテーブルと、その月額"""
+    results = scan.query(
+        "cold_tables",
+        sql_template,
+        lookback_days=COLD_TABLE_LOOKBACK_DAYS,
+        idle_days=COLD_TABLE_IDLE_DAYS,
+        min_bytes=int(COLD_TABLE_MIN_GIB * 2**30),
+        limit=COLD_TABLE_QUERY_LIMIT,
+    )
+    with span("local.cold_tables", region=scan.region):
+        tables = find_cold_tables(results, scan.region)
+    if not tables:
+        return None
+    return format_cold_tables(
+        tables, COLD_TABLE_IDLE_DAYS, COLD_TABLE_LOOKBACK_DAYS, COLD_TABLE_MAX
+    )
+
+
+def analyze_table_keys(scan, sql_template):
+    """スキャン量の多いテーブルごとの、ワークロードに合うパーティション列・クラスタリング列"""
+    results = scan.query(
+        "table_workload",
+        sql_template,
+        table_limit=KEY_ADVISOR_MAX_TABLES,
+        query_limit=KEY_ADVISOR_QUERY_LIMIT,
+    )
+    recommendations = []
+    for row in results:
+        project_id, dataset_id, table_id = row.table_name.split(".", 2)
+        tables = fetch_table_metadata(
+            scan.client,
+            [{"project_id": project_id, "dataset_id": dataset_id, "table_id": table_id}],
+            scan.deadline,
+        )
+        # 列の型が分からなければパーティション列を選べないため、推奨しない
+        if not tables or tables[0].error:
+            continue
+        with span("local.key_advisor", region=scan.region):
+            recommendations.append(recommend(build_workload(row, tables[0])))
+    if not recommendations:
+        return None
+    return format_recommendations(recommendations)
+
+
+@dataclass(frozen=True)
+class ReportSection:
+    """レポート冒頭の節。
+
+    analyze(scan, SQL テンプレート) をリージョンごとに呼び、Markdown が返ったリージョンの分
+    だけを見出しと前置きの下に並べる（結果が無い・失敗したリージョンは載せない）。
+    analyze が None の節は、全リージョン分をまとめて作る（アンチパターンの集計）。
+    """
+
+    key: str
+    heading: str
+    lead: str
+    analyze: object = None
+    sql_path: str | None = None
+    enabled: bool = True
+
+
+# レポート冒頭に載せる順（リージョンごとの分析もこの順に行う）
+REPORT_SECTIONS = (
+    ReportSection(
+        "storage",
+        "💾 ストレージ料金モデルの判定結果",
+        "テーブルごとの論理・物理ストレージ（タイムトラベル・フェイルセーフを含む）から、"
+        "データセットごとに両方の料金モデルの月額を計算し、削減額の大きい順に並べました。",
+        analyze_storage_pricing,
+        STORAGE_ANALYSIS_SQL_PATH,
+    ),
+    # ストレージ判定の結果を使うため、その直後に行う
+    ReportSection(
+        "storage_growth",
+        "📈 ストレージの増加と料金モデルの見直し時期",
+        "実行のたびに記録したデータセットごとのストレージ量と月額から、増加の傾向と、"
+        "推奨する料金モデルが入れ替わる時期を予測しました。",
+        analyze_storage_growth,
+        enabled=STORAGE_HISTORY,
+    ),
+    ReportSection(
+        "cold_tables",
+        "🧊 長期間読まれていないテーブル（未使用・コールド）",
+        f"ジョブ履歴の参照テーブルから、{COLD_TABLE_IDLE_DAYS} 日以上読まれていない"
+        "テーブルを、今の料金モデルでの月額の高い順に並べました。",
+        analyze_cold_tables,
+        COLD_TABLES_SQL_PATH,
+        COLD_TABLE_ANALYSIS,
+    ),
+    ReportSection(
+        "compute_pricing",
+        "💰 コンピュート料金モデルの試算（オンデマンド vs Editions）",
+        "調査期間のクエリの課金バイトと1分ごとのスロット使用量から、オンデマンドと"
+        "Editions の予約（ベースライン・自動スケーリングの上限）の月額を試算しました。",
+        analyze_compute_pricing,
+        COMPUTE_PRICING_SQL_PATH,
+        COMPUTE_PRICING_ANALYSIS,
+    ),
+    ReportSection(
+        "slot_timeline",
+        "⏱️ スロット使用量のピーク（同時実行の競合）",
+        "スロット使用量が多かった時間帯と、その時間帯に多くのスロットを使ったジョブです。"
+        "単体では小さいクエリでも、同じ時間帯に重なると待ちが発生します。",
+        analyze_slot_timeline,
+        SLOT_TIMELINE_SQL_PATH,
+        SLOT_TIMELINE_ANALYSIS,
+    ),
+    ReportSection(
+        "mv_candidates",
+        "🧱 マテリアライズドビュー・BI Engine の候補（繰り返される集計）",
+        "同じテーブルに対して、リテラルだけが違う集計が何度も実行されています。"
+        "1回は軽くても回数で効いているため、結果の再利用で削減できる見込みです。",
+        analyze_mv_candidates,
+        MV_CANDIDATES_SQL_PATH,
+        MV_CANDIDATE_ANALYSIS,
+    ),
+    ReportSection(
+        "table_keys",
+        "🗂️ パーティション列・クラスタリング列の推奨（ワークロードから）",
+        "スキャン量の多いテーブルごとに、そのテーブルを読むクエリが絞り込み・JOIN に使っている列を"
+        "集計し、課金バイトの多い順に配置の見直し案を示します。",
+        analyze_table_keys,
+        TABLE_WORKLOAD_SQL_PATH,
+        KEY_ADVISOR_ANALYSIS,
+    ),
+    ReportSection(
+        "antipattern_census",
+        "📊 アンチパターンの集計（調査期間のクエリ全体）",
+        "ワーストクエリに限らず、調査期間のクエリ（リテラルだけが違うものは1つにまとめる）を"
+        "すべて判定し、アンチパターンごとに課金バイトの多い順に並べました。",
+        sql_path=ANTIPATTERN_CENSUS_SQL_PATH,
+        enabled=ANTIPATTERN_CENSUS,
+    ),
+)
+
+
+def load_section_templates():
+    """有効な節の SQL テンプレート（{節の key: SQL}）。"""
+    return {
+        section.key: load_external_file(section.sql_path)
+        for section in REPORT_SECTIONS
+        if section.sql_path and section.enabled
+    }
 
 
 # ==========================================
@@ -269,7 +897,7 @@ def analyze_storage_pricing(client, target_project, region, sql_template):
 # ==========================================
 
 
-def load_master_dictionary(client, saas_project_id):
+def load_master_dictionary(client, saas_project_id, deadline=None):
     """アンチパターンマスターの読み込み"""
     logger.info("Loading anti-pattern master dictionary from BigQuery...")
     master_dict = {}
@@ -278,13 +906,14 @@ def load_master_dictionary(client, saas_project_id):
         FROM `{saas_project_id}.audit_master.antipattern_master`
     """
     try:
-        query_job = client.query(query)
-        for row in query_job:
-            master_dict[row.pattern_name] = (
-                f"■ {row.pattern_name}\n"
-                f"  - 問題点: {row.problem_description}\n"
-                f"  - 修正の定石: {row.best_practice}"
-            )
+        with span("bq.master_dictionary"):
+            query_job = client.query(query)
+            for row in query_job.result(timeout=stage_timeout(deadline, BQ_QUERY_TIMEOUT_SECONDS)):
+                master_dict[row.pattern_name] = (
+                    f"■ {row.pattern_name}\n"
+                    f"  - 問題点: {row.problem_description}\n"
+                    f"  - 修正の定石: {row.best_practice}"
+                )
         logger.info(f"Loaded {len(master_dict)} patterns into memory.")
         return master_dict
     except Exception as e:
@@ -301,7 +930,14 @@ def extract_relevant_dictionary(master_dict, detected_text):
     return "\n\n".join(relevant_texts) if relevant_texts else "特になし"
 
 
-def build_gemini_prompt(job, schema_info_text, antipattern_raw_text, master_dict_text):
+def build_gemini_prompt(
+    job,
+    schema_info_text,
+    antipattern_raw_text,
+    master_dict_text,
+    pruning_facts_text,
+    plan_facts_text,
+):
     """外部ファイルからプロンプトを読み込み、変数を注入する"""
     try:
         template = load_external_file(GEMINI_PROMPT_PATH)
@@ -315,6 +951,8 @@ def build_gemini_prompt(job, schema_info_text, antipattern_raw_text, master_dict
             "schema_info_text": schema_info_text,
             "antipattern_raw_text": antipattern_raw_text,
             "master_dict_text": master_dict_text,
+            "pruning_facts_text": pruning_facts_text,
+            "plan_facts_text": plan_facts_text,
         }
         # template.format() を使い、{} プレースホルダに辞書の中身を流し込む
         return template.format(**params)
@@ -333,7 +971,7 @@ def generate_report_signed_url(blob):
     """
     try:
         credentials, _ = google.auth.default()
-        credentials.refresh(google.auth.transport.requests.Request())
+        credentials.refresh(auth_transport.Request())
         return blob.generate_signed_url(
             version="v4",
             expiration=datetime.timedelta(days=REPORT_URL_EXPIRY_DAYS),
@@ -359,7 +997,8 @@ def upload_report_to_gcs(bucket_name, report_content, customer_project_id):
         filename = f"reports/bq_audit_report_{timestamp}.md"
         blob = bucket.blob(filename)
 
-        blob.upload_from_string(report_content, content_type="text/markdown")
+        with span("gcs.report_upload", bytes=len(report_content.encode("utf-8"))):
+            blob.upload_from_string(report_content, content_type="text/markdown")
         logger.info(f"Report uploaded to: gs://{bucket_name}/{filename}")
 
         console_url = (
@@ -373,10 +1012,13 @@ def upload_report_to_gcs(bucket_name, report_content, customer_project_id):
         return None, None
 
 
-def save_summary_for_workflow(bucket_name, text_summary, customer_project_id, report_url=""):
+def save_summary_for_workflow(
+    bucket_name, text_summary, customer_project_id, report_url="", extra=None
+):
     """Workflowが通知用に読み取れるよう、固定パスにJSON保存する。
 
     report_url にはレポートの署名付きURLを入れる（通知本文に載せるため）。
+    extra は Workflow が参照しない付加情報（ステージ別の計時など）。
     """
     if not bucket_name:
         return
@@ -391,6 +1033,7 @@ def save_summary_for_workflow(bucket_name, text_summary, customer_project_id, re
             "report_url": report_url or "",
             "timestamp": str(datetime.datetime.now()),
             "customer_project_id": customer_project_id,
+            **(extra or {}),
         }
         blob.upload_from_string(
             json.dumps(data, ensure_ascii=False), content_type="application/json"
@@ -400,224 +1043,804 @@ def save_summary_for_workflow(bucket_name, text_summary, customer_project_id, re
         logger.error(f"Failed to save summary JSON: {e}")
 
 
-# ==========================================
-# メインプロセス
-# ==========================================
+def log_generation_metrics(metrics):
+    """1クエリ分の生成時間を構造化ログ（JSON）で出す。"""
+    logger.info(f"Gemini generation metrics: {json.dumps(metrics, ensure_ascii=False)}")
 
 
-def main():
-    if not SAAS_PROJECT_ID or not CUSTOMER_PROJECT_ID:
-        # 設定不備は復旧不能なエラー。exit 1 で Workflow に失敗を伝える（サイレント失敗防止）。
-        logger.error(
-            "SAAS_PROJECT_ID / CUSTOMER_PROJECT_ID が未設定です。Workflow の overrides を確認してください。"
-        )
-        sys.exit(1)
+def generate_advice_sync(model, prompts, generation_metrics=None, deadline=None):
+    """プロンプトを1件ずつ同期生成し、{job_id: テキスト or None} を返す。
 
-    # クライアント初期化
-    bq_client = bigquery.Client(project=SAAS_PROJECT_ID)
-    customer_bq_client = bigquery.Client(project=CUSTOMER_PROJECT_ID)
-    # バケットの疎通確認
-    storage_client = storage.Client(project=CUSTOMER_PROJECT_ID)  # 顧客プロジェクト用
-    if not check_bucket_exists(storage_client, GCS_BUCKET_NAME):
-        # バケットにアクセスできない＝顧客側IAM未整備等。exit 1 で明示的に失敗させる。
-        logger.error("レポートバケットにアクセスできないため中断します（exit 1）。")
-        sys.exit(1)
+    持ち時間が足りなくなった時点で打ち切る。打ち切った job_id は結果に含めない。
+    """
+    advices = {}
+    for job_id, prompt in prompts.items():
+        if deadline and not deadline.allows(GEMINI_MIN_BUDGET_SECONDS):
+            logger.warning(
+                f"Run deadline is near. Skipping Gemini for {len(prompts) - len(advices)} "
+                "remaining queries."
+            )
+            break
+        started = time.monotonic()
+        try:
+            with span("gemini.generate", mode="sync") as sp:
+                response = model.generate_content(prompt)
+                advices[job_id] = response.text
+                sp.set(bytes=len(advices[job_id].encode("utf-8")))
+        except Exception as e:
+            logger.error(f"Failed to generate content from Gemini for Job {job_id}: {e}")
+            advices[job_id] = None
+            continue
+        # 応答全文は DEBUG のみ（INFO に全文を出すとログとレポートで二重に抱える）
+        logger.debug(f"Gemini Response for Job {job_id}:\n{advices[job_id]}\n{'-' * 50}")
+        elapsed = round(time.monotonic() - started, 3)
+        metrics = {
+            "job_id": job_id,
+            "mode": "sync",
+            # 同期生成では全文が一度に届くため、初回トークンまでの時間＝全体の時間
+            "time_to_first_token_seconds": elapsed,
+            "total_seconds": elapsed,
+            "chars": len(advices[job_id]),
+        }
+        log_generation_metrics(metrics)
+        if generation_metrics is not None:
+            generation_metrics.append(metrics)
+    return advices
 
-    vertexai.init(project=SAAS_PROJECT_ID, location=LOCATION)
-    model = GenerativeModel(GEMINI_MODEL)
 
-    # 外部SQLファイルのロード
+def chunk_text(chunk):
+    """ストリーミングのチャンクのテキスト（テキストを含まないチャンクは空文字）。
+
+    安全性による停止や、使用量のメタデータだけの最後のチャンクでは chunk.text が ValueError を
+    送出するため、候補の parts から読めるテキストだけを拾う。
+    """
     try:
-        worst_ranking_sql_template = load_external_file(WORST_RANKING_SQL_PATH)
-        storage_analysis_sql_template = load_external_file(STORAGE_ANALYSIS_SQL_PATH)
+        return chunk.text or ""
+    except ValueError:
+        candidates = getattr(chunk, "candidates", None) or []
+        if not candidates:
+            return ""
+        parts = getattr(getattr(candidates[0], "content", None), "parts", None) or []
+        return "".join(getattr(part, "text", None) or "" for part in parts)
+
+
+def stream_advice_into(
+    report, model, job_id, prompt, generation_metrics=None, deadline=None, collector=None
+):
+    """ストリーミング生成し、届いたチャンクから順にレポートへ書き込む。
+
+    collector（RewriteCollector）を渡すと、書き込んだチャンクを渡す（改善SQL の検証用）。
+    途中で失敗した場合は、書き込み済みの部分の後ろに失敗の注記を付けて False を返す。
+    持ち時間が尽きた場合は受信を打ち切り、そこまでの内容に注記を付けて残す
+    （collector.truncated を立てる）。
+    """
+    started = time.monotonic()
+    first_token_seconds = None
+    chars = 0
+    try:
+        with span("gemini.generate", mode="stream") as sp:
+            for chunk in model.generate_content(prompt, stream=True):
+                text = chunk_text(chunk)
+                if not text:
+                    continue
+                if first_token_seconds is None:
+                    first_token_seconds = round(time.monotonic() - started, 3)
+                report.write(text)
+                if collector is not None:
+                    collector.feed(text)
+                chars += len(text)
+                if deadline and deadline.expired():
+                    logger.warning(f"Run deadline reached while streaming Job {job_id}.")
+                    if collector is not None:
+                        collector.truncated = True
+                    report.append("\n\n⏱️ 実行時間の上限に達したため、助言の続きを省略しました。")
+                    break
+            sp.set(chars=chars, time_to_first_token_seconds=first_token_seconds)
     except Exception as e:
-        logger.error(f"SQL file loading error: {e}")
-        sys.exit(1)
+        logger.error(f"Failed to stream content from Gemini for Job {job_id}: {e}")
+        if chars:
+            report.append("\n\n⚠️ 助言の生成が途中で失敗したため、以降が欠けています。")
+        else:
+            report.append("⚠️ このクエリの助言生成に失敗しました。")
+        return False
 
-    # 基本情報の取得
-    analyzer_email = get_current_user_email(bq_client)
-    # Cloud Run では K_SERVICE 環境変数がセットされるため、それを利用して判定
-    if os.getenv("K_SERVICE"):
-        exec_env = "Cloud Run"
-    else:
-        exec_env = "Local"
-    logger.info(f"Execution Environment : {exec_env}")
-    logger.info(f"Execution Account     : {analyzer_email} (To be excluded)")
-    master_dict = load_master_dictionary(bq_client, SAAS_PROJECT_ID)
-    target_regions = get_active_regions(customer_bq_client, CUSTOMER_PROJECT_ID)
-
-    if not target_regions:
-        logger.info("No active regions found.")
-        save_summary_for_workflow(
-            GCS_BUCKET_NAME,
-            "分析対象のリージョン（データセット）が見つかりませんでした。",
-            CUSTOMER_PROJECT_ID,
-        )
-        return
+    report.append("")
+    metrics = {
+        "job_id": job_id,
+        "mode": "stream",
+        "time_to_first_token_seconds": first_token_seconds,
+        "total_seconds": round(time.monotonic() - started, 3),
+        "chars": chars,
+    }
+    log_generation_metrics(metrics)
+    if generation_metrics is not None:
+        generation_metrics.append(metrics)
+    return True
+
+
+def generate_advice_batch(prompts, storage_client, bucket_name, deadline=None):
+    """全プロンプトを Vertex AI バッチ予測でまとめて生成する。"""
+    gcs_prefix = GEMINI_BATCH_GCS_PREFIX or f"gs://{bucket_name}/batch"
+    backend = VertexBatchBackend(
+        GEMINI_MODEL,
+        gcs_prefix,
+        storage_client,
+        poll_interval_seconds=GEMINI_BATCH_POLL_INTERVAL_SECONDS,
+        timeout_seconds=stage_timeout(deadline, GEMINI_BATCH_TIMEOUT_SECONDS),
+    )
+    with span("gemini.batch", prompts=len(prompts)):
+        return generate_with_batch(prompts, backend)
+
+
+def format_degraded_advice(antipattern_raw_text):
+    """持ち時間不足で Gemini を省略したクエリの本文。構文解析の結果があればそれを載せる。"""
+    if antipattern_raw_text is None:
+        return "⏱️ 実行時間の上限に達したため、このクエリの解析を省略しました。"
+    return (
+        "⏱️ 実行時間の上限が近いため Gemini による助言を省略し、"
+        "構文解析ツールの指摘のみを掲載しています。\n\n"
+        f"```text\n{antipattern_raw_text}\n```"
+    )
+
+
+def rank_worst_jobs(all_jobs):
+    """プロジェクト全体でランキングし、ワースト上位だけに絞る。
 
+    (ワーストジョブ一覧, {job_id: {"cost_rank", "duration_rank"}}) を返す。
+    """
+    job_ranks = {}
+    if not all_jobs:
+        return [], job_ranks
+    sorted_billed = sorted(all_jobs, key=lambda x: x.billed_gb or 0.0, reverse=True)
+    sorted_duration = sorted(all_jobs, key=lambda x: x.duration_seconds or 0, reverse=True)
+    for rank, j in enumerate(sorted_billed, 1):
+        if j.job_id not in job_ranks:
+            job_ranks[j.job_id] = {}
+        job_ranks[j.job_id]["cost_rank"] = rank
+    for rank, j in enumerate(sorted_duration, 1):
+        job_ranks[j.job_id]["duration_rank"] = rank
+
+    worst_by_billed = sorted_billed[:WORST_QUERY_LIMIT]
+    worst_by_duration = sorted_duration[:WORST_QUERY_LIMIT]
+    final_worst_jobs = {job.job_id: job for job in (worst_by_billed + worst_by_duration)}
+    worst_jobs = list(final_worst_jobs.values())
+    logger.info(f"Filtered down to project-wide worst queries: {len(worst_jobs)} queries.")
+    return worst_jobs, job_ranks
+
+
+def run_region_sections(scan, section_templates, sections):
+    """1リージョン分の節を REPORT_SECTIONS の順に行い、結果を sections に追加する。
+
+    ワーストクエリの解析に残す秒数（scan.reserve_seconds）を切ったら、そこでやめて False を返す。
+    """
+    for section in REPORT_SECTIONS:
+        if section.analyze is None or not section.enabled:
+            continue
+        if section.sql_path and section.key not in section_templates:
+            continue
+        if not scan.deadline.allows(scan.reserve_seconds):
+            logger.warning(
+                f"Not enough time left for report sections. "
+                f"Skipping {section.key} in {scan.region} and the rest."
+            )
+            return False
+        try:
+            text = section.analyze(scan, section_templates.get(section.key))
+        except Exception as e:
+            logger.error(f"Report section {section.key} failed in {scan.region}: {e}")
+            continue
+        if text:
+            sections[section.key].append(f"### 📍 Region: {scan.region}\n\n{text}\n")
+    return True
+
+
+def collect_region_data(
+    bq_client,
+    target_regions,
+    analyzer_email,
+    worst_ranking_sql_template,
+    section_templates,
+    deadline,
+    history_store=None,
+):
+    """各リージョンからワーストクエリ候補と、レポート冒頭の節（REPORT_SECTIONS）の結果を集める。
+
+    ワーストクエリの抽出を先に全リージョンで行い、節はワーストクエリの解析に
+    REPORT_SECTION_RESERVE_SECONDS を残せる間だけ行う（足りなければ残りの節を省略する）。
+    section_templates は {節の key: SQL テンプレート}（load_section_templates）。
+    テンプレートの無い節は行わない。
+    ({節の key: [リージョンごとの Markdown]}, ワーストクエリ候補) を返す。
+    """
     start_time_expr, end_time_expr = get_time_range_expressions()
 
-    # レポート用リスト（文字列結合の最適化）
-    report_lines = []
-    report_lines.append("# BigQuery 監査レポート")
-    report_lines.append(f"**対象プロジェクト:** `{CUSTOMER_PROJECT_ID}`")
-    report_lines.append(f"**作成日時:** {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    report_lines.append("\n---")
+    def region_scan(region, reserve_seconds=0):
+        return RegionScan(
+            bq_client,
+            CUSTOMER_PROJECT_ID,
+            region,
+            analyzer_email,
+            start_time_expr,
+            end_time_expr,
+            deadline,
+            history_store,
+            reserve_seconds,
+        )
 
     all_jobs = []
-    storage_proposals = []
-
-    # 1. 各リージョンからのデータ収集
+    extracted_regions = []
     for region in target_regions:
-        # ストレージ分析
-        proposal = analyze_storage_pricing(
-            bq_client, CUSTOMER_PROJECT_ID, region, storage_analysis_sql_template
-        )
-        if (
-            "対象となるストレージデータがありません" not in proposal
-            and "失敗しました" not in proposal
-        ):
-            storage_proposals.append(f"### 📍 Region: {region}\n\n{proposal}\n")
+        if deadline.expired():
+            logger.warning(f"Run deadline reached. Skipping region {region} and the rest.")
+            break
         logger.info(f"[{region}] Start extracting the worst queries...")
-
-        # ワーストクエリ抽出
-        formatted_sql = worst_ranking_sql_template.format(
-            target_project=CUSTOMER_PROJECT_ID,
-            region=region,
-            analyzer_email=analyzer_email,
-            start_time_expr=start_time_expr,
-            end_time_expr=end_time_expr,
-            limit=WORST_QUERY_LIMIT,
-        )
+        extracted_regions.append(region)
+        # ワーストクエリ抽出（リージョンを指定してINFORMATION_SCHEMAを取得）
         try:
-            # リージョンを指定してINFORMATION_SCHEMAを取得
-            query_job = bq_client.query(formatted_sql, location=region)
-            all_jobs.extend(list(query_job.result()))
+            all_jobs.extend(
+                region_scan(region).query(
+                    "worst_ranking", worst_ranking_sql_template, limit=WORST_QUERY_LIMIT
+                )
+            )
         except Exception as e:
             logger.error(f"Error in {region}: {e}")
 
-    # 2. ランキングと重複排除
-    job_ranks = {}
-    if all_jobs:
-        sorted_billed = sorted(all_jobs, key=lambda x: x.billed_gb or 0.0, reverse=True)
-        sorted_duration = sorted(all_jobs, key=lambda x: x.duration_seconds or 0, reverse=True)
-        for rank, j in enumerate(sorted_billed, 1):
-            if j.job_id not in job_ranks:
-                job_ranks[j.job_id] = {}
-            job_ranks[j.job_id]["cost_rank"] = rank
-        for rank, j in enumerate(sorted_duration, 1):
-            job_ranks[j.job_id]["duration_rank"] = rank
-
-        worst_by_billed = sorted_billed[:WORST_QUERY_LIMIT]
-        worst_by_duration = sorted_duration[:WORST_QUERY_LIMIT]
-        final_worst_jobs = {job.job_id: job for job in (worst_by_billed + worst_by_duration)}
-        all_jobs = list(final_worst_jobs.values())
-        logger.info(f"Filtered down to project-wide worst queries: {len(all_jobs)} queries.")
-
-    # 3. ストレージ判定結果をレポートに追加
-    if storage_proposals:
-        report_lines.append("## 💾 ストレージ料金モデルの判定結果\n")
-        report_lines.append("\n".join(storage_proposals))
-        report_lines.append("---\n")
-    else:
-        logger.info("No valid storage data to report.")
-
-    # 4. ジョブがなければ終了
-    if not all_jobs:
-        logger.info("No queries to analyze.")
-        report_lines.append("対象のワーストクエリは見つかりませんでした。\n")
-        final_report = "\n".join(report_lines)
-        console_url, signed_url = upload_report_to_gcs(
-            GCS_BUCKET_NAME, final_report, CUSTOMER_PROJECT_ID
-        )
-        message = (
-            "解析が完了しました。対象のワーストクエリは見つかりませんでした。"
-            if console_url
-            else "解析は完了しましたが、レポートの保存に失敗しました。"
-        )
-        save_summary_for_workflow(
-            GCS_BUCKET_NAME, message, CUSTOMER_PROJECT_ID, report_url=signed_url or ""
-        )
-        return
-
-    # 5. 各ワーストクエリの解析
-    report_lines.append(f"## 🚨 ワーストクエリ解析（計 {len(all_jobs)} 件）\n")
+    sections = {section.key: [] for section in REPORT_SECTIONS}
+    census_rows = []
+    census_truncated = False
+    census_sql_template = section_templates.get("antipattern_census")
+    for region in extracted_regions:
+        scan = region_scan(region, REPORT_SECTION_RESERVE_SECONDS)
+        if not run_region_sections(scan, section_templates, sections):
+            break
+        # アンチパターンのセンサス（判定は全リージョン分を集めてから行う）
+        if census_sql_template and deadline.allows(REPORT_SECTION_RESERVE_SECONDS):
+            rows = fetch_census_queries(scan, census_sql_template)
+            census_rows.extend(rows)
+            census_truncated |= len(rows) >= ANTIPATTERN_CENSUS_MAX_QUERIES
+    text = analyze_antipattern_census(census_rows, deadline, census_truncated)
+    if text:
+        sections["antipattern_census"].append(f"{text}\n")
+    return sections, all_jobs
+
+
+def build_report_preamble(region_sections):
+    """レポート冒頭（見出しと、REPORT_SECTIONS のうち結果のある節）の Markdown。"""
+    report = ReportSink()
+    report.append("# BigQuery 監査レポート")
+    report.append(f"**対象プロジェクト:** `{CUSTOMER_PROJECT_ID}`")
+    report.append(f"**作成日時:** {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    report.append("\n---")
+    for section in REPORT_SECTIONS:
+        entries = region_sections.get(section.key)
+        if not entries:
+            continue
+        report.append(f"## {section.heading}\n")
+        report.append(f"{section.lead}\n")
+        report.append("\n".join(entries))
+        report.append("---\n")
+    return report.getvalue()
+
+
+def analyze_worst_jobs(
+    numbered_jobs,
+    total,
+    job_ranks,
+    bq_client,
+    storage_client,
+    model,
+    master_dict,
+    deadline,
+    open_section,
+):
+    """ワーストクエリを解析し、各クエリの節を open_section(通し番号) が返す先へ書く。
+
+    numbered_jobs は [(通し番号, job)]（シャード実行では担当分のみ）。
+    集計値 {"gemini_failures", "degraded_jobs", "generation_metrics", "partition_pruning",
+    "query_plans", "column_waste", "rewrite_validation"} を返す。
+    """
+    # 1. 各クエリの解析（スキーマ取得・構文解析）とプロンプト生成
+    #    上位から順に処理し、持ち時間が足りなければ下位のクエリほど縮退させる
+    prompts = {}
+    antipattern_results = {}
+    pruning_results = {}
+    plan_results = {}
+    waste_results = {}
+    for i, job in numbered_jobs:
+        level = degradation_level(deadline, GEMINI_MIN_BUDGET_SECONDS, ANALYSIS_MIN_BUDGET_SECONDS)
+        if level == SKIP:
+            logger.warning(f"Run deadline reached. Skipping analysis of Job {i}/{total}.")
+            continue
+
+        logger.info(f"Analyzing Job {i}/{total}: {job.job_id} ({job.region_name})")
+        # 構文解析ツールの呼び出し
+        antipattern_raw_text = analyze_antipatterns(job.query, deadline)
+        antipattern_results[job.job_id] = antipattern_raw_text
+        if level == ANTIPATTERN_ONLY:
+            logger.warning(
+                f"Run deadline is near. Job {job.job_id} gets anti-pattern results only."
+            )
+            continue
 
-    # 6. 各クエリに対して解析とGemini生成を実行
-    gemini_failures = 0
-    for i, job in enumerate(all_jobs, 1):
-        logger.info(f"Analyzing Job {i}/{len(all_jobs)}: {job.job_id} ({job.region_name})")
         logger.info("Extracting schema...")
-
         # スキーマ情報の取得 (ドライランの代わりにジョブ履歴の referenced_tables を渡す)
-        schema_info_text = get_query_schema_info(bq_client, getattr(job, "referenced_tables", []))
-        # 構文解析ツールの呼び出し
-        antipattern_raw_text = analyze_with_bq_antipattern_api(job.query)
+        referenced_tables = getattr(job, "referenced_tables", None) or []
+        with span("job.schema_info", tables=len(referenced_tables)):
+            tables = fetch_table_metadata(bq_client, referenced_tables, deadline)
+        schema_info_text = format_schema_info(tables)
+        # パーティション列・クラスタリング列での絞り込みを SQL から機械的に判定
+        with span("local.partition_pruning") as sp:
+            pruning = verify_pruning(job.query, tables)
+            sp.set(decided=pruning.decided, unpruned=len(pruning.unpruned))
+        pruning_results[job.job_id] = pruning
+        # 結果まで届く SELECT * で、クエリ中で使われていない列をどれだけ読んでいるか
+        if COLUMN_WASTE_ANALYSIS:
+            with span("local.column_waste") as sp:
+                waste = estimate_column_waste(
+                    job.query, tables, (getattr(job, "billed_gb", None) or 0) * 2**30
+                )
+                sp.set(decided=waste.decided, saved_bytes=round(waste.saved_bytes))
+            waste_results[job.job_id] = waste
+        # 実行計画から、スキャン・シャッフル・スピル・偏り・スロット待ちのどれが効いているか
+        if QUERY_PLAN_ANALYSIS:
+            plan_results[job.job_id] = fetch_query_plan(bq_client, job, deadline)
+        plan = plan_results.get(job.job_id)
+        plan_facts_text = plan.facts() if plan is not None else "- 取得していません。"
         # メモリ上の辞書から必要なルールだけを即座に抽出
         master_dict_text = extract_relevant_dictionary(master_dict, antipattern_raw_text)
         # Geminiへのプロンプト生成(外部ファイルの読み込みと変数注入)
-        prompt = build_gemini_prompt(job, schema_info_text, antipattern_raw_text, master_dict_text)
-
-        try:
-            response = model.generate_content(prompt)
-            logger.info(f"Gemini Response for Job {job.job_id}:\n{response.text}\n{'-' * 50}")
-            report_lines.append(
-                f"### 🔍 ワーストクエリ {i}/{len(all_jobs)} (Job: `{job.job_id}`)\n"
-            )
+        prompts[job.job_id] = build_gemini_prompt(
+            job,
+            schema_info_text,
+            antipattern_raw_text,
+            master_dict_text,
+            pruning.facts(),
+            plan_facts_text,
+        )
 
-            # --- ランキング情報の追記 ---
-            ranks = job_ranks.get(job.job_id, {})
-            cost_rank = ranks.get("cost_rank", "-")
-            duration_rank = ranks.get("duration_rank", "-")
-            report_lines.append(
-                f"**【プロジェクト全体ランキング】**\n- スキャン量: ワースト **{cost_rank}位**\n- 実行時間: ワースト **{duration_rank}位**\n"
-            )
-            # ---------------------------
+    # 2. Gemini による助言生成（同期 or バッチ予測）。stream は節の書き込み時に生成する
+    #    advices に無い job_id は、持ち時間不足で生成を省略したもの
+    generation_metrics = []
+    streaming = GEMINI_GENERATION_MODE == "stream"
+    if GEMINI_GENERATION_MODE == "batch":
+        logger.info(f"Submitting {len(prompts)} prompts as a Vertex AI batch prediction job...")
+        advices = generate_advice_batch(prompts, storage_client, GCS_BUCKET_NAME, deadline)
+    elif streaming:
+        advices = {}
+    else:
+        advices = generate_advice_sync(model, prompts, generation_metrics, deadline)
 
-            report_lines.append(response.text)
-            report_lines.append("\n---")
-        except Exception as e:
+    # 3. 各クエリの節を書き込む（助言の改善SQL はドライランで検証して、その結果も載せる）
+    rewrite_results = {}
+    gemini_failures = 0
+    degraded_jobs = 0
+    for i, job in numbered_jobs:
+        section = open_section(i)
+        if job.job_id in advices and advices[job.job_id] is None:
             gemini_failures += 1
-            logger.error(f"Failed to generate content from Gemini for Job {job.job_id}: {e}")
-            report_lines.append(
-                f"### 🔍 ワーストクエリ {i}/{len(all_jobs)} (Job: `{job.job_id}`)\n\n"
+            section.append(
+                f"### 🔍 ワーストクエリ {i}/{total} (Job: `{job.job_id}`)\n\n"
                 "⚠️ このクエリの助言生成に失敗しました。\n\n---"
             )
+            continue
 
-    # 7. レポートの結合と出力
-    final_report = "\n".join(report_lines)
+        section.append(f"### 🔍 ワーストクエリ {i}/{total} (Job: `{job.job_id}`)\n")
+
+        # --- ランキング情報の追記 ---
+        ranks = job_ranks.get(job.job_id, {})
+        cost_rank = ranks.get("cost_rank", "-")
+        duration_rank = ranks.get("duration_rank", "-")
+        section.append(
+            f"**【プロジェクト全体ランキング】**\n- スキャン量: ワースト **{cost_rank}位**\n- 実行時間: ワースト **{duration_rank}位**\n"
+        )
+        # ---------------------------
+        pruning = pruning_results.get(job.job_id)
+        if pruning is not None and pruning.has_facts:
+            section.append(f"**【パーティション・クラスタリングの検証】**\n{pruning.facts()}\n")
+        waste = waste_results.get(job.job_id)
+        if waste is not None and waste.has_facts:
+            section.append(f"**【SELECT * で読む列の無駄（推定）】**\n{waste.facts()}\n")
+        plan = plan_results.get(job.job_id)
+        if plan is not None and plan.stages:
+            section.append(f"**【実行計画のボトルネック】**\n{plan.facts()}\n")
+
+        advice = None
+        if job.job_id in advices:
+            advice = advices[job.job_id]
+            section.append(advice)
+        elif streaming and job.job_id in prompts and deadline.allows(GEMINI_MIN_BUDGET_SECONDS):
+            collector = RewriteCollector()
+            if stream_advice_into(
+                section,
+                model,
+                job.job_id,
+                prompts.pop(job.job_id),
+                generation_metrics,
+                deadline,
+                collector,
+            ):
+                # 打ち切った助言の改善SQL は途中までかもしれないため、検証しない
+                advice = None if collector.truncated else collector.advice()
+            else:
+                gemini_failures += 1
+        else:
+            degraded_jobs += 1
+            section.append(format_degraded_advice(antipattern_results.get(job.job_id)))
+        if REWRITE_VALIDATION and advice and deadline.allows(ANALYSIS_MIN_BUDGET_SECONDS):
+            check = validate_advice_rewrite(bq_client, job, advice, deadline)
+            if check is not None:
+                rewrite_results[job.job_id] = check
+                section.append(f"\n**【改善SQLのドライラン検証】**\n{check.facts()}")
+        section.append("\n---")
+
+    return {
+        "gemini_failures": gemini_failures,
+        "degraded_jobs": degraded_jobs,
+        "generation_metrics": generation_metrics,
+        "partition_pruning": [
+            {"job_id": job_id, **pruning.as_dict()} for job_id, pruning in pruning_results.items()
+        ],
+        "query_plans": [
+            {"job_id": job_id, **plan.as_dict()} for job_id, plan in plan_results.items()
+        ],
+        "column_waste": [
+            {"job_id": job_id, **waste.as_dict()} for job_id, waste in waste_results.items()
+        ],
+        "rewrite_validation": [
+            {"job_id": job_id, **check.as_dict()} for job_id, check in rewrite_results.items()
+        ],
+    }
+
+
+def collect_run_timing(spans=None):
+    """このプロセスの記録済みスパン（と他タスク分の spans）を集計し、構造化ログに出す。"""
+    records = list(spans or []) + drain_spans()
+    timing = summarize_spans(records)
+    logger.info(json.dumps({"message": "run_timing", **timing}, ensure_ascii=False))
+    return timing
+
+
+def finalize_report(final_report, total_jobs, stats):
+    """レポートを保存して summary.json を書く。実質的な失敗なら True を返す（呼び出し側で exit 1）。"""
+    gemini_failures = stats["gemini_failures"]
+    degraded_jobs = stats["degraded_jobs"]
     console_url, signed_url = upload_report_to_gcs(
         GCS_BUCKET_NAME, final_report, CUSTOMER_PROJECT_ID
     )
 
     if console_url:
-        analyzed = len(all_jobs) - gemini_failures
+        analyzed = total_jobs - gemini_failures - degraded_jobs
         if gemini_failures:
             message = (
-                f"解析が完了しましたが、{len(all_jobs)} 件中 {gemini_failures} 件で"
+                f"解析が完了しましたが、{total_jobs} 件中 {gemini_failures} 件で"
                 "助言の生成に失敗しました。"
             )
         else:
             message = f"解析が完了しました。ワーストクエリ {analyzed} 件を分析しました。"
+        if degraded_jobs:
+            message += f"（実行時間の上限のため {degraded_jobs} 件は助言を省略しました）"
         if not signed_url:
             message += "（署名付きURLの生成に失敗したため、GCSから直接ご確認ください）"
-        save_summary_for_workflow(
-            GCS_BUCKET_NAME, message, CUSTOMER_PROJECT_ID, report_url=signed_url or ""
-        )
     else:
-        save_summary_for_workflow(
-            GCS_BUCKET_NAME,
-            "解析が完了しましたが、レポートの保存に失敗しました。",
-            CUSTOMER_PROJECT_ID,
-        )
+        message = "解析が完了しましたが、レポートの保存に失敗しました。"
+    extra = {
+        "timing": collect_run_timing(stats.get("spans")),
+        "generation": stats.get("generation_metrics", []),
+        "partition_pruning": stats.get("partition_pruning", []),
+        "query_plan": stats.get("query_plans", []),
+        "column_waste": stats.get("column_waste", []),
+        "rewrite_validation": stats.get("rewrite_validation", []),
+    }
+    save_summary_for_workflow(
+        GCS_BUCKET_NAME, message, CUSTOMER_PROJECT_ID, report_url=signed_url or "", extra=extra
+    )
 
     # 助言が1件も作れていないなら、レポートは出ていても実質的な失敗。
     # 「成功したように見えて中身が無い」状態を検知できるよう exit 1 にする（ADR-0002）。
-    if gemini_failures == len(all_jobs):
+    # 持ち時間不足で生成を省略したクエリは Gemini の失敗ではないので数えない。
+    attempted = total_jobs - degraded_jobs
+    if attempted and gemini_failures == attempted:
         logger.error(
-            f"すべてのワーストクエリ（{len(all_jobs)} 件）で Gemini の生成に失敗しました。"
+            f"生成を試みたすべてのワーストクエリ（{attempted} 件）で Gemini の生成に失敗しました。"
             f"モデル '{GEMINI_MODEL}' がリージョン '{LOCATION}' で利用可能か確認してください。"
         )
+        return True
+    return False
+
+
+def finalize_without_jobs(preamble):
+    """ワーストクエリが無かった場合のレポート保存と summary.json。"""
+    logger.info("No queries to analyze.")
+    report = ReportSink()
+    report.write(preamble)
+    report.append("対象のワーストクエリは見つかりませんでした。\n")
+    console_url, signed_url = upload_report_to_gcs(
+        GCS_BUCKET_NAME, report.getvalue(), CUSTOMER_PROJECT_ID
+    )
+    message = (
+        "解析が完了しました。対象のワーストクエリは見つかりませんでした。"
+        if console_url
+        else "解析は完了しましたが、レポートの保存に失敗しました。"
+    )
+    save_summary_for_workflow(
+        GCS_BUCKET_NAME,
+        message,
+        CUSTOMER_PROJECT_ID,
+        report_url=signed_url or "",
+        extra={"timing": collect_run_timing()},
+    )
+
+
+def init_generative_model():
+    """Vertex AI を初期化して Gemini のモデルを返す（vertexai の import もここで起きる）。"""
+    with span("vertexai.init"):
+        vertexai.init(project=SAAS_PROJECT_ID, location=LOCATION)
+        return generative_models.GenerativeModel(GEMINI_MODEL)
+
+
+def run_startup_checks(bq_client, customer_bq_client, storage_client, deadline, extracts):
+    """互いに独立な起動時の確認・準備を並行して実行し、{名前: 結果} を返す。
+
+    どれも外部サービスの応答待ち（と vertexai の import）が大半なので、スレッドで重ねる。
+    extracts が False（シャード実行でタスク 0 以外）ならワーストクエリ抽出用の準備は省く。
+    """
+    tasks = {
+        "bucket_ok": (check_bucket_exists, storage_client, GCS_BUCKET_NAME),
+        "model": (init_generative_model,),
+    }
+    if extracts:
+        tasks["analyzer_email"] = (get_current_user_email, bq_client, deadline)
+        tasks["master_dict"] = (load_master_dictionary, bq_client, SAAS_PROJECT_ID, deadline)
+        tasks["target_regions"] = (
+            get_active_regions,
+            customer_bq_client,
+            CUSTOMER_PROJECT_ID,
+            deadline,
+        )
+    with span("startup.checks", tasks=len(tasks)):
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = {name: executor.submit(*task) for name, task in tasks.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+
+def create_shard_store(storage_client):
+    """シャード間の共有ストア。SHARD_STORE_DIR があればローカルディレクトリを使う。"""
+    if SHARD_STORE_DIR:
+        return LocalShardStore(SHARD_STORE_DIR)
+    return GcsShardStore(storage_client.bucket(GCS_BUCKET_NAME))
+
+
+def create_history_store(storage_client):
+    """ストレージ判定の履歴の置き場所（レポートバケット）。STORAGE_HISTORY=false なら None。"""
+    if not STORAGE_HISTORY:
+        return None
+    return GcsShardStore(storage_client.bucket(GCS_BUCKET_NAME))
+
+
+# ==========================================
+# メインプロセス
+# ==========================================
+
+
+def shard_context_or_exit():
+    """環境変数のシャード設定。不正なら（設定不備は復旧不能なので）exit 1 で終える。"""
+    try:
+        return ShardContext.from_env()
+    except ValueError as e:
+        logger.error(f"Invalid shard configuration: {e}")
+        sys.exit(1)
+
+
+def run_with_profiling():
+    """run() をプロファイルし、終了の仕方（sys.exit を含む）に関わらず結果を保存する。"""
+    shard = shard_context_or_exit()
+    run_id = shard.run_id
+    if run_id == "local":
+        run_id = f"local_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    logger.info(f"Profiling mode enabled (run_id={run_id}, task={shard.task_index}).")
+
+    session = profiling.ProfileSession(top_n=PROFILE_TOP_N)
+    try:
+        with session:
+            run()
+    finally:
+        logger.info(
+            f"Profile finished: wall={session.wall_seconds}s, "
+            f"peak_traced_memory={session.peak_memory_bytes} bytes"
+        )
+        if GCS_BUCKET_NAME:
+            try:
+                bucket = storage.Client(project=CUSTOMER_PROJECT_ID).bucket(GCS_BUCKET_NAME)
+                for path in profiling.upload_profile(bucket, session, run_id, shard.task_index):
+                    logger.info(f"Profile uploaded to: gs://{GCS_BUCKET_NAME}/{path}")
+            except Exception as e:
+                logger.error(f"Failed to upload profile: {e}")
+
+
+def main():
+    if TIMING_OTEL_EXPORT:
+        enable_otel_export()
+    try:
+        if PROFILE_MODE:
+            run_with_profiling()
+        else:
+            run()
+    finally:
+        if TIMING_OTEL_EXPORT:
+            shutdown_otel()
+
+
+def run():
+    if not SAAS_PROJECT_ID or not CUSTOMER_PROJECT_ID:
+        # 設定不備は復旧不能なエラー。exit 1 で Workflow に失敗を伝える（サイレント失敗防止）。
+        logger.error(
+            "SAAS_PROJECT_ID / CUSTOMER_PROJECT_ID が未設定です。Workflow の overrides を確認してください。"
+        )
+        sys.exit(1)
+
+    # 実行全体の持ち時間。以降の各ステージのタイムアウトはここから割り当てる
+    deadline = RunDeadline(RUN_DEADLINE_SECONDS, RUN_FINALIZE_RESERVE_SECONDS)
+
+    # 複数タスク実行時は、タスク 0 が抽出・ランキングを行い、全タスクで解析を分担する
+    shard = shard_context_or_exit()
+    extracts = not shard.sharded or shard.is_coordinator
+
+    # クライアント初期化
+    bq_client = bigquery.Client(project=SAAS_PROJECT_ID)
+    customer_bq_client = bigquery.Client(project=CUSTOMER_PROJECT_ID)
+    storage_client = storage.Client(project=CUSTOMER_PROJECT_ID)  # 顧客プロジェクト用
+
+    # バケットの疎通確認・Gemini の初期化・抽出の下準備を並行して行う
+    startup = run_startup_checks(bq_client, customer_bq_client, storage_client, deadline, extracts)
+    if not startup["bucket_ok"]:
+        # バケットにアクセスできない＝顧客側IAM未整備等。exit 1 で明示的に失敗させる。
+        logger.error("レポートバケットにアクセスできないため中断します（exit 1）。")
+        sys.exit(1)
+    model = startup["model"]
+
+    store = create_shard_store(storage_client) if shard.sharded else None
+    if shard.sharded:
+        logger.info(
+            f"Sharded run: task {shard.task_index}/{shard.task_count} (run: {shard.run_id})"
+        )
+
+    # タスク 0 の再試行では、既に共有したマニフェストを使い回す（他タスクとの整合を保つ）
+    manifest = load_manifest(store, shard) if shard.sharded and shard.is_coordinator else None
+    if shard.sharded and shard.is_coordinator and manifest is None:
+        clear_stale_shards(store, shard)
+    if shard.sharded and not shard.is_coordinator:
+        manifest = wait_for_manifest(store, shard, deadline, SHARD_MANIFEST_POLL_SECONDS)
+        if manifest is None:
+            logger.error("タスク 0 の抽出結果（マニフェスト）が届かないため中断します（exit 1）。")
+            sys.exit(1)
+
+    if manifest is not None:
+        preamble = manifest["preamble"]
+        all_jobs = manifest["jobs"]
+        job_ranks = manifest["job_ranks"]
+        master_dict = manifest["master_dict"]
+        if not all_jobs:
+            # 対象なしの保存はタスク 0 が済ませている
+            logger.info("No queries to analyze in this run.")
+            return
+    else:
+        # 外部SQLファイルのロード
+        try:
+            worst_ranking_sql_template = load_external_file(WORST_RANKING_SQL_PATH)
+            section_templates = load_section_templates()
+        except Exception as e:
+            logger.error(f"SQL file loading error: {e}")
+            sys.exit(1)
+
+        # 基本情報（起動時に並行して取得済み）
+        analyzer_email = startup["analyzer_email"]
+        # Cloud Run では K_SERVICE 環境変数がセットされるため、それを利用して判定
+        if os.getenv("K_SERVICE"):
+            exec_env = "Cloud Run"
+        else:
+            exec_env = "Local"
+        logger.info(f"Execution Environment : {exec_env}")
+        logger.info(f"Execution Account     : {analyzer_email} (To be excluded)")
+        master_dict = startup["master_dict"]
+        target_regions = startup["target_regions"]
+
+        if not target_regions:
+            logger.info("No active regions found.")
+            if shard.sharded:
+                publish_manifest(store, shard, "", [], {}, master_dict)
+            save_summary_for_workflow(
+                GCS_BUCKET_NAME,
+                "分析対象のリージョン（データセット）が見つかりませんでした。",
+                CUSTOMER_PROJECT_ID,
+                extra={"timing": collect_run_timing()},
+            )
+            return
+
+        # 1. 各リージョンからのデータ収集
+        region_sections, all_jobs = collect_region_data(
+            bq_client,
+            target_regions,
+            analyzer_email,
+            worst_ranking_sql_template,
+            section_templates,
+            deadline,
+            create_history_store(storage_client),
+        )
+        # 2. ランキングと重複排除
+        all_jobs, job_ranks = rank_worst_jobs(all_jobs)
+        # 3. レポート冒頭（ストレージ判定結果・料金の試算・スロット使用量のピーク・MV の候補・配置の推奨）
+        preamble = build_report_preamble(region_sections)
+
+        if shard.sharded:
+            publish_manifest(store, shard, preamble, all_jobs, job_ranks, master_dict)
+
+        # 4. ジョブがなければ終了
+        if not all_jobs:
+            finalize_without_jobs(preamble)
+            return
+
+    analysis_heading = f"## 🚨 ワーストクエリ解析（計 {len(all_jobs)} 件）\n"
+
+    # 5. 各ワーストクエリの解析（単一タスクならレポートへ直接書き込む）
+    if not shard.sharded:
+        report = ReportSink()
+        report.write(preamble)
+        report.append(analysis_heading)
+        stats = analyze_worst_jobs(
+            list(enumerate(all_jobs, 1)),
+            len(all_jobs),
+            job_ranks,
+            bq_client,
+            storage_client,
+            model,
+            master_dict,
+            deadline,
+            open_section=lambda number: report,
+        )
+        # 6. レポートの保存と summary.json
+        if finalize_report(report.getvalue(), len(all_jobs), stats):
+            sys.exit(1)
+        return
+
+    # 5'. シャード実行: 担当分を節ごとに解析してシャードとして書き出す
+    sections = []
+
+    def open_section(number):
+        sink = ReportSink()
+        sections.append((number, sink))
+        return sink
+
+    stats = analyze_worst_jobs(
+        shard.select(all_jobs),
+        len(all_jobs),
+        job_ranks,
+        bq_client,
+        storage_client,
+        model,
+        master_dict,
+        deadline,
+        open_section,
+    )
+    # このタスクの計時もシャードに載せ、結合時にまとめて集計する
+    stats["spans"] = drain_spans()
+    write_shard_result(store, shard, [(n, sink.getvalue()) for n, sink in sections], stats)
+    logger.info(f"Shard {shard.task_index} written ({len(sections)} sections).")
+
+    # 6'. 全シャードが揃っていれば（＝最後に書き終えたタスクなら）結合して保存する
+    shard_results = collect_shard_results(store, shard)
+    if shard_results is None or not store.try_claim(shard.merge_claim_path):
+        logger.info("Other shards are still running or already merging. Leaving merge to them.")
+        return
+
+    logger.info(f"Merging {shard.task_count} shards into the final report...")
+    merged_sections, merged_stats = merge_shard_results(shard_results)
+    report = ReportSink()
+    report.write(preamble)
+    report.append(analysis_heading)
+    for section in merged_sections:
+        report.write(section)
+    failed = finalize_report(report.getvalue(), len(all_jobs), merged_stats)
+    cleanup_shards(store, shard)
+    if failed:
         sys.exit(1)
 
 
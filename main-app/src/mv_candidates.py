@@ -0,0 +1,529 @@
+"""マテリアライズドビュー・BI Engine の候補（繰り返し実行される集計）の抽出。
+
+ダッシュボードは、同じテーブルに対するほぼ同じ集計を1日に何度も実行する。
+ワーストクエリのランキングは1件ごとに並べるため、1回は軽くても回数で効いている集計は
+上位に出てこない。sql/repeated_aggregations.sql でリテラルだけが違うクエリ
+（query_hashes.normalized_literals が同じもの）をまとめ、ここでさらに参照テーブルと
+GROUP BY の列が同じものを1つの候補にまとめる。
+
+候補ごとに、マテリアライズドビュー（1時間ごとの更新）と BI Engine の予約で削減できる
+課金バイト・スロット時間を見積もり、ビューにできるものは作成の DDL を示す。
+WHERE でリテラルと比べている列は実行ごとに値が変わるため、ビューでは GROUP BY に加える
+（BigQuery がクエリをビューに書き換えられる形にする）。
+"""
+
+import math
+from dataclasses import dataclass, field
+
+from antipattern_rules import (
+    Group,
+    PrescreenError,
+    Token,
+    build_tree,
+    is_word,
+    split_and,
+    tokenize,
+)
+from compute_pricing import MONTH_MINUTES, ON_DEMAND_USD_PER_TIB
+
+# BI Engine の予約の単価（米国マルチリージョンの定価、USD / GiB・時間）と、予約できる上限
+BI_ENGINE_USD_PER_GIB_HOUR = 0.0416
+BI_ENGINE_MAX_GIB = 250
+# ビューの更新間隔（分）。更新1回で元の集計1回分を読むとみなす
+MV_REFRESH_INTERVAL_MINUTES = 60
+
+MATERIALIZED_VIEW = "materialized_view"
+BI_ENGINE = "bi_engine"
+
+# 増分更新のマテリアライズドビューで使えない集計関数
+_UNSUPPORTED_AGGREGATES = frozenset({"ARRAY_AGG", "STRING_AGG", "ARRAY_CONCAT_AGG"})
+# 実行ごとに結果が変わる関数（ビューの定義に使えない）
+_NON_DETERMINISTIC = frozenset(
+    {
+        "CURRENT_DATE",
+        "CURRENT_DATETIME",
+        "CURRENT_TIME",
+        "CURRENT_TIMESTAMP",
+        "RAND",
+        "GENERATE_UUID",
+        "SESSION_USER",
+    }
+)
+# 集計関数（引数の列は集計される値で、ビューの GROUP BY には加えない）
+_AGGREGATES = frozenset(
+    {"SUM", "AVG", "MIN", "MAX", "COUNT", "COUNTIF", "ANY_VALUE", "LOGICAL_AND", "LOGICAL_OR"}
+    | {"APPROX_COUNT_DISTINCT", "HLL_COUNT", "STDDEV", "VARIANCE"}
+)
+# 最上位の SELECT を区切るキーワード
+_CLAUSES = ("FROM", "WHERE", "GROUP", "HAVING", "QUALIFY", "WINDOW", "ORDER", "LIMIT")
+# 直後の括弧を関数の引数として詰めて書かないキーワード
+_SPACED_KEYWORDS = frozenset(
+    {"AND", "AS", "BETWEEN", "BY", "FROM", "IN", "JOIN", "NOT", "ON", "OR", "OVER", "SELECT"}
+    | {"USING", "WHERE", "WHEN", "THEN", "ELSE", "EXISTS"}
+)
+# リテラルとの比較に現れてよいキーワード（DATE '2024-01-01' などの型付きリテラルを含む）
+_LITERAL_WORDS = frozenset(
+    {"AND", "BETWEEN", "IN", "NOT", "LIKE", "IS", "NULL", "TRUE", "FALSE"}
+    | {"DATE", "DATETIME", "TIMESTAMP"}
+)
+_GIB = 2**30
+_MONTH_HOURS = MONTH_MINUTES / 60
+
+
+# ==========================================
+# 集計クエリの形
+# ==========================================
+
+
+def render(items):
+    """Token と Group の列を SQL の文字列に戻す。"""
+    text = ""
+    previous = None
+    for item in items:
+        if isinstance(item, Group):
+            piece = "(" + render(item.items) + ")"
+            call = (
+                isinstance(previous, Token)
+                and previous.kind in ("word", "quoted")
+                and previous.upper not in _SPACED_KEYWORDS
+            )
+            glue = "" if call or not text or text.endswith(".") else " "
+        else:
+            piece = item.text
+            glue = "" if not text or piece in (",", ".", ";") or text.endswith(".") else " "
+        text += glue + piece
+        previous = item
+    return text
+
+
+def _split_commas(items):
+    parts, current = [], []
+    for item in items:
+        if isinstance(item, Token) and item.text == ",":
+            parts.append(current)
+            current = []
+        else:
+            current.append(item)
+    parts.append(current)
+    return [part for part in parts if part]
+
+
+def _clauses(items):
+    """最上位の SELECT を {句の名前: items} に分ける（GROUP BY・ORDER BY は BY を除く）。"""
+    clauses = {}
+    name, start = "SELECT", 1
+    for i, item in enumerate(items[1:], 1):
+        if is_word(item, *_CLAUSES) and item.upper not in clauses:
+            clauses[name] = items[start:i]
+            name = item.upper
+            start = i + 2 if name in ("GROUP", "ORDER") else i + 1
+    clauses[name] = items[start:]
+    return clauses
+
+
+def _filter_column(predicate):
+    """「列 比較 リテラル」の条件なら列（の式）の文字列を返す（それ以外は None）。"""
+    for i, item in enumerate(predicate):
+        if isinstance(item, Token) and (
+            item.kind == "op" or item.is_keyword("IN", "BETWEEN", "LIKE", "NOT", "IS")
+        ):
+            break
+    else:
+        return None
+    column, rest = predicate[:i], predicate[i:]
+    # 列そのもの（t.a）か、列を関数で包んだ式（DATE(created_at) など）
+    if not column or not all(
+        t.kind in ("word", "quoted") or t.text in (".", ",") for t in _flatten(column)
+    ):
+        return None
+    literals = 0
+    for token in _flatten(rest):
+        if token.kind in ("string", "number"):
+            literals += 1
+        elif not (token.kind == "op" or token.text == "," or token.upper in _LITERAL_WORDS):
+            return None
+    return render(column) if literals else None
+
+
+def _aggregated_columns(items):
+    """集計関数の引数に現れる列名（小文字）。"""
+    columns = set()
+    for previous, item in zip(items, items[1:]):
+        if isinstance(item, Group) and is_word(previous, *_AGGREGATES):
+            columns |= {t.name for t in _flatten(item.items) if t.kind in ("word", "quoted")}
+    for item in items:
+        if isinstance(item, Group):
+            columns |= _aggregated_columns(item.items)
+    return columns
+
+
+def _flatten(items):
+    for item in items:
+        if isinstance(item, Group):
+            yield from _flatten(item.items)
+        else:
+            yield item
+
+
+@dataclass
+class AggregationShape:
+    """1ブロックの集計クエリの形。problems が空ならビューにできる。"""
+
+    select: list  # SELECT の各式（items）
+    source: list  # FROM 句（JOIN を含む）
+    predicates: list  # ビューに残す WHERE の条件（リテラルを含まないもの）
+    filter_columns: list  # リテラルと比べている列（ビューの GROUP BY に加える）
+    group_keys: list  # GROUP BY の各式（文字列）
+    problems: list = field(default_factory=list)
+
+    def _outputs(self):
+        """SELECT の各式の {式（別名を除く、小文字）: 出力名（別名、無ければ式）}。"""
+        outputs = {}
+        for expr in self.select:
+            if len(expr) > 2 and is_word(expr[-2], "AS"):
+                outputs[render(expr[:-2]).lower()] = render(expr[-1:])
+            else:
+                outputs[render(expr).lower()] = render(expr)
+        return outputs
+
+    def absorb(self, other):
+        """同じまとまりの別のクエリの集計・条件の列をビューに加える（1つのビューで両方に答える）。"""
+        outputs = self._outputs()
+        names = {name.lower() for name in outputs.values()}
+        for expr in other.select:
+            text = render(expr).lower()
+            if text in outputs or text in {f"{e} as {n.lower()}" for e, n in outputs.items()}:
+                continue
+            alias = render(expr[-1:]).lower() if len(expr) > 2 and is_word(expr[-2], "AS") else None
+            if alias in names:
+                self.problems.append(
+                    f"別名 {alias} が別の式で使われている（どちらかの別名の変更が必要）"
+                )
+                continue
+            self.select.append(expr)
+        # ビューに残した条件の列（amount > 0 の amount など）は GROUP BY に加えない
+        kept_columns = {(_filter_column(p) or "").lower() for p in self.predicates}
+        for column in other.filter_columns:
+            if column.lower() not in {c.lower() for c in self.filter_columns} | kept_columns:
+                self.filter_columns.append(column)
+        # ビューに残す条件は両方のクエリにあること（相手のほうは GROUP BY に加えた列への条件でもよい）
+        grouped = {c.lower() for c in self.filter_columns}
+        kept = {render(p).lower() for p in self.predicates}
+        other_kept = {render(p).lower() for p in other.predicates}
+        other_columns = {c.lower() for c in other.filter_columns}
+        if any(
+            render(p).lower() not in kept and (_filter_column(p) or "").lower() not in grouped
+            for p in other.predicates
+        ) or any(
+            render(p).lower() not in other_kept
+            and (_filter_column(p) or "").lower() not in other_columns
+            for p in self.predicates
+        ):
+            self.problems.append("クエリによってビューに残す WHERE の条件が異なる")
+        self.problems += [p for p in other.problems if p not in self.problems]
+
+    @property
+    def view_keys(self):
+        """ビューの GROUP BY（元の GROUP BY に、条件の列を SELECT の出力名で加えたもの）。"""
+        outputs = self._outputs()
+        keys = list(self.group_keys)
+        for column in self.filter_columns:
+            key = outputs.get(column.lower(), column)
+            if key.lower() not in {k.lower() for k in keys}:
+                keys.append(key)
+        return keys
+
+    def view_sql(self):
+        """ビューの定義（SELECT 文）。"""
+        outputs = self._outputs()
+        extra = [c for c in self.filter_columns if c.lower() not in outputs]
+        lines = [
+            "SELECT",
+            "  " + ",\n  ".join(extra + [render(expr) for expr in self.select]),
+            "FROM",
+            "  " + render(self.source),
+        ]
+        if self.predicates:
+            lines += ["WHERE", "  " + "\n  AND ".join(render(p) for p in self.predicates)]
+        lines += ["GROUP BY", "  " + ",\n  ".join(self.view_keys)]
+        return "\n".join(lines)
+
+
+def parse_aggregation(sql):
+    """1ブロックの集計クエリ（SELECT ... GROUP BY）の形を返す。読めなければ None。"""
+    try:
+        items = build_tree(tokenize(sql)).items
+    except PrescreenError:
+        return None
+    while items and isinstance(items[-1], Token) and items[-1].text == ";":
+        items = items[:-1]
+    if not items or not is_word(items[0], "SELECT"):
+        return None
+    if any(isinstance(t, Token) and t.text == ";" for t in items):
+        return None
+    clauses = _clauses(items)
+    if "GROUP" not in clauses or "FROM" not in clauses:
+        return None
+
+    problems = []
+    tokens = list(_flatten(items))
+    names = {t.upper for t in tokens if t.kind == "word"}
+    if names & {"UNION", "INTERSECT", "EXCEPT"}:
+        return None
+    if "OVER" in names:
+        problems.append("ウィンドウ関数（OVER）を含む")
+    if unsupported := sorted(names & _UNSUPPORTED_AGGREGATES):
+        problems.append(f"増分更新で使えない集計関数（{', '.join(unsupported)}）を含む")
+    if _has_count_distinct(items):
+        problems.append(
+            "COUNT(DISTINCT) を含む（APPROX_COUNT_DISTINCT に置き換えると増分更新できる）"
+        )
+    if nondeterministic := sorted(names & _NON_DETERMINISTIC):
+        problems.append(f"実行ごとに結果が変わる関数（{', '.join(nondeterministic)}）を含む")
+    if any(isinstance(item, Group) and item.is_query for item in clauses["FROM"]):
+        problems.append("FROM 句にサブクエリを含む")
+
+    measures = _aggregated_columns(clauses["SELECT"])
+    predicates, filter_columns = [], []
+    where = clauses.get("WHERE", [])
+    split = split_and(where) if where else []
+    if split is None:
+        problems.append("WHERE の最上位に OR があり、条件の列をビューの GROUP BY に移せない")
+        split = []
+    for predicate in split:
+        column = _filter_column(predicate)
+        if column is not None and column.rsplit(".", 1)[-1].strip("`").lower() in measures:
+            # 集計される値への条件（amount > 0 など）は、毎回同じ条件とみなしてビューに残す
+            predicates.append(predicate)
+            continue
+        if column is None:
+            if any(t.kind in ("string", "number") for t in _flatten(predicate)):
+                problems.append(f"リテラルを含む条件（{render(predicate)}）をビューの列に移せない")
+            predicates.append(predicate)
+        elif column.lower() not in {c.lower() for c in filter_columns}:
+            filter_columns.append(column)
+
+    group_keys = [render(key) for key in _split_commas(clauses["GROUP"])]
+    if any(key.isdigit() for key in group_keys):
+        problems.append("GROUP BY に列番号を使っている（列名に書き換えが必要）")
+    return AggregationShape(
+        select=_split_commas(clauses["SELECT"]),
+        source=clauses["FROM"],
+        predicates=predicates,
+        filter_columns=filter_columns,
+        group_keys=group_keys,
+        problems=problems,
+    )
+
+
+def _has_count_distinct(items):
+    for previous, item in zip(items, items[1:]):
+        if (
+            is_word(previous, "COUNT")
+            and isinstance(item, Group)
+            and item.items
+            and is_word(item.items[0], "DISTINCT")
+        ):
+            return True
+    return any(isinstance(item, Group) and _has_count_distinct(item.items) for item in items)
+
+
+# ==========================================
+# 候補のまとめと見積もり
+# ==========================================
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+@dataclass
+class Candidate:
+    """参照テーブルと GROUP BY の列が同じ集計クエリのまとまり。"""
+
+    tables: tuple
+    shape: AggregationShape | None
+    sample_query: str
+    period_hours: float
+    query_hashes: int = 0
+    runs: int = 0
+    users: int = 0
+    hour_buckets: set = field(default_factory=set)  # 実行のあった時間帯（1時間単位）
+    billed_bytes: int = 0
+    slot_ms: int = 0
+
+    @property
+    def bytes_per_run(self):
+        return self.billed_bytes / self.runs if self.runs else 0
+
+    @property
+    def month_scale(self):
+        """調査期間の値を30日あたりに換算する倍率。"""
+        return _MONTH_HOURS / self.period_hours if self.period_hours else 1.0
+
+    @property
+    def active_hours(self):
+        return len(self.hour_buckets)
+
+    @property
+    def mv_refreshes(self):
+        """期間中のビューの更新回数（実行のあった時間帯ごとに1回、実行回数以下）。"""
+        per_hour = max(60 // MV_REFRESH_INTERVAL_MINUTES, 1)
+        return min(self.active_hours * per_hour, self.runs)
+
+    @property
+    def mv_saved_share(self):
+        """ビューにしたときに減る読み取りの割合。更新1回で元の集計1回分を読むとみなす。"""
+        if self.shape is None or self.shape.problems or not self.runs:
+            return 0.0
+        return max(1 - self.mv_refreshes / self.runs, 0.0)
+
+    @property
+    def mv_saved_usd(self):
+        saved = self.billed_bytes * self.mv_saved_share * self.month_scale
+        return saved / 2**40 * ON_DEMAND_USD_PER_TIB
+
+    @property
+    def bi_engine_gib(self):
+        """BI Engine に載せる量の目安（1回の実行で読む量を GiB 単位に切り上げ）。"""
+        return max(math.ceil(self.bytes_per_run / _GIB), 1)
+
+    @property
+    def bi_engine_monthly_usd(self):
+        return self.bi_engine_gib * BI_ENGINE_USD_PER_GIB_HOUR * _MONTH_HOURS
+
+    @property
+    def bi_engine_saved_usd(self):
+        """BI Engine で高速化されたクエリは課金バイトが0になる。予約の料金を引いた月あたりの差額。"""
+        if self.bi_engine_gib > BI_ENGINE_MAX_GIB:
+            return 0.0
+        on_demand = self.billed_bytes * self.month_scale / 2**40 * ON_DEMAND_USD_PER_TIB
+        return on_demand - self.bi_engine_monthly_usd
+
+    @property
+    def recommendation(self):
+        if self.mv_saved_usd <= 0 and self.bi_engine_saved_usd <= 0:
+            return None
+        return MATERIALIZED_VIEW if self.mv_saved_usd >= self.bi_engine_saved_usd else BI_ENGINE
+
+    @property
+    def saved_share(self):
+        """推奨の方法で減る読み取り・スロット時間の割合（BI Engine はすべて）。"""
+        return self.mv_saved_share if self.recommendation == MATERIALIZED_VIEW else 1.0
+
+    @property
+    def saved_bytes(self):
+        """月あたりの課金バイトの削減見込み。"""
+        return self.billed_bytes * self.saved_share * self.month_scale
+
+    @property
+    def saved_slot_hours(self):
+        """月あたりのスロット時間の削減見込み。"""
+        return self.slot_ms / 1000 / 3600 * self.saved_share * self.month_scale
+
+    @property
+    def saved_usd(self):
+        return max(self.mv_saved_usd, self.bi_engine_saved_usd, 0.0)
+
+    def view_name(self):
+        table = self.tables[0].rsplit(".", 1)[-1] if self.tables else "query"
+        keys = (
+            "_".join(k.rsplit(".", 1)[-1] for k in self.shape.view_keys[:2]) if self.shape else ""
+        )
+        return f"mv_{table}_by_{keys}" if keys else f"mv_{table}"
+
+    def ddl(self):
+        """ビューを作成する DDL（ビューにできなければ None）。"""
+        if self.shape is None or self.shape.problems:
+            return None
+        project_dataset = self.tables[0].rsplit(".", 1)[0] if self.tables else "dataset"
+        return (
+            f"CREATE MATERIALIZED VIEW `{project_dataset}.{self.view_name()}`\n"
+            f"OPTIONS (enable_refresh = true, "
+            f"refresh_interval_minutes = {MV_REFRESH_INTERVAL_MINUTES})\n"
+            f"AS\n{self.shape.view_sql()};"
+        )
+
+
+def find_candidates(rows):
+    """sql/repeated_aggregations.sql の結果を候補にまとめ、削減見込みの大きい順に返す。"""
+    candidates = {}
+    # 課金バイトの多い順に見て、まとまりの代表（DDL の元）を最も重いクエリにする
+    for row in sorted(rows, key=lambda r: _field(r, "billed_bytes") or 0, reverse=True):
+        query = _field(row, "sample_query")
+        shape = parse_aggregation(query)
+        tables = tuple(sorted(_field(row, "tables") or []))
+        keys = tuple(sorted(k.lower() for k in shape.group_keys)) if shape else (query,)
+        candidate = candidates.get((tables, keys))
+        if candidate is None:
+            candidate = Candidate(tables, shape, query, float(_field(row, "period_hours") or 0))
+            candidates[(tables, keys)] = candidate
+        elif shape is not None:
+            candidate.shape.absorb(shape)
+        candidate.query_hashes += 1
+        candidate.runs += int(_field(row, "runs") or 0)
+        candidate.users = max(candidate.users, int(_field(row, "users") or 0))
+        # まとめたクエリの実行の時間帯の和集合（ビューの更新はどのクエリの実行時間帯にも要る）
+        candidate.hour_buckets.update(_field(row, "active_hour_buckets") or [])
+        candidate.billed_bytes += int(_field(row, "billed_bytes") or 0)
+        candidate.slot_ms += int(_field(row, "slot_ms") or 0)
+    ranked = [c for c in candidates.values() if c.recommendation]
+    return sorted(ranked, key=lambda c: c.saved_usd, reverse=True)
+
+
+# ==========================================
+# レポート
+# ==========================================
+
+
+def _describe(candidate):
+    if candidate.recommendation == MATERIALIZED_VIEW:
+        return "マテリアライズドビュー"
+    return f"BI Engine（{candidate.bi_engine_gib} GiB の予約、月 ${candidate.bi_engine_monthly_usd:,.2f}）"
+
+
+def format_candidates(candidates, max_candidates=5, max_ddl=3):
+    """レポートに載せる Markdown（候補の表と、ビューの DDL）。"""
+    if not candidates:
+        return "繰り返し実行される集計クエリはありませんでした。"
+    lines = [
+        "| # | 参照テーブル | 実行回数 | 利用者 | 1回あたり (GiB) | 推奨 | 削減見込み (GiB / 月) "
+        "| 削減見込み (スロット時間 / 月) | 削減見込み (USD / 月) |",
+        "|--:|---|--:|--:|--:|---|--:|--:|--:|",
+    ]
+    shown = candidates[:max_candidates]
+    for number, candidate in enumerate(shown, 1):
+        tables = "<br>".join(f"`{t}`" for t in candidate.tables)
+        lines.append(
+            f"| {number} | {tables} | {candidate.runs:,} | {candidate.users} "
+            f"| {candidate.bytes_per_run / _GIB:,.2f} | {_describe(candidate)} "
+            f"| {candidate.saved_bytes / _GIB:,.1f} | {candidate.saved_slot_hours:,.1f} "
+            f"| {candidate.saved_usd:,.2f} |"
+        )
+    ddl_shown = 0
+    for number, candidate in enumerate(shown, 1):
+        ddl = candidate.ddl()
+        if ddl is None and candidate.shape is not None:
+            lines += [
+                "",
+                f"**候補 {number}** はビューにできません: {'、'.join(candidate.shape.problems)}",
+            ]
+            continue
+        if candidate.recommendation != MATERIALIZED_VIEW or ddl is None or ddl_shown >= max_ddl:
+            continue
+        ddl_shown += 1
+        lines += [
+            "",
+            f"**候補 {number}: {', '.join(f'`{t}`' for t in candidate.tables)} の集計"
+            f"（{candidate.query_hashes} 種類のクエリ・計 {candidate.runs:,} 回）**",
+            "",
+            "```sql",
+            ddl,
+            "```",
+        ]
+    lines.append(
+        "\nWHERE でリテラルと比べている列はビューの GROUP BY に加えています。"
+        "集計の粒度が細かくなりすぎる列（タイムスタンプなど）は、DATE() などで丸めてください。"
+        "削減見込みはオンデマンドの定価による概算で、ビューの保存料金は含みません。"
+    )
+    return "\n".join(lines)
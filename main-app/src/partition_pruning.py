@@ -0,0 +1,706 @@
+"""パーティションの絞り込み（プルーニング）とクラスタリング列の利用の検証。
+
+ワーストクエリには、パーティション分割されたテーブルをパーティション列で絞り込まずに
+全期間スキャンしているものが多い。これまではスキーマ情報と SQL を Gemini に渡して
+見つけてもらっていたが、見落としや誤検知がある。ここでは antipattern_rules と同じ括弧の木で
+クエリを読み、テーブルの別名を取得済みのスキーマ情報に対応付けて、パーティション列で
+絞り込んでいない参照とクラスタリング列の使われ方を機械的に判定する。
+結果はレポートと Gemini のプロンプトに「確定した事実」として渡す。
+
+判定は SELECT ごと（CTE・サブクエリはそれぞれ別）の WHERE 句と JOIN の ON 条件で行う。
+絞り込みとして扱うのは、パーティション列（または DATE()・TIMESTAMP_TRUNC() のように
+絞り込みを保つ関数で包んだ列）を定数・定数の範囲と比較する条件（=・<・>・BETWEEN・IN）だけ。
+サブクエリの結果や他のテーブルの列との比較（JOIN 条件）、同じテーブルの列どうしの比較、
+IS [NOT] NULL、EXTRACT などそれ以外の関数で包んだ条件は、BigQuery がパーティションを
+絞り込めない形として区別する。
+"""
+
+from dataclasses import dataclass, field
+
+from antipattern_rules import (
+    Group,
+    PrescreenError,
+    Token,
+    build_tree,
+    defined_cte_names,
+    is_column,
+    is_word,
+    query_blocks,
+    split_and,
+    table_path,
+    tokenize,
+    where_clause,
+)
+
+# 取り込み時間で分割したテーブルの疑似列（どちらで絞り込んでもよい）
+INGESTION_TIME_COLUMNS = ("_partitiontime", "_partitiondate")
+
+# 列を包んでもパーティションの絞り込みが効く関数（2つ目以降の引数は日付の単位だけ）
+_PRUNING_WRAPPERS = frozenset({"DATE", "DATE_TRUNC", "DATETIME_TRUNC", "TIMESTAMP_TRUNC"})
+# 定数の式に出てきてよい語（日付の単位・リテラル・型名など。列ではない）
+_DATE_PARTS = frozenset(
+    {
+        "MICROSECOND",
+        "MILLISECOND",
+        "SECOND",
+        "MINUTE",
+        "HOUR",
+        "DAY",
+        "WEEK",
+        "ISOWEEK",
+        "MONTH",
+        "QUARTER",
+        "YEAR",
+        "ISOYEAR",
+    }
+)
+_CONSTANT_WORDS = _DATE_PARTS | {
+    "AND",
+    "AS",
+    "INTERVAL",
+    "TRUE",
+    "FALSE",
+    "NULL",
+    "CURRENT_DATE",
+    "CURRENT_DATETIME",
+    "CURRENT_TIMESTAMP",
+    "DATE",
+    "DATETIME",
+    "TIMESTAMP",
+    "STRING",
+    "INT64",
+}
+# パーティションを絞り込める比較（!= や LIKE では絞り込めない）
+_PRUNING_OPS = frozenset({"=", "<", ">", "<=", ">="})
+
+# 判定結果（TableScan.status）
+PRUNED = "pruned"  # パーティション列で絞り込んでいる
+NOT_PRUNED = "not_pruned"  # パーティション列の条件が無い（全パーティションをスキャン）
+INEFFECTIVE = "ineffective"  # 条件はあるが、絞り込みに効かない形
+OUTER_FILTER = "outer_filter"  # CTE・サブクエリの外側の条件に依存している
+NOT_PARTITIONED = "not_partitioned"  # クラスタリングのみのテーブル
+
+# FROM 句の終わり（同じ階層でこれらが来たら FROM 句は終わる）
+_FROM_END = frozenset(
+    {"WHERE", "GROUP", "HAVING", "QUALIFY", "WINDOW", "ORDER", "LIMIT", "UNION", "INTERSECT"}
+)
+_JOIN_WORDS = frozenset({"JOIN", "LEFT", "RIGHT", "INNER", "FULL", "CROSS", "OUTER"})
+# テーブル名の直後に来ても別名ではない語
+_NOT_ALIAS = _FROM_END | _JOIN_WORDS | {"ON", "USING", "FOR", "TABLESAMPLE", "EXCEPT"}
+
+
+@dataclass
+class TableMetadata:
+    """get_table で取得したテーブルの情報（スキーマ情報の表示と絞り込みの判定に使う）。"""
+
+    name: str
+    partition_column: str | None = None
+    partition_type: str | None = None
+    partition_range: tuple | None = None  # 整数範囲分割の (start, end, interval)
+    clustering_fields: list = field(default_factory=list)
+    columns: list = field(default_factory=list)  # [(列名, 型)]
+    num_bytes: int | None = None  # 論理バイト数（get_table の num_bytes）
+    num_rows: int | None = None
+    error: str | None = None
+
+    @property
+    def partition_columns(self):
+        """絞り込みに使える列名（小文字）。取り込み時間分割なら疑似列の両方。"""
+        if not self.partition_column:
+            return set()
+        column = self.partition_column.lower()
+        if column in INGESTION_TIME_COLUMNS:
+            return set(INGESTION_TIME_COLUMNS)
+        return {column}
+
+    def has_column(self, name):
+        return name in self.partition_columns or any(
+            column.lower() == name for column, _ in self.columns
+        )
+
+
+@dataclass
+class TableScan:
+    """クエリ中のテーブル参照1つの判定結果。"""
+
+    table: str
+    alias: str
+    line: int
+    partition_column: str | None
+    status: str
+    detail: str = ""
+    clustering_used: list = field(default_factory=list)
+    clustering_unused: list = field(default_factory=list)
+    leading_clustering_unused: bool = False  # 先頭のクラスタリング列で絞り込んでいない
+
+    def as_dict(self):
+        return {
+            "table": self.table,
+            "alias": self.alias,
+            "line": self.line,
+            "partition_column": self.partition_column,
+            "status": self.status,
+            "clustering_used": self.clustering_used,
+            "clustering_unused": self.clustering_unused,
+        }
+
+
+@dataclass
+class PruningReport:
+    """クエリ1件の判定結果。decided が False ならクエリを解析できなかった。"""
+
+    decided: bool
+    scans: list = field(default_factory=list)
+    unresolved: list = field(default_factory=list)  # クエリ中に参照位置が見つからないテーブル
+    reason: str = ""
+
+    @property
+    def unpruned(self):
+        return [scan for scan in self.scans if scan.status in (NOT_PRUNED, INEFFECTIVE)]
+
+    @property
+    def has_facts(self):
+        return not self.decided or bool(self.scans or self.unresolved)
+
+    def facts(self):
+        """レポートとプロンプトに載せる箇条書き。"""
+        if not self.decided:
+            return f"- クエリを解析できなかったため、判定していません（{self.reason}）。"
+        if not self.scans and not self.unresolved:
+            return "- 参照テーブルにパーティション・クラスタリングの設定はありません。"
+        lines = [_format_scan(scan) for scan in self.scans]
+        lines += [
+            f"- `{name}`: クエリ中の参照位置を特定できなかったため判定していません。"
+            for name in self.unresolved
+        ]
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {
+            "decided": self.decided,
+            "reason": self.reason,
+            "tables": [scan.as_dict() for scan in self.scans],
+            "unresolved": self.unresolved,
+        }
+
+
+def _format_scan(scan):
+    where = f"`{scan.table}`（{scan.line} 行目" + (
+        f"、別名 {scan.alias}）" if scan.alias != scan.table.split(".")[-1].lower() else "）"
+    )
+    column = f"`{scan.partition_column}`"
+    if scan.status == PRUNED:
+        text = f"- {where}: パーティション列 {column} で絞り込んでいます。"
+    elif scan.status == NOT_PRUNED:
+        text = (
+            f"- {where}: パーティション列 {column} で絞り込んでいません。"
+            "全パーティションをスキャンします。"
+        )
+    elif scan.status == INEFFECTIVE:
+        text = (
+            f"- {where}: パーティション列 {column} の条件は{scan.detail}、"
+            "パーティションの絞り込みが効きません。"
+        )
+    elif scan.status == OUTER_FILTER:
+        text = (
+            f"- {where}: CTE・サブクエリの中ではパーティション列 {column} で絞り込んでおらず、"
+            "外側のクエリの条件に依存しています（条件が押し下げられなければ全パーティションをスキャン）。"
+        )
+    else:
+        text = f"- {where}: パーティション分割なし。"
+    if scan.clustering_used or scan.clustering_unused:
+        used = ", ".join(f"`{c}`" for c in scan.clustering_used) or "なし"
+        unused = ", ".join(f"`{c}`" for c in scan.clustering_unused) or "なし"
+        text += f"\n  - クラスタリング列: 絞り込みに使用 {used} / 未使用 {unused}"
+        if scan.clustering_used and scan.leading_clustering_unused:
+            text += "（先頭の列で絞り込んでいないため、ブロックの絞り込みが効きにくい）"
+    return text
+
+
+# ==========================================
+# FROM 句のテーブル参照
+# ==========================================
+
+
+@dataclass
+class _Reference:
+    path: str
+    alias: str
+    line: int
+    on: list = field(default_factory=list)
+    table: TableMetadata | None = None
+
+
+def _segments(items):
+    """同じ階層の items を SELECT（と ; ）ごとに切り分ける（UNION 等の各 SELECT を別に扱う）。"""
+    segments, current = [], []
+    for item in items:
+        if is_word(item, "SELECT") or (isinstance(item, Token) and item.text == ";"):
+            segments.append(current)
+            current = []
+        current.append(item)
+    segments.append(current)
+    return segments
+
+
+def _from_references(segment, sources):
+    """segment の FROM 句のテーブル参照。
+
+    サブクエリ・UNNEST は各自の階層で扱うので除き、FROM 句に書かれたサブクエリは sources に足す。
+    """
+    start = next((i for i, item in enumerate(segment) if is_word(item, "FROM")), None)
+    if start is None:
+        return []
+    end = next(
+        (j for j in range(start + 1, len(segment)) if is_word(segment[j], *_FROM_END)),
+        len(segment),
+    )
+    items = segment[start + 1 : end]
+    references = []
+    current = None
+    expect_table = True
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if expect_table:
+            expect_table = False
+            if isinstance(item, Group) or is_word(item, "UNNEST"):
+                if isinstance(item, Group) and item.is_query:
+                    sources.add(id(item))
+                current = None
+                i += 1
+                continue
+            path, i = table_path(items, i)
+            if path is None:
+                i += 1
+                continue
+            alias = path.split(".")[-1].lower()
+            if is_word(items[i] if i < len(items) else None, "AS"):
+                i += 1
+            if (
+                i < len(items)
+                and isinstance(items[i], Token)
+                and items[i].kind in ("word", "quoted")
+                and not is_word(items[i], *_NOT_ALIAS)
+            ):
+                alias = items[i].name
+                i += 1
+            current = _Reference(path, alias, item.line)
+            references.append(current)
+            continue
+        if is_word(item, "JOIN") or (isinstance(item, Token) and item.text == ","):
+            expect_table = True
+        elif is_word(item, "ON"):
+            end_on = next(
+                (
+                    k
+                    for k in range(i + 1, len(items))
+                    if is_word(items[k], *_JOIN_WORDS)
+                    or (isinstance(items[k], Token) and items[k].text == ",")
+                ),
+                len(items),
+            )
+            if current is not None:
+                current.on = items[i + 1 : end_on]
+            i = end_on
+            continue
+        i += 1
+    return references
+
+
+def _cte_bodies(block):
+    """WITH で始まる階層の CTE 定義の括弧。"""
+    items = block.items
+    if not is_word(items[0] if items else None, "WITH"):
+        return []
+    return [
+        item
+        for k, item in enumerate(items)
+        if isinstance(item, Group) and is_word(items[k - 1], "AS")
+    ]
+
+
+def match_table(path, tables):
+    """クエリ中のテーブルパスに対応する TableMetadata（短い名前は末尾で照合）。無ければ None。"""
+    path = path.lower()
+    for table in tables:
+        name = table.name.lower()
+        if name == path or name.endswith("." + path):
+            return table
+    return None
+
+
+# ==========================================
+# 条件の読み取り
+# ==========================================
+
+
+def _column_refs(items):
+    """items 中の列参照 [(修飾子 or None, 列名)] と、サブクエリを含むかを返す。
+
+    関数名（直後が括弧）や DATE '...' のような型付きリテラルの型名は列として扱わない。
+    """
+    refs = []
+    has_subquery = False
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if isinstance(item, Group):
+            if item.is_query:
+                has_subquery = True
+            else:
+                inner, inner_subquery = _column_refs(item.items)
+                refs += inner
+                has_subquery = has_subquery or inner_subquery
+            i += 1
+            continue
+        if item.kind not in ("word", "quoted"):
+            i += 1
+            continue
+        parts = [item.name]
+        j = i + 1
+        while (
+            j + 1 < len(items)
+            and isinstance(items[j], Token)
+            and items[j].text == "."
+            and isinstance(items[j + 1], Token)
+            and items[j + 1].kind in ("word", "quoted")
+        ):
+            parts.append(items[j + 1].name)
+            j += 2
+        following = items[j] if j < len(items) else None
+        is_call = isinstance(following, Group)
+        is_typed_literal = isinstance(following, Token) and following.kind == "string"
+        if not (is_call or is_typed_literal):
+            qualifier = ".".join(parts[:-1]) or None
+            refs.append((qualifier, parts[-1]))
+        i = j
+    return refs, has_subquery
+
+
+def _resolve(qualifier, column, references):
+    """列参照がどのテーブル参照のものか。特定できなければ None。"""
+    if qualifier is not None:
+        for ref in references:
+            path = ref.path.lower()
+            if qualifier in (ref.alias, path) or path.endswith("." + qualifier):
+                return ref
+        return None
+    if len(references) == 1:
+        return references[0]
+    owners = [ref for ref in references if ref.table and ref.table.has_column(column)]
+    return owners[0] if len(owners) == 1 else None
+
+
+def _split_or(items):
+    branches, current = [], []
+    for item in items:
+        if is_word(item, "OR"):
+            branches.append(current)
+            current = []
+            continue
+        current.append(item)
+    branches.append(current)
+    return branches
+
+
+@dataclass
+class _Condition:
+    """条件の AND・OR の木。op が None なら葉（items が比較1つ）。"""
+
+    op: str | None
+    items: list = field(default_factory=list)
+    children: list = field(default_factory=list)
+
+    def leaves(self):
+        if self.op is None:
+            yield self.items
+        for child in self.children:
+            yield from child.leaves()
+
+
+def _conditions(*clauses):
+    """WHERE・ON の条件を、括弧を外しながら AND・OR で再帰的に分けた木（すべての AND）。"""
+    return _Condition("AND", children=[_condition(items) for items in clauses if items])
+
+
+def _condition(items):
+    while len(items) == 1 and isinstance(items[0], Group) and not items[0].is_query:
+        items = items[0].items
+    branches = _split_or(items)
+    if len(branches) > 1:
+        return _Condition("OR", children=[_condition(branch) for branch in branches])
+    conjuncts = split_and(items) or [items]
+    if len(conjuncts) > 1:
+        return _Condition("AND", children=[_condition(conjunct) for conjunct in conjuncts])
+    return _Condition(None, items)
+
+
+def _is_constant(items):
+    """列を含まない定数の式か（リテラル・クエリパラメータ・CURRENT_DATE() などの関数）。"""
+    if not items:
+        return False
+    for i, item in enumerate(items):
+        if isinstance(item, Group):
+            if item.is_query or (item.items and not _is_constant(item.items)):
+                return False
+            continue
+        if item.kind == "quoted":
+            return False
+        if item.kind != "word":
+            continue
+        following = items[i + 1] if i + 1 < len(items) else None
+        is_call = isinstance(following, Group)
+        is_typed_literal = isinstance(following, Token) and following.kind == "string"
+        is_parameter = i > 0 and isinstance(items[i - 1], Token) and items[i - 1].text == "@"
+        if not (is_call or is_typed_literal or is_parameter or item.upper in _CONSTANT_WORDS):
+            return False
+    return True
+
+
+def _is_partition_operand(items, ref, columns, references):
+    """items がパーティション列そのもの、または絞り込みを保つ関数で包んだパーティション列か。"""
+    if is_column(items):
+        refs, _ = _column_refs(items)
+        return len(refs) == 1 and _owns(ref, columns, *refs[0], references)
+    if not (
+        len(items) == 2
+        and isinstance(items[0], Token)
+        and items[0].upper in _PRUNING_WRAPPERS
+        and isinstance(items[1], Group)
+    ):
+        return False
+    args = _split_commas(items[1].items)
+    if items[0].upper == "DATE" and len(args) != 1:
+        # DATE(ts, 'タイムゾーン') はパーティションの境界とずれるため絞り込めない
+        return False
+    rest_are_date_parts = all(
+        len(arg) == 1 and isinstance(arg[0], Token) and arg[0].upper in _DATE_PARTS
+        for arg in args[1:]
+    )
+    return rest_are_date_parts and _is_partition_operand(args[0], ref, columns, references)
+
+
+def _owns(ref, columns, qualifier, column, references):
+    return column in columns and _resolve(qualifier, column, references) is ref
+
+
+def _split_commas(items):
+    args, current = [], []
+    for item in items:
+        if isinstance(item, Token) and item.text == ",":
+            args.append(current)
+            current = []
+            continue
+        current.append(item)
+    args.append(current)
+    return args
+
+
+def _comparison_problem(branch, ref, columns, references):
+    """パーティション列を含む条件1つが絞り込みに効くなら ""、効かなければその理由。"""
+    while len(branch) == 1 and isinstance(branch[0], Group) and not branch[0].is_query:
+        branch = branch[0].items
+    if any(is_word(item, "IS") for item in branch):
+        return "IS NULL・IS NOT NULL の判定で、値の範囲を指定していないため"
+    op = next(
+        (
+            k
+            for k, item in enumerate(branch)
+            if isinstance(item, Token)
+            and (item.text in _PRUNING_OPS or item.is_keyword("BETWEEN", "IN"))
+        ),
+        None,
+    )
+    if op is None or any(is_word(item, "NOT") for item in branch[:op]):
+        return "定数・定数の範囲との比較（=・<・>・BETWEEN・IN）ではないため"
+    left, right = branch[:op], branch[op + 1 :]
+    if _is_partition_operand(left, ref, columns, references) and _is_constant(right):
+        return ""
+    if branch[op].text in _PRUNING_OPS and _is_partition_operand(right, ref, columns, references):
+        if _is_constant(left):
+            return ""
+
+    def own_columns(side):
+        return [c for q, c in _column_refs(side)[0] if _resolve(q, c, references) is ref]
+
+    if own_columns(left) and own_columns(right):
+        return "同じテーブルの列どうしを比較しているため"
+    return "パーティション列を関数や演算で加工してから比較しているため"
+
+
+def _leaf_problem(items, ref, columns, references):
+    """比較1つの判定。columns を含まなければ None、絞り込みに効けば ""、効かなければその理由。"""
+    refs, has_subquery = _column_refs(items)
+    resolved = [(_resolve(q, c, references), c) for q, c in refs]
+    if not any(owner is ref and c in columns for owner, c in resolved):
+        return None
+    if has_subquery:
+        return "サブクエリの結果と比較しているため"
+    if any(owner is not None and owner is not ref for owner, _ in resolved):
+        return "他のテーブルの列と比較している（JOIN 条件）ため"
+    return _comparison_problem(items, ref, columns, references)
+
+
+def _condition_problem(condition, ref, columns, references):
+    """条件の木の判定（値は _leaf_problem と同じ）。
+
+    AND はどれか1つが絞り込めば絞り込める。OR はすべての枝が絞り込むときだけ絞り込める。
+    """
+    if condition.op is None:
+        return _leaf_problem(condition.items, ref, columns, references)
+    results = [_condition_problem(c, ref, columns, references) for c in condition.children]
+    if condition.op == "AND":
+        if "" in results:
+            return ""
+        return next((result for result in results if result), None)
+    if all(result is None for result in results):
+        return None
+    if all(result == "" for result in results):
+        return ""
+    return next((result for result in results if result), "一部の OR の枝にしか無いため")
+
+
+def _filter_status(ref, columns, condition, references):
+    """ref の columns（いずれかの名前）での絞り込みの状態 (status, 説明)。"""
+    problem = _condition_problem(condition, ref, columns, references)
+    if problem == "":
+        return PRUNED, ""
+    if problem:
+        return INEFFECTIVE, problem
+    return NOT_PRUNED, ""
+
+
+# ==========================================
+# 判定の入口
+# ==========================================
+
+
+def verify_pruning(sql, tables):
+    """sql が tables（TableMetadata のリスト）をどう絞り込んでいるかを判定する。"""
+    targets = [t for t in tables if not t.error and (t.partition_column or t.clustering_fields)]
+    if not targets:
+        return PruningReport(True)
+    try:
+        root = build_tree(tokenize(sql))
+    except PrescreenError as e:
+        return PruningReport(False, reason=str(e))
+
+    cte_names = defined_cte_names(root)
+    blocks = query_blocks(root)
+    # FROM 句のサブクエリと CTE の定義（外側の条件が押し下げられる可能性がある階層）
+    sources = {id(body) for block in blocks for body in _cte_bodies(block)}
+    # 各階層の WHERE で使われている列名
+    where_columns = {
+        id(block): {
+            column
+            for segment in _segments(block.items)
+            for _, column in _column_refs(where_clause(segment))[0]
+        }
+        for block in blocks
+    }
+
+    scans = []
+    seen = set()
+    for block in blocks:
+        outer_columns = set().union(
+            *(columns for key, columns in where_columns.items() if key != id(block))
+        )
+        for segment in _segments(block.items):
+            references = _from_references(segment, sources)
+            for ref in references:
+                if ref.path.lower() not in cte_names:
+                    ref.table = match_table(ref.path, targets)
+            # WHERE と、すべての JOIN の ON 条件
+            predicates = _conditions(where_clause(segment), *(ref.on for ref in references))
+            for ref in references:
+                if ref.table is None:
+                    continue
+                seen.add(ref.table.name)
+                scan = TableScan(
+                    table=ref.table.name,
+                    alias=ref.alias,
+                    line=ref.line,
+                    partition_column=ref.table.partition_column,
+                    status=NOT_PARTITIONED,
+                )
+                if ref.table.partition_column:
+                    columns = ref.table.partition_columns
+                    scan.status, scan.detail = _filter_status(ref, columns, predicates, references)
+                    if (
+                        scan.status == NOT_PRUNED
+                        and id(block) in sources
+                        and columns & outer_columns
+                    ):
+                        scan.status = OUTER_FILTER
+                for column in ref.table.clustering_fields:
+                    status, _ = _filter_status(ref, {column.lower()}, predicates, references)
+                    target = scan.clustering_used if status == PRUNED else scan.clustering_unused
+                    target.append(column)
+                scan.leading_clustering_unused = bool(
+                    ref.table.clustering_fields
+                    and ref.table.clustering_fields[0] in scan.clustering_unused
+                )
+                scans.append(scan)
+
+    unresolved = [t.name for t in targets if t.name not in seen]
+    return PruningReport(True, scans, unresolved)
+
+
+# ==========================================
+# 列の使われ方（key_advisor でパーティション・クラスタリング列を選ぶのに使う）
+# ==========================================
+
+# 条件での列の使われ方（ColumnUse.kind）
+EQUALITY = "equality"  # 列 = 値 / 列 IN (...)
+RANGE = "range"  # 列 < 値 / BETWEEN
+OTHER_FILTER = "filter"  # LIKE・関数の結果との比較など
+JOIN_KEY = "join"  # 他のテーブルの列との比較（JOIN 条件）
+
+
+@dataclass(frozen=True)
+class ColumnUse:
+    table: str
+    column: str  # 小文字
+    kind: str
+
+
+def _predicate_kind(predicate):
+    tokens = [item for item in predicate if isinstance(item, Token)]
+    if any(t.is_keyword("BETWEEN") or t.text in ("<", ">", "<=", ">=") for t in tokens):
+        return RANGE
+    if any(t.is_keyword("IN") or t.text == "=" for t in tokens):
+        return EQUALITY
+    return OTHER_FILTER
+
+
+def column_usage(sql, tables):
+    """sql の WHERE 句と JOIN の ON 条件で、tables の列がどう使われているか。
+
+    ColumnUse のリスト（重複なし）を返す。クエリを解析できなければ None。
+    """
+    try:
+        root = build_tree(tokenize(sql))
+    except PrescreenError:
+        return None
+    cte_names = defined_cte_names(root)
+    uses = []
+    for block in query_blocks(root):
+        for segment in _segments(block.items):
+            references = _from_references(segment, set())
+            for ref in references:
+                if ref.path.lower() not in cte_names:
+                    ref.table = match_table(ref.path, tables)
+            conditions = _conditions(where_clause(segment), *(ref.on for ref in references))
+            for predicate in conditions.leaves():
+                refs, _ = _column_refs(predicate)
+                resolved = [(_resolve(q, c, references), c) for q, c in refs]
+                owners = {id(owner) for owner, _ in resolved if owner is not None}
+                kind = JOIN_KEY if len(owners) > 1 else _predicate_kind(predicate)
+                for owner, column in resolved:
+                    if owner is None or owner.table is None:
+                        continue
+                    use = ColumnUse(owner.table.name, column, kind)
+                    if use not in uses:
+                        uses.append(use)
+    return uses
@@ -0,0 +1,127 @@
+"""プロファイリングモード（PROFILE_MODE=true）。
+
+特定テナントの実行だけが遅い・メモリを食うといった場合に、Cloud Run 上の実行を
+そのまま cProfile と tracemalloc の下で動かし、時間を使った関数とメモリを確保した
+箇所を記録する。結果は .pstats（`python -m pstats` や snakeviz でそのまま開ける）と
+テキストの要約として、レポートと同じバケットに実行 ID 付きで保存する。
+"""
+
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# レポートバケット内の保存先。{run_id} は実行（execution）単位で一意
+PROFILE_PREFIX_TEMPLATE = "reports/profiles/{run_id}"
+PROFILE_NAME_TEMPLATE = "task-{index:04d}"
+# 確保箇所をまとめる際に遡るスタックの深さ
+TRACEMALLOC_FRAMES = 10
+# 確保箇所の集計から除く、計測側のフレーム
+_IGNORED_ALLOCATION_FILES = ("<frozen importlib._bootstrap>", "<unknown>", tracemalloc.__file__)
+
+
+class ProfileSession:
+    """with の間だけ cProfile と tracemalloc を有効にする。
+
+    例外（sys.exit による SystemExit を含む）で抜けても結果は残るので、
+    呼び出し側は finally でアップロードすればよい。
+    """
+
+    def __init__(self, top_n=30):
+        self.top_n = top_n
+        self.wall_seconds = None
+        self.peak_memory_bytes = None
+        self._profiler = cProfile.Profile()
+        self._snapshot = None
+        self._started = None
+
+    def __enter__(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._started = time.perf_counter()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._profiler.disable()
+        self.wall_seconds = round(time.perf_counter() - self._started, 3)
+        self._snapshot = tracemalloc.take_snapshot()
+        _, self.peak_memory_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return False
+
+    def pstats_bytes(self):
+        """Profile.dump_stats() と同じ形式（marshal した統計）のバイト列。"""
+        self._profiler.create_stats()
+        return marshal.dumps(self._profiler.stats)
+
+    def top_functions(self, sort_key):
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=stream)
+        stats.strip_dirs().sort_stats(sort_key).print_stats(self.top_n)
+        return stream.getvalue().strip()
+
+    def top_allocations(self):
+        """確保量の多い行を上位から返す（計測側のフレームは除く）。"""
+        if self._snapshot is None:
+            return []
+        snapshot = self._snapshot.filter_traces(
+            [tracemalloc.Filter(False, name) for name in _IGNORED_ALLOCATION_FILES]
+        )
+        return snapshot.statistics("lineno")[: self.top_n]
+
+    def summary_text(self, run_id, task_index):
+        lines = [
+            f"run_id: {run_id}",
+            f"task_index: {task_index}",
+            f"wall_seconds: {self.wall_seconds}",
+            f"peak_traced_memory_mib: {_mib(self.peak_memory_bytes or 0)}",
+            "",
+            f"== Top {self.top_n} functions by cumulative time ==",
+            self.top_functions("cumulative"),
+            "",
+            f"== Top {self.top_n} functions by own time ==",
+            self.top_functions("tottime"),
+            "",
+            f"== Top {self.top_n} allocation sites (live at end of run) ==",
+        ]
+        for stat in self.top_allocations():
+            frame = stat.traceback[0]
+            lines.append(
+                f"{_mib(stat.size):>10} MiB  {stat.count:>8} blocks  {frame.filename}:{frame.lineno}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _mib(size):
+    return f"{size / (1024 * 1024):.2f}"
+
+
+def profile_paths(run_id, task_index):
+    """(.pstats のパス, 要約テキストのパス) を返す。"""
+    base = (
+        f"{PROFILE_PREFIX_TEMPLATE.format(run_id=run_id)}/"
+        f"{PROFILE_NAME_TEMPLATE.format(index=task_index)}"
+    )
+    return f"{base}.pstats", f"{base}.txt"
+
+
+def upload_profile(bucket, session, run_id, task_index):
+    """プロファイル結果をバケットに保存し、保存したパスの一覧を返す。"""
+    pstats_path, summary_path = profile_paths(run_id, task_index)
+    metadata = {"run_id": run_id, "task_index": str(task_index)}
+
+    blob = bucket.blob(pstats_path)
+    blob.metadata = metadata
+    blob.upload_from_string(session.pstats_bytes(), content_type="application/octet-stream")
+
+    blob = bucket.blob(summary_path)
+    blob.metadata = metadata
+    blob.upload_from_string(
+        session.summary_text(run_id, task_index), content_type="text/plain; charset=utf-8"
+    )
+    return [pstats_path, summary_path]
@@ -0,0 +1,178 @@
+"""ジョブの実行計画（query_plan）からボトルネックを要約する。
+
+ワーストクエリの解析には、これまでスキャン量・実行時間・スロット時間の合計しか
+使っていなかった。同じ「スロット時間が多い」でも、原因が JOIN のシャッフルなのか、
+メモリ不足によるディスクへのスピルなのか、キーの偏り（スキュー）なのか、
+スロット不足による待ちなのかで直し方が変わる。ジョブの query_plan（段階ごとの
+待ち・読み取り・計算・書き込みの時間、シャッフル量）から、それらを判定する。
+"""
+
+from dataclasses import dataclass, field
+
+# 計算時間の最大 / 平均がこれ以上の段階を「偏りあり」とする
+SKEW_RATIO_THRESHOLD = 5.0
+# 平均がこれ未満の段階は偏りを判定しない（短い段階の比は揺れが大きい）
+SKEW_MIN_AVG_MS = 100
+# 段階の時間のうち待ちがこれ以上の割合なら「スロット待ち」とする
+WAIT_SHARE_THRESHOLD = 0.5
+
+# 主なボトルネック（PlanSummary.bottleneck）
+SPILL = "spill"
+SKEW = "skew"
+SLOT_WAIT = "slot_wait"
+SHUFFLE = "shuffle"
+READ = "read"
+COMPUTE = "compute"
+
+_BOTTLENECK_TEXT = {
+    SPILL: "シャッフルがメモリに収まらずディスクに溢れています（中間結果の縮小・JOIN 前の絞り込みが有効）",
+    SKEW: "一部のワーカーに処理が偏っています（JOIN・GROUP BY のキーの偏り）",
+    SLOT_WAIT: "スロットの割り当て待ちが大半です（同時実行の競合・予約の不足。SQL の書き換えより実行時間帯や予約の見直しが有効）",
+    SHUFFLE: "段階間のデータ受け渡し（シャッフル）が大きい（JOIN・GROUP BY の前に列と行を減らすのが有効）",
+    READ: "テーブルの読み取りが大半です（パーティション・クラスタリングでの絞り込みや列の削減が有効）",
+    COMPUTE: "計算が大半です（重い関数・正規表現・大きな JOIN の見直しが有効）",
+}
+
+# 主な段階の内訳（読み取り・計算・書き込み）のうち最も大きいもの → ボトルネック
+_PHASE_BOTTLENECK = {"read": READ, "compute": COMPUTE, "write": SHUFFLE}
+
+
+@dataclass
+class StageCost:
+    name: str
+    slot_ms: int
+    wait_ms: float
+    read_ms: float
+    compute_ms: float
+    write_ms: float
+    shuffle_bytes: int
+    spilled_bytes: int
+    skew_ratio: float | None  # 計算時間の最大 / 平均（判定しない段階は None）
+
+
+@dataclass
+class PlanSummary:
+    """実行計画の要約。stages が空なら計画を取得できなかった。"""
+
+    stages: list = field(default_factory=list)
+
+    @property
+    def total_slot_ms(self):
+        return sum(stage.slot_ms for stage in self.stages)
+
+    @property
+    def dominant_stage(self):
+        return max(self.stages, key=lambda stage: stage.slot_ms, default=None)
+
+    @property
+    def shuffle_bytes(self):
+        return sum(stage.shuffle_bytes for stage in self.stages)
+
+    @property
+    def spilled_bytes(self):
+        return sum(stage.spilled_bytes for stage in self.stages)
+
+    @property
+    def skewed_stage(self):
+        """偏りが閾値以上の段階のうち、最も偏っているもの。"""
+        skewed = [s for s in self.stages if (s.skew_ratio or 0) >= SKEW_RATIO_THRESHOLD]
+        return max(skewed, key=lambda stage: stage.skew_ratio, default=None)
+
+    @property
+    def wait_share(self):
+        """段階の時間（待ち + 読み取り + 計算 + 書き込み）のうち待ちの割合。"""
+        total = sum(s.wait_ms + s.read_ms + s.compute_ms + s.write_ms for s in self.stages)
+        return sum(s.wait_ms for s in self.stages) / total if total else 0.0
+
+    @property
+    def bottleneck(self):
+        if not self.stages:
+            return None
+        if self.spilled_bytes:
+            return SPILL
+        if self.skewed_stage is not None:
+            return SKEW
+        if self.wait_share >= WAIT_SHARE_THRESHOLD:
+            return SLOT_WAIT
+        stage = self.dominant_stage
+        phases = {"read": stage.read_ms, "compute": stage.compute_ms, "write": stage.write_ms}
+        return _PHASE_BOTTLENECK[max(phases, key=phases.get)]
+
+    def facts(self):
+        """レポートとプロンプトに載せる箇条書き。"""
+        if not self.stages:
+            return "- 実行計画を取得できませんでした。"
+        total = self.total_slot_ms
+        dominant = self.dominant_stage
+        share = dominant.slot_ms / total if total else 0.0
+        lines = [
+            f"- 主なボトルネック: {_BOTTLENECK_TEXT[self.bottleneck]}",
+            f"- 最も重い段階: `{dominant.name}`（スロット時間の {share:.0%}。"
+            f"平均 待ち {dominant.wait_ms:.0f} ms / 読み取り {dominant.read_ms:.0f} ms / "
+            f"計算 {dominant.compute_ms:.0f} ms / 書き込み {dominant.write_ms:.0f} ms）",
+            f"- シャッフル量: {_format_bytes(self.shuffle_bytes)}"
+            f"（ディスクへのスピル {_format_bytes(self.spilled_bytes)}）",
+            f"- 待ち時間の割合: {self.wait_share:.0%}",
+        ]
+        skewed = self.skewed_stage
+        if skewed is not None:
+            lines.append(f"- 計算の偏り: `{skewed.name}` で最大が平均の {skewed.skew_ratio:.1f} 倍")
+        lines.append(f"- 段階数: {len(self.stages)}")
+        return "\n".join(lines)
+
+    def as_dict(self):
+        if not self.stages:
+            return {"stages": 0}
+        dominant = self.dominant_stage
+        skewed = self.skewed_stage
+        return {
+            "stages": len(self.stages),
+            "bottleneck": self.bottleneck,
+            "dominant_stage": dominant.name,
+            "dominant_slot_share": round(dominant.slot_ms / self.total_slot_ms, 3)
+            if self.total_slot_ms
+            else 0.0,
+            "shuffle_bytes": self.shuffle_bytes,
+            "spilled_bytes": self.spilled_bytes,
+            "wait_share": round(self.wait_share, 3),
+            "skewed_stage": skewed.name if skewed else None,
+            "max_skew_ratio": skewed.skew_ratio if skewed else None,
+        }
+
+
+def _format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+
+def _number(entry, name):
+    return float(getattr(entry, name, None) or 0)
+
+
+def stage_cost(entry):
+    """QueryPlanEntry（google-cloud-bigquery）1つを StageCost にする。"""
+    compute_avg = _number(entry, "compute_ms_avg")
+    compute_max = _number(entry, "compute_ms_max")
+    parallel = _number(entry, "parallel_inputs")
+    skew_ratio = None
+    if compute_avg >= SKEW_MIN_AVG_MS and parallel > 1:
+        skew_ratio = round(compute_max / compute_avg, 1)
+    return StageCost(
+        name=getattr(entry, "name", None) or str(getattr(entry, "entry_id", "?")),
+        slot_ms=int(_number(entry, "slot_ms")),
+        wait_ms=_number(entry, "wait_ms_avg"),
+        read_ms=_number(entry, "read_ms_avg"),
+        compute_ms=compute_avg,
+        write_ms=_number(entry, "write_ms_avg"),
+        shuffle_bytes=int(_number(entry, "shuffle_output_bytes")),
+        spilled_bytes=int(_number(entry, "shuffle_output_bytes_spilled")),
+        skew_ratio=skew_ratio,
+    )
+
+
+def summarize_plan(query_plan):
+    """QueryJob.query_plan（QueryPlanEntry のリスト）を要約する。"""
+    return PlanSummary([stage_cost(entry) for entry in query_plan or []])
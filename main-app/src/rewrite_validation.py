@@ -0,0 +1,232 @@
+"""Gemini が提案した改善SQL のドライランによる検証。
+
+助言の「改善SQL」は、実行できるか・本当にスキャン量が減るかを確かめないままレポートに
+載っていた。ここでは応答の Markdown から改善SQL のコードブロックを取り出し、ドライラン
+（課金されない）で処理バイト数を求めて、元のジョブの課金バイトと比べる。
+
+ストリーミング生成では応答全文を持たずにレポートへ書き込むため、RewriteCollector で
+検証に要る部分（見出し「改善SQL」から最初のコードブロックまで）だけを受信しながら残す。
+
+ドライランは SaaS プロジェクトのジョブとして実行するため、元のジョブでは顧客プロジェクトに
+解決されていた `dataset.table` のような名前は、ドライランの前に qualify_tables で元のジョブの
+参照テーブル（referenced_tables）のプロジェクトを付けた完全修飾名に直す。
+
+ドライランそのもの（BigQuery の呼び出し）は呼び出し側が渡す。BigQuery が SQL を受け付け
+なかった（構文・列名の誤りなど）ときは RewriteRejected を送出してもらい、権限不足などの
+それ以外の失敗は「検証できなかった」として区別する。
+"""
+
+import re
+from dataclasses import dataclass
+
+from antipattern_rules import PrescreenError, table_path, tokenize
+from compute_pricing import ON_DEMAND_USD_PER_TIB
+
+# 検証結果
+SAVES = "saves"  # 実行でき、スキャン量が減る
+NOT_CHEAPER = "not_cheaper"  # 実行できるが、スキャン量が減らない
+INVALID = "invalid"  # BigQuery が受け付けない
+UNCHECKED = "unchecked"  # 権限不足などでドライランできなかった
+
+_TIB = 2**40
+_ERROR_MAX_CHARS = 300
+
+# ```sql ... ``` のコードブロック（言語の指定なしも含む）
+_FENCE = re.compile(r"```[ \t]*([A-Za-z]*)[^\n]*\n(.*?)```", re.DOTALL)
+# 回答の要件 5 の見出し「改善SQL」
+_HEADING = re.compile(r"改善\s*SQL", re.IGNORECASE)
+# チャンクの境目をまたぐ見出しを見つけるために、見出しより前のテキストから残す末尾の文字数
+_HEADING_LOOKBEHIND = 32
+
+
+class RewriteRejected(Exception):
+    """ドライランで BigQuery が改善SQL を受け付けなかった。"""
+
+
+def _normalize(sql):
+    return " ".join((sql or "").split()).rstrip(";").lower()
+
+
+def _sql_blocks(text):
+    return [
+        (m, m.group(1).lower(), m.group(2).strip())
+        for m in _FENCE.finditer(text)
+        if m.group(1).lower() in ("sql", "") and m.group(2).strip()
+    ]
+
+
+def extract_rewrite(advice, original_sql=""):
+    """助言の Markdown から改善SQL を取り出す。見つからない・元のSQLと同じなら None。
+
+    見出し「改善SQL」より後ろの最初の SQL のコードブロックを使う（「改善対象」に元のSQLが
+    そのまま載ることがあるため）。見出しが無ければ、最後の ```sql ブロックを使う。
+    """
+    if not advice:
+        return None
+    blocks = _sql_blocks(advice)
+    heading = _HEADING.search(advice)
+    candidates = [body for m, _, body in blocks if heading and m.start() > heading.start()]
+    if not candidates:
+        candidates = [body for _, lang, body in blocks if lang == "sql"][-1:]
+    if not candidates or _normalize(candidates[0]) == _normalize(original_sql):
+        return None
+    return candidates[0]
+
+
+def qualify_tables(sql, table_names):
+    """SQL 中の `dataset.table` を、table_names（完全修飾名）のうち同じものの完全修飾名に直す。
+
+    プロジェクトを省いた参照は、ドライランを実行するプロジェクトで解決されてしまうため。
+    table_names に無い名前と、字句を読めない SQL はそのまま返す。
+    """
+    qualified = {}
+    for name in table_names:
+        parts = name.split(".")
+        if len(parts) == 3:
+            qualified[".".join(parts[1:]).lower()] = name
+    try:
+        tokens = tokenize(sql)
+    except PrescreenError:
+        return sql
+    replacements = []
+    i = 0
+    while i < len(tokens):
+        previous = tokens[i - 1].text if i else ""
+        path, end = table_path(tokens, i) if previous not in (".", "-") else (None, i)
+        if path is None:
+            i += 1
+            continue
+        name = qualified.get(path.lower())
+        if name:
+            last = tokens[end - 1]
+            replacements.append((tokens[i].start, last.start + len(last.text), f"`{name}`"))
+        i = end
+    for start, stop, text in reversed(replacements):
+        sql = sql[:start] + text + sql[stop:]
+    return sql
+
+
+class RewriteCollector:
+    """ストリーミングで届く助言から、改善SQL の検証に要る部分だけを残す。
+
+    見出し「改善SQL」から、その後ろの最初の SQL のコードブロックの終わりまでと、
+    見出しより前の最後の ```sql ブロック（見出しが無いときの代わり）だけを持つ。
+    """
+
+    def __init__(self):
+        self.truncated = False  # 持ち時間が尽きて受信を打ち切った（改善SQL が途中までかもしれない）
+        self._pending = ""  # 見出しより前の、まだ調べ終えていない部分
+        self._fallback = None  # 見出しより前の最後の ```sql ブロック
+        self._section = None  # 見出しから後ろ
+        self._complete = False
+
+    def feed(self, text):
+        if self._complete:
+            return
+        if self._section is not None:
+            self._section += text
+            self._complete = bool(_sql_blocks(self._section))
+            return
+        pending = self._pending + text
+        heading = _HEADING.search(pending)
+        before = pending[: heading.start()] if heading else pending
+        end = 0
+        for m in _FENCE.finditer(before):
+            if m.group(1).lower() == "sql" and m.group(2).strip():
+                self._fallback = m.group(2).strip()
+            end = m.end()
+        if heading:
+            self._pending = ""
+            self._section = ""
+            self.feed(pending[heading.start() :])
+            return
+        rest = pending[end:]
+        # 閉じていないコードブロックは続きが届くまで残し、それ以外は末尾だけを残す
+        opening = rest.find("```")
+        self._pending = rest[opening:] if opening >= 0 else rest[-_HEADING_LOOKBEHIND:]
+
+    def advice(self):
+        """残した部分の Markdown（extract_rewrite に渡すと全文と同じ改善SQL を取り出せる）。"""
+        fallback = f"```sql\n{self._fallback}\n```\n" if self._fallback else ""
+        return fallback + (self._section or "")
+
+
+@dataclass
+class RewriteCheck:
+    """改善SQL 1件の検証結果。"""
+
+    status: str
+    original_bytes: float  # 元のジョブの課金バイト
+    rewrite_bytes: float | None = None  # ドライランで求めた改善SQL の処理バイト
+    error: str = ""
+
+    @property
+    def saved_bytes(self):
+        if self.rewrite_bytes is None:
+            return 0.0
+        return max(self.original_bytes - self.rewrite_bytes, 0.0)
+
+    def facts(self):
+        """レポートに載せる箇条書き。"""
+        if self.status == INVALID:
+            return (
+                "- ⚠️ 改善SQL はドライランでエラーになりました。そのままでは実行できないため、"
+                f"修正してから使ってください: {self.error}"
+            )
+        if self.status == UNCHECKED:
+            return f"- 改善SQL をドライランで検証できませんでした: {self.error}"
+        change = (
+            f"元のジョブの課金 {_gib(self.original_bytes)} GiB → "
+            f"改善SQL のドライラン {_gib(self.rewrite_bytes)} GiB"
+        )
+        if self.status == NOT_CHEAPER:
+            more = "増えます" if self.rewrite_bytes > self.original_bytes else "変わりません"
+            return (
+                f"- ⚠️ 改善SQL は実行できますが、スキャン量は{more}（{change}）。"
+                "実行時間・スロットの改善を狙った書き換えでなければ、見直してください。"
+            )
+        saved = self.saved_bytes
+        share = saved / self.original_bytes if self.original_bytes else 0.0
+        return (
+            f"- ✅ 改善SQL はドライランで実行できることを確認しました（{change}、{share:.0%} 減）。\n"
+            f"- このジョブ1回あたり約 {_gib(saved)} GiB"
+            f"（オンデマンド料金で ${saved / _TIB * ON_DEMAND_USD_PER_TIB:,.2f}）の削減です"
+            "（ドライランの処理バイトは今のテーブルのサイズでの見積もり）。"
+        )
+
+    def as_dict(self):
+        return {
+            "status": self.status,
+            "original_bytes": round(self.original_bytes),
+            "rewrite_bytes": None if self.rewrite_bytes is None else round(self.rewrite_bytes),
+            "saved_bytes": round(self.saved_bytes),
+            "error": self.error,
+        }
+
+
+def _gib(value):
+    return f"{value / 2**30:,.1f}"
+
+
+def _message(error):
+    text = str(error).strip().splitlines()
+    text = text[0] if text else type(error).__name__
+    return text if len(text) <= _ERROR_MAX_CHARS else text[:_ERROR_MAX_CHARS] + "…"
+
+
+def validate_rewrite(advice, original_sql, original_bytes, dry_run):
+    """助言の改善SQL をドライランして元のジョブと比べる。改善SQL が無ければ None。
+
+    dry_run(sql) は処理バイト数を返し、BigQuery が受け付けなければ RewriteRejected を送出する。
+    """
+    sql = extract_rewrite(advice, original_sql)
+    if sql is None:
+        return None
+    try:
+        rewrite_bytes = float(dry_run(sql) or 0)
+    except RewriteRejected as e:
+        return RewriteCheck(INVALID, original_bytes, error=_message(e))
+    except Exception as e:
+        return RewriteCheck(UNCHECKED, original_bytes, error=_message(e))
+    status = SAVES if rewrite_bytes < original_bytes else NOT_CHEAPER
+    return RewriteCheck(status, original_bytes, rewrite_bytes)
@@ -0,0 +1,283 @@
+"""Cloud Run Job の複数タスクでワーストクエリの解析を分担する。
+
+Cloud Run Job は CLOUD_RUN_TASK_INDEX / CLOUD_RUN_TASK_COUNT を各タスクに渡す。
+- タスク 0（コーディネーター）が抽出とランキングを行い、ランキング済みのジョブ一覧を
+  マニフェストとして共有ストア（GCS）に置く。
+- 全タスクがマニフェストを読み、順位に対して決定的に割り当てられた分だけを解析し、
+  結果をシャードファイルとして書く。
+- 最後にシャードを書き終えたタスクが全シャードを順位順に結合し、レポートと
+  summary.json を保存する（GCS は強整合なので、最後に書いたタスクは必ず全件を観測できる）。
+  同時に書き終えた複数タスクが重複して結合しないよう、結合担当はマーカーの作成で排他する。
+
+ローカルでは CLOUD_RUN_TASK_INDEX / CLOUD_RUN_TASK_COUNT / CLOUD_RUN_EXECUTION を
+手で与えて複数プロセスを起動すれば同じ動きを再現できる（SHARD_STORE_DIR で GCS の
+代わりにローカルディレクトリを共有ストアにできる）。CLOUD_RUN_EXECUTION は全プロセスで
+同じ、実行ごとに一意の値にする（前の実行のマニフェスト・シャードを拾わないため）。
+"""
+
+import datetime
+import json
+import logging
+import os
+import time
+import types
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 共有ストア上の配置（レポートバケット内）。{run_id} は実行（execution）単位で一意
+SHARD_PREFIX_TEMPLATE = "results/shards/{run_id}"
+MANIFEST_NAME = "manifest.json"
+# 結合担当の確保に使うマーカー。最初に作成できたタスクだけが結合する
+MERGE_CLAIM_NAME = "merge.claim"
+SHARD_NAME_TEMPLATE = "shard-{index:04d}.json"
+
+
+class ShardContext:
+    """このプロセスが何番目のタスクか、実行全体で何タスクあるか。"""
+
+    def __init__(self, task_index=0, task_count=1, run_id="local"):
+        if task_count < 1 or not 0 <= task_index < task_count:
+            raise ValueError(f"Invalid task index/count: {task_index}/{task_count}")
+        self.task_index = task_index
+        self.task_count = task_count
+        self.run_id = run_id
+
+    @classmethod
+    def from_env(cls, environ=None):
+        env = os.environ if environ is None else environ
+        task_count = int(env.get("CLOUD_RUN_TASK_COUNT") or 1)
+        # 同じ実行の全タスクで共通の ID。ローカルでは手で揃える
+        run_id = env.get("CLOUD_RUN_EXECUTION")
+        if task_count > 1 and not run_id:
+            # 固定の ID では、前の実行が残したマニフェスト・シャードを使い回してしまう
+            raise ValueError(
+                "CLOUD_RUN_EXECUTION must be set to the same unique value for every task "
+                "when CLOUD_RUN_TASK_COUNT > 1 (e.g. local-$(date +%s))"
+            )
+        return cls(
+            task_index=int(env.get("CLOUD_RUN_TASK_INDEX") or 0),
+            task_count=task_count,
+            run_id=run_id or "local",
+        )
+
+    @property
+    def sharded(self):
+        return self.task_count > 1
+
+    @property
+    def is_coordinator(self):
+        return self.task_index == 0
+
+    @property
+    def prefix(self):
+        return SHARD_PREFIX_TEMPLATE.format(run_id=self.run_id)
+
+    @property
+    def manifest_path(self):
+        return f"{self.prefix}/{MANIFEST_NAME}"
+
+    @property
+    def merge_claim_path(self):
+        return f"{self.prefix}/{MERGE_CLAIM_NAME}"
+
+    def shard_path(self, index=None):
+        index = self.task_index if index is None else index
+        return f"{self.prefix}/{SHARD_NAME_TEMPLATE.format(index=index)}"
+
+    def select(self, items):
+        """順位付きの一覧から、このタスクの担当分を (通し番号, 要素) で返す。
+
+        順位を task_count で割った余りで割り当てる。上位と下位が各タスクに均等に
+        行き渡るため、連続区間で切るより処理時間が揃いやすい。
+        """
+        return [
+            (number, item)
+            for number, item in enumerate(items, 1)
+            if (number - 1) % self.task_count == self.task_index
+        ]
+
+
+class GcsShardStore:
+    """GCS バケットを共有ストアとして使う。"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def write_text(self, path, text):
+        self.bucket.blob(path).upload_from_string(text, content_type="application/json")
+
+    def read_text(self, path):
+        blob = self.bucket.blob(path)
+        return blob.download_as_text() if blob.exists() else None
+
+    def try_claim(self, path):
+        """path が無ければ作成して True。既にあれば False（生成番号の前提条件で排他する）。"""
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            self.bucket.blob(path).upload_from_string("", if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            return False
+
+    def exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def delete(self, path):
+        self.bucket.blob(path).delete()
+
+
+class LocalShardStore:
+    """ローカルディレクトリを共有ストアとして使う（ローカル実行・テスト用）。"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def write_text(self, path, text):
+        target = self.root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # 書きかけを他タスクに読ませないよう、一時ファイル経由で置き換える
+        tmp = target.with_suffix(target.suffix + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(target)
+
+    def read_text(self, path):
+        target = self.root / path
+        return target.read_text(encoding="utf-8") if target.exists() else None
+
+    def try_claim(self, path):
+        target = self.root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            target.open("x").close()
+            return True
+        except FileExistsError:
+            return False
+
+    def exists(self, path):
+        return (self.root / path).exists()
+
+    def delete(self, path):
+        (self.root / path).unlink(missing_ok=True)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, types.SimpleNamespace):
+        return vars(value)
+    # BigQuery の Row（STRUCT）は items() を持つ
+    if hasattr(value, "items"):
+        return dict(value.items())
+    return str(value)
+
+
+def serialize_job(job):
+    """BigQuery の Row（または属性アクセスできるもの）を JSON 化できる dict にする。"""
+    if hasattr(job, "items"):
+        return dict(job.items())
+    return dict(vars(job))
+
+
+def deserialize_job(data):
+    """serialize_job の逆。main の処理は属性アクセスしかしないので SimpleNamespace で足りる。"""
+    return types.SimpleNamespace(**data)
+
+
+def clear_stale_shards(store, ctx):
+    """同じ run_id の前の実行が残したシャードと結合マーカーを消す。
+
+    コーディネーターが新しくマニフェストを作る前に呼ぶ（他タスクはマニフェストが現れるまで
+    シャードを書かないため、この時点で残っているものは前の実行の分）。
+    """
+    paths = [ctx.merge_claim_path] + [ctx.shard_path(i) for i in range(ctx.task_count)]
+    for path in paths:
+        if store.exists(path):
+            logger.warning(f"Removing stale shard file from a previous run: {path}")
+            store.delete(path)
+
+
+def publish_manifest(store, ctx, preamble, jobs, job_ranks, master_dict):
+    """コーディネーターの抽出結果（レポート冒頭・ランキング済みジョブ）を共有する。"""
+    manifest = {
+        "run_id": ctx.run_id,
+        "task_count": ctx.task_count,
+        "preamble": preamble,
+        "jobs": [serialize_job(job) for job in jobs],
+        "job_ranks": job_ranks,
+        "master_dict": master_dict,
+    }
+    store.write_text(
+        ctx.manifest_path, json.dumps(manifest, ensure_ascii=False, default=_json_default)
+    )
+    logger.info(f"Published shard manifest with {len(jobs)} jobs: {ctx.manifest_path}")
+
+
+def load_manifest(store, ctx):
+    text = store.read_text(ctx.manifest_path)
+    if text is None:
+        return None
+    manifest = json.loads(text)
+    manifest["jobs"] = [deserialize_job(job) for job in manifest["jobs"]]
+    return manifest
+
+
+def wait_for_manifest(store, ctx, deadline, poll_interval_seconds):
+    """コーディネーターのマニフェストを待つ。持ち時間内に現れなければ None。"""
+    while True:
+        manifest = load_manifest(store, ctx)
+        if manifest is not None:
+            return manifest
+        if deadline.expired():
+            return None
+        logger.info(f"Waiting for shard manifest: {ctx.manifest_path}")
+        time.sleep(min(poll_interval_seconds, max(deadline.remaining(), 0.1)))
+
+
+def write_shard_result(store, ctx, sections, stats):
+    """このタスクの解析結果。sections は [(通し番号, Markdown)]。"""
+    payload = {
+        "task_index": ctx.task_index,
+        "sections": [{"number": number, "markdown": text} for number, text in sections],
+        "stats": stats,
+    }
+    store.write_text(ctx.shard_path(), json.dumps(payload, ensure_ascii=False))
+
+
+def collect_shard_results(store, ctx):
+    """全タスクのシャードが揃っていれば一覧で返す。1つでも欠けていれば None。"""
+    results = []
+    for index in range(ctx.task_count):
+        text = store.read_text(ctx.shard_path(index))
+        if text is None:
+            return None
+        results.append(json.loads(text))
+    return results
+
+
+def merge_shard_results(shard_results):
+    """シャードを通し番号順の sections と合算した stats にまとめる。"""
+    sections = sorted(
+        (section for shard in shard_results for section in shard["sections"]),
+        key=lambda section: section["number"],
+    )
+    stats = {}
+    for shard in shard_results:
+        for key, value in shard["stats"].items():
+            if isinstance(value, list):
+                stats.setdefault(key, []).extend(value)
+            else:
+                stats[key] = stats.get(key, 0) + value
+    return [section["markdown"] for section in sections], stats
+
+
+def cleanup_shards(store, ctx):
+    """結合後の中間ファイルを消す（顧客バケットに残さない）。失敗しても結果には影響しない。"""
+    paths = [ctx.manifest_path, ctx.merge_claim_path]
+    paths += [ctx.shard_path(i) for i in range(ctx.task_count)]
+    for path in paths:
+        try:
+            store.delete(path)
+        except Exception as e:
+            logger.warning(f"Failed to delete shard file {path}: {e}")
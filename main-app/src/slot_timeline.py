@@ -0,0 +1,95 @@
+"""スロット使用量のタイムライン（同時実行の競合）の要約。
+
+ワーストクエリのランキングは1件ごとのスキャン量・実行時間で並べるため、
+中くらいのクエリが同じ時間帯（朝9時の定期実行など）に重なって起きる競合は見えない。
+JOBS_TIMELINE_BY_PROJECT から求めた「スロット使用量が多い分」（sql/slot_timeline.sql）を
+連続する分ごとにまとめてピークの時間帯にし、その時間帯に多くのスロットを使ったジョブと
+作成から実行開始までの待ちを表にする。
+"""
+
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+
+@dataclass
+class PeakWindow:
+    """連続したピークの分をまとめた時間帯。"""
+
+    start: object  # datetime（最初の分）
+    end: object  # datetime（最後の分の終わり）
+    peak_slots: float
+    slot_minutes: float
+    max_running_jobs: int
+    jobs: dict = field(
+        default_factory=dict
+    )  # {job_id: {"user_email", "slot_minutes", "queued_seconds"}}
+
+    @property
+    def minutes(self):
+        return int((self.end - self.start).total_seconds() // 60)
+
+    @property
+    def avg_slots(self):
+        return self.slot_minutes / self.minutes if self.minutes else 0.0
+
+    def top_jobs(self, limit):
+        ranked = sorted(self.jobs.items(), key=lambda item: item[1]["slot_minutes"], reverse=True)
+        return ranked[:limit]
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def peak_windows(rows):
+    """ピークの分（minute 順でなくてもよい）を連続する時間帯にまとめ、ピークの高い順に返す。"""
+    windows = []
+    for row in sorted(rows, key=lambda r: _field(r, "minute")):
+        minute = _field(row, "minute")
+        slots = float(_field(row, "avg_slots") or 0)
+        window = windows[-1] if windows and windows[-1].end == minute else None
+        if window is None:
+            window = PeakWindow(minute, minute, 0.0, 0.0, 0)
+            windows.append(window)
+        window.end = minute + timedelta(minutes=1)
+        window.peak_slots = max(window.peak_slots, slots)
+        window.slot_minutes += slots
+        window.max_running_jobs = max(window.max_running_jobs, int(_field(row, "running_jobs")))
+        for job in _field(row, "top_jobs") or []:
+            entry = window.jobs.setdefault(
+                _field(job, "job_id"),
+                {"user_email": _field(job, "user_email"), "slot_minutes": 0.0, "queued_seconds": 0},
+            )
+            entry["slot_minutes"] += float(_field(job, "avg_slots") or 0)
+            entry["queued_seconds"] = max(
+                entry["queued_seconds"], float(_field(job, "queued_seconds") or 0)
+            )
+    return sorted(windows, key=lambda w: w.peak_slots, reverse=True)
+
+
+def format_timeline(rows, max_windows=5, top_jobs=3):
+    """レポートに載せる Markdown（期間全体の要約と、ピークの時間帯の表）。"""
+    if not rows:
+        return "対象となるスロット使用量のデータがありませんでした。"
+    first = rows[0]
+    overall = float(_field(first, "overall_avg_slots") or 0)
+    p50 = _field(first, "p50_queued_seconds")
+    p95 = _field(first, "p95_queued_seconds")
+    lines = [
+        f"- 稼働していた時間帯の平均: {overall:,.1f} スロット",
+        f"- 作成から実行開始までの待ち: p50 {float(p50 or 0):.1f} 秒 / p95 {float(p95 or 0):.1f} 秒",
+        "",
+        "| 時間帯 (UTC) | ピーク (スロット) | 平均 (スロット) | 同時実行ジョブ | 主なジョブ（スロット・待ち） |",
+        "|---|--:|--:|--:|---|",
+    ]
+    for window in peak_windows(rows)[:max_windows]:
+        jobs = "<br>".join(
+            f"`{job_id}` ({job['user_email']}, {job['slot_minutes'] / window.minutes:,.0f} スロット, "
+            f"待ち {job['queued_seconds']:.1f} 秒)"
+            for job_id, job in window.top_jobs(top_jobs)
+        )
+        lines.append(
+            f"| {window.start:%Y-%m-%d %H:%M}–{window.end:%H:%M} | {window.peak_slots:,.0f} "
+            f"| {window.avg_slots:,.0f} | {window.max_running_jobs} | {jobs or '-'} |"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,181 @@
+"""ストレージの増加の傾向と、料金モデルの推奨が変わる時期の予測。
+
+ストレージ料金モデルの判定（storage_pricing）は実行時点の状態しか見ていない。実行のたびに
+データセットごとの論理・物理のバイト数と両方の料金モデルの月額を、リージョンごとの
+履歴（JSON。レポートバケットの history/storage/ 配下）に追記し、履歴から増加の傾向を
+直線で当てはめる。論理と物理の月額の差の傾きから、推奨する料金モデルが入れ替わる日を予測する。
+"""
+
+import datetime
+import json
+from dataclasses import dataclass
+
+from storage_pricing import LOGICAL, PHYSICAL
+
+_GIB = 2**30
+# 傾向を出すのに必要な履歴（回数と期間）
+MIN_SNAPSHOTS = 3
+MIN_SPAN_DAYS = 7
+# この期間より先の入れ替わりは予測しない
+FORECAST_HORIZON_DAYS = 365
+# 直前の記録からこれより短い間隔の実行（再実行など）は、直前の記録を置き換える
+MIN_INTERVAL = datetime.timedelta(hours=1)
+
+
+def history_path(region):
+    return f"history/storage/{region.lower()}.json"
+
+
+def load_snapshots(text):
+    """履歴の JSON から記録のリスト（古い順）。壊れていれば空から始める。"""
+    if not text:
+        return []
+    try:
+        return list(json.loads(text).get("snapshots", []))
+    except (ValueError, AttributeError):
+        return []
+
+
+def record_snapshot(snapshots, datasets, taken_at, max_snapshots):
+    """storage_pricing.analyze の結果を記録に加え、古いものを切り詰めて返す。"""
+    snapshot = {
+        "taken_at": taken_at.isoformat(),
+        "datasets": {
+            d.name: {
+                "model": d.billing_model,
+                "logical_bytes": sum(t.logical_bytes for t in d.tables),
+                "physical_bytes": sum(t.physical_bytes for t in d.tables),
+                "logical_cost": round(d.logical_cost, 4),
+                "physical_cost": round(d.physical_cost, 4),
+            }
+            for d in datasets
+        },
+    }
+    if snapshots and taken_at - _parse(snapshots[-1]["taken_at"]) < MIN_INTERVAL:
+        snapshots = snapshots[:-1]
+    return (snapshots + [snapshot])[-max_snapshots:]
+
+
+def dump_snapshots(snapshots, region):
+    return json.dumps({"version": 1, "region": region, "snapshots": snapshots}, ensure_ascii=False)
+
+
+def _parse(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def _slope(points):
+    """最小二乗法の直線の傾き（points は [(日数, 値)]）。"""
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+@dataclass
+class DatasetTrend:
+    name: str
+    days: float  # 観測期間（日）
+    logical_bytes: int
+    physical_bytes: int
+    logical_growth: float  # 1日あたりのバイト数
+    physical_growth: float
+    cost_diff: float  # 物理 - 論理の月額（最新）
+    cost_diff_slope: float  # 1日あたりの変化
+
+    @property
+    def best_model(self):
+        return PHYSICAL if self.cost_diff < 0 else LOGICAL
+
+    @property
+    def days_to_flip(self):
+        """推奨する料金モデルが入れ替わるまでの日数（予測の期間内に入れ替わらなければ None）。"""
+        if not self.cost_diff_slope or (self.cost_diff < 0) == (self.cost_diff_slope < 0):
+            return None
+        days = -self.cost_diff / self.cost_diff_slope
+        return days if days <= FORECAST_HORIZON_DAYS else None
+
+
+def trends(snapshots):
+    """最新の記録にあるデータセットの傾向（履歴が足りないデータセットは除く）。"""
+    if not snapshots:
+        return []
+    origin = _parse(snapshots[0]["taken_at"])
+    timeline = [
+        ((_parse(s["taken_at"]) - origin).total_seconds() / 86400, s["datasets"]) for s in snapshots
+    ]
+    latest_day, latest = timeline[-1]
+    results = []
+    for name, current in latest.items():
+        series = [(day, datasets[name]) for day, datasets in timeline if name in datasets]
+        days = latest_day - series[0][0]
+        if len(series) < MIN_SNAPSHOTS or days < MIN_SPAN_DAYS:
+            continue
+        results.append(
+            DatasetTrend(
+                name=name,
+                days=days,
+                logical_bytes=current["logical_bytes"],
+                physical_bytes=current["physical_bytes"],
+                logical_growth=_slope([(x, d["logical_bytes"]) for x, d in series]),
+                physical_growth=_slope([(x, d["physical_bytes"]) for x, d in series]),
+                cost_diff=current["physical_cost"] - current["logical_cost"],
+                cost_diff_slope=_slope(
+                    [(x, d["physical_cost"] - d["logical_cost"]) for x, d in series]
+                ),
+            )
+        )
+    return sorted(results, key=lambda t: t.physical_growth, reverse=True)
+
+
+def _growth(size, per_day):
+    monthly = per_day * 30
+    rate = f"（{monthly / size:+.0%}）" if size else ""
+    return f"{monthly / _GIB:+,.1f}{rate}"
+
+
+def _model_label(model):
+    return "物理" if model == PHYSICAL else "論理"
+
+
+def format_trends(snapshots, max_datasets=10):
+    """レポートに載せる Markdown（データセットごとの増加と、推奨が入れ替わる時期）。"""
+    listed = trends(snapshots)
+    if not listed:
+        span = 0
+        if snapshots:
+            elapsed = _parse(snapshots[-1]["taken_at"]) - _parse(snapshots[0]["taken_at"])
+            span = round(elapsed.total_seconds() / 86400)
+        return (
+            f"履歴は {len(snapshots)} 回分（{span} 日）です。{MIN_SNAPSHOTS} 回・{MIN_SPAN_DAYS} 日分"
+            "たまると、増加の傾向と料金モデルの見直し時期を表示します。"
+        )
+    latest = _parse(snapshots[-1]["taken_at"])
+    lines = [
+        "| データセット | 観測期間 | 論理 (GiB) | 論理の増加 (GiB / 30日) | 物理 (GiB) "
+        "| 物理の増加 (GiB / 30日) | 現在の推奨 | 推奨が変わる見込み |",
+        "|---|--:|--:|--:|--:|--:|---|---|",
+    ]
+    for trend in listed[:max_datasets]:
+        flip = trend.days_to_flip
+        if flip is None:
+            forecast = f"{FORECAST_HORIZON_DAYS} 日以内はなし"
+        else:
+            date = (latest + datetime.timedelta(days=flip)).date()
+            other = LOGICAL if trend.best_model == PHYSICAL else PHYSICAL
+            forecast = f"**{date} ごろ {_model_label(other)}へ**"
+        lines.append(
+            f"| `{trend.name}` | {trend.days:.0f} 日 | {trend.logical_bytes / _GIB:,.1f} "
+            f"| {_growth(trend.logical_bytes, trend.logical_growth)} "
+            f"| {trend.physical_bytes / _GIB:,.1f} "
+            f"| {_growth(trend.physical_bytes, trend.physical_growth)} "
+            f"| {_model_label(trend.best_model)} | {forecast} |"
+        )
+    lines.append(
+        "\n増加と見直し時期は、これまでの記録に直線を当てはめ、同じ傾向が続くとみなした予測です。"
+        "料金は記録した時点の単価で計算しています。"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,219 @@
+"""ストレージ料金モデル（論理 / 物理）の判定。
+
+料金モデルはデータセットごとの設定だが、圧縮率だけでは判断できない。物理ストレージの
+料金モデルではタイムトラベル・フェイルセーフの領域も課金され、アクティブと長期保存で
+単価も違う。テーブル単位の内訳（sql/logical_vs_physical_storage_analysis.sql）から、
+両方の料金モデルでの月額をリージョンの単価で計算し、データセットを切り替えたときの
+削減額の大きい順に並べる。
+"""
+
+from dataclasses import dataclass, field
+
+LOGICAL = "LOGICAL"
+PHYSICAL = "PHYSICAL"
+
+_GIB = 2**30
+# タイムトラベル・フェイルセーフが物理ストレージのこの割合を超えたら、保持期間の短縮を勧める
+TIME_TRAVEL_SHARE_HINT = 0.3
+
+
+@dataclass(frozen=True)
+class StoragePrices:
+    """GiB・月あたりの単価（USD）。"""
+
+    active_logical: float
+    long_term_logical: float
+    active_physical: float
+    long_term_physical: float
+
+
+# リージョンごとの定価（USD）。載っていないリージョンは米国マルチリージョンの単価で計算する。
+REGIONAL_PRICES = {
+    "us": StoragePrices(0.02, 0.01, 0.04, 0.02),
+    "eu": StoragePrices(0.02, 0.01, 0.04, 0.02),
+    "asia-northeast1": StoragePrices(0.023, 0.016, 0.052, 0.026),
+}
+DEFAULT_PRICES = REGIONAL_PRICES["us"]
+
+
+def prices_for(region):
+    """リージョンの単価と、定価表に載っているか。"""
+    prices = REGIONAL_PRICES.get((region or "").lower())
+    return (prices, True) if prices else (DEFAULT_PRICES, False)
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+@dataclass
+class TableStorage:
+    dataset: str
+    table: str
+    active_logical: int
+    long_term_logical: int
+    active_physical: int  # タイムトラベルを除く
+    long_term_physical: int
+    time_travel: int
+    fail_safe: int
+
+    @classmethod
+    def from_row(cls, row):
+        def number(name):
+            return int(_field(row, name) or 0)
+
+        return cls(
+            dataset=_field(row, "dataset_name"),
+            table=_field(row, "table_name"),
+            active_logical=number("active_logical_bytes"),
+            long_term_logical=number("long_term_logical_bytes"),
+            active_physical=number("active_physical_bytes"),
+            long_term_physical=number("long_term_physical_bytes"),
+            time_travel=number("time_travel_physical_bytes"),
+            fail_safe=number("fail_safe_physical_bytes"),
+        )
+
+    @property
+    def logical_bytes(self):
+        return self.active_logical + self.long_term_logical
+
+    @property
+    def physical_bytes(self):
+        """物理の料金モデルで課金される量（タイムトラベル・フェイルセーフを含む）。"""
+        return self.active_physical + self.long_term_physical + self.time_travel + self.fail_safe
+
+    def logical_cost(self, prices):
+        return (
+            self.active_logical * prices.active_logical
+            + self.long_term_logical * prices.long_term_logical
+        ) / _GIB
+
+    def physical_cost(self, prices):
+        # タイムトラベル・フェイルセーフはアクティブの物理ストレージの単価で課金される
+        active = self.active_physical + self.time_travel + self.fail_safe
+        return (
+            active * prices.active_physical + self.long_term_physical * prices.long_term_physical
+        ) / _GIB
+
+
+@dataclass
+class DatasetStorage:
+    name: str
+    billing_model: str
+    prices: StoragePrices
+    tables: list = field(default_factory=list)
+
+    @property
+    def logical_cost(self):
+        return sum(t.logical_cost(self.prices) for t in self.tables)
+
+    @property
+    def physical_cost(self):
+        return sum(t.physical_cost(self.prices) for t in self.tables)
+
+    @property
+    def current_cost(self):
+        return self.physical_cost if self.billing_model == PHYSICAL else self.logical_cost
+
+    @property
+    def best_model(self):
+        return PHYSICAL if self.physical_cost < self.logical_cost else LOGICAL
+
+    @property
+    def monthly_savings(self):
+        """料金モデルを切り替えたときの月あたりの削減額（切り替える必要がなければ 0）。"""
+        return self.current_cost - min(self.logical_cost, self.physical_cost)
+
+    @property
+    def time_travel_share(self):
+        physical = sum(t.physical_bytes for t in self.tables)
+        extra = sum(t.time_travel + t.fail_safe for t in self.tables)
+        return extra / physical if physical else 0.0
+
+    def costly_tables(self, limit=3):
+        """物理の料金モデルで論理より高くなるテーブル（差の大きい順）。"""
+        diffs = [
+            (t.physical_cost(self.prices) - t.logical_cost(self.prices), t) for t in self.tables
+        ]
+        ranked = sorted((d for d in diffs if d[0] > 0), key=lambda d: d[0], reverse=True)
+        return ranked[:limit]
+
+
+def analyze(rows, region):
+    """テーブル単位の行をデータセットにまとめ、削減額の大きい順に返す。"""
+    prices, _ = prices_for(region)
+    datasets = {}
+    for row in rows:
+        table = TableStorage.from_row(row)
+        dataset = datasets.setdefault(
+            table.dataset,
+            DatasetStorage(
+                table.dataset, (_field(row, "billing_model") or LOGICAL).upper(), prices
+            ),
+        )
+        dataset.tables.append(table)
+    return sorted(
+        datasets.values(), key=lambda d: (d.monthly_savings, d.current_cost), reverse=True
+    )
+
+
+def _recommendation(dataset):
+    if dataset.monthly_savings <= 0:
+        return "現状維持"
+    if dataset.best_model == PHYSICAL:
+        return "**【推奨】物理ストレージへ変更**"
+    return "**【推奨】論理ストレージへ変更**"
+
+
+def reportable(datasets):
+    """レポートに載せるデータセット（どちらかの料金モデルで月 $0.01 以上かかるもの）。"""
+    return [d for d in datasets if d.logical_cost >= 0.01 or d.physical_cost >= 0.01]
+
+
+def format_storage(datasets, region, max_datasets=10):
+    """レポートに載せる Markdown（データセットごとの月額の比較と、切り替えの推奨）。"""
+    datasets = reportable(datasets)
+    if not datasets:
+        return "対象となるストレージデータがありませんでした。"
+    lines = [
+        "| データセット | 現在のモデル | 論理 (GiB) | 物理 (GiB) | うちタイムトラベル・フェイルセーフ "
+        "| 論理の月額 (USD) | 物理の月額 (USD) | 推奨アクション | 削減 (USD / 月) |",
+        "|---|---|--:|--:|--:|--:|--:|---|--:|",
+    ]
+    for dataset in datasets[:max_datasets]:
+        logical = sum(t.logical_bytes for t in dataset.tables) / _GIB
+        physical = sum(t.physical_bytes for t in dataset.tables) / _GIB
+        lines.append(
+            f"| `{dataset.name}` | {dataset.billing_model.lower()} | {logical:,.2f} "
+            f"| {physical:,.2f} | {dataset.time_travel_share:.0%} | {dataset.logical_cost:,.2f} "
+            f"| {dataset.physical_cost:,.2f} | {_recommendation(dataset)} "
+            f"| {max(dataset.monthly_savings, 0):,.2f} |"
+        )
+    notes = []
+    total = sum(max(d.monthly_savings, 0) for d in datasets)
+    if total > 0:
+        notes.append(f"- 推奨どおりに切り替えると、合計で月 ${total:,.2f} の削減見込みです。")
+    for dataset in datasets[:max_datasets]:
+        if dataset.best_model == PHYSICAL and dataset.time_travel_share > TIME_TRAVEL_SHARE_HINT:
+            notes.append(
+                f"- `{dataset.name}`: 物理ストレージの {dataset.time_travel_share:.0%} が"
+                "タイムトラベル・フェイルセーフです。更新の多いテーブルは、タイムトラベル期間"
+                "（max_time_travel_hours）の短縮で物理の料金をさらに下げられます。"
+            )
+        costly = dataset.costly_tables()
+        if dataset.best_model == PHYSICAL and costly:
+            names = "、".join(f"`{t.table}`（+${diff:,.2f}）" for diff, t in costly)
+            notes.append(
+                f"- `{dataset.name}`: 物理にすると月額が上がるテーブル {names}。"
+                "別のデータセットに分けると削減額が増えます。"
+            )
+    _, listed = prices_for(region)
+    price_note = (
+        f"{region} の定価"
+        if listed
+        else f"{region} の単価が定価表に無いため、米国マルチリージョンの定価"
+    )
+    notes.append(
+        f"\n{price_note}で計算しています。料金モデルを切り替えると14日間は元に戻せません。"
+    )
+    return "\n".join(lines + [""] + notes)
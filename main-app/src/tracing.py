@@ -0,0 +1,193 @@
+"""ステージ単位の軽量な計時（スパン）。
+
+遅い実行がどこで時間を使ったか（リージョン探索・INFORMATION_SCHEMA・スキーマ取得・
+構文解析 API・Gemini など）を後から追えるよう、各ステージと外部呼び出しを
+span() で囲み、所要時間と付随情報（バイト数・リトライ回数・キャッシュの当否）を記録する。
+実行の最後に summarize_spans() でステージ別に集計し、summary.json とログに出す。
+
+TIMING_OTEL_EXPORT=true のときは同じスパンを OpenTelemetry にも送る
+（opentelemetry-sdk と OTLP エクスポーターが入っている場合のみ。送信先は標準の
+OTEL_EXPORTER_OTLP_ENDPOINT 等で指定する）。
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+# OpenTelemetry の属性に載せられる型（それ以外は文字列化する）
+_OTEL_ATTRIBUTE_TYPES = (str, bool, int, float)
+
+
+class Span:
+    """記録中のスパン。set() で付随情報を足す。"""
+
+    def __init__(self, stage, attrs):
+        self.stage = stage
+        self.attrs = dict(attrs)
+
+    def set(self, **attrs):
+        self.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+
+class SpanRecorder:
+    """スパンの記録先。1プロセス（1タスク）の実行につき1つ。"""
+
+    def __init__(self, clock=time.time, timer=time.perf_counter):
+        self._clock = clock
+        self._timer = timer
+        self._records = []
+        self._lock = threading.Lock()
+        self._tracer = None
+        self._listeners = []
+
+    def use_tracer(self, tracer):
+        self._tracer = tracer
+
+    def add_listener(self, listener):
+        """記録したスパンを listener(record) にも渡す（ベンチマーク等で生のスパンを集める用）。"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        span = Span(stage, attrs)
+        started_at = self._clock()
+        started = self._timer()
+        otel = self._tracer.start_as_current_span(stage) if self._tracer else nullcontext()
+        with otel as otel_span:
+            try:
+                yield span
+            except Exception as e:
+                span.set(error=type(e).__name__)
+                raise
+            finally:
+                record = {
+                    "stage": stage,
+                    "start": round(started_at, 3),
+                    "duration_seconds": round(self._timer() - started, 4),
+                    **span.attrs,
+                }
+                with self._lock:
+                    self._records.append(record)
+                for listener in list(self._listeners):
+                    listener(record)
+                if otel_span is not None:
+                    otel_span.set_attributes(
+                        {
+                            k: v if isinstance(v, _OTEL_ATTRIBUTE_TYPES) else str(v)
+                            for k, v in span.attrs.items()
+                        }
+                    )
+
+    def drain(self):
+        """記録済みのスパンを取り出して空にする。"""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
+
+
+def summarize_spans(records):
+    """スパンをステージ別に集計する（summary.json の timing に入れる形）。"""
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(
+            record["stage"],
+            {
+                "count": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "bytes": 0,
+                "retries": 0,
+                "cache_hits": 0,
+                "cache_misses": 0,
+                "errors": 0,
+            },
+        )
+        duration = record.get("duration_seconds", 0.0)
+        stage["count"] += 1
+        stage["total_seconds"] += duration
+        stage["max_seconds"] = max(stage["max_seconds"], duration)
+        stage["bytes"] += int(record.get("bytes") or 0)
+        stage["retries"] += int(record.get("retries") or 0)
+        if record.get("cache") == "hit":
+            stage["cache_hits"] += 1
+        elif record.get("cache") == "miss":
+            stage["cache_misses"] += 1
+        if record.get("error"):
+            stage["errors"] += 1
+
+    for stage in stages.values():
+        stage["total_seconds"] = round(stage["total_seconds"], 3)
+        stage["max_seconds"] = round(stage["max_seconds"], 3)
+
+    wall_seconds = 0.0
+    if records:
+        first = min(r["start"] for r in records)
+        last = max(r["start"] + r.get("duration_seconds", 0.0) for r in records)
+        wall_seconds = round(last - first, 3)
+
+    # 時間を食ったステージから並べる
+    ordered = dict(sorted(stages.items(), key=lambda kv: kv[1]["total_seconds"], reverse=True))
+    return {"wall_seconds": wall_seconds, "stages": ordered}
+
+
+def create_otel_tracer():
+    """OpenTelemetry の OTLP エクスポーターを設定してトレーサーを返す。使えなければ None。"""
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError as e:
+        logger.warning(f"OpenTelemetry export requested but not available: {e}")
+        return None
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "bq-query-analyzer"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+
+def shutdown_otel():
+    """送信待ちのスパンを flush する（プロセス終了前に呼ぶ）。"""
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, "shutdown"):
+        provider.shutdown()
+
+
+# プロセス全体で共有する記録先（logging の logger と同じ扱い）
+_recorder = SpanRecorder()
+
+
+def span(stage, **attrs):
+    return _recorder.span(stage, **attrs)
+
+
+def drain_spans():
+    return _recorder.drain()
+
+
+def add_span_listener(listener):
+    _recorder.add_listener(listener)
+
+
+def remove_span_listener(listener):
+    _recorder.remove_listener(listener)
+
+
+def enable_otel_export():
+    tracer = create_otel_tracer()
+    if tracer is not None:
+        _recorder.use_tracer(tracer)
+        logger.info("OpenTelemetry span export enabled.")
+    return tracer is not None
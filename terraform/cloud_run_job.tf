@@ -28,6 +28,10 @@ resource "google_cloud_run_v2_job" "analyzer_job" {
   deletion_protection = !var.allow_destroy
 
   template {
+    # 全タスクが同時に走る前提（タスク 0 のマニフェスト待ち・最後のタスクによる結合）
+    task_count  = var.analyzer_task_count
+    parallelism = var.analyzer_task_count
+
     template {
       service_account = data.google_service_account.analyzer_sa.email
       timeout         = "600s"
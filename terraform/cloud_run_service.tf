@@ -42,6 +42,10 @@ resource "google_cloud_run_v2_service" "antipattern_api" {
   }
 
   template {
+    # 1インスタンスに送るリクエストの上限。app.py の同時実行数（MAX_CONCURRENCY）＋
+    # 待ち行列（MAX_QUEUE）と揃え、超える分は 503 で弾かずに別インスタンスへ振り分けさせる。
+    max_instance_request_concurrency = 10
+
     containers {
       # ビルドされたイメージ名を指定（プロジェクト内のArtifact Registry等を参照）
       # ここではビルド後に生成されるパスを動的に指定するか、
@@ -53,6 +57,24 @@ resource "google_cloud_run_v2_service" "antipattern_api" {
           memory = "1024Mi"
         }
       }
+      # 起動時のウォームアップ（app.py）が終わるまでトラフィックを送らない
+      startup_probe {
+        http_get {
+          path = "/ready"
+        }
+        period_seconds    = 2
+        timeout_seconds   = 2
+        failure_threshold = 45
+      }
+      # JVM は1つで数百 MB 使うため、1GiB のインスタンスで同時に起動するのは2つまで
+      env {
+        name  = "MAX_CONCURRENCY"
+        value = "2"
+      }
+      env {
+        name  = "MAX_QUEUE"
+        value = "8"
+      }
     }
     service_account = data.google_service_account.analyzer_sa.email
   }
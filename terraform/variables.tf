@@ -22,6 +22,13 @@ variable "service_account_id" {
   default = "gemini-bq-query-analyzer-sa"
 }
 
+# Cloud Run Job のタスク数。2 以上にするとワーストクエリの解析を複数タスクで分担する
+# （タスク 0 が抽出・ランキングを行い、最後に書き終えたタスクがレポートを結合する）。
+variable "analyzer_task_count" {
+  type    = number
+  default = 1
+}
+
 variable "bq_dataset_id" {
   default = "audit_master"
 }
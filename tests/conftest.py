@@ -13,6 +13,8 @@ from pathlib import Path
 import pytest
 
 ROOT = Path(__file__).resolve().parent.parent
+# main.py は同じディレクトリの補助モジュールを import する（コンテナでも src/ が sys.path に入る）
+MAIN_APP_SRC = ROOT / "main-app" / "src"
 
 # main.py の import 文を満たすためだけのスタブ（テストでは実体を使わない）
 _STUB_MODULES = {
@@ -51,6 +53,9 @@ def main_app():
         if parent is not None and not hasattr(parent, child):
             setattr(parent, child, stub)
 
+    if str(MAIN_APP_SRC) not in sys.path:
+        sys.path.insert(0, str(MAIN_APP_SRC))
+
     try:
         spec = importlib.util.spec_from_file_location(
             "analyzer_main", ROOT / "main-app" / "src" / "main.py"
@@ -64,3 +69,9 @@ def main_app():
                 sys.modules.pop(name, None)
             else:
                 sys.modules[name] = original
+
+
+@pytest.fixture(scope="session")
+def src_module(main_app):
+    """main-app/src 配下の補助モジュールを main.py と同じ解決経路で取得する。"""
+    return importlib.import_module
@@ -0,0 +1,235 @@
+"""bq-antipattern-api（FastAPI）のテスト。
+
+fastapi・httpx・prometheus_client は pyproject.toml の dev グループで入る（CI でも実行する）。
+それ以外の環境で無ければスキップする。
+解析エンジン（JAR）の代わりに python の子プロセスを起動して、同時実行数の制限・
+混雑時の 503・タイムアウトとキャンセル時の子プロセスの停止を確認する。
+"""
+
+import asyncio
+import importlib.util
+import os
+import shlex
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("prometheus_client")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+APP_PATH = Path(__file__).resolve().parent.parent / "bq-antipattern-api" / "app.py"
+
+
+@pytest.fixture(scope="module")
+def api():
+    spec = importlib.util.spec_from_file_location("antipattern_api_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _python_command(code):
+    """末尾に付く --query <SQL> を無視して code を実行するコマンド。"""
+    return f"{shlex.quote(sys.executable)} -c {shlex.quote(code)}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_analyze_extracts_recommendations(api, monkeypatch):
+    output = (
+        "INFO: noise\n"
+        + "-" * 10
+        + "\nRecommendations for query: x\n* SimpleSelectStar\n"
+        + "-" * 10
+    )
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command(f"print({output!r})"))
+    monkeypatch.setattr(api, "limiter", api.AnalysisLimiter(1, 0))
+
+    response = TestClient(api.app).post("/analyze", json={"query": "SELECT * FROM t"})
+
+    assert response.status_code == 200
+    assert response.json()["recommendations"] == "Recommendations for query: x\n* SimpleSelectStar"
+
+
+def test_analyze_rejects_with_retry_after_when_saturated(api, monkeypatch):
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command("print('unused')"))
+    limiter = api.AnalysisLimiter(1, 1)
+    limiter.running, limiter.waiting = 1, 1
+    monkeypatch.setattr(api, "limiter", limiter)
+
+    response = TestClient(api.app).post("/analyze", json={"query": "SELECT 1"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(api.RETRY_AFTER_SECONDS)
+
+
+def test_limiter_queues_up_to_max_then_rejects(api):
+    async def scenario():
+        limiter = api.AnalysisLimiter(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        first = asyncio.ensure_future(hold())
+        second = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        assert (limiter.running, limiter.waiting) == (1, 1)
+
+        with pytest.raises(api.Saturated):
+            async with limiter.slot():
+                pass
+
+        release.set()
+        await asyncio.gather(first, second)
+        assert (limiter.running, limiter.waiting) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_run_recognizer_kills_child_on_timeout(api, monkeypatch):
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command("import time; time.sleep(30)"))
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(api.run_recognizer("SELECT 1", timeout=0.2))
+    assert time.monotonic() - started < 10
+
+
+def test_run_recognizer_kills_child_when_cancelled(api, monkeypatch, tmp_path):
+    """クライアント切断でタスクがキャンセルされたら、子プロセスも止まること。"""
+    pid_file = tmp_path / "pid"
+    code = f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); time.sleep(30)"
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command(code))
+
+    async def scenario():
+        task = asyncio.ensure_future(api.run_recognizer("SELECT 1", timeout=60))
+        for _ in range(200):
+            if pid_file.exists() and pid_file.read_text():
+                break
+            await asyncio.sleep(0.05)
+        pid = int(pid_file.read_text())
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return pid
+
+    pid = asyncio.run(scenario())
+    assert not _pid_alive(pid)
+
+
+def test_java_command_uses_cds_archive_when_present(api, monkeypatch, tmp_path):
+    archive = tmp_path / "app-cds.jsa"
+    monkeypatch.setattr(api, "CDS_ARCHIVE_PATH", str(archive))
+    monkeypatch.setattr(api, "JAVA_OPTIONS", "-XX:TieredStopAtLevel=1")
+
+    assert api.java_command() == ["java", "-XX:TieredStopAtLevel=1", "-jar", api.JAR_PATH]
+
+    archive.write_bytes(b"")
+    assert api.java_command() == [
+        "java",
+        "-XX:TieredStopAtLevel=1",
+        f"-XX:SharedArchiveFile={archive}",
+        "-Xshare:auto",
+        "-jar",
+        api.JAR_PATH,
+    ]
+
+
+def test_ready_only_after_warmup(api, monkeypatch, tmp_path):
+    """ウォームアップの解析が終わるまで /ready は 503、終わったら 200。"""
+    gate = tmp_path / "gate"
+    code = f"import os, time\nwhile not os.path.exists({str(gate)!r}): time.sleep(0.02)"
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command(code))
+    monkeypatch.setattr(api, "WARMUP_ON_STARTUP", True)
+    monkeypatch.setattr(api, "limiter", api.AnalysisLimiter(1, 0))
+    monkeypatch.setattr(
+        api, "readiness", {"ready": False, "warmup_seconds": None, "detail": "starting"}
+    )
+
+    with TestClient(api.app) as client:
+        assert client.get("/ready").status_code == 503
+        gate.write_text("")
+        for _ in range(200):
+            response = client.get("/ready")
+            if response.status_code == 200:
+                break
+            time.sleep(0.05)
+
+    assert response.status_code == 200
+    assert response.json()["warmup_seconds"] is not None
+
+
+def test_never_ready_without_recognizer(api, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", None)
+    monkeypatch.setattr(
+        api, "readiness", {"ready": False, "warmup_seconds": None, "detail": "starting"}
+    )
+
+    asyncio.run(api.warm_up())
+
+    assert api.readiness == {
+        "ready": False,
+        "warmup_seconds": None,
+        "detail": "JAR file not found.",
+    }
+
+
+def _sample(api, name, labels=None):
+    return api.metrics_registry.get_sample_value(name, labels or {}) or 0.0
+
+
+def test_metrics_count_outcomes_and_query_sizes(api, monkeypatch):
+    monkeypatch.setattr(api, "limiter", api.AnalysisLimiter(1, 0))
+    client = TestClient(api.app)
+    before = {
+        "success": _sample(api, "antipattern_api_request_seconds_count", {"outcome": "success"}),
+        "no_findings": _sample(api, "antipattern_api_no_findings_total"),
+        "nonzero": _sample(api, "antipattern_api_recognizer_nonzero_exit_total"),
+        "recognizer": _sample(api, "antipattern_api_recognizer_seconds_count"),
+        "query_bytes": _sample(api, "antipattern_api_query_bytes_sum"),
+    }
+
+    # 指摘なし・終了コード 1 の解析を1件
+    code = "import sys; print('INFO: nothing to report'); sys.exit(1)"
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command(code))
+    response = client.post("/analyze", json={"query": "SELECT 1"})
+    assert response.json()["recommendations"] == api.NO_FINDINGS
+
+    outcome = {"outcome": "success"}
+    assert _sample(api, "antipattern_api_request_seconds_count", outcome) == before["success"] + 1
+    assert _sample(api, "antipattern_api_no_findings_total") == before["no_findings"] + 1
+    assert _sample(api, "antipattern_api_recognizer_nonzero_exit_total") == before["nonzero"] + 1
+    assert _sample(api, "antipattern_api_recognizer_seconds_count") == before["recognizer"] + 1
+    assert _sample(api, "antipattern_api_query_bytes_sum") == before["query_bytes"] + 8
+
+
+def test_metrics_endpoint_exposes_in_flight_and_timeouts(api, monkeypatch):
+    monkeypatch.setattr(api, "RECOGNIZER_COMMAND", _python_command("import time; time.sleep(30)"))
+    monkeypatch.setattr(api, "ANALYSIS_TIMEOUT_SECONDS", 0.2)
+    limiter = api.AnalysisLimiter(2, 0)
+    monkeypatch.setattr(api, "limiter", limiter)
+    client = TestClient(api.app)
+    timeouts = _sample(api, "antipattern_api_timeouts_total")
+
+    assert client.post("/analyze", json={"query": "SELECT 1"}).status_code == 504
+    assert _sample(api, "antipattern_api_timeouts_total") == timeouts + 1
+
+    limiter.running, limiter.waiting = 2, 3
+    body = client.get("/metrics").text
+    assert 'antipattern_api_in_flight{state="running"} 2.0' in body
+    assert 'antipattern_api_in_flight{state="waiting"} 3.0' in body
+    assert 'antipattern_api_request_seconds_bucket{le="0.25",outcome="timeout"}' in body
@@ -0,0 +1,150 @@
+"""benchmarks/ 配下（ベンチマークの仕組み自体）の軽量なテスト。
+
+計測値そのものは環境で揺れるため検証しない。偽物につないだ main() が最後まで走ること、
+呼び出し回数がシナリオの規模どおりになること、ベースライン比較の判定を固定しておく。
+"""
+
+from pathlib import Path
+
+import pytest
+
+BENCHMARKS = Path(__file__).resolve().parent.parent / "benchmarks"
+
+
+@pytest.fixture
+def bench(main_app, monkeypatch):
+    monkeypatch.syspath_prepend(str(BENCHMARKS))
+    import bench_common
+    import main_app_bench
+
+    return main_app_bench, bench_common
+
+
+def test_main_app_bench_drives_real_main_against_fakes(bench, main_app):
+    main_app_bench, _ = bench
+    params = main_app_bench.scenario_params(
+        "small", regions=2, jobs_per_region=3, worst_limit=6, latency_scale=0.0
+    )
+
+    result = main_app_bench.run_benchmark("small", params, repeat=2, warmup=0, main_module=main_app)
+
+    assert result["failed_runs"] == 0
+    assert result["text_summary"] == "解析が完了しました。ワーストクエリ 6 件を分析しました。"
+    # 6 件のワーストクエリそれぞれに構文解析と Gemini が1回ずつ。
+    # 短いクエリなので構文解析はローカルの事前判定で済み、API は呼ばれない
+    assert result["counts"].get("calls.antipattern_api", 0) == 0
+    assert result["stages"]["local.antipattern"]["count"] == 12
+    assert result["counts"]["calls.gemini"] == 6
+    assert result["stages"]["gemini.generate"]["count"] == 12, "2回分のスパンが集まる"
+    assert result["metrics"]["peak_memory_mib"] > 0
+
+
+def test_injected_failures_are_deterministic(bench, main_app):
+    main_app_bench, _ = bench
+    params = main_app_bench.scenario_params("flaky", latency_scale=0.0)
+
+    first = main_app_bench.run_once(main_app, params)
+    second = main_app_bench.run_once(main_app, params)
+
+    assert first["calls"] == second["calls"]
+    assert first["summary"]["text_summary"] == second["summary"]["text_summary"]
+
+
+def test_compare_to_baseline_flags_slowdowns_and_extra_calls(bench):
+    _, bench_common = bench
+    baseline = {
+        "metrics": {"wall_seconds_p50": 1.0, "peak_memory_mib": 10.0},
+        "counts": {"calls.bq_metadata": 40},
+    }
+    ok = {"metrics": {"wall_seconds_p50": 1.2, "peak_memory_mib": 9.0}, "counts": {}}
+    assert bench_common.compare_to_baseline(ok, baseline, tolerance=0.25) == []
+
+    regressed = {
+        "metrics": {"wall_seconds_p50": 1.5, "peak_memory_mib": 10.0},
+        "counts": {"calls.bq_metadata": 41},
+    }
+    messages = bench_common.compare_to_baseline(regressed, baseline, tolerance=0.25)
+    assert len(messages) == 2
+    assert messages[0].startswith("wall_seconds_p50")
+
+
+def test_compare_to_baseline_ignores_tiny_absolute_jitter(bench):
+    """1回きりの数 ms のステージが倍になった程度では回帰にしない。"""
+    _, bench_common = bench
+    baseline = {"metrics": {"stage.gcs.bucket_check.p95": 0.006}}
+    result = {"metrics": {"stage.gcs.bucket_check.p95": 0.0176}}
+    assert bench_common.compare_to_baseline(result, baseline) == []
+
+
+def test_percentile_interpolates(bench):
+    _, bench_common = bench
+    assert bench_common.percentile([1, 2, 3, 4], 50) == 2.5
+    assert bench_common.percentile([5], 99) == 5.0
+    assert bench_common.percentile([], 95) == 0.0
+
+
+def test_fake_recognizer_prints_jar_style_recommendations(bench, capsys):
+    import fake_recognizer
+
+    query = "SELECT * FROM t WHERE id IN (SELECT id FROM u) ORDER BY 1"
+    fake_recognizer.main(["--query", query, "--startup-ms", "0", "--per-kb-ms", "0"])
+
+    out = capsys.readouterr().out
+    assert "Recommendations for query: query provided by cli:" in out
+    assert "* SimpleSelectStar:" in out
+    assert "* SemiJoinWithoutAgg:" in out
+    assert "* OrderByWithoutLimit:" in out
+
+
+def test_run_level_counts_statuses_and_latencies(bench):
+    """負荷生成が指定件数ちょうどを投げ、200 以外を失敗として数えること。"""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import antipattern_api_bench
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            status = 503 if b"busy" in body else 200
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        level = antipattern_api_bench.run_level(url, ["SELECT 1", "busy"], 3, 10)
+    finally:
+        server.shutdown()
+
+    assert level["statuses"] == {"200": 5, "503": 5}
+    assert level["latency"]["count"] == 5
+    assert level["rps"] > 0
+
+
+def test_parse_importtime_finds_direct_imports_of_main(bench):
+    """-X importtime の出力から main の累積時間・直接の import・読み込み数を取り出せること。"""
+    import import_time_bench
+
+    stderr = "\n".join(
+        [
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 | site",
+            "import time:        50 |         50 |     _json",
+            "import time:       200 |        250 |   json",
+            "import time:       300 |        300 |   tracing",
+            "import time:      1000 |       1550 | main",
+        ]
+    )
+    entries = import_time_bench.parse_importtime(stderr)
+    assert entries[1] == (2, "_json", 0.00005, 0.00005)
+
+    total, children, loaded = import_time_bench.top_level_import(entries, "main")
+    assert total == 0.00155
+    assert children == [("json", 0.00025), ("tracing", 0.0003)]
+    assert loaded == 4
@@ -6,8 +6,13 @@
 - Workflow が読む summary.json のキー
 """
 
+import datetime
 import json
+import os
+import pstats
 import re
+import sys
+import types
 from pathlib import Path
 
 import pytest
@@ -222,8 +227,1897 @@ def test_summary_contains_every_key_the_workflow_reads(main_app, monkeypatch):
     assert referenced <= written, f"main-app が書いていないキー: {sorted(referenced - written)}"
 
 
+def test_save_summary_merges_extra_keys(main_app, monkeypatch):
+    """計時などの付加情報は Workflow 用のキーを壊さずに追記されること。"""
+    monkeypatch.setattr(main_app.storage, "Client", _FakeStorageClient)
+    main_app.save_summary_for_workflow(
+        "report-bucket", "要点", "customer-project", extra={"timing": {"wall_seconds": 1.5}}
+    )
+
+    blob = _FakeStorageClient.last_instance.buckets["report-bucket"].blobs[
+        main_app.SUMMARY_BLOB_PATH
+    ]
+    payload = json.loads(blob.uploaded)
+    assert payload["timing"] == {"wall_seconds": 1.5}
+    assert payload["text_summary"] == "要点"
+
+
 def test_save_summary_skips_when_bucket_missing(main_app, monkeypatch):
     called = []
     monkeypatch.setattr(main_app.storage, "Client", lambda *a, **k: called.append(1))
     main_app.save_summary_for_workflow("", "summary", "customer-project")
     assert called == []
+
+
+# ==========================================
+# Gemini のバッチ予測モード
+# ==========================================
+
+
+def test_batch_generation_maps_results_back_to_jobs(src_module):
+    bp = src_module("batch_prediction")
+
+    def generate(prompt):
+        if "broken" in prompt:
+            raise RuntimeError("RESOURCE_EXHAUSTED")
+        return f"advice for {prompt}"
+
+    backend = bp.LocalBatchBackend(generate)
+    results = bp.generate_with_batch({"job_a": "query a", "job_b": "broken b"}, backend)
+
+    assert results == {"job_a": "advice for query a", "job_b": None}
+    assert len(backend.submitted) == 1, "全プロンプトが1回のバッチで投入されること"
+
+
+def test_batch_results_fall_back_to_prompt_text_without_labels(src_module):
+    """出力行に labels が残っていなくても、プロンプト本文で突き合わせられること。"""
+    bp = src_module("batch_prediction")
+    line = json.dumps(
+        {
+            "request": {"contents": [{"role": "user", "parts": [{"text": "prompt b"}]}]},
+            "response": {"candidates": [{"content": {"parts": [{"text": "advice b"}]}}]},
+        }
+    )
+    results = bp.parse_batch_results(line, {"job_a": "prompt a", "job_b": "prompt b"})
+    assert results == {"job_a": None, "job_b": "advice b"}
+
+
+def test_batch_generation_marks_all_failed_when_job_fails(src_module):
+    bp = src_module("batch_prediction")
+
+    class _FailingBackend:
+        def submit(self, requests_jsonl):
+            return "handle"
+
+        def wait(self, handle):
+            raise bp.BatchPredictionError("JOB_STATE_FAILED")
+
+    results = bp.generate_with_batch({"job_a": "a", "job_b": "b"}, _FailingBackend())
+    assert results == {"job_a": None, "job_b": None}
+
+
+def test_vertex_batch_backend_gives_up_after_timeout(src_module):
+    """ジョブが終わらなくてもタスクタイムアウト前に諦め、レポート保存の時間を残すこと。"""
+    bp = src_module("batch_prediction")
+
+    class _RunningJob:
+        has_ended = False
+        resource_name = "projects/p/locations/global/batchPredictionJobs/1"
+
+    backend = bp.VertexBatchBackend("model", "gs://bucket/batch", None, 0, timeout_seconds=0)
+    with pytest.raises(bp.BatchPredictionError):
+        backend.wait(_RunningJob())
+
+
+# ==========================================
+# Gemini のストリーミング生成
+# ==========================================
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StreamingModel:
+    """generate_content(stream=True) がチャンクを順に返すモデルの差し替え。"""
+
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    def generate_content(self, prompt, stream=False):
+        assert stream is True
+        for n, text in enumerate(self.chunks):
+            if n == self.fail_after:
+                raise RuntimeError("stream reset")
+            yield _Chunk(text)
+
+
+def test_stream_advice_writes_chunks_without_separators(main_app):
+    report = main_app.ReportSink()
+    report.append("### heading")
+    metrics = []
+
+    ok = main_app.stream_advice_into(
+        report, _StreamingModel(["## 改善", "対象\n", "SELECT 1"]), "job_a", "prompt", metrics
+    )
+
+    assert ok is True
+    assert report.getvalue() == "### heading\n## 改善対象\nSELECT 1\n"
+    assert metrics[0]["job_id"] == "job_a"
+    assert metrics[0]["chars"] == len("## 改善対象\nSELECT 1")
+    assert metrics[0]["time_to_first_token_seconds"] <= metrics[0]["total_seconds"]
+
+
+class _TextlessChunk:
+    """テキストを含まないチャンク（.text が ValueError を送出する。Vertex AI SDK と同じ）。"""
+
+    def __init__(self, parts=()):
+        self.candidates = [types.SimpleNamespace(content=types.SimpleNamespace(parts=parts))]
+
+    @property
+    def text(self):
+        raise ValueError("Response candidate content has no parts (and thus no text).")
+
+
+def test_stream_advice_tolerates_chunks_without_text(main_app):
+    class Model:
+        def generate_content(self, prompt, stream=False):
+            yield _Chunk("本文")
+            yield _TextlessChunk([types.SimpleNamespace(text="の続き")])
+            yield _TextlessChunk()  # 使用量のメタデータだけの最後のチャンク
+
+    report = main_app.ReportSink()
+
+    ok = main_app.stream_advice_into(report, Model(), "job_a", "prompt")
+
+    assert ok is True
+    assert report.getvalue() == "本文の続き\n"
+
+
+def test_stream_advice_keeps_partial_output_and_reports_failure(main_app):
+    report = main_app.ReportSink()
+    metrics = []
+
+    ok = main_app.stream_advice_into(
+        report, _StreamingModel(["前半", "後半"], fail_after=1), "job_a", "prompt", metrics
+    )
+
+    assert ok is False
+    assert report.getvalue().startswith("前半")
+    assert "途中で失敗" in report.getvalue()
+    assert metrics == []
+
+
+# ==========================================
+# 実行全体の持ち時間（デッドライン）
+# ==========================================
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_run_deadline_keeps_finalize_reserve(src_module):
+    dl = src_module("deadline")
+    clock = _FakeClock()
+    deadline = dl.RunDeadline(100, reserve_seconds=20, clock=clock)
+
+    assert deadline.remaining() == 80
+    assert deadline.timeout(60) == 60
+    clock.now = 50
+    assert deadline.timeout(60) == 30, "残り時間より長いタイムアウトを渡さないこと"
+    clock.now = 80
+    assert deadline.expired()
+    assert deadline.timeout(60) == dl.MIN_TIMEOUT_SECONDS
+
+
+def test_degradation_level_downgrades_as_budget_shrinks(src_module):
+    dl = src_module("deadline")
+    clock = _FakeClock()
+    deadline = dl.RunDeadline(100, clock=clock)
+
+    assert dl.degradation_level(deadline, 60, 15) == dl.FULL
+    clock.now = 50
+    assert dl.degradation_level(deadline, 60, 15) == dl.ANTIPATTERN_ONLY
+    clock.now = 90
+    assert dl.degradation_level(deadline, 60, 15) == dl.SKIP
+    assert dl.degradation_level(None, 60, 15) == dl.FULL
+
+
+def test_generate_advice_sync_stops_when_budget_runs_out(main_app, src_module):
+    """持ち時間が尽きたら残りは生成を試みない（失敗ではなく省略として結果から外す）。"""
+    clock = _FakeClock()
+    deadline = src_module("deadline").RunDeadline(100, clock=clock)
+
+    class _Model:
+        def generate_content(self, prompt):
+            clock.now += 50
+            return _Chunk(f"advice {prompt}")
+
+    advices = main_app.generate_advice_sync(
+        _Model(), {"job_a": "a", "job_b": "b"}, deadline=deadline
+    )
+    assert advices == {"job_a": "advice a"}
+
+
+def test_degraded_advice_shows_antipattern_results(main_app):
+    text = main_app.format_degraded_advice("Recommendations for query: SimpleSelectStar")
+    assert "SimpleSelectStar" in text
+    assert "省略" in main_app.format_degraded_advice(None)
+
+
+# ==========================================
+# Cloud Run タスクによるシャード実行
+# ==========================================
+
+
+def test_shard_context_reads_cloud_run_task_env(src_module):
+    sh = src_module("sharding")
+    ctx = sh.ShardContext.from_env(
+        {"CLOUD_RUN_TASK_INDEX": "2", "CLOUD_RUN_TASK_COUNT": "3", "CLOUD_RUN_EXECUTION": "exec-1"}
+    )
+    assert (ctx.task_index, ctx.task_count, ctx.sharded) == (2, 3, True)
+    assert ctx.manifest_path == "results/shards/exec-1/manifest.json"
+    assert sh.ShardContext.from_env({}).sharded is False
+    # 複数タスクで実行 ID が無いと、前の実行のマニフェストを拾ってしまうため起動しない
+    with pytest.raises(ValueError, match="CLOUD_RUN_EXECUTION"):
+        sh.ShardContext.from_env({"CLOUD_RUN_TASK_INDEX": "0", "CLOUD_RUN_TASK_COUNT": "2"})
+
+
+def test_shards_partition_jobs_deterministically(src_module):
+    """全タスクの担当分を合わせると、重複も漏れもなく全件になること。"""
+    sh = src_module("sharding")
+    jobs = [f"job_{n}" for n in range(7)]
+    assigned = [sh.ShardContext(i, 3).select(jobs) for i in range(3)]
+
+    numbers = sorted(number for shard in assigned for number, _ in shard)
+    assert numbers == list(range(1, 8))
+    assert assigned[0] == [(1, "job_0"), (4, "job_3"), (7, "job_6")]
+    assert assigned == [sh.ShardContext(i, 3).select(jobs) for i in range(3)]
+
+
+def test_sharded_run_merges_sections_in_rank_order(src_module, tmp_path):
+    """各タスクのシャードを、最後のタスクだけが通し番号順に結合すること。"""
+    sh = src_module("sharding")
+    store = sh.LocalShardStore(tmp_path)
+    jobs = [types.SimpleNamespace(job_id=f"job_{n}", billed_gb=1.0) for n in range(5)]
+    sh.publish_manifest(store, sh.ShardContext(0, 2, "r"), "# preamble\n", jobs, {}, {})
+
+    for index in (1, 0):
+        ctx = sh.ShardContext(index, 2, "r")
+        manifest = sh.load_manifest(store, ctx)
+        sections = [(n, f"section {job.job_id}\n") for n, job in ctx.select(manifest["jobs"])]
+        stats = {"gemini_failures": index, "generation_metrics": [{"task": index}]}
+        sh.write_shard_result(store, ctx, sections, stats)
+
+    ctx = sh.ShardContext(0, 2, "r")
+    results = sh.collect_shard_results(store, ctx)
+    assert store.try_claim(ctx.merge_claim_path) is True
+    assert store.try_claim(ctx.merge_claim_path) is False, "結合は1タスクだけが行う"
+
+    merged, stats = sh.merge_shard_results(results)
+    assert merged == [f"section job_{n}\n" for n in range(5)]
+    assert stats["gemini_failures"] == 1
+    assert len(stats["generation_metrics"]) == 2
+
+
+def test_clear_stale_shards_removes_leftovers_of_a_previous_run(src_module, tmp_path):
+    sh = src_module("sharding")
+    store = sh.LocalShardStore(tmp_path)
+    ctx = sh.ShardContext(0, 2, "r")
+    sh.write_shard_result(store, sh.ShardContext(1, 2, "r"), [(2, "stale\n")], {})
+    store.try_claim(ctx.merge_claim_path)
+
+    sh.clear_stale_shards(store, ctx)
+
+    assert not store.exists(ctx.shard_path(1))
+    assert store.try_claim(ctx.merge_claim_path) is True
+
+
+def test_collect_shard_results_waits_for_every_task(src_module, tmp_path):
+    sh = src_module("sharding")
+    store = sh.LocalShardStore(tmp_path)
+    sh.write_shard_result(store, sh.ShardContext(0, 2, "r"), [], {})
+    assert sh.collect_shard_results(store, sh.ShardContext(0, 2, "r")) is None
+
+
+# ==========================================
+# ステージ別の計時（スパン）
+# ==========================================
+
+
+class _FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_span_records_duration_and_attributes(src_module):
+    tracing = src_module("tracing")
+    timer = _FakeTimer()
+    recorder = tracing.SpanRecorder(clock=timer, timer=timer)
+
+    with recorder.span("bq.worst_ranking", region="us") as sp:
+        timer.now += 2.5
+        sp.set(bytes=1024, rows=None)
+
+    (record,) = recorder.drain()
+    assert record == {
+        "stage": "bq.worst_ranking",
+        "start": 0.0,
+        "duration_seconds": 2.5,
+        "region": "us",
+        "bytes": 1024,
+    }
+    assert recorder.drain() == []
+
+
+def test_span_marks_errors_and_reraises(src_module):
+    tracing = src_module("tracing")
+    recorder = tracing.SpanRecorder()
+    with pytest.raises(TimeoutError):
+        with recorder.span("api.antipattern"):
+            raise TimeoutError("slow")
+    assert recorder.drain()[0]["error"] == "TimeoutError"
+
+
+def test_summarize_spans_aggregates_per_stage(src_module):
+    tracing = src_module("tracing")
+    records = [
+        {"stage": "gemini.generate", "start": 10.0, "duration_seconds": 4.0, "bytes": 100},
+        {"stage": "gemini.generate", "start": 14.0, "duration_seconds": 6.0, "bytes": 50},
+        {"stage": "api.antipattern", "start": 10.0, "duration_seconds": 1.0, "cache": "miss"},
+        {"stage": "api.antipattern", "start": 11.0, "duration_seconds": 0.5, "cache": "hit"},
+        {"stage": "api.antipattern", "start": 12.0, "duration_seconds": 0.5, "error": "HTTPError"},
+    ]
+
+    summary = tracing.summarize_spans(records)
+
+    assert summary["wall_seconds"] == 10.0
+    assert list(summary["stages"]) == ["gemini.generate", "api.antipattern"], "遅い順"
+    gemini = summary["stages"]["gemini.generate"]
+    assert (gemini["count"], gemini["total_seconds"], gemini["max_seconds"]) == (2, 10.0, 6.0)
+    assert gemini["bytes"] == 150
+    api = summary["stages"]["api.antipattern"]
+    assert (api["cache_hits"], api["cache_misses"], api["errors"]) == (1, 1, 1)
+
+
+# ==========================================
+# プロファイリングモード
+# ==========================================
+
+
+def _allocate_rows(n):
+    return [{"job_id": f"job_{i}", "query": "SELECT 1" * 10} for i in range(n)]
+
+
+def test_profile_session_reports_hot_functions_and_allocations(src_module, tmp_path):
+    profiling = src_module("profiling")
+    session = profiling.ProfileSession(top_n=10)
+    with session:
+        rows = _allocate_rows(20000)
+
+    summary = session.summary_text("exec-1", 0)
+    assert "run_id: exec-1" in summary
+    assert "_allocate_rows" in summary
+    assert session.peak_memory_bytes > 0
+
+    # .pstats はそのまま pstats で開ける形式であること
+    path = tmp_path / "task-0000.pstats"
+    path.write_bytes(session.pstats_bytes())
+    assert pstats.Stats(str(path)).total_calls > 0
+    assert len(rows) == 20000
+
+
+def test_run_with_profiling_uploads_even_when_run_exits(main_app, monkeypatch):
+    """sys.exit(1) で終わった実行でもプロファイルが実行 ID 付きで保存されること。"""
+    monkeypatch.setattr(main_app.storage, "Client", _FakeStorageClient)
+    monkeypatch.setattr(main_app, "GCS_BUCKET_NAME", "report-bucket")
+    monkeypatch.setenv("CLOUD_RUN_EXECUTION", "exec-9")
+    monkeypatch.setenv("CLOUD_RUN_TASK_INDEX", "1")
+    monkeypatch.setenv("CLOUD_RUN_TASK_COUNT", "2")
+    monkeypatch.setattr(main_app, "run", lambda: sys.exit(1))
+
+    with pytest.raises(SystemExit):
+        main_app.run_with_profiling()
+
+    blobs = _FakeStorageClient.last_instance.buckets["report-bucket"].blobs
+    assert sorted(blobs) == [
+        "reports/profiles/exec-9/task-0001.pstats",
+        "reports/profiles/exec-9/task-0001.txt",
+    ]
+    assert blobs["reports/profiles/exec-9/task-0001.pstats"].metadata["run_id"] == "exec-9"
+
+
+def test_run_with_profiling_exits_cleanly_on_invalid_shard_config(main_app, monkeypatch, caplog):
+    """シャード設定の不備は run() と同じくトレースバックではなく exit 1 で終える。"""
+    monkeypatch.delenv("CLOUD_RUN_EXECUTION", raising=False)
+    monkeypatch.setenv("CLOUD_RUN_TASK_INDEX", "0")
+    monkeypatch.setenv("CLOUD_RUN_TASK_COUNT", "2")
+    monkeypatch.setattr(main_app, "run", lambda: pytest.fail("run() must not start"))
+
+    with pytest.raises(SystemExit) as exc:
+        main_app.run_with_profiling()
+
+    assert exc.value.code == 1
+    assert "Invalid shard configuration" in caplog.text
+
+
+# ==========================================
+# 起動の高速化（遅延 import・実行者の特定・並行した起動時確認）
+# ==========================================
+
+
+def test_lazy_module_imports_on_first_attribute_access(src_module, tmp_path, monkeypatch):
+    lazy_imports = src_module("lazy_imports")
+    (tmp_path / "heavy_sdk_for_test.py").write_text("LOADED = True\nClient = object\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "heavy_sdk_for_test", raising=False)
+
+    proxy = lazy_imports.lazy_module("heavy_sdk_for_test")
+    assert "heavy_sdk_for_test" not in sys.modules
+    assert proxy.loaded is False
+
+    assert proxy.LOADED is True
+    # 差し替え（テストの monkeypatch 等）は本体のモジュールに届く
+    proxy.Client = dict
+    assert sys.modules["heavy_sdk_for_test"].Client is dict
+
+
+class _QueryCountingClient:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, sql, **kwargs):
+        self.queries.append(sql)
+        return types.SimpleNamespace(
+            result=lambda timeout=None: [types.SimpleNamespace(user_email="user@example.com")]
+        )
+
+
+def test_analyzer_email_comes_from_credentials_without_query(main_app, monkeypatch):
+    monkeypatch.setattr(main_app.google.auth, "default", lambda: (_FakeCredentials(), None))
+    client = _QueryCountingClient()
+
+    assert main_app.get_current_user_email(client) == _FakeCredentials.service_account_email
+    assert client.queries == [], "SA の場合は session_user() を問い合わせない"
+
+
+def test_analyzer_email_refreshes_metadata_credentials(main_app, monkeypatch):
+    """Cloud Run の認証情報は refresh するまで "default" を返す。"""
+
+    class _MetadataCredentials:
+        service_account_email = "default"
+
+        def refresh(self, request):
+            self.service_account_email = "job-sa@example.iam.gserviceaccount.com"
+
+    monkeypatch.setattr(main_app.google.auth, "default", lambda: (_MetadataCredentials(), None))
+    monkeypatch.setattr(main_app, "auth_transport", types.SimpleNamespace(Request=object))
+    assert main_app.get_credentials_email() == "job-sa@example.iam.gserviceaccount.com"
+
+
+def test_analyzer_email_falls_back_to_session_user(main_app, monkeypatch):
+    """ユーザー認証（ローカル実行）にはメールが無いので、従来どおり BigQuery に聞く。"""
+    user_credentials = types.SimpleNamespace(token="t")
+    monkeypatch.setattr(main_app.google.auth, "default", lambda: (user_credentials, None))
+    client = _QueryCountingClient()
+
+    assert main_app.get_current_user_email(client) == "user@example.com"
+    assert len(client.queries) == 1
+
+
+def test_startup_checks_run_concurrently(main_app, monkeypatch):
+    """起動時の確認が逐次実行だと Barrier が揃わずタイムアウトする。"""
+    import threading
+
+    barrier = threading.Barrier(5, timeout=5)
+
+    def task(result):
+        def run(*args):
+            barrier.wait()
+            return result
+
+        return run
+
+    monkeypatch.setattr(main_app, "check_bucket_exists", task(True))
+    monkeypatch.setattr(main_app, "init_generative_model", task("model"))
+    monkeypatch.setattr(main_app, "get_current_user_email", task("sa@example.com"))
+    monkeypatch.setattr(main_app, "load_master_dictionary", task({"p": "text"}))
+    monkeypatch.setattr(main_app, "get_active_regions", task({"us"}))
+
+    startup = main_app.run_startup_checks(None, None, None, None, extracts=True)
+
+    assert startup == {
+        "bucket_ok": True,
+        "model": "model",
+        "analyzer_email": "sa@example.com",
+        "master_dict": {"p": "text"},
+        "target_regions": {"us"},
+    }
+
+
+def test_startup_checks_skip_extraction_prep_on_worker_shards(main_app, monkeypatch):
+    monkeypatch.setattr(main_app, "check_bucket_exists", lambda *a: True)
+    monkeypatch.setattr(main_app, "init_generative_model", lambda: "model")
+    startup = main_app.run_startup_checks(None, None, None, None, extracts=False)
+    assert set(startup) == {"bucket_ok", "model"}
+
+
+# ==========================================
+# 構文解析 API の混雑（503 + Retry-After）への対応
+# ==========================================
+
+
+class _FakeApiResponse:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._payload = payload or {}
+        self.content = b"{}"
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self._payload
+
+
+@pytest.fixture
+def antipattern_api(main_app, monkeypatch):
+    """構文解析 API への POST を、用意した応答の列で置き換える。"""
+    monkeypatch.setattr(main_app, "BQ_ANTIPATTERN_API_URL", "https://api.example.com")
+    monkeypatch.setattr(
+        main_app, "oauth2_id_token", types.SimpleNamespace(fetch_id_token=lambda req, aud: "t")
+    )
+    monkeypatch.setattr(main_app, "auth_transport", types.SimpleNamespace(Request=object))
+    main_app.get_oidc_token.cache_clear()
+    sleeps = []
+    monkeypatch.setattr(main_app.time, "sleep", sleeps.append)
+
+    responses = []
+    posts = []
+
+    def post(url, **kwargs):
+        posts.append(url)
+        return responses.pop(0)
+
+    monkeypatch.setattr(main_app, "requests", types.SimpleNamespace(post=post))
+    yield responses, posts, sleeps
+    main_app.get_oidc_token.cache_clear()
+
+
+def test_antipattern_api_retries_after_busy_response(main_app, antipattern_api):
+    responses, posts, sleeps = antipattern_api
+    responses += [
+        _FakeApiResponse(503, headers={"Retry-After": "3"}),
+        _FakeApiResponse(200, {"recommendations": "* SimpleSelectStar"}),
+    ]
+
+    assert main_app.analyze_with_bq_antipattern_api("SELECT *") == "* SimpleSelectStar"
+    assert len(posts) == 2
+    assert sleeps == [3.0], "Retry-After の秒数だけ待つ"
+
+
+def test_antipattern_api_gives_up_when_busy_past_deadline(main_app, src_module, antipattern_api):
+    """残り時間で再送を待てないときは、待たずに失敗扱い（解析なし）にする。"""
+    responses, posts, sleeps = antipattern_api
+    responses += [_FakeApiResponse(503, headers={"Retry-After": "30"})]
+    deadline = src_module("deadline").RunDeadline(20, clock=lambda: 0.0)
+
+    result = main_app.analyze_with_bq_antipattern_api("SELECT 1", deadline=deadline)
+
+    assert result == "アンチパターンの解析ツール呼び出しに失敗しました。"
+    assert len(posts) == 1
+    assert sleeps == []
+
+
+# ==========================================
+# 構文解析の事前判定（ローカルのルール）
+# ==========================================
+
+_PARITY_CORPUS = Path(__file__).parent / "data" / "antipattern_parity.jsonl"
+
+
+def _parity_cases():
+    with open(_PARITY_CORPUS, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize("case", _parity_cases(), ids=lambda case: case["id"])
+def test_prescreen_matches_parity_corpus(src_module, case):
+    """decidable のクエリはローカルで判定し、コーパスの期待値と同じルールが当たる。
+
+    期待値は tools/antipattern_parity.py --record で JAR の結果に置き換える（source が "jar"）。
+    """
+    rules = src_module("antipattern_rules")
+    screening = rules.prescreen(case["query"])
+    assert screening.decided == case["decidable"], screening.reason
+    if screening.decided:
+        expected = {rule for rule in case["jar"] if rule in rules.SUPPORTED_RULES}
+        assert {f.rule for f in screening.findings} == expected
+
+
+def test_prescreen_stays_off_until_parity_is_recorded(main_app):
+    """JAR と突き合わせていない期待値が残っている間は、ローカル判定を既定で使わない。"""
+    unrecorded = [case["id"] for case in _parity_cases() if case["source"] != "jar"]
+    if unrecorded and "ANTIPATTERN_PRESCREEN" not in os.environ:
+        assert main_app.ANTIPATTERN_PRESCREEN is False
+
+
+@pytest.mark.parametrize(
+    "sql, reason",
+    [
+        ("SELECT 1; SELECT 2", "multiple statements"),
+        ("CREATE TEMP TABLE t AS SELECT 1", "not a query"),
+        ("SELECT * FROM t PIVOT (SUM(x) FOR y IN ('a'))", "unsupported syntax: PIVOT"),
+        ("SELECT (1", "unbalanced"),
+        ("SELECT 'unterminated", ""),
+    ],
+)
+def test_prescreen_leaves_unsupported_queries_to_api(src_module, sql, reason):
+    screening = src_module("antipattern_rules").prescreen(sql)
+    assert not screening.decided
+    assert reason in screening.reason
+
+
+def test_prescreen_respects_query_size_limit(src_module):
+    rules = src_module("antipattern_rules")
+    sql = "SELECT id FROM t WHERE id IN (" + ", ".join(["1"] * 100) + ")"
+    assert rules.prescreen(sql).decided
+    assert rules.prescreen(sql, max_query_bytes=64).reason == "query too long"
+
+
+def test_prescreen_report_matches_api_format(src_module):
+    rules = src_module("antipattern_rules")
+
+    report = rules.prescreen("SELECT * FROM `p.d.t` ORDER BY id").report()
+
+    assert report.splitlines()[0] == rules.REPORT_HEADER
+    assert rules.rule_names(report) == ["SimpleSelectStar", "OrderByWithoutLimit"]
+    assert rules.prescreen("SELECT id FROM t LIMIT 1").report() == rules.NO_FINDINGS
+
+
+def test_analyze_antipatterns_skips_api_when_decided(main_app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main_app, "ANTIPATTERN_PRESCREEN", True)
+    monkeypatch.setattr(
+        main_app, "analyze_with_bq_antipattern_api", lambda q, deadline=None: calls.append(q)
+    )
+
+    assert "SimpleSelectStar" in main_app.analyze_antipatterns("SELECT * FROM `p.d.t`")
+    main_app.analyze_antipatterns("SELECT 1; SELECT 2")
+
+    assert calls == ["SELECT 1; SELECT 2"], "判定できないクエリだけ API に送る"
+
+
+def test_analyze_antipatterns_falls_back_to_api_when_prescreen_crashes(main_app, monkeypatch):
+    def broken(sql, max_query_bytes=None):
+        raise IndexError("unexpected token layout")
+
+    monkeypatch.setattr(main_app, "ANTIPATTERN_PRESCREEN", True)
+    monkeypatch.setattr(main_app, "prescreen", broken)
+    monkeypatch.setattr(
+        main_app, "analyze_with_bq_antipattern_api", lambda q, deadline=None: "from api"
+    )
+
+    assert main_app.analyze_antipatterns("SELECT * FROM `p.d.t`") == "from api"
+
+
+def test_analyze_antipatterns_can_disable_prescreen(main_app, monkeypatch):
+    monkeypatch.setattr(main_app, "ANTIPATTERN_PRESCREEN", False)
+    monkeypatch.setattr(
+        main_app, "analyze_with_bq_antipattern_api", lambda q, deadline=None: "from api"
+    )
+
+    assert main_app.analyze_antipatterns("SELECT * FROM `p.d.t`") == "from api"
+
+
+# ==========================================
+# パーティションの絞り込みの検証
+# ==========================================
+
+
+@pytest.fixture
+def pruning_tables(src_module):
+    TableMetadata = src_module("partition_pruning").TableMetadata
+    return [
+        TableMetadata(
+            "proj.ds.events",
+            partition_column="dt",
+            partition_type="DAY",
+            clustering_fields=["user_id", "type"],
+            columns=[("dt", "DATE"), ("user_id", "STRING"), ("type", "STRING")],
+        ),
+        TableMetadata(
+            "proj.ds.users",
+            partition_column="_PARTITIONTIME",
+            partition_type="DAY",
+            columns=[("user_id", "STRING"), ("country", "STRING")],
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "sql, statuses",
+    [
+        ("SELECT * FROM `proj.ds.events` WHERE user_id = 'a'", ["not_pruned"]),
+        ("SELECT * FROM ds.events e WHERE e.dt >= '2024-01-01' AND e.type = 'x'", ["pruned"]),
+        ("SELECT * FROM ds.events WHERE dt = '2024-01-01' OR dt = '2024-01-02'", ["pruned"]),
+        ("SELECT * FROM ds.events WHERE dt = '2024-01-01' OR type = 'x'", ["ineffective"]),
+        (
+            "SELECT * FROM ds.events WHERE dt = (SELECT MAX(dt) FROM ds.events)",
+            ["ineffective", "not_pruned"],
+        ),
+        (
+            "SELECT e.id FROM proj.ds.events AS e JOIN `proj.ds.users` u ON e.dt = DATE(u._PARTITIONTIME)"
+            " WHERE u._PARTITIONDATE = '2024-01-01'",
+            ["ineffective", "pruned"],
+        ),
+        (
+            "WITH x AS (SELECT * FROM proj.ds.events) SELECT * FROM x WHERE dt = '2024-01-01'",
+            ["outer_filter"],
+        ),
+        (
+            "SELECT a FROM ds.events WHERE dt > '2024' UNION ALL SELECT a FROM ds.events",
+            ["pruned", "not_pruned"],
+        ),
+        # 定数・定数の範囲との比較（絞り込みを保つ関数で包んだ列を含む）だけが絞り込みになる
+        ("SELECT * FROM ds.events WHERE dt BETWEEN '2024-01-01' AND '2024-01-31'", ["pruned"]),
+        ("SELECT * FROM ds.events WHERE dt IN ('2024-01-01', '2024-01-02')", ["pruned"]),
+        (
+            "SELECT * FROM ds.events WHERE dt >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)",
+            ["pruned"],
+        ),
+        ("SELECT * FROM ds.events WHERE @start <= dt", ["pruned"]),
+        ("SELECT * FROM ds.users WHERE DATE(_PARTITIONTIME) = '2024-01-01'", ["pruned"]),
+        (
+            "SELECT * FROM ds.users WHERE TIMESTAMP_TRUNC(_PARTITIONTIME, DAY) = TIMESTAMP '2024-01-01'",
+            ["pruned"],
+        ),
+        ("SELECT * FROM ds.events e WHERE e.dt IS NOT NULL", ["ineffective"]),
+        ("SELECT * FROM ds.events WHERE EXTRACT(YEAR FROM dt) = 2024", ["ineffective"]),
+        ("SELECT * FROM ds.events WHERE FORMAT_DATE('%Y', dt) = '2024'", ["ineffective"]),
+        ("SELECT * FROM ds.events WHERE dt != '2024-01-01'", ["ineffective"]),
+        ("SELECT * FROM ds.events WHERE dt = DATE(type)", ["ineffective"]),
+        ("SELECT * FROM ds.events WHERE dt > user_id", ["ineffective"]),
+        # 括弧・入れ子の AND / OR は再帰的に分ける（OR はすべての枝が絞り込むときだけ）
+        ("SELECT * FROM ds.events WHERE (type = 'x' AND dt = '2024-01-01')", ["pruned"]),
+        (
+            "SELECT * FROM ds.events WHERE type = 'x' AND (dt = '2024-01-01' OR dt = '2024-01-02')",
+            ["pruned"],
+        ),
+        (
+            "SELECT * FROM ds.events WHERE (dt = '2024-01-01' AND type = 'x') OR dt = '2024-01-02'",
+            ["pruned"],
+        ),
+        (
+            "SELECT * FROM ds.events WHERE (dt = '2024-01-01' AND type = 'x') OR type = 'y'",
+            ["ineffective"],
+        ),
+        (
+            "SELECT * FROM ds.events WHERE ((dt IS NOT NULL)) AND (dt > '2024-01-01')",
+            ["pruned"],
+        ),
+    ],
+)
+def test_verify_pruning_classifies_each_table_reference(src_module, pruning_tables, sql, statuses):
+    report = src_module("partition_pruning").verify_pruning(sql, pruning_tables)
+    assert report.decided
+    assert [scan.status for scan in report.scans] == statuses
+
+
+@pytest.mark.parametrize(
+    "where, detail",
+    [
+        ("dt IS NOT NULL", "IS NULL・IS NOT NULL の判定"),
+        ("EXTRACT(YEAR FROM dt) = 2024", "関数や演算で加工してから比較"),
+        ("dt > user_id", "同じテーブルの列どうしを比較"),
+        ("(dt = '2024-01-01' AND type = 'x') OR type = 'y'", "一部の OR の枝にしか無い"),
+    ],
+)
+def test_ineffective_filters_explain_why(src_module, pruning_tables, where, detail):
+    report = src_module("partition_pruning").verify_pruning(
+        f"SELECT * FROM ds.events WHERE {where}", pruning_tables
+    )
+    assert detail in report.scans[0].detail
+    assert "パーティションの絞り込みが効きません" in report.facts()
+
+
+def test_verify_pruning_reports_clustering_usage(src_module, pruning_tables):
+    pp = src_module("partition_pruning")
+    sql = "SELECT * FROM proj.ds.events WHERE dt = '2024-01-01' AND type = 'x'"
+
+    (scan,) = pp.verify_pruning(sql, pruning_tables).scans
+
+    assert scan.clustering_used == ["type"]
+    assert scan.clustering_unused == ["user_id"]
+    assert scan.leading_clustering_unused
+
+
+def test_verify_pruning_abstains_when_it_cannot_read_the_query(src_module, pruning_tables):
+    pp = src_module("partition_pruning")
+
+    unreadable = pp.verify_pruning("SELECT 'unterminated", pruning_tables)
+    update = pp.verify_pruning(
+        "UPDATE proj.ds.events SET type = 'y' WHERE dt = 'x'", pruning_tables
+    )
+
+    assert not unreadable.decided
+    assert "判定していません" in unreadable.facts()
+    assert update.scans == []
+    assert "proj.ds.events" in update.unresolved
+
+
+def test_pruning_facts_reach_prompt_and_report(main_app, monkeypatch):
+    """判定結果はプロンプトとレポートの節に載り、summary 用の集計にも入る。"""
+    table = types.SimpleNamespace(
+        time_partitioning=types.SimpleNamespace(field="dt", type_="DAY"),
+        clustering_fields=None,
+        schema=[types.SimpleNamespace(name="dt", field_type="DATE")],
+    )
+    bq_client = types.SimpleNamespace(get_table=lambda name, timeout=None: table)
+    job = types.SimpleNamespace(
+        job_id="j1",
+        region_name="asia-northeast1",
+        query="SELECT * FROM `p.d.events`",
+        referenced_tables=[{"project_id": "p", "dataset_id": "d", "table_id": "events"}],
+        billed_gb=1.0,
+        duration_seconds=1,
+        slot_hours=0.1,
+        source_type="User",
+        difficulty="Low",
+    )
+    prompts = {}
+    monkeypatch.setattr(main_app, "analyze_antipatterns", lambda q, deadline=None: "特になし")
+    monkeypatch.setattr(
+        main_app,
+        "generate_advice_sync",
+        lambda model, p, metrics, deadline: prompts.update(p) or {"j1": "advice"},
+    )
+    monkeypatch.setattr(main_app, "GEMINI_GENERATION_MODE", "sync")
+    sections = {}
+
+    def open_section(i):
+        sections[i] = main_app.ReportSink()
+        return sections[i]
+
+    stats = main_app.analyze_worst_jobs(
+        [(1, job)], 1, {}, bq_client, None, None, {}, main_app.RunDeadline(600), open_section
+    )
+
+    assert "パーティション列 `dt` で絞り込んでいません" in prompts["j1"]
+    assert "パーティション列 `dt` で絞り込んでいません" in sections[1].getvalue()
+    assert stats["partition_pruning"][0]["tables"][0]["status"] == "not_pruned"
+
+
+# ==========================================
+# 実行計画（query_plan）のボトルネック
+# ==========================================
+
+
+def _plan_entry(name, slot_ms=1000, wait=10, read=10, compute=10, write=10, **extra):
+    values = dict(
+        name=name,
+        slot_ms=slot_ms,
+        parallel_inputs=50,
+        wait_ms_avg=wait,
+        read_ms_avg=read,
+        compute_ms_avg=compute,
+        compute_ms_max=compute,
+        write_ms_avg=write,
+        shuffle_output_bytes=0,
+        shuffle_output_bytes_spilled=0,
+    )
+    values.update(extra)
+    return types.SimpleNamespace(**values)
+
+
+@pytest.mark.parametrize(
+    "plan, bottleneck",
+    [
+        ([_plan_entry("S00: Input", read=900), _plan_entry("S01: Output")], "read"),
+        ([_plan_entry("S00: Join+", compute=800)], "compute"),
+        ([_plan_entry("S00: Join+", write=800, shuffle_output_bytes=10**9)], "shuffle"),
+        ([_plan_entry("S00: Join+", shuffle_output_bytes_spilled=10**6)], "spill"),
+        ([_plan_entry("S00: Aggregate", compute=200, compute_ms_max=2000)], "skew"),
+        ([_plan_entry("S00: Input", wait=900)], "slot_wait"),
+    ],
+)
+def test_summarize_plan_finds_the_bottleneck(src_module, plan, bottleneck):
+    assert src_module("query_plan").summarize_plan(plan).bottleneck == bottleneck
+
+
+def test_plan_facts_name_the_dominant_stage(src_module):
+    plan = src_module("query_plan").summarize_plan(
+        [
+            _plan_entry("S00: Input", slot_ms=100),
+            _plan_entry("S01: Join+", slot_ms=900, compute=200, compute_ms_max=1200),
+        ]
+    )
+
+    facts = plan.facts()
+
+    assert "`S01: Join+`（スロット時間の 90%" in facts
+    assert "最大が平均の 6.0 倍" in facts
+    assert plan.as_dict()["skewed_stage"] == "S01: Join+"
+
+
+def test_fetch_query_plan_tolerates_missing_permission(main_app):
+    def get_job(*args, **kwargs):
+        raise Forbidden("jobs.get")
+
+    job = types.SimpleNamespace(job_id="j1", project_id="p", region_name="US")
+    plan = main_app.fetch_query_plan(types.SimpleNamespace(get_job=get_job), job)
+
+    assert plan.stages == []
+    assert plan.facts() == "- 実行計画を取得できませんでした。"
+
+
+# ==========================================
+# スロット使用量のタイムライン（同時実行の競合）
+# ==========================================
+
+
+def _timeline_row(minute, slots, jobs):
+    return {
+        "minute": datetime.datetime(2024, 1, 1, 9, minute, tzinfo=datetime.timezone.utc),
+        "avg_slots": slots,
+        "running_jobs": len(jobs),
+        "overall_avg_slots": 50.0,
+        "p50_queued_seconds": 0.5,
+        "p95_queued_seconds": 8.0,
+        "top_jobs": [
+            {"job_id": job_id, "user_email": "a@example.com", "avg_slots": s, "queued_seconds": q}
+            for job_id, s, q in jobs
+        ],
+    }
+
+
+def test_peak_windows_merge_consecutive_minutes(src_module):
+    st = src_module("slot_timeline")
+    rows = [
+        _timeline_row(1, 300, [("j1", 200, 1.0), ("j2", 100, 4.0)]),
+        _timeline_row(0, 200, [("j1", 150, 1.0)]),
+        _timeline_row(30, 400, [("j3", 400, 0.0)]),
+    ]
+
+    windows = st.peak_windows(rows)
+
+    assert [(w.start.minute, w.minutes) for w in windows] == [(30, 1), (0, 2)]
+    early = windows[1]
+    assert early.peak_slots == 300
+    assert early.avg_slots == 250
+    assert [job_id for job_id, _ in early.top_jobs(2)] == ["j1", "j2"]
+    assert early.jobs["j2"]["queued_seconds"] == 4.0
+
+
+def test_format_timeline_renders_table_and_queue_summary(src_module):
+    st = src_module("slot_timeline")
+
+    text = st.format_timeline([_timeline_row(0, 120, [("j1", 120, 2.0)])])
+
+    assert "p95 8.0 秒" in text
+    assert "| 2024-01-01 09:00–09:01 | 120 | 120 | 1 | `j1`" in text
+    assert st.format_timeline([]).startswith("対象となるスロット使用量のデータがありません")
+
+
+# ==========================================
+# レポート冒頭の節（リージョンごとの分析）
+# ==========================================
+
+
+def _region_scan(main_app, query, region="US"):
+    client = types.SimpleNamespace(query=query)
+    return main_app.RegionScan(client, "p", region, "me@example.com", "", "")
+
+
+def _result(rows):
+    return types.SimpleNamespace(result=lambda timeout=None: rows, total_bytes_processed=0)
+
+
+def _pricing_row():
+    return types.SimpleNamespace(
+        period_minutes=1440,
+        job_count=10,
+        billed_bytes=2**40,
+        reserved_slot_share=0.25,
+        minute_slots=[100.0] * 60,
+    )
+
+
+@pytest.mark.parametrize(
+    "analyzer",
+    [
+        "analyze_storage_pricing",
+        "analyze_storage_growth",
+        "analyze_cold_tables",
+        "analyze_compute_pricing",
+        "analyze_slot_timeline",
+        "analyze_mv_candidates",
+        "analyze_table_keys",
+    ],
+)
+def test_section_analyzers_return_none_without_results(main_app, analyzer):
+    scan = _region_scan(main_app, lambda sql, location=None: _result([]))
+
+    assert getattr(main_app, analyzer)(scan, "{target_project}") is None
+
+
+def test_region_sections_keep_only_regions_with_results(main_app):
+    job = types.SimpleNamespace(job_id="j1", billed_gb=1.0, duration_seconds=1)
+
+    def query(sql, location=None):
+        if sql == "storage" or (sql == "cold" and location == "EU"):
+            raise Forbidden("TABLE_STORAGE")
+        return _result({"worst": [job], "compute": [_pricing_row()]}.get(sql, []))
+
+    templates = {
+        "storage": "storage",
+        "cold_tables": "cold",
+        "compute_pricing": "compute",
+        "slot_timeline": "slot",
+    }
+    sections, jobs = main_app.collect_region_data(
+        types.SimpleNamespace(query=query),
+        ["US", "EU"],
+        "me@example.com",
+        "worst",
+        templates,
+        main_app.RunDeadline(600),
+    )
+
+    # 失敗・結果なしの節は載せず、同じリージョンの他の節とワーストクエリの抽出は続ける
+    assert [entry.split("\n")[0] for entry in sections["compute_pricing"]] == [
+        "### 📍 Region: US",
+        "### 📍 Region: EU",
+    ]
+    assert sections["storage"] == sections["cold_tables"] == sections["slot_timeline"] == []
+    # テンプレートの無い節は行わない
+    assert sections["mv_candidates"] == sections["antipattern_census"] == []
+    assert jobs == [job, job]
+    preamble = main_app.build_report_preamble(sections)
+    headings = [line for line in preamble.splitlines() if line.startswith("## ")]
+    assert headings == ["## 💰 コンピュート料金モデルの試算（オンデマンド vs Editions）"]
+    assert "スロット使用量の 25% は既存の予約で実行されています" in preamble
+
+
+@pytest.mark.parametrize(
+    ("run_seconds", "section_calls"),
+    [
+        # 節のクエリは、ワーストクエリの解析に残す 240 秒を除いた 60 秒までしか待たない
+        (300, [("compute", "US", 60), ("compute", "EU", 60)]),
+        # 残す秒数に足りなければ節は省略し、ワーストクエリの抽出だけを行う
+        (200, []),
+    ],
+)
+def test_worst_ranking_runs_before_report_sections(main_app, run_seconds, section_calls):
+    job = types.SimpleNamespace(job_id="j1", billed_gb=1.0, duration_seconds=1)
+    calls = []
+
+    def query(sql, location=None):
+        def result(timeout=None):
+            calls.append((sql, location, timeout))
+            return [job] if sql == "worst" else [_pricing_row()]
+
+        return types.SimpleNamespace(result=result, total_bytes_processed=0)
+
+    sections, jobs = main_app.collect_region_data(
+        types.SimpleNamespace(query=query),
+        ["US", "EU"],
+        "me@example.com",
+        "worst",
+        {"compute_pricing": "compute"},
+        main_app.RunDeadline(run_seconds, clock=lambda: 0.0),
+    )
+
+    assert calls == [("worst", "US", 180), ("worst", "EU", 180)] + section_calls
+    assert jobs == [job, job]
+    assert len(sections["compute_pricing"]) == len(section_calls)
+
+
+# ==========================================
+# コンピュート料金モデルの試算（オンデマンド vs Editions）
+# ==========================================
+
+
+def test_autoscale_slot_minutes_matches_per_minute_sum(src_module):
+    cp = src_module("compute_pricing")
+    minute_slots = [10, 60, 120, 480, 260, 0, 75]
+    demand = cp.SlotDemand(minute_slots, period_minutes=20)
+
+    for baseline, max_slots in [(0, 500), (100, 300), (50, 100), (300, 300)]:
+        expected = sum(
+            min(max(cp._round_up(s) - baseline, 0), max_slots - baseline) for s in minute_slots
+        )
+        assert demand.autoscale_slot_minutes(baseline, max_slots) == expected
+    assert demand.peak == 500
+    # 使用量の無い分（20 - 6 = 14 分）を含めた中央値は 0
+    assert demand.quantile(0.5) == 0
+    assert demand.over_capacity_share(300) == 200 / demand.total_slot_minutes
+
+
+def test_steady_load_prefers_committed_baseline(src_module):
+    cp = src_module("compute_pricing")
+    # 1日中 2000 スロット（Standard の上限 1600 を超える）を使い、1日に 1 PiB を読む
+    simulation = cp.simulate([2000.0] * 1440, 1440, 1024 * 2**40, job_count=5000)
+
+    best = simulation.best
+    assert best.edition == "Enterprise"
+    assert best.baseline_slots == 2000 and best.committed
+    assert simulation.monthly_savings_usd > 0
+    text = cp.format_pricing(simulation)
+    assert "**最安の構成: Enterprise（ベースライン 2000 / 上限 2000 スロット" in text
+    assert "| Enterprise | 2000 | 2000 | 1年コミット |" in text
+    assert "| Standard |" not in text
+
+
+def test_light_bursty_load_stays_on_demand(src_module):
+    cp = src_module("compute_pricing")
+    # 1日に数分だけ大きく使い、読む量は少ない
+    simulation = cp.simulate([2000.0] * 5, 1440, 50 * 2**30, job_count=5)
+
+    assert simulation.monthly_savings_usd <= 0
+    assert "オンデマンドのままが安い見込みです" in cp.format_pricing(simulation)
+    assert cp.format_pricing(cp.simulate([], 0, 0)).startswith(
+        "対象となるクエリの実行履歴がありません"
+    )
+
+
+def test_compute_pricing_section_from_query_row(main_app):
+    scan = _region_scan(main_app, lambda sql, location=None: _result([_pricing_row()]))
+
+    text = main_app.analyze_compute_pricing(scan, "{period_end_expr}")
+
+    assert "- オンデマンド: $187.50 / 月（課金 1.00 TiB）" in text
+    assert "スロット使用量の 25% は既存の予約で実行されています" in text
+
+
+# ==========================================
+# マテリアライズドビュー・BI Engine の候補（繰り返される集計）
+# ==========================================
+
+DASHBOARD_QUERY = """
+SELECT region, DATE(created_at) AS day, SUM(amount) AS total
+FROM `proj.sales.orders` AS o
+WHERE status = 'paid' AND DATE(created_at) >= '2024-01-01' AND o.amount > 0
+GROUP BY region, day
+ORDER BY total DESC
+"""
+
+
+def _aggregation_row(query_hash, query, runs, gib_per_run, tables=("proj.sales.orders",)):
+    return {
+        "query_hash": query_hash,
+        "runs": runs,
+        "users": 4,
+        "active_hour_buckets": list(range(10)),
+        "billed_bytes": runs * gib_per_run * 2**30,
+        "slot_ms": runs * 60_000,
+        "sample_query": query,
+        "tables": list(tables),
+        "period_hours": 24,
+    }
+
+
+def test_view_moves_literal_filters_into_group_by(src_module):
+    mv = src_module("mv_candidates")
+
+    shape = mv.parse_aggregation(DASHBOARD_QUERY)
+
+    assert shape.problems == []
+    assert shape.view_keys == ["region", "day", "status"]
+    sql = shape.view_sql()
+    # 実行ごとに変わる条件は消え、集計される値への条件は残る
+    assert "WHERE\n  o.amount > 0\nGROUP BY" in sql
+    assert "'paid'" not in sql and "2024-01-01" not in sql
+    assert "ORDER BY" not in sql
+
+
+def test_view_problems_are_reported(src_module):
+    mv = src_module("mv_candidates")
+
+    shape = mv.parse_aggregation(
+        "SELECT a, COUNT(DISTINCT b) FROM t WHERE a = 1 OR b = 2 GROUP BY a"
+    )
+
+    assert any("COUNT(DISTINCT)" in p for p in shape.problems)
+    assert any("OR" in p for p in shape.problems)
+    assert mv.parse_aggregation("SELECT a FROM t") is None
+
+
+def test_candidates_cluster_same_tables_and_keys(src_module):
+    mv = src_module("mv_candidates")
+    variant = DASHBOARD_QUERY.replace("SUM(amount) AS total", "COUNT(*) AS orders")
+    rows = [
+        _aggregation_row("h1", DASHBOARD_QUERY, 500, 4),
+        _aggregation_row("h2", variant, 100, 4),
+        _aggregation_row(
+            "h3", "SELECT a, STRING_AGG(b) FROM `p.d.t` GROUP BY a", 300, 1, ["p.d.t"]
+        ),
+    ]
+    # h2 は h1 と 5 時間帯だけ重なる時間帯（5〜14時台）に実行された
+    rows[1]["active_hour_buckets"] = list(range(5, 15))
+
+    candidates = mv.find_candidates(rows)
+
+    orders, small = candidates
+    assert (orders.query_hashes, orders.runs) == (2, 600)
+    assert orders.recommendation == mv.MATERIALIZED_VIEW
+    # 1時間ごとの更新（どちらかのクエリの実行があった 15 時間帯）の分だけ読む
+    assert orders.active_hours == 15 and orders.mv_saved_share == 1 - 15 / 600
+    assert small.recommendation == mv.BI_ENGINE and small.ddl() is None
+    text = mv.format_candidates(candidates)
+    assert "CREATE MATERIALIZED VIEW `proj.sales.mv_orders_by_region_day`" in text
+    # 同じまとまりの別のクエリの集計も1つのビューに入る
+    assert "SUM(amount) AS total" in text and "COUNT(*) AS orders" in text
+    assert "**候補 2** はビューにできません: 増分更新で使えない集計関数（STRING_AGG）" in text
+    assert "BI Engine（1 GiB の予約" in text
+    assert mv.format_candidates([]) == "繰り返し実行される集計クエリはありませんでした。"
+
+
+# ==========================================
+# パーティション列・クラスタリング列の推奨（ワークロードから）
+# ==========================================
+
+
+def _orders_table(pp, **kwargs):
+    columns = [
+        ("order_date", "DATE"),
+        ("created_at", "TIMESTAMP"),
+        ("customer_id", "INT64"),
+        ("status", "STRING"),
+        ("amount", "FLOAT64"),
+    ]
+    return pp.TableMetadata("p.d.orders", columns=columns, **kwargs)
+
+
+def _workload_row(queries):
+    return {
+        "table_name": "p.d.orders",
+        "billed_bytes": sum(gib for _, gib in queries) * 2**30,
+        "runs": len(queries),
+        "queries": [
+            {"query": query, "runs": 1, "billed_bytes": gib * 2**30} for query, gib in queries
+        ],
+    }
+
+
+def test_column_usage_classifies_filters_and_joins(src_module):
+    pp = src_module("partition_pruning")
+    customers = pp.TableMetadata("p.d.customers", columns=[("id", "INT64"), ("country", "STRING")])
+
+    uses = pp.column_usage(
+        "SELECT * FROM p.d.orders o JOIN p.d.customers c ON o.customer_id = c.id "
+        "WHERE o.order_date BETWEEN '2024-01-01' AND '2024-02-01' AND status = 'paid'",
+        [_orders_table(pp), customers],
+    )
+
+    assert {(u.table, u.column, u.kind) for u in uses} == {
+        ("p.d.orders", "order_date", pp.RANGE),
+        ("p.d.orders", "status", pp.EQUALITY),
+        ("p.d.orders", "customer_id", pp.JOIN_KEY),
+        ("p.d.customers", "id", pp.JOIN_KEY),
+    }
+    assert pp.column_usage("SELECT ((", [customers]) is None
+
+
+def test_recommends_partition_and_clustering_from_workload(src_module):
+    pp = src_module("partition_pruning")
+    ka = src_module("key_advisor")
+    row = _workload_row(
+        [
+            ("SELECT * FROM p.d.orders WHERE order_date >= '2024-01-01' AND status = 'paid'", 600),
+            ("SELECT * FROM p.d.orders WHERE created_at > TIMESTAMP '2024-01-01'", 300),
+            ("SELECT * FROM p.d.orders WHERE amount > 100", 50),
+            ("SELECT ((", 50),
+        ]
+    )
+
+    rec = ka.recommend(ka.build_workload(row, _orders_table(pp)))
+
+    assert rec.partition_column == "order_date" and rec.partition_expression == "order_date"
+    # FLOAT64 はクラスタリング列にできない
+    assert rec.clustering == ["status", "created_at"]
+    assert rec.workload.coverage == 0.95
+    # 600 GiB: 分割とクラスタで 0.2 * 0.5 / 300 GiB: クラスタで 0.5
+    assert rec.saved_bytes == (600 * 0.9 + 300 * 0.5) * 2**30
+    text = ka.format_recommendations([rec])
+    assert "| `p.d.orders` | 1,000.0 | 95% | 分割 なし / クラスタ なし |" in text
+    assert "PARTITION BY order_date\nCLUSTER BY status, created_at" in text
+
+
+def test_current_layout_is_kept_when_it_fits(src_module):
+    pp = src_module("partition_pruning")
+    ka = src_module("key_advisor")
+    table = _orders_table(pp, partition_column="order_date", clustering_fields=["status"])
+    row = _workload_row(
+        [("SELECT * FROM p.d.orders WHERE order_date = '2024-01-01' AND status = 'x'", 100)]
+    )
+
+    rec = ka.recommend(ka.build_workload(row, table))
+
+    assert not rec.changed and rec.saved_bytes == 0
+    assert "現在のままで良い" in ka.format_recommendations([rec])
+
+
+@pytest.mark.parametrize(
+    ("partitioning", "clause"),
+    [
+        ({"partition_type": "MONTH"}, "PARTITION BY TIMESTAMP_TRUNC(created_at, MONTH)\n"),
+        ({"partition_type": "DAY"}, "PARTITION BY DATE(created_at)\n"),
+        ({"partition_type": "HOUR"}, "PARTITION BY TIMESTAMP_TRUNC(created_at, HOUR)\n"),
+    ],
+)
+def test_kept_partitioning_is_rebuilt_with_its_granularity(src_module, partitioning, clause):
+    pp = src_module("partition_pruning")
+    ka = src_module("key_advisor")
+    table = _orders_table(pp, partition_column="created_at", **partitioning)
+    row = _workload_row(
+        [
+            (
+                "SELECT * FROM p.d.orders WHERE created_at > TIMESTAMP '2024-01-01' AND status = 'x'",
+                100,
+            )
+        ]
+    )
+
+    rec = ka.recommend(ka.build_workload(row, table))
+
+    # 分割列はそのまま（単位も変えない）で、クラスタリング列だけを提案する
+    assert rec.partition_expression is None and rec.clustering == ["status"] and rec.changed
+    assert clause + "CLUSTER BY status\nAS SELECT * FROM `p.d.orders`;" in rec.ddl()
+
+
+def test_kept_range_partitioning_is_rebuilt(src_module):
+    pp = src_module("partition_pruning")
+    ka = src_module("key_advisor")
+    table = _orders_table(
+        pp, partition_column="customer_id", partition_type="RANGE", partition_range=(0, 1000, 10)
+    )
+    row = _workload_row([("SELECT * FROM p.d.orders WHERE status = 'x'", 100)])
+
+    rec = ka.recommend(ka.build_workload(row, table))
+
+    assert rec.ddl().startswith(
+        "CREATE TABLE `p.d.orders_new`\n"
+        "PARTITION BY RANGE_BUCKET(customer_id, GENERATE_ARRAY(0, 1000, 10))\n"
+        "CLUSTER BY status\n"
+    )
+
+
+def test_ingestion_time_tables_get_no_ctas(src_module):
+    pp = src_module("partition_pruning")
+    ka = src_module("key_advisor")
+    table = _orders_table(pp, partition_column="_PARTITIONTIME", partition_type="DAY")
+    row = _workload_row([("SELECT * FROM p.d.orders WHERE status = 'x'", 100)])
+
+    rec = ka.recommend(ka.build_workload(row, table))
+
+    assert rec.changed and rec.ddl() is None
+    text = ka.format_recommendations([rec])
+    assert "```sql" not in text and "`_PARTITIONTIME` を引き継げない" in text
+
+
+# ==========================================
+# ストレージ料金モデルの判定（テーブル単位）
+# ==========================================
+
+
+def _storage_row(dataset, table, billing_model="LOGICAL", **gib):
+    names = ("active_logical", "long_term_logical", "active_physical", "long_term_physical")
+    names += ("time_travel_physical", "fail_safe_physical")
+    row = {f"{name}_bytes": gib.get(name, 0) * 2**30 for name in names}
+    return dict(row, dataset_name=dataset, table_name=table, billing_model=billing_model)
+
+
+def test_physical_cost_includes_time_travel_and_fail_safe(src_module):
+    sp = src_module("storage_pricing")
+    table = sp.TableStorage.from_row(
+        _storage_row(
+            "d",
+            "t",
+            active_logical=100,
+            long_term_logical=100,
+            active_physical=20,
+            long_term_physical=10,
+            time_travel_physical=5,
+            fail_safe_physical=5,
+        )
+    )
+    prices = sp.prices_for("US")[0]
+
+    assert table.logical_cost(prices) == 100 * 0.02 + 100 * 0.01
+    # タイムトラベル・フェイルセーフはアクティブの物理の単価
+    assert table.physical_cost(prices) == 30 * 0.04 + 10 * 0.02
+    assert sp.prices_for("asia-northeast1")[1] and not sp.prices_for("me-central2")[1]
+
+
+def test_datasets_are_ranked_by_savings_from_current_model(src_module):
+    sp = src_module("storage_pricing")
+    rows = [
+        # 圧縮が効く論理のデータセット -> 物理に変えると安い
+        _storage_row("compressed", "a", active_logical=1000, active_physical=100),
+        # 既に物理だが、更新が多くタイムトラベルで論理より高い -> 論理に戻す
+        _storage_row(
+            "churny",
+            "b",
+            "PHYSICAL",
+            active_logical=100,
+            active_physical=50,
+            time_travel_physical=100,
+        ),
+        _storage_row("fine", "c", active_logical=10, active_physical=9),
+    ]
+
+    datasets = sp.analyze(rows, "US")
+
+    assert [d.name for d in datasets] == ["compressed", "churny", "fine"]
+    assert datasets[0].best_model == sp.PHYSICAL
+    assert round(datasets[0].monthly_savings, 2) == 1000 * 0.02 - 100 * 0.04
+    assert datasets[1].best_model == sp.LOGICAL
+    assert round(datasets[1].monthly_savings, 2) == 150 * 0.04 - 100 * 0.02
+    assert datasets[2].monthly_savings == 0
+
+
+def test_storage_report_lists_costs_and_costly_tables(src_module):
+    sp = src_module("storage_pricing")
+    rows = [
+        _storage_row("d", "big", active_logical=1000, active_physical=100),
+        _storage_row("d", "churny", active_logical=10, active_physical=10, time_travel_physical=40),
+    ]
+
+    text = sp.format_storage(sp.analyze(rows, "me-central2"), "me-central2")
+
+    assert (
+        "| `d` | logical | 1,010.00 | 150.00 | 27% | 20.20 | 6.00 | **【推奨】物理ストレージへ変更** | 14.20 |"
+        in text
+    )
+    assert "`churny`（+$1.80）" in text
+    assert "米国マルチリージョンの定価" in text
+    assert sp.format_storage([], "US") == "対象となるストレージデータがありませんでした。"
+
+
+# ==========================================
+# ストレージの増加の傾向（実行ごとの履歴）
+# ==========================================
+
+
+def _storage_datasets(sp, logical_gib, physical_gib):
+    return sp.analyze(
+        [_storage_row("d", "t", active_logical=logical_gib, active_physical=physical_gib)], "US"
+    )
+
+
+def test_storage_trend_forecasts_when_recommendation_flips(src_module):
+    sp = src_module("storage_pricing")
+    sh = src_module("storage_history")
+    start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    snapshots = []
+    # 論理は 1 日 10 GiB、物理は 1 日 10 GiB 増える（圧縮の効かないデータが増えている）
+    for day in (0, 10, 20, 30):
+        datasets = _storage_datasets(sp, 1000 + 10 * day, 300 + 10 * day)
+        snapshots = sh.record_snapshot(
+            snapshots, datasets, start + datetime.timedelta(days=day), 365
+        )
+
+    (trend,) = sh.trends(snapshots)
+
+    assert trend.days == 30 and trend.best_model == sp.PHYSICAL
+    assert round(trend.physical_growth) == 10 * 2**30
+    # 差（物理 - 論理）は 1 日 0.2 USD 増え、最新は -2 USD -> 10 日後に論理が安くなる
+    assert round(trend.days_to_flip) == 10
+    text = sh.format_trends(snapshots)
+    assert "| `d` | 30 日 | 1,300.0 | +300.0（+23%） | 600.0 | +300.0（+50%） | 物理 |" in text
+    assert "**2026-02-10 ごろ 論理へ**" in text
+
+
+def test_storage_history_is_persisted_per_region(main_app, src_module, tmp_path):
+    sp = src_module("storage_pricing")
+    store = main_app.LocalShardStore(tmp_path)
+    now = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    datasets = _storage_datasets(sp, 100, 10)
+
+    first = main_app.update_storage_history(store, "US", datasets, now)
+    # 再実行（1時間以内）は直前の記録を置き換える
+    main_app.update_storage_history(store, "US", datasets, now + datetime.timedelta(minutes=5))
+    later = main_app.update_storage_history(store, "US", datasets, now + datetime.timedelta(days=1))
+
+    assert "履歴は 1 回分（0 日）です" in first
+    assert "履歴は 2 回分（1 日）です" in later
+    saved = json.loads((tmp_path / "history/storage/us.json").read_text())
+    assert saved["snapshots"][0]["datasets"]["d"]["logical_bytes"] == 100 * 2**30
+
+
+# ==========================================
+# 長期間読まれていないテーブル（未使用・コールド）
+# ==========================================
+
+
+def _cold_row(table, billing_model="LOGICAL", last_read=None, **gib):
+    row = _storage_row("d", table, billing_model, **gib)
+    modified = datetime.datetime(2026, 1, 2, tzinfo=datetime.timezone.utc)
+    return dict(
+        row,
+        creation_time=modified,
+        last_modified_time=modified,
+        last_read_time=last_read,
+        read_jobs=1 if last_read else 0,
+    )
+
+
+def test_cold_tables_are_priced_under_dataset_billing_model(src_module):
+    ct = src_module("cold_tables")
+    rows = [
+        _cold_row("logs", long_term_logical=1000, long_term_physical=100),
+        _cold_row("raw", "PHYSICAL", long_term_logical=3000, long_term_physical=200),
+    ]
+
+    tables = ct.find_cold_tables(rows, "US")
+
+    # 論理 1000 GiB * 0.01 = 10 USD / 物理 200 GiB * 0.02 = 4 USD
+    assert [(t.name, t.monthly_cost) for t in tables] == [("d.logs", 10.0), ("d.raw", 4.0)]
+    assert tables[1].size_bytes == 200 * 2**30
+
+
+def test_cold_table_report_shows_last_read_and_total(src_module):
+    ct = src_module("cold_tables")
+    read = datetime.datetime(2026, 3, 1, tzinfo=datetime.timezone.utc)
+    rows = [
+        _cold_row("logs", long_term_logical=1000),
+        _cold_row("old", last_read=read, active_logical=100),
+    ]
+
+    text = ct.format_cold_tables(ct.find_cold_tables(rows, "US"), 90, 180, max_tables=1)
+
+    assert "| `d.logs` | 180 日以上なし | 2026-01-02 | 1,000.0 | logical | 10.00 |" in text
+    assert "`d.old`" not in text
+    assert "90 日以上読まれていないテーブルが 2 件（上位 1 件を表示）、月 $12.00" in text
+    assert ct.format_cold_tables([], 90, 180) == "対象となるコールドテーブルはありませんでした。"
+
+
+# ==========================================
+# アンチパターンの集計（センサス）
+# ==========================================
+
+
+def _census_rows():
+    return [
+        {"query_hash": "a", "query": "SELECT * FROM d.t", "runs": 10, "billed_bytes": 3 * 2**40},
+        {
+            "query_hash": "b",
+            "query": "SELECT x FROM d.t ORDER BY x",
+            "runs": 5,
+            "billed_bytes": 2**40,
+        },
+        {"query_hash": "c", "query": "SELECT x FROM d.t LIMIT 1", "runs": 1, "billed_bytes": 2**40},
+        # ローカルでは判定できない（DML）。課金の多い順に API へ送る
+        {
+            "query_hash": "d",
+            "query": "DELETE FROM d.t WHERE TRUE",
+            "runs": 2,
+            "billed_bytes": 2 * 2**40,
+        },
+        {
+            "query_hash": "e",
+            "query": "DELETE FROM d.u WHERE TRUE",
+            "runs": 1,
+            "billed_bytes": 2**40,
+        },
+    ]
+
+
+def _census(src_module, **kwargs):
+    ac = src_module("antipattern_census")
+    rules = src_module("antipattern_rules")
+    shapes = ac.build_shapes([dict(row, slot_ms=3_600_000) for row in _census_rows()])
+    remote = (
+        "Recommendations for query: query provided by cli:\n"
+        "* SimpleSelectStar: x\n* MissingDropStatement: y"
+    )
+    return ac, ac.run_census(shapes, rules.prescreen, analyze_remote=lambda q: remote, **kwargs)
+
+
+def test_census_counts_patterns_across_all_queries(src_module):
+    _, census = _census(src_module, max_remote=1, concurrency=2)
+
+    stats = {p.rule: (p.queries, p.runs, p.billed_bytes / 2**40) for p in census.ranked()}
+    assert stats == {
+        "SimpleSelectStar": (2, 12, 5.0),
+        "MissingDropStatement": (1, 2, 2.0),
+        "OrderByWithoutLimit": (1, 5, 1.0),
+    }
+    # 上限（1件）を超えた分は未判定
+    assert [s.query_hash for s in census.shapes if s.rules is None] == ["e"]
+
+
+def test_census_stops_calling_api_when_out_of_time(src_module):
+    ac, census = _census(src_module, max_remote=10, allows=lambda: False)
+
+    assert set(census.patterns) == {"SimpleSelectStar", "OrderByWithoutLimit"}
+    text = ac.format_census(census, truncated=True)
+    # 割合の分母は判定できたクエリ（3 + 1 + 1 TiB）の課金だけ
+    assert "| SimpleSelectStar | 1 | 10 | 3.00 | 60% | 1.0 |" in text
+    assert (
+        "判定したクエリ: 3 件（うち構文解析 API で判定 0 件）、指摘なし 1 件（課金 1.00 TiB）"
+        in text
+    )
+    assert "未判定（ローカルで判定できず、API でも判定しなかった）: 2 件（課金 3.00 TiB）" in text
+    assert "上限件数までを対象にしています" in text
+
+
+def test_census_uses_local_rules_even_when_prescreen_is_off(main_app, monkeypatch):
+    monkeypatch.setattr(main_app, "ANTIPATTERN_PRESCREEN", False)
+    monkeypatch.setattr(main_app, "BQ_ANTIPATTERN_API_URL", None)
+
+    text = main_app.analyze_antipattern_census(
+        [dict(row, slot_ms=0) for row in _census_rows()], main_app.RunDeadline(600)
+    )
+
+    assert "| SimpleSelectStar | 1 | 10 | 3.00 | 60% | 0.0 |" in text
+    assert "| OrderByWithoutLimit | 1 | 5 | 1.00 | 20% | 0.0 |" in text
+
+
+# ==========================================
+# SELECT * で読む列の無駄（列単位の見積もり）
+# ==========================================
+
+
+def _events_table(pp):
+    # 2**27 行: INT64・TIMESTAMP は 1 GiB ずつ、残り 8 GiB を STRING の2列で等分
+    return pp.TableMetadata(
+        "p.d.events",
+        columns=[("id", "INT64"), ("status", "STRING"), ("payload", "STRING"), ("ts", "TIMESTAMP")],
+        num_bytes=10 * 2**30,
+        num_rows=2**27,
+    )
+
+
+def test_column_sizes_are_estimated_from_types(src_module):
+    pp = src_module("partition_pruning")
+    cw = src_module("column_waste")
+
+    sizes = cw.column_sizes(_events_table(pp))
+
+    assert {name: size / 2**30 for name, size in sizes.items()} == {
+        "id": 1,
+        "status": 4,
+        "payload": 4,
+        "ts": 1,
+    }
+    assert cw.column_sizes(pp.TableMetadata("p.d.empty", columns=[("a", "STRING")])) is None
+
+
+def test_estimates_bytes_read_only_because_of_select_star(src_module):
+    pp = src_module("partition_pruning")
+    cw = src_module("column_waste")
+    users = pp.TableMetadata(
+        "p.d.users", columns=[("id", "INT64"), ("name", "STRING")], num_bytes=2**30, num_rows=2**26
+    )
+
+    report = cw.estimate_column_waste(
+        "SELECT * FROM p.d.events WHERE status = 'x'", [_events_table(pp), users], 10 * 2**30
+    )
+
+    (scan,) = report.scans
+    assert [name for name, _ in scan.unused] == ["payload", "id", "ts"]
+    assert report.saved_bytes == 6 * 2**30
+    facts = report.facts()
+    assert "SELECT * で 4 列（推定 10.0 GiB）を読み、そのうち 3 列（推定 6.0 GiB、60%）" in facts
+    assert "約 6.0 GiB（オンデマンド料金で $0.04）の削減見込み" in facts
+
+
+def test_select_star_pruned_by_outer_query_is_not_waste(src_module):
+    pp = src_module("partition_pruning")
+    cw = src_module("column_waste")
+    table = _events_table(pp)
+
+    pruned = cw.estimate_column_waste(
+        "WITH e AS (SELECT * FROM p.d.events) SELECT id FROM e", [table], 2**30
+    )
+    excepted = cw.estimate_column_waste(
+        "SELECT * EXCEPT (payload) FROM p.d.events", [table], 6 * 2**30
+    )
+
+    assert pruned.decided and not pruned.scans and not pruned.has_facts
+    assert excepted.scans[0].read_columns == 3
+    assert "payload" not in [name for name, _ in excepted.scans[0].unused]
+
+
+# ==========================================
+# 改善SQL のドライラン検証
+# ==========================================
+
+_ADVICE = """### 1. 改善対象
+```sql
+SELECT * FROM p.d.events
+```
+### 5. 改善SQL
+```sql
+SELECT id FROM p.d.events WHERE dt = '2024-01-01'
+```
+"""
+
+
+def test_extract_rewrite_takes_the_block_under_the_heading(src_module):
+    rv = src_module("rewrite_validation")
+
+    assert rv.extract_rewrite(_ADVICE) == "SELECT id FROM p.d.events WHERE dt = '2024-01-01'"
+    assert rv.extract_rewrite("```sql\nSELECT 1\n```\n説明のみ") == "SELECT 1"
+    # 改善の余地が無い回答（コードブロック無し・元のSQLのまま）は検証しない
+    assert rv.extract_rewrite("改善の必要はありません。") is None
+    unchanged = "改善SQL\n```sql\nselect  *\nFROM p.d.events;\n```"
+    assert rv.extract_rewrite(unchanged, "SELECT * FROM p.d.events") is None
+
+
+@pytest.mark.parametrize(
+    "advice",
+    [
+        "前置きの説明。" * 200 + _ADVICE + "\n### 6. 補足\n" + "長い説明。" * 200,
+        "```text\nログ\n```\n" + "説明のみ。" * 200 + "```sql\nSELECT 1\n```\n" + "後書き。" * 200,
+        "改善の必要はありません。" * 100,
+    ],
+)
+def test_rewrite_collector_keeps_only_the_rewrite(src_module, advice):
+    rv = src_module("rewrite_validation")
+    collector = rv.RewriteCollector()
+
+    for start in range(0, len(advice), 5):
+        collector.feed(advice[start : start + 5])
+
+    kept = collector.advice()
+    assert rv.extract_rewrite(kept, "SELECT * FROM p.d.events") == rv.extract_rewrite(
+        advice, "SELECT * FROM p.d.events"
+    )
+    # 応答全文は持たない（見出しから改善SQL のブロックまでと、見出しより前の最後の SQL だけ）
+    assert len(kept) < 150
+
+
+def test_validate_rewrite_reports_savings_and_warnings(src_module):
+    rv = src_module("rewrite_validation")
+
+    def rejected(sql):
+        raise rv.RewriteRejected("Unrecognized name: dt at [1:35]")
+
+    def forbidden(sql):
+        raise PermissionError("Access Denied: Table p:d.events")
+
+    saves = rv.validate_rewrite(_ADVICE, "SELECT * FROM p.d.events", 8 * 2**30, lambda sql: 2**30)
+    costlier = rv.validate_rewrite(_ADVICE, "", 2**30, lambda sql: 2 * 2**30)
+    invalid = rv.validate_rewrite(_ADVICE, "", 2**30, rejected)
+    unchecked = rv.validate_rewrite(_ADVICE, "", 2**30, forbidden)
+
+    assert saves.status == rv.SAVES and saves.saved_bytes == 7 * 2**30
+    assert "8.0 GiB → 改善SQL のドライラン 1.0 GiB、88% 減" in saves.facts()
+    assert "約 7.0 GiB（オンデマンド料金で $0.04）の削減" in saves.facts()
+    assert costlier.status == rv.NOT_CHEAPER and costlier.saved_bytes == 0
+    assert "スキャン量は増えます" in costlier.facts()
+    assert invalid.status == rv.INVALID
+    assert "ドライランでエラー" in invalid.facts() and "Unrecognized name: dt" in invalid.facts()
+    assert unchecked.status == rv.UNCHECKED and "検証できませんでした" in unchecked.facts()
+    assert rv.validate_rewrite("改善の必要はありません。", "", 2**30, rejected) is None
+
+
+def _analyze_streamed_jobs(main_app, monkeypatch, replies, deadline):
+    """replies（{job_id: チャンクのリスト}）を stream で受け取る体でワーストクエリを解析する。"""
+    dry_runs = []
+
+    def query(sql, job_config=None, location=None, timeout=None):
+        dry_runs.append((sql, job_config.dry_run, location))
+        if "missing" in sql:
+            raise main_app.api_exceptions.BadRequest("Unrecognized name: missing")
+        return types.SimpleNamespace(total_bytes_processed=2**30)
+
+    bq_client = types.SimpleNamespace(
+        query=query,
+        get_table=lambda name, timeout=None: None,
+        get_job=lambda *args, **kwargs: types.SimpleNamespace(query_plan=[]),
+    )
+    jobs = [
+        types.SimpleNamespace(
+            job_id=job_id,
+            region_name="US",
+            query="SELECT * FROM `p.d.events`",
+            referenced_tables=[{"project_id": "p", "dataset_id": "d", "table_id": "events"}],
+            billed_gb=4.0,
+            duration_seconds=1,
+            slot_hours=0.1,
+            source_type="User",
+            difficulty="Low",
+        )
+        for job_id in replies
+    ]
+    model = types.SimpleNamespace(
+        generate_content=lambda prompt, stream=False: iter(
+            types.SimpleNamespace(text=text) for text in replies[prompt]
+        )
+    )
+    monkeypatch.setattr(main_app, "analyze_antipatterns", lambda q, deadline=None: None)
+    monkeypatch.setattr(main_app, "build_gemini_prompt", lambda job, *args: job.job_id)
+    monkeypatch.setattr(main_app, "GEMINI_GENERATION_MODE", "stream")
+    monkeypatch.setattr(
+        main_app,
+        "bigquery",
+        types.SimpleNamespace(QueryJobConfig=lambda **kwargs: types.SimpleNamespace(**kwargs)),
+    )
+    sections = {}
+
+    def open_section(i):
+        sections[i] = main_app.ReportSink()
+        return sections[i]
+
+    stats = main_app.analyze_worst_jobs(
+        list(enumerate(jobs, 1)),
+        len(jobs),
+        {},
+        bq_client,
+        None,
+        model,
+        {},
+        deadline,
+        open_section,
+    )
+    return dry_runs, sections, stats
+
+
+def test_streamed_rewrite_is_dry_run_and_reported(main_app, monkeypatch):
+    """stream でも受信した助言から改善SQL を取り出し、検証結果を節と summary 用の集計に載せる。"""
+    replies = {
+        "j1": ["### 改善SQL\n```sql\nSELECT id ", "FROM `p.d.events`\n```\n"],
+        "j2": ["### 改善SQL\n```sql\nSELECT missing FROM `p.d.events`\n```\n"],
+    }
+
+    dry_runs, sections, stats = _analyze_streamed_jobs(
+        main_app, monkeypatch, replies, main_app.RunDeadline(600)
+    )
+
+    assert dry_runs[0] == ("SELECT id FROM `p.d.events`", True, "US")
+    assert "**【改善SQLのドライラン検証】**" in sections[1].getvalue()
+    assert "4.0 GiB → 改善SQL のドライラン 1.0 GiB、75% 減" in sections[1].getvalue()
+    assert "Unrecognized name: missing" in sections[2].getvalue()
+    assert [(r["job_id"], r["status"]) for r in stats["rewrite_validation"]] == [
+        ("j1", "saves"),
+        ("j2", "invalid"),
+    ]
+
+
+def test_rewrite_with_dataset_only_table_is_dry_run_fully_qualified(main_app, monkeypatch):
+    """ドライランは SaaS プロジェクトで動くので、`dataset.table` は元のジョブのプロジェクトで修飾する。"""
+    replies = {
+        "j1": [
+            "### 改善SQL\n```sql\nSELECT id FROM d.events -- d.events\nWHERE s = 'd.events'\n```"
+        ]
+    }
+
+    dry_runs, sections, stats = _analyze_streamed_jobs(
+        main_app, monkeypatch, replies, main_app.RunDeadline(600)
+    )
+
+    assert dry_runs[0][0] == "SELECT id FROM `p.d.events` -- d.events\nWHERE s = 'd.events'"
+    assert [r["status"] for r in stats["rewrite_validation"]] == ["saves"]
+
+
+def test_truncated_stream_is_not_dry_run(main_app, monkeypatch):
+    clock = _FakeClock()
+
+    def chunks():
+        yield "### 改善SQL\n```sql\nSELECT id FROM `p.d.events` WHERE dt >= "
+        clock.now = 600  # 持ち時間が尽き、ここで受信を打ち切る
+        yield "'2024-01-01'\n```\n"
+
+    dry_runs, sections, stats = _analyze_streamed_jobs(
+        main_app, monkeypatch, {"j1": chunks()}, main_app.RunDeadline(600, clock=clock)
+    )
+
+    assert "助言の続きを省略しました" in sections[1].getvalue()
+    assert dry_runs == [] and stats["rewrite_validation"] == []
+    assert "改善SQLのドライラン検証" not in sections[1].getvalue()
@@ -0,0 +1,116 @@
+"""アンチパターンのローカル判定（antipattern_rules）と JAR の判定が一致するか確認する。
+
+tests/data/antipattern_parity.jsonl の各クエリを JAR（または起動中の bq-antipattern-api）で
+解析し、ローカル判定の結果と突き合わせる。ローカルで判定するクエリ（decided=True）で
+当たったルールが食い違うか、decidable のクエリをローカルで判定しなかった（API に回した）
+ときは非ゼロ終了する。--record を付けると JAR の結果でコーパスの期待値（jar）を書き換え、
+source を "jar" にする（JAR を更新したとき、クエリを追加したとき）。source が "expected" の
+行は手で書いた期待値で、まだ JAR と突き合わせていない。
+
+    python tools/antipattern_parity.py --jar bq-antipattern-api/bigquery-antipattern-recognition.jar
+    python tools/antipattern_parity.py --url http://localhost:8080
+    python tools/antipattern_parity.py --jar ... --record
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "main-app" / "src"))
+
+from antipattern_rules import SUPPORTED_RULES, prescreen, rule_names  # noqa: E402
+
+CORPUS_PATH = ROOT / "tests" / "data" / "antipattern_parity.jsonl"
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_corpus(entries, path=CORPUS_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def analyze_with_jar(jar, query):
+    completed = subprocess.run(
+        ["java", "-jar", jar, "--query", query],
+        capture_output=True,
+        text=True,
+        timeout=120,
+        check=False,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"JAR exited with {completed.returncode}: {completed.stderr[-500:]}")
+    return completed.stdout
+
+
+def analyze_with_api(url, query):
+    request = urllib.request.Request(
+        url.rstrip("/") + "/analyze",
+        data=json.dumps({"query": query}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())["recommendations"]
+
+
+def compare(entry, jar_rules):
+    """食い違いの説明を返す（一致、またはローカルで判定しないはずのクエリなら None）。"""
+    screening = prescreen(entry["query"])
+    if not screening.decided:
+        if entry.get("decidable"):
+            return f"local prescreen abstained ({screening.reason})"
+        return None
+    local = {f.rule for f in screening.findings}
+    # ローカルで判定しないルールは比較しない（そのルールが当たるクエリは API に送る前提）
+    expected = {rule for rule in jar_rules if rule in SUPPORTED_RULES}
+    if local == expected:
+        return None
+    return f"local={sorted(local)} jar={sorted(expected)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカル判定と JAR の判定の一致を確認")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--jar", help="bigquery-antipattern-recognition.jar のパス")
+    source.add_argument("--url", help="起動中の bq-antipattern-api の URL")
+    parser.add_argument("--record", action="store_true", help="JAR の結果で期待値を書き換える")
+    args = parser.parse_args()
+
+    entries = load_corpus()
+    mismatches = []
+    for entry in entries:
+        if args.jar:
+            output = analyze_with_jar(args.jar, entry["query"])
+        else:
+            output = analyze_with_api(args.url, entry["query"])
+        jar_rules = rule_names(output)
+        if args.record:
+            entry["jar"] = jar_rules
+            entry["source"] = "jar"
+        problem = compare(entry, jar_rules)
+        status = "MISMATCH" if problem else "ok"
+        print(f"{status:8} {entry['id']}: {', '.join(jar_rules) or '-'}")
+        if problem:
+            mismatches.append(f"{entry['id']}: {problem}")
+
+    if args.record:
+        save_corpus(entries)
+        print(f"Recorded {len(entries)} queries to {CORPUS_PATH.relative_to(ROOT)}")
+    if mismatches:
+        print("\nローカル判定と JAR の判定が一致しないクエリ:")
+        for message in mismatches:
+            print(f"  - {message}")
+        sys.exit(1)
+    print(f"\n{len(entries)} queries: local prescreen agrees with the JAR.")
+
+
+if __name__ == "__main__":
+    main()